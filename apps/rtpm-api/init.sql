@@ -113,9 +113,27 @@ SELECT add_retention_policy('aggregated_metrics', INTERVAL '365 days', if_not_ex
 SELECT add_compression_policy('metrics', INTERVAL '7 days', if_not_exists => TRUE);
 SELECT add_compression_policy('aggregated_metrics', INTERVAL '30 days', if_not_exists => TRUE);
 
--- Create continuous aggregates for common queries (optional)
+-- Create continuous aggregates for common queries
+-- The query planner (src/services/query.py) reads the coarsest tier that fits a
+-- query's step and stitches in the tail after each view's cagg_watermark from raw
+-- rows itself, so real-time aggregation is disabled (materialized_only) to avoid
+-- counting it twice. The tier lags declared there are only a fallback for when the
+-- watermark cannot be read; keep them in sync with the refresh policies.
+CREATE MATERIALIZED VIEW IF NOT EXISTS metrics_5m
+WITH (timescaledb.continuous, timescaledb.materialized_only = true) AS
+SELECT
+    time_bucket('5 minutes', timestamp) AS bucket,
+    metric_name,
+    labels,
+    AVG(value) AS avg_value,
+    MAX(value) AS max_value,
+    MIN(value) AS min_value,
+    COUNT(*) AS sample_count
+FROM metrics
+GROUP BY bucket, metric_name, labels;
+
 CREATE MATERIALIZED VIEW IF NOT EXISTS metrics_hourly
-WITH (timescaledb.continuous) AS
+WITH (timescaledb.continuous, timescaledb.materialized_only = true) AS
 SELECT
     time_bucket('1 hour', timestamp) AS bucket,
     metric_name,
@@ -127,13 +145,45 @@ SELECT
 FROM metrics
 GROUP BY bucket, metric_name, labels;
 
--- Refresh policy for continuous aggregates
+CREATE MATERIALIZED VIEW IF NOT EXISTS metrics_daily
+WITH (timescaledb.continuous, timescaledb.materialized_only = true) AS
+SELECT
+    time_bucket('1 day', timestamp) AS bucket,
+    metric_name,
+    labels,
+    AVG(value) AS avg_value,
+    MAX(value) AS max_value,
+    MIN(value) AS min_value,
+    COUNT(*) AS sample_count
+FROM metrics
+GROUP BY bucket, metric_name, labels;
+
+-- IF NOT EXISTS leaves an older metrics_hourly untouched; make its setting match
+ALTER MATERIALIZED VIEW metrics_hourly SET (timescaledb.materialized_only = true);
+
+CREATE INDEX IF NOT EXISTS idx_metrics_5m_name_bucket ON metrics_5m (metric_name, bucket DESC);
+CREATE INDEX IF NOT EXISTS idx_metrics_hourly_name_bucket ON metrics_hourly (metric_name, bucket DESC);
+CREATE INDEX IF NOT EXISTS idx_metrics_daily_name_bucket ON metrics_daily (metric_name, bucket DESC);
+
+-- Refresh policies for continuous aggregates
+SELECT add_continuous_aggregate_policy('metrics_5m',
+    start_offset => INTERVAL '1 hour',
+    end_offset => INTERVAL '5 minutes',
+    schedule_interval => INTERVAL '5 minutes',
+    if_not_exists => TRUE);
+
 SELECT add_continuous_aggregate_policy('metrics_hourly',
     start_offset => INTERVAL '1 day',
     end_offset => INTERVAL '1 hour',
     schedule_interval => INTERVAL '1 hour',
     if_not_exists => TRUE);
 
+SELECT add_continuous_aggregate_policy('metrics_daily',
+    start_offset => INTERVAL '3 days',
+    end_offset => INTERVAL '1 day',
+    schedule_interval => INTERVAL '1 hour',
+    if_not_exists => TRUE);
+
 -- Grant permissions
 GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA public TO rtmp;
 GRANT ALL PRIVILEGES ON ALL SEQUENCES IN SCHEMA public TO rtmp;
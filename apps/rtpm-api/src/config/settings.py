@@ -1,6 +1,12 @@
-from typing import List, Optional
+import os
+from typing import List, Optional, Union
+from pydantic import field_validator
 from pydantic_settings import BaseSettings
 
+# Relative file paths below are resolved against the app directory (apps/rtpm-api,
+# the image's working directory), not whatever directory the server was started from
+APP_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 
 class Settings(BaseSettings):
     environment: str = "development"
@@ -9,14 +15,114 @@ class Settings(BaseSettings):
     api_host: str = "0.0.0.0"
     api_port: int = 8000
 
-    cors_origins: List[str] = []
+    # Accepts a JSON list or the comma-separated form used in fly.toml / docker-compose
+    cors_origins: Union[List[str], str] = []
 
     database_url: Optional[str] = None
+    # asyncpg pool: connection bounds, prepared statements cached per connection,
+    # seconds between health probes and allowed for in-flight work on shutdown
+    database_pool_min_size: int = 2
+    database_pool_max_size: int = 20
+    database_statement_cache_size: int = 1024
+    database_command_timeout: float = 30.0
+    database_health_interval: float = 5.0
+    database_drain_timeout: float = 10.0
     redis_url: Optional[str] = None
 
     jwt_secret: Optional[str] = None
     secret_key: Optional[str] = None
 
+    # Production startup: what a missing secret does ("strict" refuses to start,
+    # "advisory" logs it, "off" skips the check), seconds allowed for the checks,
+    # and a file remembering verified secrets for secrets_cache_ttl seconds ("" disables)
+    startup_secrets_check: str = "strict"
+    secrets_check_timeout: float = 10.0
+    secrets_cache_path: str = "data/secrets-verified.json"
+    secrets_cache_ttl: float = 300.0
+
+    # Metric ingestion pipeline
+    ingest_queue_size: int = 50000
+    ingest_batch_size: int = 1000
+    ingest_flush_interval: float = 0.25
+
+    # WebSocket fan-out: per-connection queue bound, eviction threshold and
+    # shared heartbeat interval (seconds; 0 disables heartbeats)
+    websocket_queue_size: int = 256
+    websocket_max_lag: float = 10.0
+    websocket_heartbeat_interval: float = 5.0
+
+    # In-memory hot window: seconds kept, points per series, series cap
+    hot_window_seconds: float = 900.0
+    hot_window_points: int = 512
+    hot_window_max_series: int = 20000
+
+    # Write-ahead spool for batches the database cannot take ("" disables): segment
+    # size, fsync batching, disk cap, seconds the batcher waits on a slow write and
+    # backlog rows per second replayed after recovery
+    spool_dir: str = "data/spool"
+    spool_segment_bytes: int = 64 * 1024 * 1024
+    spool_fsync_interval: float = 0.2
+    spool_max_bytes: int = 1024 * 1024 * 1024
+    spool_write_timeout: float = 2.0
+    spool_replay_rate: float = 5000.0
+
+    # Agent liveness: seconds without a heartbeat before an agent is offline, and
+    # the timer wheel tick (how late an offline transition may be)
+    heartbeat_timeout: float = 30.0
+    heartbeat_resolution: float = 1.0
+
+    # Cross-replica fan-out over Redis pub/sub (enabled when redis_url is set)
+    fanout_channel: str = "rtpm:metrics"
+    fanout_batch_size: int = 500
+    fanout_max_pending: int = 50000
+
+    # Ingestion limits (0 disables): series in total / per metric / per tenant,
+    # eviction of series idle for series_idle_seconds (longer than the hot window
+    # and alert staleness), and samples per second per tenant with a bucket of
+    # ingest_rate_burst samples. A tenant is one of ingest_api_keys (same list
+    # formats as cors_origins) or, for any other client, its address
+    ingest_api_keys: Union[List[str], str] = []
+    max_series: int = 1000000
+    max_series_per_metric: int = 10000
+    max_series_per_tenant: int = 100000
+    series_idle_seconds: float = 3600.0
+    ingest_rate_limit: float = 50000.0
+    ingest_rate_burst: float = 100000.0
+
+    # Request latency: rolling window for /debug/latency, request-ID exemplars
+    latency_window: float = 60.0
+    request_exemplars: bool = True
+
+    # /metrics: seconds a rendered exposition is served before re-rendering (0 disables)
+    metrics_cache_interval: float = 1.0
+
+    # Metric queries: seconds rollup watermarks read from TimescaleDB are reused
+    query_watermark_ttl: float = 10.0
+
+    # Alert engine: seconds between batched writes to alerts, stale-series timeout
+    alert_flush_interval: float = 1.0
+    alert_stale_after: float = 600.0
+
+    @field_validator("startup_secrets_check")
+    @classmethod
+    def _check_secrets_mode(cls, value):
+        if value not in ("strict", "advisory", "off"):
+            raise ValueError("startup_secrets_check must be strict, advisory or off")
+        return value
+
+    @field_validator("secrets_cache_path", "spool_dir")
+    @classmethod
+    def _anchor_paths(cls, value):
+        # "" keeps meaning disabled
+        return os.path.join(APP_DIR, value) if value else value
+
+    @field_validator("cors_origins", "ingest_api_keys", mode="before")
+    @classmethod
+    def _split_lists(cls, value):
+        if isinstance(value, str):
+            return [o.strip() for o in value.split(",") if o.strip()]
+        return value
+
     class Config:
         env_prefix = ""
         case_sensitive = False
@@ -1,201 +1,254 @@
 """
 RTPM API - Main Application Entry Point
 Real-time Performance Monitoring Dashboard
+
+The services (ingestion, fan-out, storage, alerting, ...) are process-wide
+and configured from ``settings`` at import; ``create_app(config)`` builds
+the ASGI app around them, so every deployment (Docker, Kubernetes, Fly)
+runs the same routes and differs only in the startup check it plugs in.
+Heavy optional dependencies (boto3, asyncpg, redis) are imported only
+when the code that needs them first runs, never at import time.
 """
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
-from starlette.middleware.base import BaseHTTPMiddleware
+from fastapi import APIRouter, FastAPI, WebSocket, WebSocketDisconnect, Request
 from fastapi.middleware.cors import CORSMiddleware
 import os
 from fastapi.responses import JSONResponse
 import asyncio
 import json
-from datetime import datetime
-import random
-from typing import List
+import math
+from dataclasses import replace
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, List, Optional, Tuple, Union
 import logging
-from prometheus_client import (
-    Counter,
-    Histogram,
-    Gauge,
-    generate_latest,
-    CONTENT_TYPE_LATEST,
-)
-from time import perf_counter
 
-# Note: Response is imported lazily where needed to avoid unused import warnings
-import boto3
-from botocore.exceptions import ClientError
+from .config.settings import Settings, settings
+from .services.agents import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    AgentError,
+    AgentRegistry,
+    etag_matches,
+    parse_agent,
+    parse_filters,
+)
+from .services.alerting import (
+    AlertEngine,
+    AlertRuleConflict,
+    AlertRuleError,
+    parse_rule,
+)
+from .services.broadcast import ConnectionManager
+from .services.database import Database
+from .services.encoding import encode_frame
+from .services.exposition import ExpositionCache
+from .services.fanout import RedisFanout
+from .services.heartbeat import (
+    HeartbeatTracker,
+    liveness_samples,
+    transition_to_dict,
+)
+from .services.hotwindow import HotWindow
+from .services.ingestion import (
+    IngestionPipeline,
+    IngestionQueueFull,
+    MetricSample,
+    MetricValidationError,
+    intern_samples,
+    parse_payload,
+    parse_sample,
+)
+from .services.latency import LatencyTracker
+from .services.limits import TenantQuotas
+from .services.middleware import HTTPMiddleware
+from .services.query import (
+    MetricQuery,
+    QueryEngine,
+    QueryError,
+    QueryUnavailable,
+    format_duration,
+    parse_duration,
+    parse_query,
+)
+from .services.series import registry as series_registry
+from .services.spool import Spool
+from .services.startup import SecretVerifier, StartupPhases, check_secrets
+from .services.storage import DurableWriter, MetricWriter
+from .services.subscriptions import SubscriptionError, parse_label_selectors, parse_subscription
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Create FastAPI app
-app = FastAPI(
-    title="RTPM Dashboard API",
-    description="Real-time Performance Monitoring Dashboard API",
-    version="1.0.0",
-)
+# Routes; the app itself is built by create_app below
+router = APIRouter()
 
-# Configure CORS (env-driven)
-allowed_origins_env = os.getenv("CORS_ORIGINS", "").strip()
-cf_env = os.getenv("CF_ENV")
-if allowed_origins_env:
-    allowed_origins = [o.strip() for o in allowed_origins_env.split(",") if o.strip()]
-else:
-    # Default: strict in production, wildcard in non-prod
-    node_env = (
-        cf_env or os.getenv("NODE_ENV") or os.getenv("ENV") or os.getenv("PY_ENV") or "development"
-    )
-    if node_env == "production":
-        allowed_origins = [
-            "https://dashboard.candlefish.ai",
-            "https://candlefish.ai",
-            "https://www.candlefish.ai",
-        ]
-    else:
-        allowed_origins = ["*"]
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=allowed_origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# Request latency per route, shared by the HTTP middleware and /debug/latency
+latency_tracker = LatencyTracker(window=settings.latency_window)
 
+# WebSocket connection manager
 
-# Prometheus metrics
-REQUEST_COUNT = Counter(
-    "rtpm_request_total",
-    "Total HTTP requests",
-    ["method", "endpoint", "status"],
-)
-REQUEST_LATENCY = Histogram(
-    "rtpm_request_latency_seconds",
-    "Request latency",
-    buckets=(0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5),
-)
-WEBSOCKET_CONNECTIONS = Gauge(
-    "rtpm_websocket_connections",
-    "Active WebSocket connections",
+manager = ConnectionManager(
+    max_queue_size=settings.websocket_queue_size,
+    max_lag=settings.websocket_max_lag,
+    heartbeat_interval=settings.websocket_heartbeat_interval,
 )
 
+# Metric ingestion pipeline: handlers enqueue, a background batcher fans out
 
-class RequestMetricsMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
-        start = perf_counter()
-        response = await call_next(request)
-        elapsed = perf_counter() - start
-        REQUEST_LATENCY.observe(elapsed)
-        endpoint = request.url.path
-        REQUEST_COUNT.labels(
-            request.method,
-            endpoint,
-            str(response.status_code),
-        ).inc()
-        return response
 
+async def broadcast_batch(batch: List[MetricSample]):
+    """Ingestion sink that forwards samples to subscribed WebSocket clients"""
+    if not manager.clients:
+        return
+    for sample in batch:
+        await manager.publish_sample(sample)
 
-app.add_middleware(RequestMetricsMiddleware)
 
+ingestion = IngestionPipeline(
+    max_queue_size=settings.ingest_queue_size,
+    batch_size=settings.ingest_batch_size,
+    flush_interval=settings.ingest_flush_interval,
+)
+ingestion.add_sink(broadcast_batch, name="websocket")
 
-class SecurityHeadersMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request, call_next):
-        response = await call_next(request)
-        response.headers.setdefault(
-            "Strict-Transport-Security",
-            "max-age=31536000; includeSubDomains",
-        )
-        response.headers.setdefault("X-Content-Type-Options", "nosniff")
-        response.headers.setdefault("X-Frame-Options", "DENY")
-        response.headers.setdefault(
-            "Referrer-Policy",
-            "strict-origin-when-cross-origin",
-        )
-        response.headers.setdefault(
-            "Permissions-Policy",
-            "geolocation=(), microphone=(), camera()",
-        )
-        return response
+series_registry.configure(
+    max_series_per_metric=settings.max_series_per_metric,
+    max_series_per_tenant=settings.max_series_per_tenant,
+    max_series=settings.max_series,
+    idle_seconds=settings.series_idle_seconds,
+)
+quotas = TenantQuotas(settings.ingest_rate_limit, settings.ingest_rate_burst)
+# Keys that identify a tenant for quotas and series limits
+api_keys = frozenset(settings.ingest_api_keys)
+
+hot_window = HotWindow(
+    retention=settings.hot_window_seconds,
+    capacity=settings.hot_window_points,
+    max_series=settings.hot_window_max_series,
+)
+ingestion.add_sink(hot_window.record, name="hot_window")
 
 
-app.add_middleware(SecurityHeadersMiddleware)
+async def relay_remote_batch(batch: List[MetricSample]):
+    """Samples ingested by another replica: local clients and hot window only
 
-# WebSocket connection manager
+    Alerts, heartbeats and storage already ran on the receiving replica.
+    """
+    batch = intern_samples(batch)
+    await broadcast_batch(batch)
+    await hot_window.record(batch)
 
 
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+fanout = RedisFanout(
+    settings.redis_url,
+    channel=settings.fanout_channel,
+    batch_size=settings.fanout_batch_size,
+    max_pending=settings.fanout_max_pending,
+)
+fanout.add_relay(relay_remote_batch)
+
+database = Database(
+    settings.database_url,
+    min_size=settings.database_pool_min_size,
+    max_size=settings.database_pool_max_size,
+    statement_cache_size=settings.database_statement_cache_size,
+    command_timeout=settings.database_command_timeout,
+    health_interval=settings.database_health_interval,
+    drain_timeout=settings.database_drain_timeout,
+)
+metric_writer = MetricWriter(database)
+# With a spool, batches the database cannot take are kept on disk and replayed
+durable_writer = (
+    DurableWriter(
+        metric_writer,
+        Spool(
+            settings.spool_dir,
+            segment_bytes=settings.spool_segment_bytes,
+            fsync_interval=settings.spool_fsync_interval,
+            max_bytes=settings.spool_max_bytes,
+        ),
+        write_timeout=settings.spool_write_timeout,
+        replay_rate=settings.spool_replay_rate,
+    )
+    if settings.spool_dir
+    else None
+)
+query_engine = QueryEngine(database, watermark_ttl=settings.query_watermark_ttl)
 
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-        try:
-            WEBSOCKET_CONNECTIONS.set(len(self.active_connections))
-        except Exception:
-            pass
-        logger.info(
-            "WebSocket connected. Total connections: %d",
-            len(self.active_connections),
-        )
+alert_engine = AlertEngine(
+    database,
+    flush_interval=settings.alert_flush_interval,
+    stale_after=settings.alert_stale_after,
+)
+ingestion.add_sink(alert_engine.evaluate, name="alerts")
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-        try:
-            WEBSOCKET_CONNECTIONS.set(len(self.active_connections))
-        except Exception:
-            pass
-        logger.info(
-            "WebSocket disconnected. Total connections: %d",
-            len(self.active_connections),
-        )
 
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
+async def broadcast_alert(alert: dict):
+    """Push firing and resolved transitions to every WebSocket client"""
+    if manager.clients:
+        await manager.broadcast(encode_frame({"type": "alert", "payload": alert}))
+
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except Exception:
-                # Ignore send errors for disconnected clients
-                pass
+alert_engine.add_notifier(broadcast_alert)
 
 
-manager = ConnectionManager()
+async def on_database_connect():
+    """Attach persistence whenever the pool (re)opens"""
+    if durable_writer is None:
+        ingestion.add_sink(metric_writer.write, name="timescaledb")
+    logger.info("Alerting: %d rules loaded", await alert_engine.load_rules())
+
+
+database.on_connect(on_database_connect)
 
 # Health check endpoint
 
 
-@app.get("/health")
+@router.get("/health")
 async def health_check():
-    """Health check endpoint"""
-    return {
-        "status": "healthy",
+    """Health check endpoint; 503 while a configured database is unreachable"""
+    body = {
+        "status": "healthy" if database.ready else "unhealthy",
         "timestamp": datetime.utcnow().isoformat(),
         "service": "rtpm-api",
         "version": "1.0.0",
+        "database": database.status(),
     }
+    if not database.ready:
+        return JSONResponse(status_code=503, content=body)
+    return body
 
 
 # Metrics endpoint
 
+exposition = ExpositionCache(interval=settings.metrics_cache_interval)
 
-@app.get("/metrics")
-async def get_metrics():
-    """Prometheus metrics endpoint"""
+
+@router.get("/metrics")
+async def get_metrics(request: Request):
+    """Prometheus metrics endpoint; OpenMetrics (with exemplars) when the scraper asks"""
     from starlette.responses import Response
 
-    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+    body, headers = await exposition.response(
+        request.headers.get("accept", ""), request.headers.get("accept-encoding", "")
+    )
+    return Response(body, headers=headers)
+
+
+@router.get("/debug/latency")
+async def get_debug_latency():
+    """Live p50/p95/p99 per route over the last one to two latency windows"""
+    return {
+        "window_seconds": latency_tracker.window,
+        "routes": latency_tracker.snapshot(),
+    }
 
 
 # Root endpoint
 
 
-@app.get("/")
+@router.get("/")
 async def root():
     """Root endpoint"""
     return {
@@ -213,104 +266,605 @@ async def root():
 # API endpoints
 
 
-@app.get("/api/v1/status")
+def _service_state(configured: bool, up: bool) -> str:
+    if not configured:
+        return "not_configured"
+    return "healthy" if up else "unhealthy"
+
+
+@router.get("/api/v1/status")
 async def get_status():
-    """Get system status"""
+    """System status from the live database pool and Redis fan-out"""
     return {
-        "status": "operational",
-        "services": {"api": "healthy", "database": "healthy", "cache": "healthy"},
+        "status": "operational" if database.ready else "degraded",
+        "services": {
+            "api": "healthy",
+            "database": _service_state(database.configured, database.healthy),
+            "cache": _service_state(fanout.configured, fanout.running),
+        },
+        "database": database.status(),
         "timestamp": datetime.utcnow().isoformat(),
     }
 
 
-@app.get("/api/v1/metrics/current")
-async def get_current_metrics():
-    """Get current metrics"""
+@router.get("/api/v1/metrics/current")
+async def get_current_metrics(request: Request):
+    """Latest value of every series, served from the in-memory hot window"""
+    try:
+        labels = parse_label_selectors(request.query_params.getlist("labels") or None)
+        limit = int(request.query_params.get("limit", 1000))
+    except ValueError as e:
+        return _invalid_query(e)
+    latest = hot_window.latest(request.query_params.get("metric_name"), labels)
     return {
         "metrics": [
             {
-                "name": "cpu_usage",
-                "value": random.uniform(20, 80),
-                "unit": "percent",
-                "timestamp": datetime.utcnow().isoformat(),
-            },
-            {
-                "name": "memory_usage",
-                "value": random.uniform(30, 70),
-                "unit": "percent",
-                "timestamp": datetime.utcnow().isoformat(),
+                "name": point["metric_name"],
+                "value": point["value"],
+                "unit": point["unit"],
+                "timestamp": point["timestamp"],
+                "labels": point["labels"],
+            }
+            for point in latest[:limit]
+        ],
+        "series_count": len(latest),
+    }
+
+
+@router.get("/api/v1/metrics/latest/{metric_name}")
+async def get_latest_metric(metric_name: str, request: Request):
+    """Most recent sample of a metric, plus the latest point of each of its series"""
+    try:
+        labels = parse_label_selectors(request.query_params.getlist("labels") or None)
+    except ValueError as e:
+        return _invalid_query(e)
+    latest = hot_window.latest(metric_name, labels)
+    if not latest:
+        return JSONResponse(
+            status_code=404,
+            content={"error": "No recent samples", "metric_name": metric_name},
+        )
+    return {**latest[0], "series": latest}
+
+
+@router.get("/api/v1/metrics/realtime")
+async def get_realtime_metrics(request: Request):
+    """Raw points from the hot window (metric_name, window, repeated labels=name=value)"""
+    params = request.query_params
+    try:
+        labels = parse_label_selectors(params.getlist("labels") or None)
+        window = parse_duration(params.get("window", hot_window.retention))
+    except ValueError as e:
+        return _invalid_query(e)
+    seconds = min(window.total_seconds(), hot_window.retention)
+    return {
+        "window": format_duration(timedelta(seconds=seconds)),
+        "series": hot_window.window(params.get("metric_name"), labels, seconds),
+    }
+
+
+@router.get("/api/v1/series/cardinality")
+async def get_series_cardinality(request: Request):
+    """Series registry totals; with metric_name, distinct values per label of that metric"""
+    params = request.query_params
+    metric_name = params.get("metric_name")
+    if metric_name:
+        return series_registry.cardinality(metric_name)
+    try:
+        limit = int(params.get("limit", 10))
+    except ValueError as e:
+        return _invalid_query(e)
+    stats = series_registry.stats(limit=max(1, min(limit, 1000)))
+    for entry in stats["top_tenants"]:
+        entry["tenant"] = _redact_tenant(entry["tenant"])
+    return stats
+
+
+def _tenant(request: Request) -> str:
+    """Configured API key the request is metered under; other clients by address
+
+    Unknown keys fall back to the address, so rotating made-up keys buys
+    neither a fresh token bucket nor a fresh series budget.
+    """
+    key = request.headers.get("x-api-key")
+    if not key:
+        scheme, _, token = request.headers.get("authorization", "").partition(" ")
+        if scheme.lower() == "bearer":
+            key = token.strip()
+    if key and key in api_keys:
+        return key
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
+def _redact_tenant(tenant: str) -> str:
+    """Tenant as shown in stats: client addresses as is, API keys truncated"""
+    if tenant.startswith("ip:"):
+        return tenant
+    return f"{tenant[:4]}***" if len(tenant) > 8 else "***"
+
+
+async def _accept_metrics(
+    request: Request, parse
+) -> Union[Tuple[List[MetricSample], int], JSONResponse]:
+    """Parse a request body and hand the samples to the ingestion pipeline
+
+    Returns the accepted samples and the number refused by cardinality limits.
+    """
+    try:
+        data = await request.json()
+    except ValueError:
+        return JSONResponse(status_code=422, content={"error": "Invalid JSON body"})
+    try:
+        samples = parse(data)
+    except MetricValidationError as e:
+        return JSONResponse(status_code=422, content={"error": "Invalid metric", "detail": str(e)})
+
+    # Before charging the quota, so a 503 costs the client nothing
+    if not ingestion.has_room(len(samples)):
+        return _queue_full()
+
+    tenant = _tenant(request)
+    allowed, retry_after = quotas.take(tenant, len(samples))
+    if not allowed:
+        if math.isinf(retry_after):
+            return JSONResponse(
+                status_code=413,
+                content={
+                    "error": "Batch exceeds ingestion quota",
+                    "detail": f"at most {quotas.burst:g} samples per request for this client",
+                },
+            )
+        return JSONResponse(
+            status_code=429,
+            content={
+                "error": "Ingestion rate limit exceeded",
+                "detail": f"limit is {quotas.rate:g} samples per second per client",
             },
-            {
-                "name": "response_time",
-                "value": random.uniform(50, 200),
-                "unit": "ms",
-                "timestamp": datetime.utcnow().isoformat(),
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+
+    # Only now register series: a refused request must not grow the registry
+    accepted = intern_samples(samples, tenant)
+    rejected = len(samples) - len(accepted)
+    if not accepted:
+        return JSONResponse(
+            status_code=422,
+            content={
+                "error": "Series limit exceeded",
+                "detail": "samples would create series beyond the series limits",
             },
-        ]
-    }
+        )
+    try:
+        ingestion.submit(accepted)
+    except IngestionQueueFull:
+        quotas.refund(tenant, len(samples))
+        return _queue_full()
+    return accepted, rejected
+
+
+def _queue_full() -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={"error": "Ingestion queue full"},
+        headers={"Retry-After": "1"},
+    )
+
 
+def _parse_batch(data) -> List[MetricSample]:
+    if not isinstance(data, dict) or not isinstance(data.get("metrics"), list):
+        raise MetricValidationError("batch body must be an object with a metrics list")
+    return parse_payload(data)
 
-@app.post("/api/v1/metrics")
+
+@router.post("/api/v1/metrics", status_code=202)
 async def ingest_metric(request: Request):
-    """Ingest a new metric"""
-    data = await request.json()
-    # In production, this would save to database
-    logger.info("Ingested metric: %s", data)
+    """Ingest one metric, a batch or an agent snapshot"""
+    result = await _accept_metrics(request, parse_payload)
+    if isinstance(result, JSONResponse):
+        return result
+
+    samples, rejected = result
+    return {
+        "status": "accepted",
+        "message": "Metric accepted for ingestion",
+        "processed_count": len(samples),
+        "rejected_count": rejected,
+        "timestamp": datetime.utcnow().isoformat(),
+    }
+
+
+@router.post("/api/v1/metrics/ingest", status_code=202)
+async def ingest_single_metric(request: Request):
+    """Ingest a single metric"""
+    result = await _accept_metrics(request, lambda data: [parse_sample(data)])
+    if isinstance(result, JSONResponse):
+        return result
+
+    sample = result[0][0]
+    return {
+        "status": "accepted",
+        "metric_name": sample.metric_name,
+        "timestamp": sample.timestamp.isoformat(),
+    }
+
 
-    # Broadcast to WebSocket clients
-    await manager.broadcast(json.dumps({"type": "metric", "payload": data}))
+@router.post("/api/v1/metrics/batch", status_code=202)
+async def ingest_metrics_batch(request: Request):
+    """Ingest a batch of metrics; rows reach TimescaleDB with one COPY per flush"""
+    result = await _accept_metrics(request, _parse_batch)
+    if isinstance(result, JSONResponse):
+        return result
 
+    samples, rejected = result
     return {
-        "status": "success",
-        "message": "Metric ingested",
+        "status": "accepted",
+        "metrics_count": len(samples),
+        "rejected_count": rejected,
         "timestamp": datetime.utcnow().isoformat(),
     }
 
 
+# Query endpoints: bucketing and aggregation run inside TimescaleDB
+
+
+def _invalid_query(e: Exception) -> JSONResponse:
+    return JSONResponse(status_code=422, content={"error": "Invalid query", "detail": str(e)})
+
+
+def _params_query(request: Request) -> MetricQuery:
+    params = request.query_params
+    return parse_query(dict(params), labels=params.getlist("labels") or None)
+
+
+async def _run_query(run, query: MetricQuery):
+    """Run a query; returns (plan, rows) or an error response"""
+    try:
+        return await run(query)
+    except QueryUnavailable as e:
+        return JSONResponse(
+            status_code=503,
+            content={"error": "Metric storage unavailable", "detail": str(e)},
+            headers={"Retry-After": "5"},
+        )
+
+
+@router.post("/api/v1/metrics/query")
+async def query_metrics(request: Request):
+    """Query one metric over a time range; returns one series per label set"""
+    try:
+        data = await request.json()
+    except ValueError:
+        return JSONResponse(status_code=422, content={"error": "Invalid JSON body"})
+    if not isinstance(data, dict):
+        return _invalid_query(QueryError("query body must be an object"))
+    try:
+        query = parse_query(data)
+    except QueryError as e:
+        return _invalid_query(e)
+
+    result = await _run_query(query_engine.range_query, query)
+    if isinstance(result, JSONResponse):
+        return result
+    return result[1]
+
+
+@router.get("/api/v1/metrics/historical")
+async def get_historical_metrics(request: Request):
+    """Bucketed history for one metric (metric_name, start_time, end_time, step)"""
+    try:
+        query = _params_query(request)
+    except QueryError as e:
+        return _invalid_query(e)
+
+    result = await _run_query(query_engine.range_query, query)
+    if isinstance(result, JSONResponse):
+        return result
+    plan, series = result
+    return {**query.describe(), **plan.describe(), "series": series}
+
+
+@router.get("/api/v1/metrics/aggregate")
+async def get_aggregate_metrics(request: Request):
+    """One aggregate per series over the whole time range"""
+    try:
+        query = _params_query(request)
+    except QueryError as e:
+        return _invalid_query(e)
+
+    result = await _run_query(query_engine.aggregate, query)
+    if isinstance(result, JSONResponse):
+        return result
+    plan, series = result
+    description = query.describe()
+    del description["step"]
+    return {**description, **plan.describe(), "series": series}
+
+
+# Alerting endpoints: rules are evaluated in-process against the ingestion stream
+
+
+def _invalid_rule(e: Exception) -> JSONResponse:
+    status_code = 409 if isinstance(e, AlertRuleConflict) else 422
+    return JSONResponse(
+        status_code=status_code, content={"error": "Invalid alert rule", "detail": str(e)}
+    )
+
+
+def _rule_not_found(rule_id: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=404, content={"error": "Alert rule not found", "rule_id": rule_id}
+    )
+
+
+async def _save_rule(request: Request, rule_id: str = None, base: dict = None):
+    """Validate and store a rule from the request body; returns the rule or an error"""
+    try:
+        data = await request.json()
+    except ValueError:
+        return JSONResponse(status_code=422, content={"error": "Invalid JSON body"})
+    if not isinstance(data, dict):
+        return _invalid_rule(AlertRuleError("rule must be an object"))
+    try:
+        rule = parse_rule({**(base or {}), **data}, rule_id=rule_id)
+        return await alert_engine.save_rule(rule)
+    except AlertRuleError as e:
+        return _invalid_rule(e)
+
+
+@router.get("/api/v1/alerts/active")
+async def get_active_alerts(request: Request):
+    """Pending and firing alerts, optionally filtered by status and severity"""
+    params = request.query_params
+    return alert_engine.active(status=params.get("status"), severity=params.get("severity"))
+
+
+@router.get("/api/v1/alerts/rules")
+async def list_alert_rules():
+    """All alert rules, enabled or not"""
+    return [rule.to_dict() for rule in alert_engine.rules()]
+
+
+@router.post("/api/v1/alerts/rules", status_code=201)
+async def create_alert_rule(request: Request):
+    """Create a rule; it applies to the next ingested sample"""
+    result = await _save_rule(request)
+    if isinstance(result, JSONResponse):
+        return result
+    return result.to_dict()
+
+
+@router.get("/api/v1/alerts/rules/{rule_id}")
+async def get_alert_rule(rule_id: str):
+    rule = alert_engine.get_rule(rule_id)
+    if rule is None:
+        return _rule_not_found(rule_id)
+    return rule.to_dict()
+
+
+@router.put("/api/v1/alerts/rules/{rule_id}")
+async def update_alert_rule(rule_id: str, request: Request):
+    """Update a rule; omitted fields keep their current values"""
+    rule = alert_engine.get_rule(rule_id)
+    if rule is None:
+        return _rule_not_found(rule_id)
+    result = await _save_rule(request, rule_id=rule_id, base=rule.to_dict())
+    if isinstance(result, JSONResponse):
+        return result
+    return result.to_dict()
+
+
+@router.delete("/api/v1/alerts/rules/{rule_id}", status_code=204)
+async def delete_alert_rule(rule_id: str):
+    from starlette.responses import Response
+
+    if not await alert_engine.delete_rule(rule_id):
+        return _rule_not_found(rule_id)
+    return Response(status_code=204)
+
+
+# Agent registry
+
+agent_registry = AgentRegistry()
+
+
+def _agent_not_found(agent_id: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=404, content={"error": "Agent not found", "agent_id": agent_id}
+    )
+
+
+def _invalid_agent(e: Exception) -> JSONResponse:
+    return JSONResponse(status_code=422, content={"error": "Invalid agent", "detail": str(e)})
+
+
+async def _save_agent(request: Request, agent_id: str = None, base: dict = None):
+    """Validate and store an agent from the request body; returns (agent, created) or an error"""
+    try:
+        data = await request.json()
+    except ValueError:
+        return JSONResponse(status_code=422, content={"error": "Invalid JSON body"})
+    if not isinstance(data, dict):
+        return _invalid_agent(AgentError("agent must be an object"))
+    try:
+        agent = parse_agent({**(base or {}), **data}, agent_id=agent_id)
+    except AgentError as e:
+        return _invalid_agent(e)
+    return agent, agent_registry.upsert(agent)
+
+
+@router.get("/api/v1/agents")
+async def list_agents(request: Request):
+    """Page of agents sorted by ID; 304 while the registry is unchanged"""
+    from starlette.responses import Response
+
+    headers = {"ETag": agent_registry.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), agent_registry.etag):
+        return Response(status_code=304, headers=headers)
+
+    params = request.query_params
+    try:
+        filters = parse_filters(params.multi_items())
+        limit = max(1, min(int(params.get("limit", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE))
+        agents, total, next_cursor = agent_registry.list(filters, params.get("cursor"), limit)
+    except ValueError as e:
+        return _invalid_query(e)
+    return JSONResponse(
+        content={
+            "data": [agent.to_dict() for agent in agents],
+            "total": total,
+            "limit": limit,
+            "next_cursor": next_cursor,
+        },
+        headers=headers,
+    )
+
+
+@router.post("/api/v1/agents", status_code=201)
+async def register_agent(request: Request):
+    """Register an agent; re-registering an existing ID replaces it (200)"""
+    result = await _save_agent(request)
+    if isinstance(result, JSONResponse):
+        return result
+    agent, created = result
+    heartbeats.heartbeat(agent.id)
+    return JSONResponse(status_code=201 if created else 200, content=agent.to_dict())
+
+
+@router.get("/api/v1/agents/{agent_id}")
+async def get_agent(agent_id: str):
+    agent = agent_registry.get(agent_id)
+    if agent is None:
+        return _agent_not_found(agent_id)
+    return agent.to_dict()
+
+
+@router.put("/api/v1/agents/{agent_id}")
+async def update_agent(agent_id: str, request: Request):
+    """Update an agent; omitted fields keep their current values"""
+    agent = agent_registry.get(agent_id)
+    if agent is None:
+        return _agent_not_found(agent_id)
+    result = await _save_agent(request, agent_id=agent_id, base=agent.to_dict())
+    if isinstance(result, JSONResponse):
+        return result
+    return result[0].to_dict()
+
+
+@router.delete("/api/v1/agents/{agent_id}", status_code=204)
+async def delete_agent(agent_id: str):
+    from starlette.responses import Response
+
+    if not agent_registry.delete(agent_id):
+        return _agent_not_found(agent_id)
+    heartbeats.forget(agent_id)
+    return Response(status_code=204)
+
+
+# Agent liveness: heartbeats and agent snapshots keep agents online
+
+heartbeats = HeartbeatTracker(
+    timeout=settings.heartbeat_timeout,
+    resolution=settings.heartbeat_resolution,
+)
+
+
+async def record_agent_heartbeats(batch):
+    """Ingestion sink: a registered agent's snapshot counts as a heartbeat"""
+    seen = set()
+    for sample in batch:
+        if sample.source == "agent":
+            agent_id = sample.labels["agent_id"]
+            if agent_id not in seen:
+                seen.add(agent_id)
+                # Unregistered IDs would be tracked forever; deletion is what forgets
+                if agent_registry.get(agent_id) is not None:
+                    heartbeats.heartbeat(agent_id)
+
+
+ingestion.add_sink(record_agent_heartbeats, name="heartbeats")
+
+
+async def publish_agent_transitions(transitions):
+    """Mirror online/offline transitions into the registry, alerts and WebSockets"""
+    now = datetime.now(timezone.utc)
+    for agent_id, state, age in transitions:
+        agent = agent_registry.get(agent_id)
+        # Maintenance is set by operators, not by liveness
+        if agent is not None and agent.status not in (state, "maintenance"):
+            last_seen = now - timedelta(seconds=age)
+            agent_registry.upsert(replace(agent, status=state, last_seen=last_seen))
+    await alert_engine.evaluate(liveness_samples(transitions, now))
+    if manager.clients:
+        payload = [transition_to_dict(t, now) for t in transitions]
+        await manager.broadcast(encode_frame({"type": "agent_status", "payload": payload}))
+
+
+heartbeats.add_listener(publish_agent_transitions)
+
+
+@router.post("/api/v1/agents/{agent_id}/heartbeat", status_code=204)
+async def agent_heartbeat(agent_id: str):
+    """Mark a registered agent as alive"""
+    from starlette.responses import Response
+
+    if agent_registry.get(agent_id) is None:
+        return _agent_not_found(agent_id)
+    heartbeats.heartbeat(agent_id)
+    return Response(status_code=204)
+
+
 # WebSocket endpoint for real-time metrics
 
 
-@app.websocket("/ws/metrics")
+async def handle_client_message(websocket: WebSocket, data: str):
+    """Apply subscribe messages; anything else is treated as a keepalive"""
+    try:
+        message = json.loads(data)
+    except ValueError:
+        logger.debug("Received WebSocket message: %s", data)
+        return
+    if not isinstance(message, dict) or message.get("type") != "subscribe":
+        logger.debug("Received WebSocket message: %s", data)
+        return
+
+    try:
+        subscription = parse_subscription(message)
+    except SubscriptionError as e:
+        await manager.send_personal_message(
+            encode_frame({"type": "error", "error": "Invalid subscription", "detail": str(e)}),
+            websocket,
+        )
+        return
+    manager.subscribe(websocket, subscription)
+    await manager.send_personal_message(
+        encode_frame({"type": "subscribed", "subscription": subscription.to_dict()}),
+        websocket,
+    )
+
+
+@router.websocket("/ws/metrics")
 async def websocket_metrics(websocket: WebSocket):
     """WebSocket endpoint for real-time metrics"""
     await manager.connect(websocket)
 
     try:
         # Send initial connection message
-        await websocket.send_text(
-            json.dumps(
+        await manager.send_personal_message(
+            encode_frame(
                 {
                     "type": "connection",
                     "status": "connected",
                     "timestamp": datetime.utcnow().isoformat(),
                 }
-            )
+            ),
+            websocket,
         )
 
-        # Keep connection alive and send periodic metrics
+        # Only reads here: data and heartbeats reach the client through its
+        # queue and writer task, so an idle connection just awaits the socket
         while True:
-            # Wait for any message from client (keepalive)
-            try:
-                data = await asyncio.wait_for(websocket.receive_text(), timeout=5.0)
-                logger.info("Received WebSocket message: %s", data)
-            except asyncio.TimeoutError:
-                # Send a metric update
-                metric = {
-                    "type": "metric",
-                    "payload": {
-                        "name": random.choice(
-                            [
-                                "cpu_usage",
-                                "memory_usage",
-                                "response_time",
-                                "disk_io",
-                            ]
-                        ),
-                        "value": random.uniform(20, 80),
-                        "timestamp": datetime.utcnow().isoformat(),
-                    },
-                }
-                await websocket.send_text(json.dumps(metric))
+            data = await websocket.receive_text()
+            await handle_client_message(websocket, data)
 
     except WebSocketDisconnect:
         manager.disconnect(websocket)
@@ -323,61 +877,189 @@ async def websocket_metrics(websocket: WebSocket):
 # Error handlers
 
 
-@app.exception_handler(404)
 async def not_found_handler(request: Request, exc):
     return JSONResponse(status_code=404, content={"error": "Not found", "path": str(request.url)})
 
 
-@app.exception_handler(500)
 async def internal_error_handler(request: Request, exc):
     return JSONResponse(status_code=500, content={"error": "Internal server error"})
 
 
-# Startup event
+# Startup and shutdown
+
+PRODUCTION_ORIGINS = [
+    "https://dashboard.candlefish.ai",
+    "https://candlefish.ai",
+    "https://www.candlefish.ai",
+]
+
+# Runs before any service starts; raising stops the process from starting
+StartupCheck = Callable[[], Awaitable[None]]
 
 
-@app.on_event("startup")
-async def startup_event():
-    logger.info("RTPM API starting up...")
-    # Fail closed in production if required secrets are missing
-    env = (
+def deployment_env() -> str:
+    return (
         os.getenv("CF_ENV")
         or os.getenv("NODE_ENV")
         or os.getenv("ENV")
         or os.getenv("PY_ENV")
         or "development"
     )
-    if env == "production":
-        region = os.getenv("AWS_REGION", "us-east-1")
-        sm = boto3.client("secretsmanager", region_name=region)
-        required = [
-            "candlefish-database-production",
-            "candlefish-redis-production",
-            "candlefish-auth-secrets-production",
-            "candlefish-jwt-keys-production",
-            "candlefish-api-keys-production",
-        ]
-        for sid in required:
-            try:
-                sm.describe_secret(SecretId=sid)
-            except ClientError as e:
-                logger.error("Missing or inaccessible secret: %s", sid)
-                raise RuntimeError("Startup denied: required secret missing") from e
-    logger.info("Database: Connected")
-    logger.info("Redis: Connected")
-    logger.info("Ready to accept connections")
-
-
-# Shutdown event
-
-
-@app.on_event("shutdown")
-async def shutdown_event():
+
+
+def secrets_check(config: Settings) -> StartupCheck:
+    """The production check: required secrets, as ``startup_secrets_check`` says"""
+
+    async def check() -> None:
+        verifier = SecretVerifier(
+            region=os.getenv("AWS_REGION", "us-east-1"),
+            timeout=config.secrets_check_timeout,
+            cache_path=config.secrets_cache_path or None,
+            cache_ttl=config.secrets_cache_ttl,
+        )
+        await check_secrets(verifier, config.startup_secrets_check)
+
+    return check
+
+
+async def start_services(phases: StartupPhases) -> None:
+    with phases.phase("database"):
+        if await database.connect():
+            logger.info(
+                "Database: Connected (pool %d-%d)", database.min_size, database.max_size
+            )
+        elif database.configured:
+            logger.info(
+                "Database: Not connected yet, retrying every %gs", database.health_interval
+            )
+        else:
+            logger.info("Database: Not configured, metrics will not be persisted")
+        await database.start()
+    if database.configured and durable_writer is not None:
+        with phases.phase("spool"):
+            await durable_writer.start()
+        ingestion.add_sink(durable_writer.write, name="timescaledb")
+        logger.info(
+            "Spool: Writing to %s while the database is unavailable",
+            durable_writer.spool.directory,
+        )
+    with phases.phase("redis"):
+        if await fanout.start():
+            ingestion.add_sink(fanout.publish, name="fanout")
+            logger.info("Redis: Connected, fanning out on %s", fanout.channel)
+        else:
+            logger.info("Redis: Not connected, broadcasts reach this replica's clients only")
+    with phases.phase("workers"):
+        await ingestion.start()
+        await alert_engine.start()
+        await heartbeats.start()
+
+
+async def stop_services() -> None:
     logger.info("RTPM API shutting down...")
-    logger.info("Closing database connections...")
+    await heartbeats.stop()
+    await ingestion.stop()
+    ingestion.remove_sink("fanout")
+    await fanout.stop()
+    await alert_engine.stop()
+    ingestion.remove_sink("timescaledb")
+    if durable_writer is not None:
+        await durable_writer.stop()
+    logger.info("Draining database connections...")
+    await database.close()
     logger.info("Shutdown complete")
 
 
+# Settings create_app applies to the app it builds (or that nothing reads); all
+# others configured the process-wide services at import
+APP_SETTINGS = frozenset(
+    {
+        "environment",
+        "log_level",
+        "api_host",
+        "api_port",
+        "jwt_secret",
+        "secret_key",
+        "cors_origins",
+        "request_exemplars",
+        "startup_secrets_check",
+        "secrets_check_timeout",
+        "secrets_cache_path",
+        "secrets_cache_ttl",
+    }
+)
+
+
+def create_app(
+    config: Optional[Settings] = None, startup_check: Optional[StartupCheck] = None
+) -> FastAPI:
+    """Build the ASGI app around the process-wide services
+
+    ``config`` (default: the module ``settings``) sets CORS, request
+    exemplars and the secrets check of this app.  The services were built
+    from ``settings`` at import and are shared by every app in the process,
+    so a ``config`` that changes any of their settings is refused with
+    ``ValueError`` rather than silently ignored.  ``startup_check`` runs
+    first at startup; by default that is the secrets check in production
+    and nothing elsewhere.  CORS allows ``config.cors_origins``, or the
+    candlefish domains in production and any origin elsewhere when none
+    are set.
+    """
+    if config is None:
+        config = settings
+    overridden = sorted(
+        name
+        for name in Settings.model_fields
+        if name not in APP_SETTINGS and getattr(config, name) != getattr(settings, name)
+    )
+    if overridden:
+        raise ValueError(
+            "create_app cannot change process-wide service settings: " + ", ".join(overridden)
+        )
+    production = deployment_env() == "production"
+    if startup_check is None and production:
+        startup_check = secrets_check(config)
+
+    application = FastAPI(
+        title="RTPM Dashboard API",
+        description="Real-time Performance Monitoring Dashboard API",
+        version="1.0.0",
+    )
+    application.add_middleware(
+        CORSMiddleware,
+        allow_origins=config.cors_origins or (PRODUCTION_ORIGINS if production else ["*"]),
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    # Request metrics and security headers
+    application.add_middleware(
+        HTTPMiddleware,
+        latency=latency_tracker,
+        exemplars=config.request_exemplars,
+    )
+    application.include_router(router)
+    application.add_exception_handler(404, not_found_handler)
+    application.add_exception_handler(500, internal_error_handler)
+
+    async def startup_event():
+        logger.info("RTPM API starting up...")
+        phases = StartupPhases()
+        if startup_check is not None:
+            with phases.phase("checks"):
+                await startup_check()
+        await start_services(phases)
+        logger.info("Startup phases: %s", phases.finish())
+        logger.info("Ready to accept connections")
+
+    application.add_event_handler("startup", startup_event)
+    application.add_event_handler("shutdown", stop_services)
+    return application
+
+
+app = create_app()
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -0,0 +1,295 @@
+"""
+Agent registry
+
+Agents are held in memory, keyed by ID, with a secondary index per
+filterable field (``status``, ``region``, ``platform``, ``version``, and
+each of ``capabilities`` and ``tags``) mapping a value to the set of
+agent IDs that carry it.  A filtered listing intersects the matching
+sets, smallest first, instead of scanning the fleet, and an unfiltered
+one slices a sorted ID list.  Pages are addressed by an opaque cursor
+(the last ID returned), so deep pages cost the same as the first.
+
+Every change bumps ``generation``, which is also the listing's ETag: a
+dashboard polling with ``If-None-Match`` gets ``304 Not Modified``
+without the registry doing any work while nothing has changed.  The ETag
+also carries a random ``epoch`` drawn per registry, since generations
+restart at 0 with every process and replicas count independently; an
+ETag from another replica or a previous process never matches.
+"""
+
+import base64
+import binascii
+import secrets
+from bisect import bisect_right, insort
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from prometheus_client import Gauge
+
+from .ingestion import MetricValidationError, parse_timestamp
+
+AGENT_STATUSES = ("online", "offline", "warning", "error", "maintenance")
+MAX_ID_LENGTH = 255
+MAX_TEXT_LENGTH = 255
+MAX_LIST_ITEMS = 64
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Query parameter -> Agent attribute; list attributes index each element
+FILTERS = {
+    "status": "status",
+    "region": "region",
+    "platform": "platform",
+    "version": "version",
+    "capability": "capabilities",
+    "tag": "tags",
+}
+LIST_FIELDS = ("capabilities", "tags")
+
+AGENTS_REGISTERED = Gauge(
+    "rtpm_agents",
+    "Agents in the registry, by status",
+    ["status"],
+)
+
+
+class AgentError(ValueError):
+    """Raised when an agent definition or listing query is invalid"""
+
+
+@dataclass
+class Agent:
+    """One registered agent"""
+
+    id: str
+    name: str
+    status: str = "online"
+    version: str = ""
+    capabilities: List[str] = field(default_factory=list)
+    last_seen: Optional[datetime] = None
+    region: str = ""
+    platform: str = ""
+    tags: List[str] = field(default_factory=list)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "version": self.version,
+            "capabilities": self.capabilities,
+            "lastSeen": self.last_seen.isoformat() if self.last_seen else None,
+            "region": self.region,
+            "platform": self.platform,
+            "tags": self.tags,
+        }
+
+
+def _text(data: Dict[str, Any], key: str, required: bool = False) -> str:
+    raw = data.get(key)
+    if raw is None or raw == "":
+        if required:
+            raise AgentError(f"{key} is required")
+        return ""
+    if not isinstance(raw, str):
+        raise AgentError(f"{key} must be a string")
+    raw = raw.strip()
+    if required and not raw:
+        raise AgentError(f"{key} is required")
+    if len(raw) > MAX_TEXT_LENGTH:
+        raise AgentError(f"{key} must be at most {MAX_TEXT_LENGTH} characters")
+    return raw
+
+
+def _strings(data: Dict[str, Any], key: str) -> List[str]:
+    raw = data.get(key)
+    if raw is None:
+        return []
+    if not isinstance(raw, list) or not all(isinstance(item, str) for item in raw):
+        raise AgentError(f"{key} must be a list of strings")
+    if len(raw) > MAX_LIST_ITEMS:
+        raise AgentError(f"at most {MAX_LIST_ITEMS} {key}")
+    # Order kept, duplicates dropped
+    return list(dict.fromkeys(item for item in raw if item))
+
+
+def parse_agent(data: Any, agent_id: Optional[str] = None) -> Agent:
+    """Validate an agent from the API; camelCase and snake_case keys are accepted"""
+    if not isinstance(data, dict):
+        raise AgentError("agent must be an object")
+    agent_id = agent_id or data.get("id")
+    if not isinstance(agent_id, str) or not agent_id.strip():
+        raise AgentError("id is required")
+    if len(agent_id) > MAX_ID_LENGTH:
+        raise AgentError(f"id must be at most {MAX_ID_LENGTH} characters")
+
+    status = data.get("status") or "online"
+    if status not in AGENT_STATUSES:
+        raise AgentError(f"status must be one of {', '.join(AGENT_STATUSES)}")
+    last_seen = data.get("lastSeen", data.get("last_seen"))
+    try:
+        last_seen = parse_timestamp(last_seen)
+    except MetricValidationError as e:
+        raise AgentError(f"lastSeen: {e}") from None
+
+    return Agent(
+        id=agent_id.strip(),
+        name=_text(data, "name", required=True),
+        status=status,
+        version=_text(data, "version"),
+        capabilities=_strings(data, "capabilities"),
+        last_seen=last_seen,
+        region=_text(data, "region"),
+        platform=_text(data, "platform"),
+        tags=_strings(data, "tags"),
+    )
+
+
+def encode_cursor(agent_id: str) -> str:
+    return base64.urlsafe_b64encode(agent_id.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> str:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return base64.b64decode(padded, altchars=b"-_", validate=True).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        raise AgentError("invalid cursor") from None
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an ``If-None-Match`` header names ``etag`` (weak comparison)"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag.removeprefix("W/"):
+            return True
+    return False
+
+
+class AgentRegistry:
+    """Agents by ID with per-field inverted indexes"""
+
+    def __init__(self):
+        self._agents: Dict[str, Agent] = {}
+        # Sorted, for cursor pagination of unfiltered listings
+        self._ids: List[str] = []
+        # field -> value -> agent IDs
+        self._index: Dict[str, Dict[str, Set[str]]] = {attr: {} for attr in FILTERS.values()}
+        self.generation = 0
+        self.epoch = secrets.token_hex(4)
+        for status in AGENT_STATUSES:
+            AGENTS_REGISTERED.labels(status).set_function(
+                lambda s=status: len(self._index["status"].get(s, ()))
+            )
+
+    def __len__(self) -> int:
+        return len(self._agents)
+
+    @property
+    def etag(self) -> str:
+        return f'W/"agents-{self.epoch}-{self.generation}"'
+
+    def get(self, agent_id: str) -> Optional[Agent]:
+        return self._agents.get(agent_id)
+
+    @staticmethod
+    def _values(agent: Agent, attr: str) -> Iterable[str]:
+        value = getattr(agent, attr)
+        return value if attr in LIST_FIELDS else (value,)
+
+    def _link(self, agent: Agent) -> None:
+        for attr, values in self._index.items():
+            for value in self._values(agent, attr):
+                values.setdefault(value, set()).add(agent.id)
+
+    def _unlink(self, agent: Agent) -> None:
+        for attr, values in self._index.items():
+            for value in self._values(agent, attr):
+                ids = values.get(value)
+                if ids is not None:
+                    ids.discard(agent.id)
+                    if not ids:
+                        del values[value]
+
+    def upsert(self, agent: Agent) -> bool:
+        """Register or replace an agent; returns True when it is new"""
+        previous = self._agents.get(agent.id)
+        if previous is not None:
+            self._unlink(previous)
+        else:
+            insort(self._ids, agent.id)
+        self._agents[agent.id] = agent
+        self._link(agent)
+        self.generation += 1
+        return previous is None
+
+    def delete(self, agent_id: str) -> bool:
+        agent = self._agents.pop(agent_id, None)
+        if agent is None:
+            return False
+        self._unlink(agent)
+        index = bisect_right(self._ids, agent_id) - 1
+        del self._ids[index]
+        self.generation += 1
+        return True
+
+    def _matching(self, filters: Dict[str, List[str]]) -> Optional[Set[str]]:
+        """IDs matching every field (any of its values); None when unfiltered"""
+        groups = []
+        for param, values in filters.items():
+            index = self._index[FILTERS[param]]
+            if len(values) == 1:
+                groups.append(index.get(values[0], set()))
+            else:
+                groups.append(set().union(*(index.get(v, ()) for v in values)))
+        if not groups:
+            return None
+        groups.sort(key=len)
+        matched = set(groups[0])
+        for group in groups[1:]:
+            matched &= group
+            if not matched:
+                break
+        return matched
+
+    def list(
+        self,
+        filters: Optional[Dict[str, List[str]]] = None,
+        cursor: Optional[str] = None,
+        limit: int = DEFAULT_PAGE_SIZE,
+    ) -> Tuple[List[Agent], int, Optional[str]]:
+        """One page of agents sorted by ID: (agents, total matching, next cursor)"""
+        matched = self._matching(filters or {})
+        ids = self._ids if matched is None else sorted(matched)
+        start = bisect_right(ids, decode_cursor(cursor)) if cursor else 0
+        page = ids[start : start + limit]
+        next_cursor = encode_cursor(page[-1]) if start + limit < len(ids) else None
+        return [self._agents[i] for i in page], len(ids), next_cursor
+
+    def counts(self, attr: str = "status") -> Dict[str, int]:
+        """Agents per value of an indexed field"""
+        return {value: len(ids) for value, ids in self._index[attr].items()}
+
+
+def parse_filters(params: Iterable[Tuple[str, str]]) -> Dict[str, List[str]]:
+    """Listing filters from query parameters; repeated or comma-separated values are OR'd"""
+    filters: Dict[str, List[str]] = {}
+    for key, raw in params:
+        if key == "capabilities":
+            key = "capability"
+        elif key == "tags":
+            key = "tag"
+        if key not in FILTERS:
+            continue
+        values = [v.strip() for v in raw.split(",") if v.strip()]
+        if not values:
+            continue
+        if key == "status":
+            for value in values:
+                if value not in AGENT_STATUSES:
+                    raise AgentError(f"status must be one of {', '.join(AGENT_STATUSES)}")
+        filters.setdefault(key, []).extend(values)
+    return filters
@@ -0,0 +1,733 @@
+"""
+Streaming alert evaluation
+
+Enabled rules from ``alert_rules`` are indexed by ``metric_name`` and
+every ingested sample is checked only against the rules for its metric,
+so a threshold breach is noticed within one ingestion flush instead of
+one ``evaluation_interval`` of database polling.
+
+Each rule/series pair has a fingerprint.  A breach starts a *pending*
+alert; once the condition has held for ``for_duration`` seconds of
+sample time it becomes *firing*, and the first sample back inside the
+threshold resolves it.  Sample time is capped at the time the sample
+was received, so future-dated samples cannot fire early; staleness is
+measured from when a series was last received, on the same wall clock
+that ``resolve_stale`` reads, so backfilled breaches do not resolve on
+the next tick.  Pending state lives only in memory; firing and
+resolved transitions are upserted into ``alerts`` (keyed by fingerprint)
+in batches by a background task.  Rule ``labels`` act as equality
+selectors on the series a rule applies to; ``evaluation_interval`` is
+kept for compatibility but no longer drives evaluation.
+
+Rules created, edited or deleted while the database is down (or when
+writing them fails) take effect at once and are written once it is
+healthy again, winning over the stored rows on a reload meanwhile.
+Editing or deleting a rule resolves its firing alerts before their state
+is dropped; a deleted rule's alert rows go with it (``ON DELETE
+CASCADE``), so its transitions are not written.  A batch the database
+refuses outright (a constraint or data error) is retried row by row and
+only the refused rows are dropped.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import operator
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from time import perf_counter, time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from .database import Database
+from .ingestion import MetricSample
+from .subscriptions import SubscriptionError, parse_label_selectors
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+FIRING = "firing"
+RESOLVED = "resolved"
+
+OPERATORS: Dict[str, Callable[[float, float], bool]] = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+# Spellings used by older clients and the load-test scenarios
+OPERATOR_ALIASES = {
+    "gt": ">",
+    "greater_than": ">",
+    "gte": ">=",
+    "ge": ">=",
+    "lt": "<",
+    "less_than": "<",
+    "lte": "<=",
+    "le": "<=",
+    "eq": "==",
+    "equals": "==",
+    "ne": "!=",
+    "not_equals": "!=",
+}
+SEVERITIES = ("info", "low", "warning", "medium", "high", "critical")
+MAX_FOR_DURATION = 86400
+# Firing alerts whose series stopped reporting are resolved after this many seconds
+DEFAULT_STALE_AFTER = 600.0
+
+ALERT_EVALUATIONS = Counter(
+    "rtpm_alert_evaluations_total",
+    "Samples checked against an alert rule",
+)
+ALERT_TRANSITIONS = Counter(
+    "rtpm_alert_transitions_total",
+    "Alert state changes",
+    ["status"],
+)
+ALERT_EVALUATION_LATENCY = Histogram(
+    "rtpm_alert_evaluation_latency_seconds",
+    "Time to evaluate one ingestion batch against the rule index",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1),
+)
+ALERT_WRITE_ERRORS = Counter(
+    "rtpm_alert_write_errors_total",
+    "Batches of alert transitions that could not be written",
+)
+ALERTS_ACTIVE = Gauge(
+    "rtpm_alerts_active",
+    "Alerts currently pending or firing",
+    ["status"],
+)
+
+ALERT_COLUMNS = (
+    "id",
+    "rule_id",
+    "rule_name",
+    "metric_name",
+    "status",
+    "severity",
+    "current_value",
+    "threshold",
+    "condition",
+    "labels",
+    "annotations",
+    "started_at",
+    "resolved_at",
+    "last_seen",
+    "fingerprint",
+)
+UPSERT_ALERT_SQL = f"""
+INSERT INTO alerts ({", ".join(ALERT_COLUMNS)})
+VALUES ({", ".join(f"${i}" for i in range(1, len(ALERT_COLUMNS) + 1))})
+ON CONFLICT (fingerprint) DO UPDATE SET
+    status = EXCLUDED.status,
+    severity = EXCLUDED.severity,
+    current_value = EXCLUDED.current_value,
+    threshold = EXCLUDED.threshold,
+    condition = EXCLUDED.condition,
+    annotations = EXCLUDED.annotations,
+    started_at = EXCLUDED.started_at,
+    resolved_at = EXCLUDED.resolved_at,
+    last_seen = EXCLUDED.last_seen
+"""
+RULE_COLUMNS = (
+    "id",
+    "name",
+    "metric_name",
+    "condition",
+    "threshold",
+    "severity",
+    "labels",
+    "annotations",
+    "evaluation_interval",
+    "for_duration",
+    "enabled",
+)
+UPSERT_RULE_SQL = f"""
+INSERT INTO alert_rules ({", ".join(RULE_COLUMNS)})
+VALUES ({", ".join(f"${i}" for i in range(1, len(RULE_COLUMNS) + 1))})
+ON CONFLICT (id) DO UPDATE SET
+    {", ".join(f"{c} = EXCLUDED.{c}" for c in RULE_COLUMNS[1:])},
+    updated_at = NOW()
+"""
+DELETE_RULE_SQL = "DELETE FROM alert_rules WHERE id = $1"
+
+
+class AlertRuleError(ValueError):
+    """Raised when an alert rule definition is invalid"""
+
+
+class AlertRuleConflict(AlertRuleError):
+    """Raised when another rule already has the same name"""
+
+
+def _permanent(error: Exception) -> bool:
+    """Integrity or data errors (SQLSTATE class 23/22) fail the same way on retry"""
+    return str(getattr(error, "sqlstate", None) or "")[:2] in ("22", "23")
+
+
+def _isoformat(epoch: Optional[float]) -> Optional[str]:
+    if epoch is None:
+        return None
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat()
+
+
+def _datetime(epoch: Optional[float]) -> Optional[datetime]:
+    return None if epoch is None else datetime.fromtimestamp(epoch, timezone.utc)
+
+
+def parse_condition(raw: Any) -> str:
+    """Operator of a condition such as ``"> 80"``, ``">"`` or ``"greater_than"``"""
+    if not isinstance(raw, str) or not raw.strip():
+        raise AlertRuleError("condition must be a comparison operator such as '>'")
+    token = raw.split()[0]
+    op = OPERATOR_ALIASES.get(token.lower(), token)
+    if op not in OPERATORS:
+        # "> 80" may also arrive without the space
+        op = next((o for o in sorted(OPERATORS, key=len, reverse=True) if token.startswith(o)), "")
+    if not op:
+        raise AlertRuleError(f"condition must start with one of {', '.join(OPERATORS)}")
+    return op
+
+
+def _json_object(raw: Any, name: str) -> Dict[str, Any]:
+    if raw is None:
+        return {}
+    if isinstance(raw, str):
+        # JSONB columns come back from asyncpg as text
+        try:
+            raw = json.loads(raw)
+        except ValueError:
+            raise AlertRuleError(f"{name} must be a JSON object") from None
+    if not isinstance(raw, dict):
+        raise AlertRuleError(f"{name} must be an object")
+    return raw
+
+
+def _seconds(raw: Any, name: str, default: int) -> int:
+    if raw is None:
+        return default
+    if isinstance(raw, bool) or not isinstance(raw, (int, float)):
+        raise AlertRuleError(f"{name} must be a number of seconds")
+    if not 0 <= raw <= MAX_FOR_DURATION:
+        raise AlertRuleError(f"{name} must be between 0 and {MAX_FOR_DURATION} seconds")
+    return int(raw)
+
+
+@dataclass
+class AlertRule:
+    """One row of ``alert_rules``"""
+
+    id: str
+    name: str
+    metric_name: str
+    condition: str
+    threshold: float
+    severity: str = "warning"
+    labels: Dict[str, str] = field(default_factory=dict)
+    annotations: Dict[str, Any] = field(default_factory=dict)
+    evaluation_interval: int = 60
+    for_duration: int = 300
+    enabled: bool = True
+
+    def matches(self, labels: Dict[str, str]) -> bool:
+        for name, value in self.labels.items():
+            if labels.get(name) != value:
+                return False
+        return True
+
+    def breached(self, value: float) -> bool:
+        return OPERATORS[self.condition](value, self.threshold)
+
+    @property
+    def expression(self) -> str:
+        """Condition text as stored in ``alert_rules.condition``"""
+        return f"{self.condition} {self.threshold:g}"
+
+    def to_record(self) -> tuple:
+        return (
+            uuid.UUID(self.id),
+            self.name,
+            self.metric_name,
+            self.expression,
+            self.threshold,
+            self.severity,
+            json.dumps(self.labels),
+            json.dumps(self.annotations),
+            self.evaluation_interval,
+            self.for_duration,
+            self.enabled,
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "metric_name": self.metric_name,
+            "condition": self.expression,
+            "threshold": self.threshold,
+            "severity": self.severity,
+            "labels": self.labels,
+            "annotations": self.annotations,
+            "evaluation_interval": self.evaluation_interval,
+            "for_duration": self.for_duration,
+            "enabled": self.enabled,
+        }
+
+
+def parse_rule(data: Any, rule_id: Optional[str] = None) -> AlertRule:
+    """Validate a rule from the API or an ``alert_rules`` row"""
+    if not isinstance(data, dict):
+        raise AlertRuleError("rule must be an object")
+    name = data.get("name")
+    if not isinstance(name, str) or not name.strip():
+        raise AlertRuleError("name is required")
+    metric_name = data.get("metric_name", data.get("metric"))
+    if not isinstance(metric_name, str) or not metric_name:
+        raise AlertRuleError("metric_name is required")
+
+    condition = parse_condition(data.get("condition", data.get("operator")))
+    threshold = data.get("threshold")
+    if threshold is None and isinstance(data.get("condition"), str):
+        # Threshold only given inside the condition, e.g. "> 80"
+        parts = data["condition"].replace(condition, "", 1).split()
+        threshold = parts[0] if parts else None
+    try:
+        threshold = float(threshold)
+    except (TypeError, ValueError):
+        raise AlertRuleError("threshold must be a number") from None
+    if threshold != threshold or threshold in (float("inf"), float("-inf")):
+        raise AlertRuleError("threshold must be finite")
+
+    severity = data.get("severity") or "warning"
+    if severity not in SEVERITIES:
+        raise AlertRuleError(f"severity must be one of {', '.join(SEVERITIES)}")
+    labels = data.get("labels")
+    try:
+        if isinstance(labels, str):
+            labels = json.loads(labels)
+        labels = parse_label_selectors(labels)
+    except (SubscriptionError, ValueError) as e:
+        raise AlertRuleError(f"labels: {e}") from None
+    enabled = data.get("enabled", True)
+    if not isinstance(enabled, bool):
+        raise AlertRuleError("enabled must be a boolean")
+
+    rule_id = rule_id or data.get("id") or str(uuid.uuid4())
+    try:
+        rule_id = str(uuid.UUID(str(rule_id)))
+    except ValueError:
+        raise AlertRuleError("id must be a UUID") from None
+
+    return AlertRule(
+        id=rule_id,
+        name=name.strip(),
+        metric_name=metric_name,
+        condition=condition,
+        threshold=threshold,
+        severity=severity,
+        labels=labels,
+        annotations=_json_object(data.get("annotations"), "annotations"),
+        evaluation_interval=_seconds(data.get("evaluation_interval"), "evaluation_interval", 60),
+        for_duration=_seconds(data.get("for_duration", data.get("duration")), "for_duration", 300),
+        enabled=enabled,
+    )
+
+
+def fingerprint(rule_id: str, labels: Dict[str, str]) -> str:
+    """Stable identity of one rule applied to one series"""
+    key = json.dumps([rule_id, sorted(labels.items())], separators=(",", ":"))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class AlertState:
+    """Pending or firing alert for one fingerprint"""
+
+    __slots__ = (
+        "id",
+        "rule",
+        "series_id",
+        "labels",
+        "fingerprint",
+        "status",
+        "started_at",
+        "resolved_at",
+        "last_seen",
+        "value",
+    )
+
+    def __init__(self, rule: AlertRule, sample: MetricSample, now: float):
+        self.id = str(uuid.uuid4())
+        self.rule = rule
+        self.series_id = sample.series_id
+        self.labels = sample.labels
+        self.fingerprint = fingerprint(rule.id, sample.labels)
+        self.status = PENDING
+        self.started_at = now
+        self.resolved_at: Optional[float] = None
+        self.last_seen = now
+        self.value = 0.0
+
+    def to_record(self) -> tuple:
+        rule = self.rule
+        return (
+            uuid.UUID(self.id),
+            uuid.UUID(rule.id),
+            rule.name,
+            rule.metric_name,
+            self.status,
+            rule.severity,
+            self.value,
+            rule.threshold,
+            rule.expression,
+            json.dumps(self.labels),
+            json.dumps(rule.annotations),
+            _datetime(self.started_at),
+            _datetime(self.resolved_at),
+            _datetime(self.last_seen),
+            self.fingerprint,
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        rule = self.rule
+        return {
+            "id": self.id,
+            "rule_id": rule.id,
+            "rule_name": rule.name,
+            "metric_name": rule.metric_name,
+            "status": self.status,
+            "severity": rule.severity,
+            "current_value": self.value,
+            "threshold": rule.threshold,
+            "condition": rule.expression,
+            "labels": self.labels,
+            "annotations": rule.annotations,
+            "started_at": _isoformat(self.started_at),
+            "resolved_at": _isoformat(self.resolved_at),
+            "last_seen": _isoformat(self.last_seen),
+            "fingerprint": self.fingerprint,
+        }
+
+
+Notifier = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class AlertEngine:
+    """Evaluates enabled rules against the ingestion stream"""
+
+    def __init__(
+        self,
+        database: Database,
+        flush_interval: float = 1.0,
+        stale_after: float = DEFAULT_STALE_AFTER,
+        clock: Callable[[], float] = time,
+    ):
+        self.database = database
+        self.flush_interval = flush_interval
+        self.stale_after = stale_after
+        self.clock = clock
+        self._rules: Dict[str, AlertRule] = {}
+        # Rule changes not yet written to alert_rules: id -> rule, None when deleted
+        self._unsaved: Dict[str, Optional[AlertRule]] = {}
+        # metric name -> enabled rules for it
+        self._by_metric: Dict[str, List[AlertRule]] = {}
+        # (rule id, series id) -> state; the text fingerprint is only built once
+        self._states: Dict[Tuple[str, int], AlertState] = {}
+        # fingerprint -> latest unwritten transition
+        self._unwritten: Dict[str, tuple] = {}
+        self._notifiers: List[Notifier] = []
+        self._task: Optional[asyncio.Task] = None
+        for status in (PENDING, FIRING):
+            ALERTS_ACTIVE.labels(status).set_function(lambda s=status: self._count(s))
+
+    def _count(self, status: str) -> int:
+        # Called from the exposition thread: copy before iterating
+        return sum(1 for state in list(self._states.values()) if state.status == status)
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def add_notifier(self, callback: Notifier) -> None:
+        """Register a coroutine called with each firing or resolved alert"""
+        self._notifiers.append(callback)
+
+    # Rules
+
+    def rules(self) -> List[AlertRule]:
+        return sorted(self._rules.values(), key=lambda r: r.name)
+
+    def get_rule(self, rule_id: str) -> Optional[AlertRule]:
+        return self._rules.get(rule_id)
+
+    def set_rules(self, rules: Sequence[AlertRule]) -> List[AlertState]:
+        """Replace the rule set; returns the alerts resolved because their rule changed"""
+        self._rules = {rule.id: rule for rule in rules}
+        return self._reindex()
+
+    def _reindex(self) -> List[AlertState]:
+        by_metric: Dict[str, List[AlertRule]] = {}
+        for rule in self._rules.values():
+            if rule.enabled:
+                by_metric.setdefault(rule.metric_name, []).append(rule)
+        self._by_metric = by_metric
+        # States of removed or edited rules start over against the new definition;
+        # firing ones are resolved first so their alert rows do not stay open
+        now = self.clock()
+        resolved = []
+        for key, state in list(self._states.items()):
+            if self._rules.get(state.rule.id) is not state.rule:
+                del self._states[key]
+                if state.status == FIRING:
+                    resolved.append(self._transition(state, RESOLVED, now))
+        # Alert rows of deleted rules are cascaded away; upserting them would fail
+        rule_ids = {uuid.UUID(rule_id) for rule_id in self._rules}
+        for key, record in list(self._unwritten.items()):
+            if record[1] not in rule_ids:
+                del self._unwritten[key]
+        return resolved
+
+    async def load_rules(self) -> int:
+        """Replace the rule set with the rows of ``alert_rules``
+
+        Changes made while the database was unreachable are written first and
+        kept over the stored rows if that still fails.
+        """
+        async with self.database.pool.acquire() as conn:
+            await self._write_unsaved(conn)
+            rows = await conn.fetch(f"SELECT {', '.join(RULE_COLUMNS)} FROM alert_rules")
+        rules = {}
+        for row in rows:
+            try:
+                rule = parse_rule(dict(row), rule_id=str(row["id"]))
+            except AlertRuleError as e:
+                logger.warning("Skipping alert rule %s: %s", row["name"], e)
+                continue
+            rules[rule.id] = rule
+        for rule_id, rule in self._unsaved.items():
+            if rule is None:
+                rules.pop(rule_id, None)
+            else:
+                rules[rule_id] = rule
+        for state in self.set_rules(list(rules.values())):
+            await self._notify(state.to_dict())
+        return len(rules)
+
+    async def _write_unsaved(self, conn) -> None:
+        for rule_id, rule in list(self._unsaved.items()):
+            try:
+                if rule is None:
+                    await conn.execute(DELETE_RULE_SQL, uuid.UUID(rule_id))
+                else:
+                    await conn.execute(UPSERT_RULE_SQL, *rule.to_record())
+            except Exception as e:
+                if not _permanent(e):
+                    logger.warning("Alert rule %s not saved yet: %s", rule_id, e)
+                    continue
+                logger.error("Alert rule %s refused by the database: %s", rule_id, e)
+            del self._unsaved[rule_id]
+
+    async def save_pending(self) -> None:
+        """Write rule changes made while the database was unreachable"""
+        try:
+            async with self.database.pool.acquire() as conn:
+                await self._write_unsaved(conn)
+        except Exception as e:
+            logger.warning("Alert rule changes not saved yet: %s", e)
+
+    async def _persist(self, rule_id: str, rule: Optional[AlertRule]) -> None:
+        # Queued first, in order, so a failed write is retried instead of lost
+        self._unsaved.pop(rule_id, None)
+        self._unsaved[rule_id] = rule
+        if self.database.healthy:
+            await self.save_pending()
+
+    async def save_rule(self, rule: AlertRule) -> AlertRule:
+        """Create or replace a rule; persisted now or once the database is healthy"""
+        for other in self._rules.values():
+            if other.name == rule.name and other.id != rule.id:
+                raise AlertRuleConflict(f"a rule named {rule.name!r} already exists")
+        await self._persist(rule.id, rule)
+        self._rules[rule.id] = rule
+        for state in self._reindex():
+            await self._notify(state.to_dict())
+        return rule
+
+    async def delete_rule(self, rule_id: str) -> bool:
+        if rule_id not in self._rules:
+            return False
+        await self._persist(rule_id, None)
+        del self._rules[rule_id]
+        for state in self._reindex():
+            await self._notify(state.to_dict())
+        return True
+
+    # Evaluation
+
+    async def evaluate(self, batch: Sequence[MetricSample]) -> None:
+        """Ingestion sink"""
+        by_metric = self._by_metric
+        if not by_metric:
+            return
+        start = perf_counter()
+        received = self.clock()
+        changed: List[Dict[str, Any]] = []
+        evaluations = 0
+        for sample in batch:
+            rules = by_metric.get(sample.metric_name)
+            if not rules:
+                continue
+            for rule in rules:
+                if rule.labels and not rule.matches(sample.labels):
+                    continue
+                evaluations += 1
+                state = self._apply(rule, sample, received)
+                if state is not None:
+                    # Snapshot: the same alert may change again later in the batch
+                    changed.append(state.to_dict())
+        if evaluations:
+            ALERT_EVALUATIONS.inc(evaluations)
+            ALERT_EVALUATION_LATENCY.observe(perf_counter() - start)
+        for alert in changed:
+            await self._notify(alert)
+
+    def _apply(
+        self, rule: AlertRule, sample: MetricSample, received: float
+    ) -> Optional[AlertState]:
+        """Advance one fingerprint; returns the state when it fired or resolved"""
+        key = (rule.id, sample.series_id)
+        state = self._states.get(key)
+        now = min(sample.timestamp.timestamp(), received)
+        if not rule.breached(sample.value):
+            if state is None:
+                return None
+            del self._states[key]
+            if state.status != FIRING:
+                return None
+            state.value = sample.value
+            state.last_seen = received
+            return self._transition(state, RESOLVED, now)
+
+        if state is None:
+            state = self._states[key] = AlertState(rule, sample, now)
+            ALERT_TRANSITIONS.labels(PENDING).inc()
+        state.value = sample.value
+        state.last_seen = received
+        if state.status == PENDING and now - state.started_at >= rule.for_duration:
+            return self._transition(state, FIRING, now)
+        return None
+
+    def _transition(self, state: AlertState, status: str, now: float) -> AlertState:
+        state.status = status
+        if status == RESOLVED:
+            state.resolved_at = now
+        ALERT_TRANSITIONS.labels(status).inc()
+        self._unwritten[state.fingerprint] = state.to_record()
+        logger.info("Alert %s %s: %s", state.rule.name, status, state.labels)
+        return state
+
+    async def _notify(self, alert: Dict[str, Any]) -> None:
+        for notify in self._notifiers:
+            try:
+                await notify(alert)
+            except Exception as e:
+                logger.error("Alert notifier failed: %s", e)
+
+    def resolve_stale(self, now: Optional[float] = None) -> List[AlertState]:
+        """Resolve firing alerts whose series stopped reporting"""
+        now = self.clock() if now is None else now
+        stale = [s for s in self._states.values() if now - s.last_seen > self.stale_after]
+        resolved = []
+        for state in stale:
+            del self._states[(state.rule.id, state.series_id)]
+            if state.status == FIRING:
+                resolved.append(self._transition(state, RESOLVED, now))
+        return resolved
+
+    def active(self, status: Optional[str] = None, severity: Optional[str] = None) -> List[Dict]:
+        """Pending and firing alerts, most recently started first"""
+        states = [
+            s
+            for s in self._states.values()
+            if (status is None or s.status == status)
+            and (severity is None or s.rule.severity == severity)
+        ]
+        states.sort(key=lambda s: s.started_at, reverse=True)
+        return [s.to_dict() for s in states]
+
+    # Persistence
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            for state in self.resolve_stale():
+                await self._notify(state.to_dict())
+            if self._unsaved and self.database.healthy:
+                await self.save_pending()
+            await self.flush()
+
+    async def flush(self) -> int:
+        """Write buffered transitions to ``alerts`` in one round trip"""
+        if not self._unwritten:
+            return 0
+        if not self.database.connected:
+            # Nothing to write to; the in-memory state is the source of truth
+            self._unwritten.clear()
+            return 0
+        records, self._unwritten = list(self._unwritten.values()), {}
+        try:
+            async with self.database.pool.acquire() as conn:
+                await conn.executemany(UPSERT_ALERT_SQL, records)
+        except Exception as e:
+            ALERT_WRITE_ERRORS.inc()
+            if _permanent(e):
+                # executemany is atomic: find and drop the records it refused
+                return await self._write_each(records)
+            logger.error("Failed to write %d alert transitions: %s", len(records), e)
+            self._retry(records)
+            return 0
+        return len(records)
+
+    async def _write_each(self, records: List[tuple]) -> int:
+        written = 0
+        pending = list(records)
+        try:
+            async with self.database.pool.acquire() as conn:
+                while pending:
+                    try:
+                        await conn.execute(UPSERT_ALERT_SQL, *pending[0])
+                        written += 1
+                    except Exception as e:
+                        if not _permanent(e):
+                            raise
+                        logger.error("Dropping alert transition %s: %s", pending[0][-1], e)
+                    pending.pop(0)
+        except Exception as e:
+            logger.error("Failed to write %d alert transitions: %s", len(pending), e)
+            self._retry(pending)
+        return written
+
+    def _retry(self, records: List[tuple]) -> None:
+        # Retry on the next flush unless a newer transition superseded them
+        for record in records:
+            self._unwritten.setdefault(record[-1], record)
@@ -0,0 +1,298 @@
+"""
+WebSocket fan-out
+
+Every connection gets a bounded outbound queue drained by its own writer
+task, so ``broadcast`` only appends to queues and never waits on a socket.
+When a client falls behind, the oldest queued frames are dropped to make
+room for fresh ones; a client whose oldest pending frame is older than
+``max_lag`` seconds is evicted.  Frames are encoded once (see
+``encoding``) and the same object is queued for every client.  Metric
+events go only to clients whose subscription matches (see
+``subscriptions``); windowed subscriptions get per-series summaries from
+a shared flush task instead of raw samples (see ``downsampling``).  Idle
+connections are kept alive by one shared ticker that queues a single
+``heartbeat`` frame per interval for everyone, so a quiet connection costs
+no timers or CPU of its own.
+"""
+
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+from time import monotonic, time
+from typing import Deque, Dict, List, Optional, Set, Tuple, Union
+
+from fastapi import WebSocket
+from prometheus_client import Counter, Gauge, Histogram
+
+from .downsampling import Downsampler
+from .encoding import JSON, MSGPACK, Frame, as_frame, encode_frame, negotiate_subprotocol
+from .ingestion import MetricSample
+from .subscriptions import Subscription, TopicIndex
+
+logger = logging.getLogger(__name__)
+
+# Close code sent to evicted clients ("try again later")
+SLOW_CONSUMER_CLOSE_CODE = 1013
+# How often closed downsampling windows are flushed to their clients
+WINDOW_FLUSH_INTERVAL = 0.05
+
+WEBSOCKET_CONNECTIONS = Gauge(
+    "rtpm_websocket_connections",
+    "Active WebSocket connections",
+)
+WEBSOCKET_SEND_LAG = Histogram(
+    "rtpm_websocket_send_lag_seconds",
+    "Time a frame waits in a connection's queue before it is written",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+WEBSOCKET_MAX_LAG = Gauge(
+    "rtpm_websocket_max_lag_seconds",
+    "Age of the oldest undelivered frame across all connections",
+)
+WEBSOCKET_QUEUED_FRAMES = Gauge(
+    "rtpm_websocket_queued_frames",
+    "Frames waiting in connection queues",
+)
+WEBSOCKET_DROPPED_FRAMES = Counter(
+    "rtpm_websocket_dropped_frames_total",
+    "Frames discarded because a connection queue was full",
+)
+WEBSOCKET_EVICTIONS = Counter(
+    "rtpm_websocket_evictions_total",
+    "Connections closed for falling too far behind",
+)
+
+
+class ClientConnection:
+    """Outbound queue and writer task for one WebSocket"""
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        max_queue_size: int,
+        max_lag: float,
+        encoding: str = JSON,
+    ):
+        self.websocket = websocket
+        self.max_queue_size = max_queue_size
+        self.max_lag = max_lag
+        self.encoding = encoding
+        self.downsampler: Optional[Downsampler] = None
+        self.queue: Deque[Tuple[float, Frame]] = deque()
+        self.sent = 0
+        self.dropped = 0
+        self.connected_at = monotonic()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def lag(self) -> float:
+        """Seconds the oldest undelivered frame has been waiting"""
+        return monotonic() - self.queue[0][0] if self.queue else 0.0
+
+    def start(self, on_done) -> None:
+        self._task = asyncio.create_task(self._run())
+        self._task.add_done_callback(lambda _: on_done(self.websocket))
+
+    def stop(self) -> None:
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    def enqueue(self, message: Frame) -> bool:
+        """Queue a frame; returns False when the client should be evicted"""
+        now = monotonic()
+        if self.queue:
+            if now - self.queue[0][0] > self.max_lag:
+                return False
+            if len(self.queue) >= self.max_queue_size:
+                # Keep the freshest data: a behind client skips old frames
+                self.queue.popleft()
+                self.dropped += 1
+                WEBSOCKET_DROPPED_FRAMES.inc()
+        self.queue.append((now, message))
+        self._wakeup.set()
+        return True
+
+    async def _run(self) -> None:
+        queue = self.queue
+        binary = self.encoding == MSGPACK
+        while True:
+            if not queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            enqueued_at, frame = queue.popleft()
+            try:
+                if binary:
+                    await self.websocket.send_bytes(frame.msgpack)
+                else:
+                    await self.websocket.send_text(frame.text)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.info("WebSocket send failed, dropping client: %s", e)
+                return
+            self.sent += 1
+            WEBSOCKET_SEND_LAG.observe(monotonic() - enqueued_at)
+
+
+class ConnectionManager:
+    def __init__(
+        self,
+        max_queue_size: int = 256,
+        max_lag: float = 10.0,
+        heartbeat_interval: float = 5.0,
+    ):
+        self.max_queue_size = max_queue_size
+        self.max_lag = max_lag
+        # Seconds between shared heartbeat frames; 0 disables them
+        self.heartbeat_interval = heartbeat_interval
+        self.clients: Dict[WebSocket, ClientConnection] = {}
+        self.index = TopicIndex()
+        self._windowed: Dict[WebSocket, ClientConnection] = {}
+        self._window_task: Optional[asyncio.Task] = None
+        self._ticker: Optional[asyncio.Task] = None
+        self._closing: Set[asyncio.Task] = set()
+        WEBSOCKET_MAX_LAG.set_function(self.max_client_lag)
+        WEBSOCKET_QUEUED_FRAMES.set_function(
+            lambda: sum(len(c.queue) for c in list(self.clients.values()))
+        )
+
+    @property
+    def active_connections(self) -> List[WebSocket]:
+        return list(self.clients)
+
+    def max_client_lag(self) -> float:
+        return max((c.lag for c in list(self.clients.values())), default=0.0)
+
+    async def connect(self, websocket: WebSocket):
+        subprotocol = negotiate_subprotocol(websocket.scope.get("subprotocols") or ())
+        await websocket.accept(subprotocol=subprotocol)
+        client = ClientConnection(
+            websocket,
+            self.max_queue_size,
+            self.max_lag,
+            encoding=subprotocol or JSON,
+        )
+        self.clients[websocket] = client
+        self.index.add(websocket, Subscription())
+        client.start(self.disconnect)
+        if self.heartbeat_interval > 0 and (self._ticker is None or self._ticker.done()):
+            self._ticker = asyncio.create_task(self._tick())
+        WEBSOCKET_CONNECTIONS.set(len(self.clients))
+        logger.info(
+            "WebSocket connected. Total connections: %d",
+            len(self.clients),
+        )
+
+    def disconnect(self, websocket: WebSocket):
+        """Forget a connection; safe to call more than once"""
+        client = self.clients.pop(websocket, None)
+        if client is None:
+            return
+        self.index.remove(websocket)
+        self._windowed.pop(websocket, None)
+        client.stop()
+        if not self.clients and self._ticker is not None:
+            self._ticker.cancel()
+            self._ticker = None
+        WEBSOCKET_CONNECTIONS.set(len(self.clients))
+        logger.info(
+            "WebSocket disconnected. Total connections: %d",
+            len(self.clients),
+        )
+
+    async def send_personal_message(self, message: Union[Frame, str], websocket: WebSocket):
+        client = self.clients.get(websocket)
+        if client is not None and not client.enqueue(as_frame(message)):
+            self._evict(client)
+
+    def subscribe(self, websocket: WebSocket, subscription: Subscription) -> None:
+        """Replace a client's subscription"""
+        client = self.clients.get(websocket)
+        if client is None:
+            return
+        self.index.add(websocket, subscription)
+        if subscription.window:
+            client.downsampler = Downsampler(subscription.window)
+            self._windowed[websocket] = client
+            if self._window_task is None or self._window_task.done():
+                self._window_task = asyncio.create_task(self._flush_windows())
+        else:
+            client.downsampler = None
+            self._windowed.pop(websocket, None)
+
+    async def publish_sample(self, sample: MetricSample):
+        """Route one ingested sample to the clients subscribed to its series"""
+        targets = self.index.match(sample.metric_name, sample.labels, series=sample.series_id)
+        if not targets:
+            return
+        frame = None
+        now = None
+        evicted = []
+        for websocket in targets:
+            client = self.clients.get(websocket)
+            if client is None:
+                continue
+            if client.downsampler is not None:
+                if now is None:
+                    now = time()
+                client.downsampler.add(sample, now)
+                continue
+            if frame is None:
+                # Serialized at most once; every raw subscriber shares the frame
+                frame = encode_frame({"type": "metric", "payload": sample.to_dict()})
+            if not client.enqueue(frame):
+                evicted.append(client)
+        for client in evicted:
+            self._evict(client)
+
+    async def broadcast(self, message: Union[Frame, str]):
+        """Queue one shared frame for every client; never waits on a socket"""
+        frame = as_frame(message)
+        evicted = [c for c in list(self.clients.values()) if not c.enqueue(frame)]
+        for client in evicted:
+            self._evict(client)
+
+    async def _tick(self) -> None:
+        """Queue one shared heartbeat frame per interval while anyone is connected"""
+        while self.clients:
+            await asyncio.sleep(self.heartbeat_interval)
+            await self.broadcast(
+                encode_frame(
+                    {
+                        "type": "heartbeat",
+                        "timestamp": datetime.utcnow().isoformat(),
+                        "connections": len(self.clients),
+                    }
+                )
+            )
+
+    async def _flush_windows(self) -> None:
+        while self._windowed:
+            await asyncio.sleep(WINDOW_FLUSH_INTERVAL)
+            now = time()
+            for client in list(self._windowed.values()):
+                for event in client.downsampler.drain(now):
+                    if not client.enqueue(encode_frame(event)):
+                        self._evict(client)
+                        break
+
+    def _evict(self, client: ClientConnection) -> None:
+        WEBSOCKET_EVICTIONS.inc()
+        logger.warning(
+            "Evicting slow WebSocket client (lag %.1fs, %d frames dropped)",
+            client.lag,
+            client.dropped,
+        )
+        self.disconnect(client.websocket)
+        task = asyncio.create_task(self._close(client.websocket))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def _close(self, websocket: WebSocket) -> None:
+        try:
+            await websocket.close(code=SLOW_CONSUMER_CLOSE_CODE)
+        except Exception:
+            pass
@@ -0,0 +1,191 @@
+"""
+TimescaleDB connection handling
+
+Owns the process-wide asyncpg pool.  asyncpg is imported lazily so the
+API can still start (without persistence) where the driver or the
+database is unavailable.
+
+Connections are opened once, between ``min_size`` and ``max_size``, and
+each keeps an LRU cache of prepared statements so the hot ingestion and
+query statements are parsed and planned once per connection rather than
+once per request.  A monitor task probes the pool every
+``health_interval`` seconds, reconnects after the database comes back and
+drives readiness in ``/health``; ``close`` lets in-flight work finish for
+up to ``drain_timeout`` seconds before terminating what is left.
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from prometheus_client import Gauge
+
+logger = logging.getLogger(__name__)
+
+DB_HEALTHY = Gauge(
+    "rtpm_db_healthy",
+    "1 when the last database health probe succeeded",
+)
+DB_POOL_SIZE = Gauge(
+    "rtpm_db_pool_connections",
+    "Open connections in the database pool",
+    ["state"],
+)
+
+ConnectCallback = Callable[[], Awaitable[Any]]
+
+
+def normalize_dsn(url: str) -> str:
+    """Strip SQLAlchemy driver suffixes (``postgresql+asyncpg://``) for asyncpg"""
+    scheme, sep, rest = url.partition("://")
+    if not sep:
+        return url
+    return f"{scheme.split('+', 1)[0]}://{rest}"
+
+
+class Database:
+    """Owns the process-wide asyncpg pool"""
+
+    def __init__(
+        self,
+        dsn: Optional[str],
+        min_size: int = 1,
+        max_size: int = 10,
+        statement_cache_size: int = 1024,
+        command_timeout: Optional[float] = 30.0,
+        health_interval: float = 5.0,
+        drain_timeout: float = 10.0,
+    ):
+        self.dsn = normalize_dsn(dsn) if dsn else None
+        self.min_size = min_size
+        self.max_size = max_size
+        self.statement_cache_size = statement_cache_size
+        self.command_timeout = command_timeout
+        self.health_interval = health_interval
+        self.drain_timeout = drain_timeout
+        self.healthy = False
+        self._pool: Optional[Any] = None
+        self._monitor: Optional[asyncio.Task] = None
+        self._on_connect: List[ConnectCallback] = []
+        DB_HEALTHY.set_function(lambda: 1 if self.healthy else 0)
+        DB_POOL_SIZE.labels("open").set_function(lambda: self._pool_size("get_size"))
+        DB_POOL_SIZE.labels("idle").set_function(lambda: self._pool_size("get_idle_size"))
+
+    @property
+    def configured(self) -> bool:
+        return self.dsn is not None
+
+    @property
+    def connected(self) -> bool:
+        return self._pool is not None
+
+    @property
+    def pool(self) -> Any:
+        if self._pool is None:
+            raise RuntimeError("database pool is not connected")
+        return self._pool
+
+    def _pool_size(self, method: str) -> int:
+        return getattr(self._pool, method)() if self._pool is not None else 0
+
+    def on_connect(self, callback: ConnectCallback) -> None:
+        """Run ``callback`` after every successful (re)connect"""
+        self._on_connect.append(callback)
+
+    async def connect(self) -> bool:
+        """Open the pool; returns False instead of raising when unavailable"""
+        if not self.configured or self.connected:
+            return self.connected
+        try:
+            import asyncpg
+
+            self._pool = await asyncpg.create_pool(
+                self.dsn,
+                min_size=self.min_size,
+                max_size=self.max_size,
+                statement_cache_size=self.statement_cache_size,
+                command_timeout=self.command_timeout,
+            )
+        except Exception as e:
+            logger.warning("Database unavailable, metrics will not be persisted: %s", e)
+            self._pool = None
+        self.healthy = self.connected
+        if self.connected:
+            for callback in self._on_connect:
+                try:
+                    await callback()
+                except Exception as e:
+                    logger.error("Database connect callback failed: %s", e)
+        return self.connected
+
+    async def check(self) -> bool:
+        """Probe the pool with a trivial query; updates ``healthy``"""
+        if self._pool is None:
+            self.healthy = False
+            return False
+        try:
+            async with self._pool.acquire(timeout=self.health_interval) as conn:
+                await conn.fetchval("SELECT 1", timeout=self.health_interval)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if self.healthy:
+                logger.warning("Database health check failed: %s", e)
+            self.healthy = False
+            return False
+        if not self.healthy:
+            logger.info("Database healthy again")
+        self.healthy = True
+        return True
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "configured": self.configured,
+            "connected": self.connected,
+            "healthy": self.healthy,
+            "pool_size": self._pool_size("get_size"),
+            "pool_idle": self._pool_size("get_idle_size"),
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+        }
+
+    @property
+    def ready(self) -> bool:
+        """False only when a database is configured but cannot serve queries"""
+        return not self.configured or self.healthy
+
+    async def start(self) -> None:
+        """Start the health monitor; it also reconnects a pool that never opened"""
+        if not self.configured or self._monitor is not None:
+            return
+        self._monitor = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_interval)
+            if self.connected:
+                await self.check()
+            elif await self.connect():
+                logger.info("Database: Connected")
+
+    async def close(self) -> None:
+        """Stop monitoring and drain the pool, terminating it after ``drain_timeout``"""
+        if self._monitor is not None:
+            task, self._monitor = self._monitor, None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self.healthy = False
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            try:
+                # Waits for acquired connections to be released
+                await asyncio.wait_for(pool.close(), self.drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(
+                    "Database connections still busy after %.0fs, terminating",
+                    self.drain_timeout,
+                )
+                pool.terminate()
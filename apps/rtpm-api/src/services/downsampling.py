@@ -0,0 +1,102 @@
+"""
+Time-window downsampling for live streams
+
+A subscription with a ``window`` no longer receives every raw sample.
+Samples are folded into a fixed-size accumulator per series as they
+arrive (min/max/sum/count/last, constant memory regardless of the sample
+rate) and one summary per series is sent when the window closes.
+Windows are aligned to multiples of the window size in wall-clock time,
+so clients that choose the same window see the same boundaries.
+"""
+
+import math
+from datetime import datetime, timezone
+from typing import Any, Dict, Hashable, List
+
+from .ingestion import MetricSample
+
+
+class WindowAggregate:
+    """Running min/max/avg/last/count for one series in one window"""
+
+    __slots__ = ("sample", "min", "max", "sum", "count", "last")
+
+    def __init__(self, sample: MetricSample):
+        self.sample = sample
+        self.min = self.max = self.sum = self.last = sample.value
+        self.count = 1
+
+    def add(self, sample: MetricSample) -> None:
+        value = sample.value
+        if value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.sum += value
+        self.count += 1
+        self.last = value
+        self.sample = sample
+
+    def to_event(self, start: float, end: float) -> Dict[str, Any]:
+        sample = self.sample
+        window_end = datetime.fromtimestamp(end, timezone.utc).isoformat()
+        return {
+            "type": "metric",
+            "payload": {
+                "name": sample.metric_name,
+                "type": sample.metric_type,
+                "value": self.last,
+                "timestamp": window_end,
+                "labels": sample.labels,
+                "unit": sample.unit,
+                "source": sample.source,
+                "window": {
+                    "start": datetime.fromtimestamp(start, timezone.utc).isoformat(),
+                    "end": window_end,
+                    "min": self.min,
+                    "max": self.max,
+                    "avg": self.sum / self.count,
+                    "last": self.last,
+                    "count": self.count,
+                },
+            },
+        }
+
+
+class Downsampler:
+    """Coalesces one subscription's samples into fixed windows"""
+
+    def __init__(self, window: float):
+        self.window = window
+        self.start = 0.0
+        self.end = 0.0
+        self._series: Dict[Hashable, WindowAggregate] = {}
+        self._ready: List[Dict[str, Any]] = []
+
+    def __len__(self) -> int:
+        return len(self._series)
+
+    def add(self, sample: MetricSample, now: float, key: Hashable = None) -> None:
+        if now >= self.end:
+            self._roll(now)
+        if key is None:
+            key = sample.series_id
+        aggregate = self._series.get(key)
+        if aggregate is None:
+            self._series[key] = WindowAggregate(sample)
+        else:
+            aggregate.add(sample)
+
+    def drain(self, now: float) -> List[Dict[str, Any]]:
+        """Summaries for every window that has closed by ``now``"""
+        if now >= self.end:
+            self._roll(now)
+        ready, self._ready = self._ready, []
+        return ready
+
+    def _roll(self, now: float) -> None:
+        if self._series:
+            self._ready.extend(a.to_event(self.start, self.end) for a in self._series.values())
+            self._series = {}
+        self.start = math.floor(now / self.window) * self.window
+        self.end = self.start + self.window
@@ -0,0 +1,90 @@
+"""
+WebSocket frame encoding
+
+Outbound events are serialized once into a :class:`Frame` and the same
+immutable payload is queued for every subscriber.  JSON goes through
+orjson when it is installed; clients that offer the ``msgpack``
+subprotocol at connect time receive binary MessagePack frames instead,
+encoded lazily and at most once per frame.
+"""
+
+import json
+from typing import Any, Iterable, Optional
+
+from prometheus_client import Counter
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional subprotocol
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+
+FRAMES_ENCODED = Counter(
+    "rtpm_websocket_frames_encoded_total",
+    "Outbound frames serialized, by wire format",
+    ["format"],
+)
+
+
+def dumps(event: Any) -> str:
+    """Serialize an event to JSON text with the fastest available encoder"""
+    if orjson is not None:
+        return orjson.dumps(event, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(event, default=str)
+
+
+class Frame:
+    """An event serialized for the wire; shared by every subscriber"""
+
+    __slots__ = ("event", "_text", "_msgpack")
+
+    def __init__(self, event: Any = None, text: Optional[str] = None):
+        self.event = event
+        self._text = text
+        self._msgpack: Optional[bytes] = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = dumps(self.event)
+            FRAMES_ENCODED.labels(JSON).inc()
+        return self._text
+
+    @property
+    def msgpack(self) -> bytes:
+        if self._msgpack is None:
+            if self.event is None and self._text is not None:
+                # Text produced elsewhere; parse it back once for binary clients
+                self.event = json.loads(self._text)
+            self._msgpack = msgpack.packb(self.event, default=str)
+            FRAMES_ENCODED.labels(MSGPACK).inc()
+        return self._msgpack
+
+
+def encode_frame(event: Any) -> Frame:
+    """Build a frame for an event; JSON is rendered eagerly as most clients need it"""
+    FRAMES_ENCODED.labels(JSON).inc()
+    return Frame(event, text=dumps(event))
+
+
+def as_frame(message: Any) -> Frame:
+    """Accept pre-encoded frames, JSON text or raw events"""
+    if isinstance(message, Frame):
+        return message
+    if isinstance(message, str):
+        return Frame(text=message)
+    return encode_frame(message)
+
+
+def negotiate_subprotocol(offered: Iterable[str]) -> Optional[str]:
+    """Pick the wire format from the client's Sec-WebSocket-Protocol offer"""
+    if msgpack is not None and MSGPACK in offered:
+        return MSGPACK
+    return None
@@ -0,0 +1,117 @@
+"""
+Cached Prometheus exposition
+
+``generate_latest`` walks every collector on each call, so its cost grows
+with the number of metric families and is paid once per scraper.  The
+cache renders each exposition format at most once per ``interval``
+seconds, off the event loop, and hands every scraper the same bytes;
+scrapers that arrive while a render is running wait for it instead of
+starting another.  The gzip body is compressed on first request and then
+shared the same way.
+
+Because rendering runs on a worker thread, ``Gauge.set_function``
+callbacks run there too, while the loop keeps mutating service state.
+Callbacks must not iterate live dicts or sets; they copy them first
+(``list(d.values())`` is a single step under the GIL) or read a length.
+"""
+
+import asyncio
+import gzip
+from time import monotonic
+from typing import Dict, Optional, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest
+from prometheus_client.openmetrics import exposition as openmetrics
+
+TEXT = "text"
+OPENMETRICS = "openmetrics"
+
+CONTENT_TYPES = {
+    TEXT: CONTENT_TYPE_LATEST,
+    OPENMETRICS: openmetrics.CONTENT_TYPE_LATEST,
+}
+_RENDERERS = {
+    TEXT: generate_latest,
+    OPENMETRICS: openmetrics.generate_latest,
+}
+
+
+class Snapshot:
+    """One rendered exposition, shared by every scraper until it expires"""
+
+    __slots__ = ("body", "rendered_at", "_gzipped")
+
+    def __init__(self, body: bytes, rendered_at: float):
+        self.body = body
+        self.rendered_at = rendered_at
+        self._gzipped: Optional[bytes] = None
+
+    @property
+    def gzipped(self) -> bytes:
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body, compresslevel=6)
+        return self._gzipped
+
+
+def negotiate(accept: str) -> str:
+    """Exposition format for an Accept header"""
+    return OPENMETRICS if "application/openmetrics-text" in accept else TEXT
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """Whether an Accept-Encoding header allows gzip (``gzip;q=0`` refuses it)"""
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().lower() != "gzip":
+            continue
+        key, _, quality = params.partition("=")
+        if key.strip().lower() != "q":
+            return True
+        try:
+            return float(quality) > 0
+        except ValueError:
+            return False
+    return False
+
+
+class ExpositionCache:
+    """Renders each format at most once per ``interval`` seconds (0 renders every scrape)"""
+
+    def __init__(self, interval: float = 1.0, registry: CollectorRegistry = REGISTRY):
+        self.interval = interval
+        self.registry = registry
+        self._snapshots: Dict[str, Snapshot] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def _fresh(self, fmt: str) -> Optional[Snapshot]:
+        snapshot = self._snapshots.get(fmt)
+        if snapshot is not None and monotonic() - snapshot.rendered_at < self.interval:
+            return snapshot
+        return None
+
+    async def get(self, fmt: str = TEXT) -> Snapshot:
+        snapshot = self._fresh(fmt)
+        if snapshot is not None:
+            return snapshot
+        lock = self._locks.get(fmt)
+        if lock is None:
+            lock = self._locks[fmt] = asyncio.Lock()
+        async with lock:
+            # Another scraper may have rendered while this one waited
+            snapshot = self._fresh(fmt)
+            if snapshot is None:
+                body = await asyncio.to_thread(_RENDERERS[fmt], self.registry)
+                snapshot = self._snapshots[fmt] = Snapshot(body, monotonic())
+            return snapshot
+
+    async def response(
+        self, accept: str = "", accept_encoding: str = ""
+    ) -> Tuple[bytes, Dict[str, str]]:
+        """Body and headers for a scrape with the given Accept headers"""
+        fmt = negotiate(accept)
+        snapshot = await self.get(fmt)
+        headers = {"Content-Type": CONTENT_TYPES[fmt], "Vary": "Accept, Accept-Encoding"}
+        if accepts_gzip(accept_encoding):
+            headers["Content-Encoding"] = "gzip"
+            return snapshot.gzipped, headers
+        return snapshot.body, headers
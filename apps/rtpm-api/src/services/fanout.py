@@ -0,0 +1,245 @@
+"""
+Cross-replica fan-out over Redis pub/sub
+
+``ConnectionManager`` only reaches clients of its own process.  With
+several workers or machines, each replica publishes the samples it
+ingests to one Redis channel and relays samples published by the other
+replicas to its local WebSocket clients.
+
+Relayed samples only reach the relay callbacks (in the API: local
+WebSocket clients and the hot window).  Everything else that ingestion
+feeds, namely alert rules, agent heartbeats and TimescaleDB writes, runs
+once, on the replica that received the sample over HTTP.  Alert state
+and agent liveness are therefore per replica, and each replica's
+evaluation sees only the series ingested through it.
+
+Publishing never blocks ingestion: samples go into a bounded local
+buffer drained by a background task that packs up to ``batch_size``
+samples into each Redis message.  When Redis cannot keep up the oldest
+buffered samples are dropped (and counted) rather than growing memory.
+redis-py is imported lazily so the API runs without it when ``REDIS_URL``
+is not set.
+"""
+
+import asyncio
+import json
+import logging
+import uuid
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, List, Optional, Sequence
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from .encoding import dumps
+from .ingestion import MetricSample, MetricValidationError, parse_sample
+
+logger = logging.getLogger(__name__)
+
+# Backoff between reconnect attempts of the listener, in seconds
+RECONNECT_DELAYS = (0.5, 1, 2, 5, 10)
+
+FANOUT_SAMPLES = Counter(
+    "rtpm_fanout_samples_total",
+    "Samples sent to or received from other replicas",
+    ["direction"],
+)
+FANOUT_MESSAGES = Counter(
+    "rtpm_fanout_messages_total",
+    "Redis pub/sub messages sent or received",
+    ["direction"],
+)
+FANOUT_DROPPED = Counter(
+    "rtpm_fanout_dropped_total",
+    "Samples discarded because the publish buffer was full",
+)
+FANOUT_ERRORS = Counter(
+    "rtpm_fanout_errors_total",
+    "Redis publish or subscribe failures",
+    ["operation"],
+)
+FANOUT_PENDING = Gauge(
+    "rtpm_fanout_pending_samples",
+    "Samples waiting to be published to Redis",
+)
+FANOUT_PUBLISH_LATENCY = Histogram(
+    "rtpm_fanout_publish_latency_seconds",
+    "Time to publish one batch message to Redis",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+
+RelayCallback = Callable[[List[MetricSample]], Awaitable[None]]
+
+
+def _default_client_factory(url: str) -> Callable[[], Any]:
+    def factory():
+        import redis.asyncio as redis
+
+        return redis.from_url(url)
+
+    return factory
+
+
+async def _close(client: Any) -> None:
+    close = getattr(client, "aclose", None) or getattr(client, "close", None)
+    if close is not None:
+        result = close()
+        if asyncio.iscoroutine(result):
+            await result
+
+
+class RedisFanout:
+    """Publishes local samples and relays samples from other replicas"""
+
+    def __init__(
+        self,
+        redis_url: Optional[str] = None,
+        channel: str = "rtpm:metrics",
+        batch_size: int = 500,
+        max_pending: int = 50000,
+        client_factory: Optional[Callable[[], Any]] = None,
+    ):
+        if client_factory is None and redis_url:
+            client_factory = _default_client_factory(redis_url)
+        self.client_factory = client_factory
+        self.channel = channel
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.replica_id = uuid.uuid4().hex
+        self._relays: List[RelayCallback] = []
+        self._pending: Deque[MetricSample] = deque()
+        self._wakeup = asyncio.Event()
+        self._client: Optional[Any] = None
+        self._tasks: List[asyncio.Task] = []
+        FANOUT_PENDING.set_function(lambda: len(self._pending))
+
+    @property
+    def configured(self) -> bool:
+        return self.client_factory is not None
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    def add_relay(self, callback: RelayCallback) -> None:
+        """Register a callback for samples published by other replicas"""
+        self._relays.append(callback)
+
+    async def start(self) -> bool:
+        """Connect and start publishing; returns False when Redis is unavailable"""
+        if not self.configured or self.running:
+            return self.running
+        try:
+            self._client = self.client_factory()
+            await self._client.ping()
+        except Exception as e:
+            logger.warning("Redis unavailable, broadcasts stay local to this replica: %s", e)
+            if self._client is not None:
+                await _close(self._client)
+            self._client = None
+            return False
+        self._tasks = [
+            asyncio.create_task(self._publish_loop()),
+            asyncio.create_task(self._listen_loop()),
+        ]
+        logger.info("Fan-out on Redis channel %s as replica %s", self.channel, self.replica_id)
+        return True
+
+    async def stop(self) -> None:
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._pending and self._client is not None:
+            # Best effort: hand over what is already buffered
+            try:
+                await self._flush()
+            except Exception as e:
+                logger.warning("Dropping %d unpublished samples: %s", len(self._pending), e)
+        self._pending.clear()
+        if self._client is not None:
+            await _close(self._client)
+            self._client = None
+
+    async def publish(self, batch: Sequence[MetricSample]) -> None:
+        """Ingestion sink: buffer samples for the publisher task"""
+        pending = self._pending
+        pending.extend(batch)
+        overflow = len(pending) - self.max_pending
+        if overflow > 0:
+            for _ in range(overflow):
+                pending.popleft()
+            FANOUT_DROPPED.inc(overflow)
+        self._wakeup.set()
+
+    async def _publish_loop(self) -> None:
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            try:
+                await self._flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # The batch stays buffered; the bound on _pending applies meanwhile
+                FANOUT_ERRORS.labels("publish").inc()
+                logger.warning("Redis publish failed: %s", e)
+                await asyncio.sleep(RECONNECT_DELAYS[0])
+
+    async def _flush(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._pending:
+            count = min(len(self._pending), self.batch_size)
+            batch = [self._pending[i] for i in range(count)]
+            message = dumps({"origin": self.replica_id, "samples": [s.to_dict() for s in batch]})
+            start = loop.time()
+            await self._client.publish(self.channel, message)
+            FANOUT_PUBLISH_LATENCY.observe(loop.time() - start)
+            for _ in range(count):
+                self._pending.popleft()
+            FANOUT_MESSAGES.labels("out").inc()
+            FANOUT_SAMPLES.labels("out").inc(count)
+
+    async def _listen_loop(self) -> None:
+        attempt = 0
+        while True:
+            pubsub = self._client.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                attempt = 0
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message is not None and message.get("type") == "message":
+                        await self._relay(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                FANOUT_ERRORS.labels("subscribe").inc()
+                delay = RECONNECT_DELAYS[min(attempt, len(RECONNECT_DELAYS) - 1)]
+                attempt += 1
+                logger.warning("Redis subscription lost, retrying in %ss: %s", delay, e)
+                await asyncio.sleep(delay)
+            finally:
+                try:
+                    await _close(pubsub)
+                except Exception:
+                    pass
+
+    async def _relay(self, data: Any) -> None:
+        try:
+            envelope = json.loads(data)
+            if envelope.get("origin") == self.replica_id:
+                return
+            samples = [parse_sample(raw) for raw in envelope["samples"]]
+        except (ValueError, KeyError, TypeError, AttributeError, MetricValidationError) as e:
+            FANOUT_ERRORS.labels("decode").inc()
+            logger.warning("Ignoring malformed fan-out message: %s", e)
+            return
+        FANOUT_MESSAGES.labels("in").inc()
+        FANOUT_SAMPLES.labels("in").inc(len(samples))
+        for relay in self._relays:
+            try:
+                await relay(samples)
+            except Exception as e:
+                logger.error("Fan-out relay failed: %s", e)
@@ -0,0 +1,249 @@
+"""
+Agent liveness
+
+Heartbeats only record a timestamp: O(1), no timer is touched.  Each
+live agent has exactly one expiry scheduled on a hierarchical timer
+wheel, and when it fires the tracker compares it with the agent's last
+heartbeat: a stale agent goes offline, a fresh one is re-armed for the
+remaining time.  A tick therefore costs O(expiries due), not O(agents),
+and an agent sending heartbeats every few seconds costs one re-arm per
+``timeout`` rather than one per heartbeat.
+
+The wheel has ``levels`` rings of ``slots`` buckets.  Ring 0 buckets are
+one ``resolution`` tick wide, ring ``n`` buckets ``slots**n`` ticks;
+timers due further out sit in coarser rings and cascade down as time
+advances, so scheduling, cancelling and firing are all O(1) per timer.
+
+Transitions are also turned into ``agent_up`` gauge samples (1 online,
+0 offline) so alert rules such as ``agent_up < 1`` page on lost agents.
+"""
+
+import asyncio
+import logging
+import math
+from datetime import datetime, timedelta, timezone
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+from prometheus_client import Counter, Gauge
+
+from .ingestion import MetricSample
+from .series import REJECTED, registry
+
+logger = logging.getLogger(__name__)
+
+ONLINE = "online"
+OFFLINE = "offline"
+LIVENESS_METRIC = "agent_up"
+
+AGENTS_TRACKED = Gauge(
+    "rtpm_heartbeat_agents",
+    "Agents tracked for liveness, by state",
+    ["state"],
+)
+AGENT_TRANSITIONS = Counter(
+    "rtpm_heartbeat_transitions_total",
+    "Agents going online or offline",
+    ["state"],
+)
+
+# (agent_id, state, seconds since the last heartbeat)
+Transition = Tuple[str, str, float]
+TransitionListener = Callable[[List[Transition]], Awaitable[Any]]
+
+
+def transition_to_dict(transition: Transition, now: datetime) -> Dict[str, Any]:
+    agent_id, state, age = transition
+    return {
+        "agent_id": agent_id,
+        "status": state,
+        "lastSeen": (now - timedelta(seconds=age)).isoformat(),
+    }
+
+
+def liveness_samples(
+    transitions: List[Transition], now: Optional[datetime] = None
+) -> List[MetricSample]:
+    """``agent_up`` samples for the alert engine, one per transition"""
+    now = now or datetime.now(timezone.utc)
+    samples = []
+    for agent_id, state, _ in transitions:
+        labels = {"agent_id": agent_id}
+        series_id = registry.intern(LIVENESS_METRIC, labels)
+        if series_id == REJECTED:
+            continue
+        samples.append(
+            MetricSample(
+                timestamp=now,
+                metric_name=LIVENESS_METRIC,
+                metric_type="gauge",
+                value=1.0 if state == ONLINE else 0.0,
+                labels=labels,
+                source="heartbeat",
+                series_id=series_id,
+            )
+        )
+    return samples
+
+
+class TimerWheel:
+    """Hierarchical timing wheel keyed by hashable timer IDs"""
+
+    def __init__(self, resolution: float = 1.0, slots: int = 64, levels: int = 4, now: float = 0.0):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self._spans = [slots**level for level in range(levels + 1)]
+        self._rings: List[List[Set[Hashable]]] = [
+            [set() for _ in range(slots)] for _ in range(levels)
+        ]
+        # key -> (level, slot, expiry tick)
+        self._timers: Dict[Hashable, Tuple[int, int, int]] = {}
+        self._tick = self._to_tick(now)
+
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._timers
+
+    def _to_tick(self, when: float) -> int:
+        return math.floor(when / self.resolution)
+
+    def _place(self, key: Hashable, expiry: int) -> None:
+        delta = expiry - self._tick
+        for level in range(self.levels):
+            if delta < self._spans[level + 1]:
+                slot = (expiry // self._spans[level]) % self.slots
+                break
+        else:
+            # Beyond the wheel's horizon: park in the last bucket of the top ring
+            level = self.levels - 1
+            slot = ((self._tick // self._spans[level]) - 1) % self.slots
+        self._rings[level][slot].add(key)
+        self._timers[key] = (level, slot, expiry)
+
+    def schedule(self, key: Hashable, when: float) -> None:
+        """Fire ``key`` at ``when`` (rounded up to a tick); replaces any earlier timer"""
+        self.cancel(key)
+        self._place(key, max(math.ceil(when / self.resolution), self._tick + 1))
+
+    def cancel(self, key: Hashable) -> bool:
+        timer = self._timers.pop(key, None)
+        if timer is None:
+            return False
+        level, slot, _ = timer
+        self._rings[level][slot].discard(key)
+        return True
+
+    def advance(self, now: float) -> List[Hashable]:
+        """Move the clock to ``now``; returns the keys that fired, in expiry order"""
+        target = self._to_tick(now)
+        fired: List[Hashable] = []
+        while self._tick < target:
+            if not self._timers:
+                self._tick = target
+                break
+            self._tick += 1
+            # Coarser rings first so timers cascade all the way down in one tick
+            for level in range(self.levels - 1, 0, -1):
+                if self._tick % self._spans[level]:
+                    continue
+                slot = (self._tick // self._spans[level]) % self.slots
+                bucket, self._rings[level][slot] = self._rings[level][slot], set()
+                for key in bucket:
+                    self._place(key, self._timers[key][2])
+            slot = self._tick % self.slots
+            bucket, self._rings[0][slot] = self._rings[0][slot], set()
+            for key in bucket:
+                del self._timers[key]
+            fired.extend(bucket)
+        return fired
+
+
+class HeartbeatTracker:
+    """Marks agents offline ``timeout`` seconds after their last heartbeat"""
+
+    def __init__(
+        self,
+        timeout: float = 30.0,
+        resolution: float = 1.0,
+        clock: Callable[[], float] = monotonic,
+    ):
+        self.timeout = timeout
+        self.clock = clock
+        self.wheel = TimerWheel(resolution=resolution, now=clock())
+        self._last_seen: Dict[str, float] = {}
+        self._offline: Set[str] = set()
+        self._listeners: List[TransitionListener] = []
+        self._pending: List[Transition] = []
+        self._task: Optional[asyncio.Task] = None
+        AGENTS_TRACKED.labels(ONLINE).set_function(lambda: len(self.wheel))
+        AGENTS_TRACKED.labels(OFFLINE).set_function(lambda: len(self._offline))
+
+    def add_listener(self, callback: TransitionListener) -> None:
+        """Register a coroutine receiving each tick's transitions"""
+        self._listeners.append(callback)
+
+    def is_online(self, agent_id: str) -> bool:
+        return agent_id in self.wheel
+
+    def last_seen(self, agent_id: str) -> Optional[float]:
+        return self._last_seen.get(agent_id)
+
+    def heartbeat(self, agent_id: str, now: Optional[float] = None) -> None:
+        """Record a heartbeat; O(1) unless the agent was offline or unknown"""
+        now = self.clock() if now is None else now
+        self._last_seen[agent_id] = now
+        if agent_id in self.wheel:
+            return
+        self.wheel.schedule(agent_id, now + self.timeout)
+        self._offline.discard(agent_id)
+        self._pending.append((agent_id, ONLINE, 0.0))
+        AGENT_TRANSITIONS.labels(ONLINE).inc()
+
+    def forget(self, agent_id: str) -> None:
+        """Stop tracking a deregistered agent, without a transition"""
+        self.wheel.cancel(agent_id)
+        self._last_seen.pop(agent_id, None)
+        self._offline.discard(agent_id)
+
+    def expire(self, now: Optional[float] = None) -> List[Transition]:
+        """Advance the wheel; returns every transition since the last call"""
+        now = self.clock() if now is None else now
+        for agent_id in self.wheel.advance(now):
+            last = self._last_seen[agent_id]
+            if now - last < self.timeout:
+                # Heard from since this timer was armed
+                self.wheel.schedule(agent_id, last + self.timeout)
+                continue
+            self._offline.add(agent_id)
+            self._pending.append((agent_id, OFFLINE, now - last))
+            AGENT_TRANSITIONS.labels(OFFLINE).inc()
+        transitions, self._pending = self._pending, []
+        return transitions
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.wheel.resolution)
+            transitions = self.expire()
+            if not transitions:
+                continue
+            for listener in self._listeners:
+                try:
+                    await listener(transitions)
+                except Exception as e:
+                    logger.error("Heartbeat listener failed: %s", e)
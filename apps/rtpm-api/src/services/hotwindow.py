@@ -0,0 +1,232 @@
+"""
+In-memory hot window
+
+The most recent samples of every series are kept in process so that
+"latest" and "last N minutes" reads never touch the database.  Each
+series owns two ``array('d')`` ring buffers (epoch seconds and values)
+that grow on demand up to ``capacity`` points and then overwrite their
+oldest entry, so memory per series is bounded at ``16 * capacity`` bytes
+and the number of series is capped by ``max_series``.  Buffers are keyed
+by series ID and label selectors are answered by the series registry's
+inverted index.
+"""
+
+import logging
+from array import array
+from datetime import datetime, timezone
+from time import monotonic, time
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+from prometheus_client import Counter, Gauge
+
+from .ingestion import MetricSample
+from .series import SeriesRegistry, registry as default_registry
+
+logger = logging.getLogger(__name__)
+
+# Bytes per stored point: one double for the timestamp, one for the value
+POINT_BYTES = 2 * array("d").itemsize
+# Idle series are dropped at most this often
+PRUNE_INTERVAL = 30.0
+# Epoch seconds datetime can render on every platform: 1970-01-01 to 9999-12-31
+MIN_EPOCH = 0.0
+MAX_EPOCH = 253402300799.0
+
+HOT_WINDOW_SERIES = Gauge(
+    "rtpm_hot_window_series",
+    "Series held in the in-memory hot window",
+)
+HOT_WINDOW_BYTES = Gauge(
+    "rtpm_hot_window_bytes",
+    "Bytes allocated for hot-window point buffers",
+)
+HOT_WINDOW_REJECTED = Counter(
+    "rtpm_hot_window_rejected_series_total",
+    "Samples not kept because the hot window is at max_series",
+)
+
+
+def _isoformat(epoch: float) -> str:
+    # Clamped so a stray point can never turn a read into a 500
+    epoch = min(max(epoch, MIN_EPOCH), MAX_EPOCH)
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat()
+
+
+class SeriesBuffer:
+    """Fixed-capacity ring of (timestamp, value) points for one series"""
+
+    __slots__ = (
+        "metric_name",
+        "labels",
+        "metric_type",
+        "unit",
+        "capacity",
+        "_ts",
+        "_values",
+        "_next",
+    )
+
+    def __init__(self, sample: MetricSample, capacity: int):
+        self.metric_name = sample.metric_name
+        self.labels = sample.labels
+        self.metric_type = sample.metric_type
+        self.unit = sample.unit
+        self.capacity = capacity
+        self._ts = array("d")
+        self._values = array("d")
+        # Oldest point once the ring is full
+        self._next = 0
+
+    def __len__(self) -> int:
+        return len(self._ts)
+
+    @property
+    def nbytes(self) -> int:
+        return len(self._ts) * POINT_BYTES
+
+    def append(self, timestamp: float, value: float) -> bool:
+        """Store a point; returns True when the buffer grew"""
+        if len(self._ts) < self.capacity:
+            self._ts.append(timestamp)
+            self._values.append(value)
+            return True
+        i = self._next
+        self._ts[i] = timestamp
+        self._values[i] = value
+        self._next = (i + 1) % self.capacity
+        return False
+
+    def latest(self) -> Tuple[float, float]:
+        i = (self._next - 1) % len(self._ts)
+        return self._ts[i], self._values[i]
+
+    def points(self, since: float = 0.0) -> Iterator[Tuple[float, float]]:
+        """Points in arrival order with timestamps at or after ``since``"""
+        ts, values, start = self._ts, self._values, self._next
+        for i in range(start, len(ts)):
+            if ts[i] >= since:
+                yield ts[i], values[i]
+        for i in range(start):
+            if ts[i] >= since:
+                yield ts[i], values[i]
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "metric_name": self.metric_name,
+            "labels": self.labels,
+            "unit": self.unit,
+            "type": self.metric_type,
+        }
+
+
+class HotWindow:
+    """Per-series ring buffers fed by the ingestion pipeline"""
+
+    def __init__(
+        self,
+        retention: float = 900.0,
+        capacity: int = 512,
+        max_series: int = 20000,
+        registry: Optional[SeriesRegistry] = None,
+    ):
+        self.retention = retention
+        self.capacity = capacity
+        self.max_series = max_series
+        self.registry = registry or default_registry
+        self._buffers: Dict[int, SeriesBuffer] = {}
+        self._points = 0
+        self._last_prune = monotonic()
+        HOT_WINDOW_SERIES.set_function(lambda: len(self._buffers))
+        HOT_WINDOW_BYTES.set_function(self.nbytes)
+
+    def __len__(self) -> int:
+        return len(self._buffers)
+
+    def nbytes(self) -> int:
+        return self._points * POINT_BYTES
+
+    def add(self, sample: MetricSample) -> None:
+        buffer = self._buffers.get(sample.series_id)
+        if buffer is None:
+            if len(self._buffers) >= self.max_series:
+                HOT_WINDOW_REJECTED.inc()
+                return
+            buffer = self._buffers[sample.series_id] = SeriesBuffer(sample, self.capacity)
+        if buffer.append(sample.timestamp.timestamp(), sample.value):
+            self._points += 1
+
+    async def record(self, batch: Sequence[MetricSample]) -> None:
+        """Ingestion sink"""
+        for sample in batch:
+            self.add(sample)
+        if monotonic() - self._last_prune >= PRUNE_INTERVAL:
+            self.prune()
+
+    def prune(self, now: Optional[float] = None) -> int:
+        """Drop series with no point inside the retention window"""
+        self._last_prune = monotonic()
+        cutoff = (time() if now is None else now) - self.retention
+        idle = [i for i, b in self._buffers.items() if b.latest()[0] < cutoff]
+        for series_id in idle:
+            self._points -= len(self._buffers.pop(series_id))
+        removed = len(idle)
+        if removed:
+            logger.debug("Pruned %d idle series from the hot window", removed)
+        return removed
+
+    def series(
+        self, metric_name: Optional[str] = None, labels: Optional[Dict[str, str]] = None
+    ) -> List[SeriesBuffer]:
+        """Buffers for one metric (or all), filtered by label equality"""
+        if metric_name is None and not labels:
+            return list(self._buffers.values())
+        ids: Set[int] = self.registry.select(metric_name, labels)
+        buffers = self._buffers
+        if len(ids) > len(buffers):
+            return [b for i, b in buffers.items() if i in ids]
+        return [buffers[i] for i in ids if i in buffers]
+
+    def latest(
+        self, metric_name: Optional[str] = None, labels: Optional[Dict[str, str]] = None
+    ) -> List[Dict[str, Any]]:
+        """Most recent point of each matching series, newest first"""
+        points = []
+        for buffer in self.series(metric_name, labels):
+            timestamp, value = buffer.latest()
+            points.append((timestamp, value, buffer))
+        points.sort(key=lambda p: p[0], reverse=True)
+        return [
+            {**buffer.describe(), "value": value, "timestamp": _isoformat(timestamp)}
+            for timestamp, value, buffer in points
+        ]
+
+    def window(
+        self,
+        metric_name: Optional[str] = None,
+        labels: Optional[Dict[str, str]] = None,
+        seconds: Optional[float] = None,
+        now: Optional[float] = None,
+    ) -> List[Dict[str, Any]]:
+        """Points of each matching series from the last ``seconds``"""
+        span = self.retention if seconds is None else min(seconds, self.retention)
+        since = (time() if now is None else now) - span
+        result = []
+        for buffer in self.series(metric_name, labels):
+            data_points = [
+                {"timestamp": _isoformat(ts), "value": value} for ts, value in buffer.points(since)
+            ]
+            if data_points:
+                result.append({**buffer.describe(), "data_points": data_points})
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        nbytes = self.nbytes()
+        series = len(self._buffers)
+        return {
+            "series": series,
+            "metrics": len({b.metric_name for b in self._buffers.values()}),
+            "bytes": nbytes,
+            "bytes_per_series": nbytes / series if series else 0,
+            "capacity": self.capacity,
+            "retention_seconds": self.retention,
+        }
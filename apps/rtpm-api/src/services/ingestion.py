@@ -0,0 +1,420 @@
+"""
+Metric ingestion pipeline
+
+Payloads accepted by the ingestion endpoints are validated against the
+shape of the ``metrics`` table (see ``init.sql``), placed on a bounded
+asyncio queue and handed to the registered sinks in batches.  A batch is
+flushed when ``batch_size`` samples are buffered or ``flush_interval``
+seconds after its first sample arrived, whichever comes first.
+
+Parsing only validates; ``intern_samples`` assigns series IDs once a
+request has been accepted, so a refused request never registers series.
+"""
+
+import asyncio
+import logging
+import math
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from .series import REJECTED, registry
+
+logger = logging.getLogger(__name__)
+
+METRIC_TYPES = ("gauge", "counter", "histogram", "summary")
+MAX_NAME_LENGTH = 255
+MAX_LABELS = 32
+MAX_LABEL_LENGTH = 255
+MAX_TEXT_LENGTH = 1024
+MAX_BATCH_SAMPLES = 10000
+# Accepted sample times: not before the epoch, at most a day of clock skew ahead
+MIN_TIMESTAMP = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MAX_FUTURE_SKEW = timedelta(days=1)
+
+# Agent snapshots ({"agentId": ..., "cpu": ..., ...}) are expanded into one
+# sample per numeric field; these keys are identity, not measurements.
+AGENT_IDENTITY_FIELDS = ("agentId", "timestamp")
+
+INGEST_SAMPLES = Counter(
+    "rtpm_ingest_samples_total",
+    "Metric samples seen by the ingestion pipeline",
+    ["status"],
+)
+INGEST_QUEUE_DEPTH = Gauge(
+    "rtpm_ingest_queue_depth",
+    "Samples waiting in the ingestion queue",
+)
+INGEST_BATCH_SIZE = Histogram(
+    "rtpm_ingest_batch_size",
+    "Samples per flushed ingestion batch",
+    buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000),
+)
+INGEST_FLUSH_LATENCY = Histogram(
+    "rtpm_ingest_flush_latency_seconds",
+    "Time spent delivering one batch to all sinks",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+INGEST_SINK_ERRORS = Counter(
+    "rtpm_ingest_sink_errors_total",
+    "Batches a sink failed to process",
+    ["sink"],
+)
+
+
+class MetricValidationError(ValueError):
+    """Raised when a payload does not match the metrics table shape"""
+
+
+class IngestionQueueFull(Exception):
+    """Raised when the ingestion queue cannot take the whole submission"""
+
+
+@dataclass(slots=True)
+class MetricSample:
+    """One row of the ``metrics`` table"""
+
+    timestamp: datetime
+    metric_name: str
+    metric_type: str
+    value: float
+    labels: Dict[str, str] = field(default_factory=dict)
+    help_text: str = ""
+    unit: str = ""
+    source: str = "api"
+    # Interned (metric_name, labels) from intern_samples; series.REJECTED until
+    # then or when over a cardinality limit
+    series_id: int = REJECTED
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Wire representation used for WebSocket payloads"""
+        return {
+            "name": self.metric_name,
+            "type": self.metric_type,
+            "value": self.value,
+            "timestamp": self.timestamp.isoformat(),
+            "labels": self.labels,
+            "unit": self.unit,
+            "source": self.source,
+        }
+
+
+def parse_timestamp(raw: Any) -> datetime:
+    """ISO-8601 text or epoch seconds/milliseconds as an aware datetime; None is now
+
+    Times before ``MIN_TIMESTAMP`` or more than ``MAX_FUTURE_SKEW`` ahead are
+    refused.
+    """
+    parsed = _parse_timestamp(raw)
+    if parsed < MIN_TIMESTAMP or parsed > datetime.now(timezone.utc) + MAX_FUTURE_SKEW:
+        raise MetricValidationError(f"timestamp out of range: {str(raw)[:64]!r}")
+    return parsed
+
+
+def _parse_timestamp(raw: Any) -> datetime:
+    if raw is None:
+        return datetime.now(timezone.utc)
+    if isinstance(raw, bool):
+        raise MetricValidationError("timestamp must be an ISO-8601 string or epoch seconds")
+    if isinstance(raw, (int, float)):
+        if not math.isfinite(raw):
+            raise MetricValidationError("timestamp must be finite")
+        # Accept epoch milliseconds as sent by browser agents
+        seconds = raw / 1000.0 if raw > 1e11 else float(raw)
+        try:
+            return datetime.fromtimestamp(seconds, tz=timezone.utc)
+        except (OverflowError, OSError, ValueError) as e:
+            raise MetricValidationError(f"timestamp out of range: {raw!r}") from e
+    if isinstance(raw, str):
+        text = raw.strip()
+        if text.endswith("Z"):
+            text = text[:-1] + "+00:00"
+        try:
+            parsed = datetime.fromisoformat(text)
+        except ValueError as e:
+            raise MetricValidationError(f"invalid timestamp: {raw[:64]!r}") from e
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)
+        return parsed
+    raise MetricValidationError("timestamp must be an ISO-8601 string or epoch seconds")
+
+
+def _parse_value(raw: Any) -> float:
+    if isinstance(raw, bool) or not isinstance(raw, (int, float)):
+        raise MetricValidationError("value must be a number")
+    value = float(raw)
+    if not math.isfinite(value):
+        raise MetricValidationError("value must be finite")
+    return value
+
+
+def _parse_text(data: Dict[str, Any], key: str, default: str) -> str:
+    raw = data.get(key, default)
+    if raw is None:
+        return default
+    if not isinstance(raw, str):
+        raise MetricValidationError(f"{key} must be a string")
+    if len(raw) > MAX_TEXT_LENGTH:
+        raise MetricValidationError(f"{key} exceeds {MAX_TEXT_LENGTH} characters")
+    return raw
+
+
+def _parse_labels(raw: Any) -> Dict[str, str]:
+    if raw is None:
+        return {}
+    if not isinstance(raw, dict):
+        raise MetricValidationError("labels must be an object")
+    if len(raw) > MAX_LABELS:
+        raise MetricValidationError(f"at most {MAX_LABELS} labels are allowed")
+    labels = {}
+    for key, value in raw.items():
+        if isinstance(value, (dict, list)) or value is None:
+            raise MetricValidationError(f"label {key!r} must be a scalar")
+        text = value if isinstance(value, str) else str(value)
+        if len(key) > MAX_LABEL_LENGTH or len(text) > MAX_LABEL_LENGTH:
+            raise MetricValidationError(f"label {key!r} exceeds {MAX_LABEL_LENGTH} characters")
+        labels[key] = text
+    return labels
+
+
+def _parse_name(raw: Any) -> str:
+    if not isinstance(raw, str) or not raw:
+        raise MetricValidationError("metric name is required")
+    if len(raw) > MAX_NAME_LENGTH:
+        raise MetricValidationError(f"metric name exceeds {MAX_NAME_LENGTH} characters")
+    return raw
+
+
+def parse_sample(data: Any) -> MetricSample:
+    """Validate a single metric object.
+
+    Both the API field names (``name``/``type``) and the column names
+    (``metric_name``/``metric_type``) are accepted.
+    """
+    if not isinstance(data, dict):
+        raise MetricValidationError("metric must be an object")
+    name = _parse_name(data.get("name", data.get("metric_name")))
+    metric_type = data.get("type", data.get("metric_type")) or "gauge"
+    if metric_type not in METRIC_TYPES:
+        raise MetricValidationError(f"type must be one of {', '.join(METRIC_TYPES)}")
+    if "value" not in data:
+        raise MetricValidationError("value is required")
+    timestamp = parse_timestamp(data.get("timestamp"))
+    value = _parse_value(data["value"])
+    labels = _parse_labels(data.get("labels"))
+    help_text = _parse_text(data, "help_text", "")
+    unit = _parse_text(data, "unit", "")
+    source = _parse_text(data, "source", "api")
+    return MetricSample(
+        timestamp=timestamp,
+        metric_name=name,
+        metric_type=metric_type,
+        value=value,
+        labels=labels,
+        help_text=help_text,
+        unit=unit,
+        source=source,
+    )
+
+
+def _expand_agent_snapshot(data: Dict[str, Any]) -> List[MetricSample]:
+    agent_id = data["agentId"]
+    if not isinstance(agent_id, str) or not agent_id:
+        raise MetricValidationError("agentId must be a non-empty string")
+    timestamp = parse_timestamp(data.get("timestamp"))
+    labels = {"agent_id": agent_id}
+    samples = []
+    for key, raw in data.items():
+        if key in AGENT_IDENTITY_FIELDS or isinstance(raw, bool):
+            continue
+        if isinstance(raw, (int, float)):
+            name = _parse_name(key)
+            samples.append(
+                MetricSample(
+                    timestamp=timestamp,
+                    metric_name=name,
+                    metric_type="gauge",
+                    value=_parse_value(raw),
+                    labels=labels,
+                    source="agent",
+                )
+            )
+    if not samples:
+        raise MetricValidationError("agent snapshot contains no numeric fields")
+    return samples
+
+
+def parse_payload(data: Any) -> List[MetricSample]:
+    """Turn a request body into metric samples.
+
+    Accepted shapes:
+
+    * a single metric object (``{"name": ..., "value": ...}``)
+    * a batch (``{"metrics": [...]}``) or a bare list of metric objects
+    * an agent snapshot (``{"agentId": ..., "cpu": ..., ...}``), expanded
+      into one gauge per numeric field labelled with ``agent_id``
+    """
+    if isinstance(data, dict) and "metrics" in data:
+        data = data["metrics"]
+    if isinstance(data, list):
+        if not data:
+            raise MetricValidationError("metrics batch is empty")
+        if len(data) > MAX_BATCH_SAMPLES:
+            raise MetricValidationError(f"at most {MAX_BATCH_SAMPLES} metrics per request")
+        samples = []
+        for index, item in enumerate(data):
+            try:
+                samples.append(parse_sample(item))
+            except MetricValidationError as e:
+                raise MetricValidationError(f"metrics[{index}]: {e}") from e
+        return samples
+    if isinstance(data, dict) and "agentId" in data and "value" not in data:
+        return _expand_agent_snapshot(data)
+    return [parse_sample(data)]
+
+
+def intern_samples(
+    samples: List[MetricSample], tenant: Optional[str] = None
+) -> List[MetricSample]:
+    """Assign series IDs; returns the samples not refused by a cardinality limit
+
+    New series count against ``tenant``, the API key the request was
+    accepted under; relayed samples were already counted where they arrived.
+    """
+    registry.evict_idle_if_due()
+    accepted = []
+    for sample in samples:
+        sample.series_id = registry.intern(sample.metric_name, sample.labels, tenant)
+        if sample.series_id != REJECTED:
+            accepted.append(sample)
+    return accepted
+
+
+BatchSink = Callable[[List[MetricSample]], Awaitable[None]]
+
+
+class IngestionPipeline:
+    """Bounded queue plus a single background batcher task"""
+
+    def __init__(
+        self,
+        max_queue_size: int = 50000,
+        batch_size: int = 1000,
+        flush_interval: float = 0.25,
+    ):
+        self.max_queue_size = max_queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._sinks: List[tuple] = []
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        # Batch under assembly and batch being flushed, kept so stop() loses nothing
+        self._pending: List[MetricSample] = []
+        self._inflight: Optional[asyncio.Future] = None
+
+    def add_sink(self, sink: BatchSink, name: Optional[str] = None) -> None:
+        """Register a coroutine that receives every flushed batch; names are unique"""
+        name = name or getattr(sink, "__name__", "sink")
+        self.remove_sink(name)
+        self._sinks.append((name, sink))
+
+    def remove_sink(self, name: str) -> None:
+        self._sinks = [(n, s) for n, s in self._sinks if n != name]
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def start(self) -> None:
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        INGEST_QUEUE_DEPTH.set_function(lambda: self.queue_depth)
+        self._task = asyncio.create_task(self._run(), name="rtpm-ingest-batcher")
+
+    async def stop(self) -> None:
+        """Stop the batcher and flush whatever is still queued"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._inflight is not None:
+            await self._inflight
+            self._inflight = None
+        if self._queue is not None:
+            remaining, self._pending = self._pending, []
+            while not self._queue.empty():
+                remaining.append(self._queue.get_nowait())
+            for start in range(0, len(remaining), self.batch_size):
+                await self._flush(remaining[start : start + self.batch_size])
+
+    def has_room(self, count: int) -> bool:
+        """Whether submit() would take ``count`` more samples right now"""
+        return self.running and self._queue.qsize() + count <= self.max_queue_size
+
+    def submit(self, samples: List[MetricSample]) -> None:
+        """Enqueue samples without waiting; all or nothing."""
+        if not self.running:
+            raise IngestionQueueFull("ingestion pipeline is not running")
+        if self._queue.qsize() + len(samples) > self.max_queue_size:
+            INGEST_SAMPLES.labels("rejected").inc(len(samples))
+            raise IngestionQueueFull("ingestion queue is full")
+        for sample in samples:
+            self._queue.put_nowait(sample)
+        INGEST_SAMPLES.labels("accepted").inc(len(samples))
+
+    async def _fill_batch(self) -> None:
+        loop = asyncio.get_running_loop()
+        batch = self._pending
+        batch.append(await self._queue.get())
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            # Drain whatever is already buffered before waiting on the clock
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            if len(batch) >= self.batch_size:
+                break
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+    async def _run(self) -> None:
+        while True:
+            await self._fill_batch()
+            batch, self._pending = self._pending, []
+            # Shielded so a shutdown cancel never interrupts a half-delivered batch
+            self._inflight = asyncio.ensure_future(self._flush(batch))
+            await asyncio.shield(self._inflight)
+            self._inflight = None
+
+    async def _deliver(self, name: str, sink: BatchSink, batch: List[MetricSample]) -> None:
+        try:
+            await sink(batch)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            INGEST_SINK_ERRORS.labels(name).inc()
+            logger.error("Ingestion sink %s failed for %d samples: %s", name, len(batch), e)
+
+    async def _flush(self, batch: List[MetricSample]) -> None:
+        if not batch:
+            return
+        INGEST_BATCH_SIZE.observe(len(batch))
+        start = perf_counter()
+        # Sinks run side by side so a slow database write never delays the fan-out
+        await asyncio.gather(*(self._deliver(name, sink, batch) for name, sink in self._sinks))
+        INGEST_FLUSH_LATENCY.observe(perf_counter() - start)
@@ -0,0 +1,130 @@
+"""
+Live request latency percentiles
+
+Prometheus histograms answer quantiles only as coarse bucket
+interpolations over a scrape range.  For ``/debug/latency`` every route
+also feeds a log-bucketed sketch in the style of HdrHistogram: bucket
+``i`` covers ``(gamma**(i-1), gamma**i]``, so any quantile is reported
+within ``precision`` relative error using a few hundred integer counters
+per route, and recording a value is O(1).
+
+Sketches are kept for the current and the previous window and merged on
+read, so the percentiles always describe the last one to two windows of
+traffic.
+"""
+
+import math
+from time import monotonic
+from typing import Any, Dict, List, Optional, Tuple
+
+RouteKey = Tuple[str, str]
+
+
+class LatencySketch:
+    """Log-bucketed histogram with bounded relative error"""
+
+    __slots__ = ("precision", "_gamma", "_log_gamma", "_counts", "count", "total", "max")
+
+    def __init__(self, precision: float = 0.01):
+        self.precision = precision
+        self._gamma = (1 + precision) / (1 - precision)
+        self._log_gamma = math.log(self._gamma)
+        self._counts: Dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value: float) -> None:
+        # Anything under a nanosecond shares the lowest bucket
+        index = math.ceil(math.log(max(value, 1e-9)) / self._log_gamma)
+        self._counts[index] = self._counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other: "LatencySketch") -> None:
+        for index, count in other._counts.items():
+            self._counts[index] = self._counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def quantiles(self, qs: List[float]) -> List[float]:
+        """Values at each quantile in ``qs`` (ascending), 0.0 when empty"""
+        if not self.count:
+            return [0.0] * len(qs)
+        results = []
+        seen = 0
+        indexes = iter(sorted(self._counts))
+        index = None
+        for q in qs:
+            rank = q * (self.count - 1)
+            while index is None or seen <= rank:
+                index = next(indexes, None)
+                if index is None:
+                    break
+                seen += self._counts[index]
+            if index is None:
+                results.append(self.max)
+                continue
+            # Midpoint of the bucket, in relative terms
+            value = 2 * self._gamma**index / (self._gamma + 1)
+            results.append(min(value, self.max))
+        return results
+
+
+class LatencyTracker:
+    """Rolling per-route latency sketches"""
+
+    def __init__(self, window: float = 60.0, precision: float = 0.01):
+        self.window = window
+        self.precision = precision
+        self._current: Dict[RouteKey, LatencySketch] = {}
+        self._previous: Dict[RouteKey, LatencySketch] = {}
+        self._started = monotonic()
+
+    def _rotate(self, now: float) -> None:
+        if now - self._started < self.window:
+            return
+        # A window with no traffic leaves nothing worth keeping
+        self._previous = self._current if now - self._started < 2 * self.window else {}
+        self._current = {}
+        self._started = now
+
+    def record(self, method: str, route: str, seconds: float, now: Optional[float] = None) -> None:
+        self._rotate(monotonic() if now is None else now)
+        key = (method, route)
+        sketch = self._current.get(key)
+        if sketch is None:
+            sketch = self._current[key] = LatencySketch(self.precision)
+        sketch.record(seconds)
+
+    def snapshot(self, now: Optional[float] = None) -> List[Dict[str, Any]]:
+        """p50/p95/p99 per route in milliseconds, slowest p99 first"""
+        self._rotate(monotonic() if now is None else now)
+        merged: Dict[RouteKey, LatencySketch] = {}
+        for sketches in (self._previous, self._current):
+            for key, sketch in sketches.items():
+                target = merged.get(key)
+                if target is None:
+                    target = merged[key] = LatencySketch(self.precision)
+                target.merge(sketch)
+
+        routes = []
+        for (method, route), sketch in merged.items():
+            p50, p95, p99 = sketch.quantiles([0.5, 0.95, 0.99])
+            routes.append(
+                {
+                    "method": method,
+                    "route": route,
+                    "count": sketch.count,
+                    "mean_ms": round(sketch.total / sketch.count * 1000, 3),
+                    "p50_ms": round(p50 * 1000, 3),
+                    "p95_ms": round(p95 * 1000, 3),
+                    "p99_ms": round(p99 * 1000, 3),
+                    "max_ms": round(sketch.max * 1000, 3),
+                }
+            )
+        routes.sort(key=lambda r: r["p99_ms"], reverse=True)
+        return routes
@@ -0,0 +1,108 @@
+"""
+Ingestion limits
+
+Two guards keep one misbehaving client from exhausting the process or
+the ``metrics`` label index:
+
+* cardinality limits on new series in total, per metric and per tenant,
+  enforced by the series registry when a sample is interned
+* a token bucket per tenant that meters ingested samples per second
+
+A tenant is a configured API key or, for any other client, its address.
+
+Buckets refill lazily from the elapsed time when they are charged, so a
+check costs O(1) whatever the batch size, and idle tenants are evicted
+least-recently-used once ``max_tenants`` buckets exist.
+"""
+
+import math
+from collections import OrderedDict
+from time import monotonic
+from typing import Optional, Tuple
+
+from prometheus_client import Counter, Gauge
+
+# Rejection reasons, used as the Prometheus label
+RATE = "rate"
+SERIES_PER_METRIC = "series_per_metric"
+SERIES_PER_TENANT = "series_per_tenant"
+SERIES_TOTAL = "series_total"
+
+LIMIT_REJECTED_SAMPLES = Counter(
+    "rtpm_limit_rejected_samples_total",
+    "Samples refused by an ingestion limit",
+    ["reason"],
+)
+LIMIT_REJECTED_REQUESTS = Counter(
+    "rtpm_limit_rejected_requests_total",
+    "Ingestion requests refused because the API key exceeded its rate",
+)
+QUOTA_TENANTS = Gauge(
+    "rtpm_quota_tenants",
+    "API keys with a live ingestion token bucket",
+)
+
+
+class TokenBucket:
+    """``rate`` tokens per second, holding at most ``burst``"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, count: float, now: float) -> float:
+        """Spend ``count`` tokens; returns 0 or the seconds until they are available"""
+        tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if tokens >= count:
+            self.tokens = tokens - count
+            return 0.0
+        self.tokens = tokens
+        if count > self.burst:
+            # Can never be satisfied in one piece
+            return math.inf
+        return (count - tokens) / self.rate
+
+
+class TenantQuotas:
+    """Per-tenant sample rate limits"""
+
+    def __init__(self, rate: float, burst: Optional[float] = None, max_tenants: int = 10000):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.max_tenants = max_tenants
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        QUOTA_TENANTS.set_function(lambda: len(self._buckets))
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def take(self, tenant: str, count: int, now: Optional[float] = None) -> Tuple[bool, float]:
+        """Charge ``count`` samples to ``tenant``; returns (allowed, retry_after seconds)"""
+        if not self.enabled:
+            return True, 0.0
+        now = monotonic() if now is None else now
+        bucket = self._buckets.get(tenant)
+        if bucket is None:
+            bucket = self._buckets[tenant] = TokenBucket(self.rate, self.burst, now)
+            if len(self._buckets) > self.max_tenants:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(tenant)
+        wait = bucket.take(count, now)
+        if wait:
+            LIMIT_REJECTED_REQUESTS.inc()
+            LIMIT_REJECTED_SAMPLES.labels(RATE).inc(count)
+            return False, wait
+        return True, 0.0
+
+    def refund(self, tenant: str, count: int) -> None:
+        """Give back samples charged to a request that was refused later"""
+        bucket = self._buckets.get(tenant)
+        if bucket is not None:
+            bucket.tokens = min(bucket.burst, bucket.tokens + count)
@@ -0,0 +1,140 @@
+"""
+HTTP middleware
+
+A single pure ASGI middleware records request metrics and adds the
+security headers.  Unlike ``BaseHTTPMiddleware`` it does not wrap the
+response in a stream or spawn a task per request: it only intercepts the
+``http.response.start`` message on its way out.
+
+Requests are labelled with the route template that matched (for example
+``/api/v1/alerts/rules/{rule_id}``), never the raw path, so the label set
+is bounded by the number of routes.  With exemplars enabled each latency
+observation carries the request's ``X-Request-ID`` (generated when the
+client sent none, and echoed in the response) so a slow bucket in an
+OpenMetrics scrape links back to a concrete request.
+"""
+
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+from uuid import uuid4
+
+from prometheus_client import Counter, Histogram
+
+from .latency import LatencyTracker
+
+# Label for requests no route matched (404s, probes for random paths)
+UNMATCHED = "<unmatched>"
+
+REQUEST_COUNT = Counter(
+    "rtpm_request_total",
+    "Total HTTP requests",
+    ["method", "endpoint", "status"],
+)
+REQUEST_LATENCY = Histogram(
+    "rtpm_request_latency_seconds",
+    "Request latency",
+    ["method", "endpoint"],
+    # Cached reads answer in well under a millisecond; ingestion and queries take longer
+    buckets=(
+        0.0001,
+        0.00025,
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+        5,
+        10,
+    ),
+)
+
+SECURITY_HEADERS: Tuple[Tuple[str, str], ...] = (
+    ("Strict-Transport-Security", "max-age=31536000; includeSubDomains"),
+    ("X-Content-Type-Options", "nosniff"),
+    ("X-Frame-Options", "DENY"),
+    ("Referrer-Policy", "strict-origin-when-cross-origin"),
+    ("Permissions-Policy", "geolocation=(), microphone=(), camera=()"),
+)
+
+REQUEST_ID_HEADER = b"x-request-id"
+
+
+def route_template(scope: Dict[str, Any]) -> str:
+    """Path template of the route the router matched, if any"""
+    route = scope.get("route")
+    if route is None:
+        return UNMATCHED
+    return getattr(route, "path_format", None) or getattr(route, "path", UNMATCHED)
+
+
+class HTTPMiddleware:
+    """Request metrics and security headers as one pure ASGI middleware"""
+
+    def __init__(
+        self,
+        app: Callable,
+        headers: Iterable[Tuple[str, str]] = SECURITY_HEADERS,
+        latency: Optional[LatencyTracker] = None,
+        exemplars: bool = False,
+    ):
+        self.app = app
+        self.latency = latency
+        self.exemplars = exemplars
+        # Encoded once; appended to each response that does not set them itself
+        self.headers = [
+            (name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers
+        ]
+
+    def _add_headers(self, message: Dict[str, Any], request_id: Optional[bytes]) -> None:
+        headers = list(message.get("headers", ()))
+        present = {name.lower() for name, _ in headers}
+        headers.extend(h for h in self.headers if h[0] not in present)
+        if request_id is not None and REQUEST_ID_HEADER not in present:
+            headers.append((REQUEST_ID_HEADER, request_id))
+        message["headers"] = headers
+
+    @staticmethod
+    def _request_id(scope: Dict[str, Any]) -> bytes:
+        for name, value in scope["headers"]:
+            if name == REQUEST_ID_HEADER:
+                # Exemplar labels are limited to 128 characters in total
+                return value[:64]
+        return uuid4().hex.encode("ascii")
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = perf_counter()
+        status = 500
+        request_id = self._request_id(scope) if self.exemplars else None
+
+        async def send_wrapper(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                self._add_headers(message, request_id)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router records the matched route in the shared scope
+            elapsed = perf_counter() - start
+            endpoint = route_template(scope)
+            method = scope["method"]
+            exemplar = None
+            if request_id is not None:
+                exemplar = {"request_id": request_id.decode("latin-1")}
+            REQUEST_LATENCY.labels(method, endpoint).observe(elapsed, exemplar)
+            REQUEST_COUNT.labels(method, endpoint, str(status)).inc()
+            if self.latency is not None:
+                self.latency.record(method, endpoint, elapsed)
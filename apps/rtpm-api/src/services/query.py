@@ -0,0 +1,545 @@
+"""
+Metric queries
+
+Range queries are turned into a single ``time_bucket`` statement so that
+TimescaleDB does the bucketing and aggregation, and only one row per
+series per step crosses the wire.  The planner answers each query from
+the coarsest tier whose buckets nest inside the requested step: the
+daily, hourly or 5-minute continuous aggregates from ``init.sql``, or the
+raw ``metrics`` hypertable.  Rollups are materialized-only and lag behind
+``now``, so the tail after each rollup's watermark is read from raw rows
+in the same statement.  Watermarks are read from TimescaleDB
+(``cagg_watermark``) and cached for ``watermark_ttl`` seconds, so a
+stalled refresh job means more raw rows, never a gap; without them the
+planner assumes the lag of the refresh policies in ``init.sql``.
+Whole-range aggregates need exact edges, so a range that starts or ends
+inside a rollup bucket reads those partial buckets from raw rows the same
+way (a raw head and tail around the rollup).
+
+Storage failures (no pool, a dropped connection, a timeout or any asyncpg
+error) raise ``QueryUnavailable`` so the API answers 503, not 500.
+"""
+
+import asyncio
+import json
+import logging
+import re
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from time import monotonic, perf_counter
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from prometheus_client import Histogram
+
+from .database import Database
+from .ingestion import parse_timestamp
+from .subscriptions import parse_label_selectors
+
+logger = logging.getLogger(__name__)
+
+AGGREGATIONS = ("avg", "min", "max", "sum", "count", "last")
+DEFAULT_RANGE = timedelta(hours=1)
+# Point budget per series when the client does not pick a step
+DEFAULT_POINTS = 300
+MAX_POINTS = 11000
+MIN_STEP = timedelta(seconds=1)
+NICE_STEPS = tuple(
+    timedelta(seconds=s)
+    for s in (1, 5, 10, 15, 30, 60, 300, 600, 900, 1800, 3600, 10800, 21600, 43200, 86400, 604800)
+)
+
+_DURATION = re.compile(r"^(\d+(?:\.\d+)?)(ms|s|m|h|d|w)?$")
+_UNIT_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+QUERY_LATENCY = Histogram(
+    "rtpm_query_latency_seconds",
+    "Time to run one metric query against TimescaleDB",
+    ["source"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+
+class QueryError(ValueError):
+    """Raised when a query cannot be planned"""
+
+
+class QueryUnavailable(Exception):
+    """Raised when there is no database to answer a query"""
+
+
+def parse_duration(raw: Any) -> timedelta:
+    """``"5m"``, ``"1h"``, ``"30s"`` or a number of seconds"""
+    if isinstance(raw, bool):
+        raise QueryError("duration must be a string like 5m or a number of seconds")
+    if isinstance(raw, (int, float)):
+        seconds = float(raw)
+    elif isinstance(raw, str):
+        match = _DURATION.match(raw.strip())
+        if match is None:
+            raise QueryError(f"invalid duration: {raw[:32]!r}")
+        seconds = float(match.group(1)) * _UNIT_SECONDS[match.group(2) or "s"]
+    else:
+        raise QueryError("duration must be a string like 5m or a number of seconds")
+    if seconds <= 0:
+        raise QueryError("duration must be positive")
+    return timedelta(seconds=seconds)
+
+
+def format_duration(value: timedelta) -> str:
+    seconds = value.total_seconds()
+    for unit in ("w", "d", "h", "m", "s"):
+        size = _UNIT_SECONDS[unit]
+        if seconds >= size and seconds % size == 0:
+            return f"{int(seconds // size)}{unit}"
+    return f"{seconds:g}s"
+
+
+@dataclass
+class MetricQuery:
+    """A validated request for one metric over a time range"""
+
+    metric_name: str
+    start: datetime
+    end: datetime
+    step: timedelta
+    aggregation: str = "avg"
+    labels: Dict[str, str] = field(default_factory=dict)
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "metric_name": self.metric_name,
+            "start_time": self.start.isoformat(),
+            "end_time": self.end.isoformat(),
+            "step": format_duration(self.step),
+            "aggregation": self.aggregation,
+            "labels": self.labels,
+        }
+
+
+def default_step(span: timedelta, points: int = DEFAULT_POINTS) -> timedelta:
+    """Smallest round step that keeps ``span`` within ``points`` buckets"""
+    for step in NICE_STEPS:
+        if span / step <= points:
+            return step
+    return NICE_STEPS[-1]
+
+
+def parse_query(params: Dict[str, Any], labels: Any = None) -> MetricQuery:
+    """Build a :class:`MetricQuery` from a JSON body or query parameters"""
+    name = params.get("metric_name", params.get("name"))
+    if not isinstance(name, str) or not name:
+        raise QueryError("metric_name is required")
+
+    try:
+        end = parse_timestamp(params.get("end_time", params.get("end")))
+        raw_start = params.get("start_time", params.get("start"))
+        start = end - DEFAULT_RANGE if raw_start is None else parse_timestamp(raw_start)
+        selectors = parse_label_selectors(params.get("labels") if labels is None else labels)
+    except ValueError as e:
+        raise QueryError(str(e)) from e
+    if start >= end:
+        raise QueryError("start_time must be before end_time")
+
+    max_points = params.get("max_points", DEFAULT_POINTS)
+    try:
+        max_points = int(max_points)
+    except (TypeError, ValueError):
+        raise QueryError("max_points must be an integer") from None
+    if not 1 <= max_points <= MAX_POINTS:
+        raise QueryError(f"max_points must be between 1 and {MAX_POINTS}")
+
+    raw_step = params.get("step", params.get("interval"))
+    if raw_step is None:
+        step = default_step(end - start, max_points)
+    else:
+        step = parse_duration(raw_step)
+    if step < MIN_STEP:
+        raise QueryError(f"step must be at least {format_duration(MIN_STEP)}")
+    if (end - start) / step > MAX_POINTS:
+        raise QueryError(f"range and step would return more than {MAX_POINTS} points per series")
+
+    aggregation = params.get("aggregation", "avg")
+    if aggregation not in AGGREGATIONS:
+        raise QueryError(f"aggregation must be one of {', '.join(AGGREGATIONS)}")
+
+    return MetricQuery(
+        metric_name=name,
+        start=start,
+        end=end,
+        step=step,
+        aggregation=aggregation,
+        labels=selectors,
+    )
+
+
+@dataclass(frozen=True)
+class Source:
+    """A table or continuous aggregate that can answer metric queries"""
+
+    name: str
+    time_column: str
+    # None for raw samples
+    resolution: Optional[timedelta]
+    expressions: Dict[str, str]
+    count_expression: str
+    # How far behind now the refresh policy in init.sql may leave this rollup;
+    # only assumed when the real watermark cannot be read
+    materialization_lag: timedelta = timedelta(0)
+
+    def supports(self, aggregation: str) -> bool:
+        return aggregation in self.expressions
+
+    def divides(self, step: timedelta) -> bool:
+        """True when buckets of ``step`` are made of whole source buckets"""
+        if self.resolution is None:
+            return True
+        return step >= self.resolution and step % self.resolution == timedelta(0)
+
+    def aligned(self, value: datetime) -> bool:
+        return self.resolution is None or floor_time(value, self.resolution) == value
+
+    def materialized_until(self, now: datetime) -> datetime:
+        return floor_time(now - self.materialization_lag, self.resolution)
+
+
+RAW = Source(
+    name="metrics",
+    time_column="timestamp",
+    resolution=None,
+    expressions={
+        "avg": "avg(value)",
+        "min": "min(value)",
+        "max": "max(value)",
+        "sum": "sum(value)",
+        "count": "count(*)",
+        "last": "last(value, timestamp)",
+    },
+    count_expression="count(*)",
+)
+
+# Rollups store avg/min/max/count per bucket; sums are rebuilt from avg * count
+_ROLLUP_EXPRESSIONS = {
+    "avg": "sum(avg_value * sample_count) / sum(sample_count)",
+    "min": "min(min_value)",
+    "max": "max(max_value)",
+    "sum": "sum(avg_value * sample_count)",
+    "count": "sum(sample_count)",
+}
+
+
+def _rollup(name: str, resolution: timedelta, lag: timedelta) -> Source:
+    return Source(
+        name=name,
+        time_column="bucket",
+        resolution=resolution,
+        expressions=_ROLLUP_EXPRESSIONS,
+        count_expression="sum(sample_count)",
+        materialization_lag=lag,
+    )
+
+
+# Lags are end_offset + schedule_interval of each refresh policy
+FIVE_MINUTE = _rollup("metrics_5m", timedelta(minutes=5), timedelta(minutes=10))
+HOURLY = _rollup("metrics_hourly", timedelta(hours=1), timedelta(hours=2))
+DAILY = _rollup("metrics_daily", timedelta(days=1), timedelta(days=1, hours=1))
+
+# Coarsest first
+SOURCES = (DAILY, HOURLY, FIVE_MINUTE, RAW)
+
+
+WATERMARK_SQL = """
+SELECT user_view_name AS name,
+       _timescaledb_functions.to_timestamp(
+           _timescaledb_functions.cagg_watermark(mat_hypertable_id)
+       ) AS watermark
+FROM _timescaledb_catalog.continuous_agg
+WHERE user_view_name = ANY($1::text[])
+"""
+
+
+def floor_time(value: datetime, resolution: timedelta) -> datetime:
+    seconds = resolution.total_seconds()
+    epoch = value.timestamp()
+    return datetime.fromtimestamp(epoch - epoch % seconds, timezone.utc)
+
+
+def ceil_time(value: datetime, resolution: timedelta) -> datetime:
+    floor = floor_time(value, resolution)
+    return floor if floor == value else floor + resolution
+
+
+@dataclass
+class QueryPlan:
+    """Where a query's rows come from"""
+
+    source: Source
+    query: MetricQuery
+    # Rows from here to the end of the range are rolled up from raw data
+    raw_from: Optional[datetime] = None
+    # Rows from the start of the range to here are rolled up from raw data
+    raw_until: Optional[datetime] = None
+
+    @property
+    def start(self) -> datetime:
+        if self.source.resolution is None:
+            return self.query.start
+        # Include the rollup bucket the range starts in
+        return floor_time(self.query.start, self.source.resolution)
+
+    @property
+    def rollup_start(self) -> datetime:
+        return self.raw_until or self.start
+
+    @property
+    def rollup_end(self) -> datetime:
+        return self.raw_from or self.query.end
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "source": self.source.name,
+            "raw_head_until": self.raw_until.isoformat() if self.raw_until else None,
+            "raw_tail_from": self.raw_from.isoformat() if self.raw_from else None,
+        }
+
+
+class _Args(list):
+    """Positional query arguments; ``add`` returns the ``$n`` placeholder"""
+
+    def add(self, value: Any, cast: str = "") -> str:
+        self.append(value)
+        return f"${len(self)}{cast}"
+
+
+def _from_clause(plan: QueryPlan, args: _Args) -> str:
+    source, query = plan.source, plan.query
+    name = args.add(query.metric_name)
+    labels = ""
+    if query.labels:
+        labels = " AND labels @> " + args.add(
+            json.dumps(query.labels, separators=(",", ":")), "::jsonb"
+        )
+    column = source.time_column
+
+    if plan.raw_from is None and plan.raw_until is None:
+        start = args.add(plan.start)
+        end = args.add(query.end)
+        return (
+            f"FROM {source.name} WHERE metric_name = {name} "
+            f"AND {column} >= {start} AND {column} < {end}{labels}"
+        )
+
+    # Raw edges take the rollup's shape, so one set of aggregate expressions applies
+    resolution = args.add(source.resolution, "::interval")
+
+    def raw(start: datetime, end: datetime) -> str:
+        return (
+            f"SELECT time_bucket({resolution}, timestamp) AS bucket, labels, "
+            "avg(value) AS avg_value, max(value) AS max_value, min(value) AS min_value, "
+            "count(*) AS sample_count "
+            f"FROM metrics WHERE metric_name = {name} "
+            f"AND timestamp >= {args.add(start)} AND timestamp < {args.add(end)}{labels} "
+            "GROUP BY 1, 2"
+        )
+
+    segments = []
+    if plan.raw_until is not None:
+        segments.append(raw(query.start, plan.raw_until))
+    segments.append(
+        f"SELECT bucket, labels, avg_value, max_value, min_value, sample_count "
+        f"FROM {source.name} WHERE metric_name = {name} "
+        f"AND bucket >= {args.add(plan.rollup_start)} "
+        f"AND bucket < {args.add(plan.rollup_end)}{labels}"
+    )
+    if plan.raw_from is not None:
+        segments.append(raw(plan.raw_from, query.end))
+    return f"FROM ({' UNION ALL '.join(segments)}) AS stitched"
+
+
+def build_range_sql(plan: QueryPlan) -> Tuple[str, List[Any]]:
+    """One ``time_bucket`` statement returning (time, labels, value) rows"""
+    source, query = plan.source, plan.query
+    args = _Args()
+    step = args.add(query.step, "::interval")
+    sql = (
+        f"SELECT time_bucket({step}, {source.time_column}) AS time, labels, "
+        f"{source.expressions[query.aggregation]} AS value "
+        f"{_from_clause(plan, args)} "
+        "GROUP BY time, labels ORDER BY labels, time"
+    )
+    return sql, args
+
+
+def build_aggregate_sql(plan: QueryPlan) -> Tuple[str, List[Any]]:
+    """One row per series with the aggregate over the whole range"""
+    source, query = plan.source, plan.query
+    args = _Args()
+    sql = (
+        f"SELECT labels, {source.expressions[query.aggregation]} AS value, "
+        f"{source.count_expression} AS samples "
+        f"{_from_clause(plan, args)} "
+        "GROUP BY labels ORDER BY labels"
+    )
+    return sql, args
+
+
+def _labels(raw: Any) -> Dict[str, str]:
+    # asyncpg returns jsonb as text unless a codec is registered
+    return json.loads(raw) if isinstance(raw, str) else dict(raw or {})
+
+
+class QueryEngine:
+    """Plans metric queries and runs them on the shared pool"""
+
+    def __init__(
+        self,
+        database: Database,
+        sources: Sequence[Source] = SOURCES,
+        watermark_ttl: float = 10.0,
+    ):
+        self.database = database
+        self.sources = tuple(sources)
+        self.watermark_ttl = watermark_ttl
+        # rollup name -> end of its materialized data, as TimescaleDB reports it
+        self.watermarks: Dict[str, datetime] = {}
+        self._watermarks_at: Optional[float] = None
+        self._watermark_error: Optional[str] = None
+
+    def materialized_until(self, source: Source, now: datetime) -> datetime:
+        watermark = self.watermarks.get(source.name)
+        if watermark is None:
+            return source.materialized_until(now)
+        return floor_time(watermark, source.resolution)
+
+    async def refresh_watermarks(self) -> None:
+        """Read the rollup watermarks, at most once per ``watermark_ttl``"""
+        at = monotonic()
+        if not self.database.connected or (
+            self._watermarks_at is not None and at - self._watermarks_at < self.watermark_ttl
+        ):
+            return
+        # Set first so concurrent queries do not all refresh
+        self._watermarks_at = at
+        names = [s.name for s in self.sources if s.resolution is not None]
+        try:
+            async with self.database.pool.acquire() as conn:
+                rows = await conn.fetch(WATERMARK_SQL, names)
+        except Exception as e:
+            if str(e) != self._watermark_error:
+                logger.warning("Rollup watermarks unavailable, assuming refresh lags: %s", e)
+            self._watermark_error = str(e)
+            self.watermarks = {}
+            return
+        self._watermark_error = None
+        self.watermarks = {
+            row["name"]: row["watermark"]
+            for row in rows
+            if isinstance(row["watermark"], datetime) and row["watermark"].tzinfo is not None
+        }
+
+    def plan(self, query: MetricQuery, now: Optional[datetime] = None) -> QueryPlan:
+        """Coarsest tier whose buckets nest inside the query step"""
+        now = now or datetime.now(timezone.utc)
+        for source in self.sources:
+            if source.supports(query.aggregation) and source.divides(query.step):
+                plan = self._materialized(source, query, now)
+                if plan is not None:
+                    return plan
+        raise QueryError(f"no source supports aggregation {query.aggregation!r}")
+
+    def plan_aggregate(self, query: MetricQuery, now: Optional[datetime] = None) -> QueryPlan:
+        """Coarsest tier that covers the range exactly, partial edge buckets read raw"""
+        now = now or datetime.now(timezone.utc)
+        for source in self.sources:
+            if not source.supports(query.aggregation):
+                continue
+            plan = self._materialized(source, query, now)
+            if plan is None:
+                continue
+            if source.resolution is None:
+                return plan
+            if not source.aligned(query.start):
+                plan.raw_until = ceil_time(query.start, source.resolution)
+            if plan.raw_from is None and not source.aligned(query.end):
+                plan.raw_from = floor_time(query.end, source.resolution)
+            # Worth it only while at least one whole bucket comes from the rollup
+            if plan.rollup_start < plan.rollup_end:
+                return plan
+        raise QueryError(f"no source supports aggregation {query.aggregation!r}")
+
+    def _materialized(
+        self, source: Source, query: MetricQuery, now: datetime
+    ) -> Optional[QueryPlan]:
+        """Plan on ``source``, stitching raw data after its watermark"""
+        if source.resolution is None:
+            return QueryPlan(source, query)
+        materialized = self.materialized_until(source, now)
+        if materialized >= query.end:
+            return QueryPlan(source, query)
+        if materialized <= floor_time(query.start, source.resolution):
+            # Nothing of this range is rolled up yet; a finer tier does better
+            return None
+        return QueryPlan(source, query, raw_from=materialized)
+
+    async def range_query(self, query: MetricQuery) -> Tuple[QueryPlan, List[Dict[str, Any]]]:
+        await self.refresh_watermarks()
+        plan = self.plan(query)
+        sql, args = build_range_sql(plan)
+        rows = await self._fetch(plan.source, sql, args)
+
+        series: List[Dict[str, Any]] = []
+        current_labels = None
+        for row in rows:
+            if row["labels"] != current_labels or not series:
+                current_labels = row["labels"]
+                series.append(
+                    {
+                        "metric_name": query.metric_name,
+                        "labels": _labels(current_labels),
+                        "data_points": [],
+                    }
+                )
+            series[-1]["data_points"].append(
+                {"timestamp": row["time"].isoformat(), "value": _number(row["value"])}
+            )
+        return plan, series
+
+    async def aggregate(self, query: MetricQuery) -> Tuple[QueryPlan, List[Dict[str, Any]]]:
+        await self.refresh_watermarks()
+        plan = self.plan_aggregate(query)
+        sql, args = build_aggregate_sql(plan)
+        rows = await self._fetch(plan.source, sql, args)
+        return plan, [
+            {
+                "labels": _labels(row["labels"]),
+                "value": _number(row["value"]),
+                "samples": int(row["samples"]),
+            }
+            for row in rows
+        ]
+
+    async def _fetch(self, source: Source, sql: str, args: List[Any]) -> List[Any]:
+        if not self.database.connected:
+            raise QueryUnavailable("metric storage is not connected")
+        start = perf_counter()
+        try:
+            async with self.database.pool.acquire() as conn:
+                rows = await conn.fetch(sql, *args)
+        except Exception as e:
+            if not _storage_error(e):
+                raise
+            logger.warning("Query on %s failed: %s", source.name, e)
+            raise QueryUnavailable(f"metric storage did not answer: {e}") from e
+        QUERY_LATENCY.labels(source.name).observe(perf_counter() - start)
+        return rows
+
+
+def _storage_error(error: Exception) -> bool:
+    """Whether a failure is the database's rather than a bug in the query path"""
+    if isinstance(error, (OSError, asyncio.TimeoutError)):
+        return True
+    # asyncpg is imported lazily; match its exceptions by module
+    return type(error).__module__.split(".")[0] == "asyncpg"
+
+
+def _number(value: Any) -> Optional[float]:
+    return None if value is None else float(value)
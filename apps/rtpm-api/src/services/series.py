@@ -0,0 +1,286 @@
+"""
+Series registry
+
+Every distinct ``(metric_name, labels)`` pair is canonicalized once, when
+the sample is parsed, into a small integer series ID.  In-process
+consumers (WebSocket routing, downsampling, the hot window, alerting) key
+their state by that integer instead of hashing and comparing label dicts
+for every sample.  An inverted index from ``label=value`` to series IDs
+answers label selectors by set intersection, and per-label value counts
+make cardinality growth visible before it exhausts memory.  Optional
+limits on series in total, per metric and per tenant (the API key or
+client address that created the series) refuse new series (the sample
+gets ``REJECTED`` as its ID) once the registry, a metric or a tenant is
+full.
+
+Series that receive no sample for ``idle_seconds`` are evicted so their
+room is reclaimed.  Instead of a timestamp per series, a set of series
+touched since the last sweep is kept (the hot path stays a dict lookup and
+a set add); a sweep, due every ``idle_seconds`` and checked once per
+ingested batch and before creating a series, evicts everything untouched
+since the previous one.  IDs are never reused: a series that comes back after eviction
+gets a new ID, and consumers drop state for the old one on their own
+(hot window retention, stale alert resolution), which is why
+``idle_seconds`` should exceed both.
+"""
+
+from time import monotonic
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from prometheus_client import Counter, Gauge
+
+from .limits import LIMIT_REJECTED_SAMPLES, SERIES_PER_METRIC, SERIES_PER_TENANT, SERIES_TOTAL
+
+# Series ID of a sample refused by a cardinality limit
+REJECTED = -1
+
+SeriesKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+SERIES_REGISTERED = Gauge(
+    "rtpm_series_registered",
+    "Distinct series interned by the series registry",
+)
+SERIES_LABEL_PAIRS = Gauge(
+    "rtpm_series_label_pairs",
+    "Distinct label name/value pairs across registered series",
+)
+SERIES_EVICTED = Counter(
+    "rtpm_series_evicted_total",
+    "Series removed from the registry after receiving no samples for idle_seconds",
+)
+
+
+def series_key(metric_name: str, labels: Dict[str, str]) -> SeriesKey:
+    return (metric_name, tuple(sorted(labels.items())))
+
+
+class SeriesRegistry:
+    """Interns series to dense integer IDs with an inverted label index"""
+
+    def __init__(
+        self,
+        max_series_per_metric: int = 0,
+        max_series_per_tenant: int = 0,
+        max_series: int = 0,
+        idle_seconds: float = 0.0,
+        clock: Callable[[], float] = monotonic,
+    ):
+        self.configure(max_series_per_metric, max_series_per_tenant, max_series, idle_seconds)
+        self.clock = clock
+        self._ids: Dict[SeriesKey, int] = {}
+        self._keys: Dict[int, SeriesKey] = {}
+        self._next_id = 0
+        self._by_metric: Dict[str, Set[int]] = {}
+        # Series created per tenant; a series belongs to the tenant that first sent it
+        self._by_tenant: Dict[str, int] = {}
+        self._tenants: Dict[int, str] = {}
+        # label name -> label value -> series IDs
+        self._postings: Dict[str, Dict[str, Set[int]]] = {}
+        self._label_pairs = 0
+        # Series that received a sample since the last idle sweep
+        self._touched: Set[int] = set()
+        self._swept_at = clock()
+
+    def configure(
+        self,
+        max_series_per_metric: int = 0,
+        max_series_per_tenant: int = 0,
+        max_series: int = 0,
+        idle_seconds: float = 0.0,
+    ) -> None:
+        """Set cardinality limits and idle eviction; 0 disables each"""
+        self.max_series_per_metric = max_series_per_metric
+        self.max_series_per_tenant = max_series_per_tenant
+        self.max_series = max_series
+        self.idle_seconds = idle_seconds
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def lookup(self, metric_name: str, labels: Dict[str, str]) -> Optional[int]:
+        """ID of an already registered series, without registering it"""
+        return self._ids.get(series_key(metric_name, labels))
+
+    def intern(
+        self, metric_name: str, labels: Dict[str, str], tenant: Optional[str] = None
+    ) -> int:
+        """ID of the series, registering it on first sight; REJECTED past a limit
+
+        New series count against ``tenant``; without one (internal and
+        relayed samples) only the total and per-metric limits apply.
+        """
+        key = series_key(metric_name, labels)
+        series_id = self._ids.get(key)
+        if series_id is not None:
+            self._touched.add(series_id)
+            return series_id
+
+        self.evict_idle_if_due()
+        if self.max_series and len(self._keys) >= self.max_series:
+            LIMIT_REJECTED_SAMPLES.labels(SERIES_TOTAL).inc()
+            return REJECTED
+        metric_series = self._by_metric.get(metric_name)
+        limit = self.max_series_per_metric
+        if limit and metric_series is not None and len(metric_series) >= limit:
+            LIMIT_REJECTED_SAMPLES.labels(SERIES_PER_METRIC).inc()
+            return REJECTED
+        if tenant is not None:
+            tenant_series = self._by_tenant.get(tenant, 0)
+            if self.max_series_per_tenant and tenant_series >= self.max_series_per_tenant:
+                LIMIT_REJECTED_SAMPLES.labels(SERIES_PER_TENANT).inc()
+                return REJECTED
+            self._by_tenant[tenant] = tenant_series + 1
+
+        series_id = self._next_id
+        self._next_id += 1
+        self._ids[key] = series_id
+        self._keys[series_id] = key
+        self._touched.add(series_id)
+        if tenant is not None:
+            self._tenants[series_id] = tenant
+        if metric_series is None:
+            metric_series = self._by_metric[metric_name] = set()
+        metric_series.add(series_id)
+        for name, value in key[1]:
+            values = self._postings.setdefault(name, {})
+            ids = values.get(value)
+            if ids is None:
+                ids = values[value] = set()
+                self._label_pairs += 1
+            ids.add(series_id)
+        return series_id
+
+    def evict_idle_if_due(self) -> int:
+        """Sweep when ``idle_seconds`` have passed since the last sweep"""
+        if self.idle_seconds and self.clock() - self._swept_at >= self.idle_seconds:
+            return self.evict_idle()
+        return 0
+
+    def evict_idle(self) -> int:
+        """Remove series that received no sample since the last sweep; returns how many"""
+        idle = [series_id for series_id in self._keys if series_id not in self._touched]
+        for series_id in idle:
+            self._remove(series_id)
+        self._touched = set()
+        self._swept_at = self.clock()
+        if idle:
+            SERIES_EVICTED.inc(len(idle))
+        return len(idle)
+
+    def _remove(self, series_id: int) -> None:
+        key = self._keys.pop(series_id)
+        del self._ids[key]
+        metric_series = self._by_metric[key[0]]
+        metric_series.discard(series_id)
+        if not metric_series:
+            del self._by_metric[key[0]]
+        tenant = self._tenants.pop(series_id, None)
+        if tenant is not None:
+            remaining = self._by_tenant[tenant] - 1
+            if remaining:
+                self._by_tenant[tenant] = remaining
+            else:
+                del self._by_tenant[tenant]
+        for name, value in key[1]:
+            values = self._postings[name]
+            ids = values[value]
+            ids.discard(series_id)
+            if not ids:
+                del values[value]
+                self._label_pairs -= 1
+                if not values:
+                    del self._postings[name]
+
+    @property
+    def label_pairs(self) -> int:
+        return self._label_pairs
+
+    def key(self, series_id: int) -> SeriesKey:
+        return self._keys[series_id]
+
+    def metric_name(self, series_id: int) -> str:
+        return self._keys[series_id][0]
+
+    def labels(self, series_id: int) -> Dict[str, str]:
+        return dict(self._keys[series_id][1])
+
+    def select(
+        self, metric_name: Optional[str] = None, labels: Optional[Dict[str, str]] = None
+    ) -> Set[int]:
+        """IDs of the series matching a metric name and label equality selectors"""
+        candidates: List[Set[int]] = []
+        if metric_name is not None:
+            ids = self._by_metric.get(metric_name)
+            if not ids:
+                return set()
+            candidates.append(ids)
+        for name, value in (labels or {}).items():
+            ids = self._postings.get(name, {}).get(value)
+            if not ids:
+                return set()
+            candidates.append(ids)
+        if not candidates:
+            return set(self._keys)
+        # Intersect starting from the most selective posting list
+        candidates.sort(key=len)
+        result = set(candidates[0])
+        for ids in candidates[1:]:
+            result.intersection_update(ids)
+            if not result:
+                break
+        return result
+
+    def cardinality(self, metric_name: str) -> Dict[str, Any]:
+        """Series count and distinct values per label name for one metric"""
+        ids = self._by_metric.get(metric_name, ())
+        values: Dict[str, Set[str]] = {}
+        for series_id in ids:
+            for name, value in self._keys[series_id][1]:
+                values.setdefault(name, set()).add(value)
+        return {
+            "metric_name": metric_name,
+            "series": len(ids),
+            "labels": dict(
+                sorted(((n, len(v)) for n, v in values.items()), key=lambda i: -i[1])
+            ),
+        }
+
+    def stats(self, limit: int = 10) -> Dict[str, Any]:
+        """Totals plus the metrics and label names with the most series"""
+        top_metrics = sorted(self._by_metric.items(), key=lambda i: len(i[1]), reverse=True)
+        top_labels = sorted(self._postings.items(), key=lambda i: len(i[1]), reverse=True)
+        return {
+            "series": len(self._keys),
+            "metrics": len(self._by_metric),
+            "label_names": len(self._postings),
+            "label_pairs": self._label_pairs,
+            "limits": {
+                "series": self.max_series or None,
+                "series_per_metric": self.max_series_per_metric or None,
+                "series_per_tenant": self.max_series_per_tenant or None,
+                "idle_seconds": self.idle_seconds or None,
+            },
+            "top_tenants": [
+                {"tenant": tenant, "series": count}
+                for tenant, count in sorted(
+                    self._by_tenant.items(), key=lambda i: i[1], reverse=True
+                )[:limit]
+            ],
+            "top_metrics": [
+                {"metric_name": name, "series": len(ids)} for name, ids in top_metrics[:limit]
+            ],
+            "top_labels": [
+                {
+                    "label": name,
+                    "values": len(values),
+                    "series": sum(len(ids) for ids in values.values()),
+                }
+                for name, values in top_labels[:limit]
+            ],
+        }
+
+
+# Process-wide registry: series IDs are assigned when samples are parsed
+registry = SeriesRegistry()
+SERIES_REGISTERED.set_function(lambda: len(registry))
+SERIES_LABEL_PAIRS.set_function(lambda: registry.label_pairs)
@@ -0,0 +1,435 @@
+"""
+Append-only write-ahead spool
+
+When the database is down or slow, ingestion batches are appended to a
+local spool instead of being dropped or blocking the batcher, and are
+replayed in order once the database recovers.
+
+On disk the spool is a directory of numbered segment files
+(``00000001.seg``, ...).  Each record is framed as::
+
+    | length (u32, big endian) | crc32 of payload (u32) | payload |
+
+Writes go straight to the active segment and are made durable by an
+``fsync`` at most every ``fsync_interval`` seconds, so a burst of
+appends costs one sync.  The active segment is rotated once it exceeds
+``segment_bytes``, and every ``open`` starts a fresh one, so a torn
+record left by a crash can only ever sit at the end of a segment that is
+no longer written; the reader skips to the next segment when it finds
+one.  All file I/O of ``append``, ``peek``, ``commit`` and the fsync runs
+in a worker thread, one operation at a time, so a slow disk never stalls
+the event loop, and a write the kernel cuts short is truncated away (or
+left behind a rotation) so framing stays intact.  Replay progress is
+kept in a ``checkpoint`` file and fully replayed segments are deleted.  A
+lost checkpoint means records are replayed again, never skipped.  Past
+``max_bytes`` the oldest segment is dropped (and counted) so an outage
+cannot fill the disk.
+
+A spool belongs to one process at a time: ``open`` takes an exclusive
+``fcntl`` lock on ``lock`` in the directory.  When another process (a
+sibling gunicorn worker) holds it, the spool claims the first free slot
+directory instead (``<directory>.1``, ``<directory>.2``, ...), so workers
+never interleave writes, and a restarted worker picks up a slot left by
+one that died together with its unreplayed records.  Slots nobody claims
+again (fewer workers after a restart) are found by ``adopt``: a running
+spool locks each unclaimed sibling slot in turn, appends its unreplayed
+records to its own segments, syncs them and only then deletes the
+sibling's files.
+"""
+
+import asyncio
+import errno
+import fcntl
+import logging
+import os
+import struct
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+from prometheus_client import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct(">II")
+SEGMENT_SUFFIX = ".seg"
+CHECKPOINT = "checkpoint"
+LOCK = "lock"
+MAX_SLOTS = 64
+
+SPOOL_RECORDS = Counter(
+    "rtpm_spool_records_total",
+    "Records appended to or replayed from the write-ahead spool",
+    ["op"],
+)
+SPOOL_DROPPED_BYTES = Counter(
+    "rtpm_spool_dropped_bytes_total",
+    "Spooled bytes discarded because the spool exceeded max_bytes or was corrupt",
+)
+SPOOL_BYTES = Gauge(
+    "rtpm_spool_bytes",
+    "Bytes held in write-ahead spool segments",
+)
+
+
+class Spool:
+    """Segmented, length-prefixed record log with a replay cursor"""
+
+    def __init__(
+        self,
+        directory: str,
+        segment_bytes: int = 64 * 1024 * 1024,
+        fsync_interval: float = 0.2,
+        max_bytes: int = 1024 * 1024 * 1024,
+    ):
+        self.base_directory = directory
+        # The slot directory actually claimed by open()
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        # Sequence numbers of segments on disk, oldest first; the last one is active
+        self._segments: List[int] = []
+        self._sizes: Dict[int, int] = {}
+        self._fd: Optional[int] = None
+        self._lock_fd: Optional[int] = None
+        self._dirty = False
+        # Replay cursor: segment and byte offset of the next unreplayed record
+        self._read_seq = 0
+        self._read_offset = 0
+        # Offset just past the record returned by peek(), until commit()
+        self._peeked: Optional[Tuple[int, int]] = None
+        # A short write could not be cut off: rotate before the next record
+        self._torn = False
+        # Serializes the threaded file operations
+        self._io = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        SPOOL_BYTES.set_function(lambda: self.size)
+
+    # Layout
+
+    def _path(self, seq: int, directory: Optional[str] = None) -> str:
+        return os.path.join(directory or self.directory, f"{seq:08d}{SEGMENT_SUFFIX}")
+
+    @property
+    def size(self) -> int:
+        # Also read by the gauge from the exposition thread: copy before iterating
+        return sum(list(self._sizes.values()))
+
+    @property
+    def empty(self) -> bool:
+        """True when every appended record has been replayed"""
+        if not self._segments:
+            return True
+        active = self._segments[-1]
+        return self._read_seq == active and self._read_offset >= self._sizes[active]
+
+    def open(self) -> None:
+        """Claim a slot, load its segments and checkpoint, then start a new active segment"""
+        self._claim()
+        for seq in self._segment_seqs(self.directory):
+            self._segments.append(seq)
+            self._sizes[seq] = os.path.getsize(self._path(seq))
+        self._read_seq, self._read_offset = self._load_checkpoint()
+        # Segments before the checkpoint were fully replayed before a crash
+        for seq in [s for s in self._segments if s < self._read_seq]:
+            self._delete(seq)
+        if self._segments and self._read_seq not in self._sizes:
+            self._read_seq, self._read_offset = self._segments[0], 0
+        self._rotate()
+        if self._read_seq not in self._sizes:
+            self._read_seq, self._read_offset = self._segments[0], 0
+        if not self.empty:
+            logger.info("Spool: %d bytes awaiting replay in %s", self.size, self.directory)
+
+    def _slot(self, slot: int) -> str:
+        return self.base_directory if slot == 0 else f"{self.base_directory}.{slot}"
+
+    @staticmethod
+    def _lock(directory: str) -> Optional[int]:
+        """Descriptor holding the slot's lock, or None while another process has it"""
+        fd = os.open(os.path.join(directory, LOCK), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def _claim(self) -> None:
+        """Lock the base directory, or the first free slot next to it"""
+        for slot in range(MAX_SLOTS):
+            directory = self._slot(slot)
+            os.makedirs(directory, exist_ok=True)
+            fd = self._lock(directory)
+            if fd is not None:
+                self.directory, self._lock_fd = directory, fd
+                return
+        raise RuntimeError(f"no free spool slot next to {self.base_directory}")
+
+    @staticmethod
+    def _segment_seqs(directory: str) -> List[int]:
+        return sorted(
+            int(name[: -len(SEGMENT_SUFFIX)])
+            for name in os.listdir(directory)
+            if name.endswith(SEGMENT_SUFFIX) and name[: -len(SEGMENT_SUFFIX)].isdigit()
+        )
+
+    def _load_checkpoint(self, directory: Optional[str] = None) -> Tuple[int, int]:
+        try:
+            with open(os.path.join(directory or self.directory, CHECKPOINT)) as f:
+                seq, offset = f.read().split()
+                return int(seq), int(offset)
+        except (OSError, ValueError):
+            return 0, 0
+
+    def _save_checkpoint(self) -> None:
+        path = os.path.join(self.directory, CHECKPOINT)
+        with open(path + ".tmp", "w") as f:
+            f.write(f"{self._read_seq} {self._read_offset}")
+        os.replace(path + ".tmp", path)
+
+    def _rotate(self) -> None:
+        if self._fd is not None:
+            os.fsync(self._fd)
+            os.close(self._fd)
+        seq = self._segments[-1] + 1 if self._segments else 1
+        self._fd = os.open(self._path(seq), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        # Sized before it is listed: ``empty`` reads both from the event loop
+        self._sizes[seq] = 0
+        self._segments.append(seq)
+        self._dirty = False
+        self._torn = False
+
+    def _delete(self, seq: int) -> None:
+        self._segments.remove(seq)
+        self._sizes.pop(seq, None)
+        try:
+            os.unlink(self._path(seq))
+        except FileNotFoundError:
+            pass
+
+    # Writing
+
+    async def append(self, payload: bytes) -> None:
+        """Frame and write one record; durable after the next fsync"""
+        async with self._io:
+            await asyncio.to_thread(self._append, payload)
+
+    def _append(self, payload: bytes) -> None:
+        if self._fd is None:
+            raise RuntimeError("spool is not open")
+        active = self._segments[-1]
+        if self._torn or self._sizes[active] >= self.segment_bytes:
+            self._rotate()
+            active = self._segments[-1]
+        self._write(HEADER.pack(len(payload), zlib.crc32(payload)) + payload, active)
+        self._sizes[active] += HEADER.size + len(payload)
+        self._dirty = True
+        SPOOL_RECORDS.labels("appended").inc()
+        self._enforce_limit()
+
+    def _write(self, data: bytes, active: int) -> None:
+        """Write a whole record or none of it"""
+        view = memoryview(data)
+        try:
+            while view:
+                written = os.write(self._fd, view)
+                if written <= 0:
+                    raise OSError(errno.EIO, "spool write made no progress")
+                view = view[written:]
+        except OSError:
+            try:
+                os.ftruncate(self._fd, self._sizes[active])
+            except OSError:
+                # The partial record stays past the segment's known size, where
+                # replay never reads; later records go to a new segment
+                self._torn = True
+            raise
+
+    def _enforce_limit(self) -> None:
+        while self.size > self.max_bytes and len(self._segments) > 1:
+            oldest = self._segments[0]
+            dropped = self._sizes[oldest]
+            if oldest == self._read_seq:
+                dropped -= self._read_offset
+                self._read_seq, self._read_offset = self._segments[1], 0
+                self._peeked = None
+            self._delete(oldest)
+            SPOOL_DROPPED_BYTES.inc(dropped)
+            logger.warning(
+                "Spool over %d bytes, dropped %d unreplayed bytes", self.max_bytes, dropped
+            )
+
+    def sync(self) -> None:
+        if self._dirty and self._fd is not None:
+            self._dirty = False
+            os.fsync(self._fd)
+
+    # Slots left by exited workers
+
+    async def adopt(self) -> int:
+        """Move the records of unclaimed sibling slots into this spool; returns the count"""
+        async with self._io:
+            return await asyncio.to_thread(self._adopt)
+
+    def _adopt(self) -> int:
+        if self._fd is None:
+            raise RuntimeError("spool is not open")
+        adopted = 0
+        for slot in range(MAX_SLOTS):
+            directory = self._slot(slot)
+            if directory == self.directory or not os.path.isdir(directory):
+                continue
+            if not self._segment_seqs(directory):
+                continue
+            fd = self._lock(directory)
+            if fd is None:
+                # Claimed by a running worker, which replays it itself
+                continue
+            try:
+                records = self._merge(directory)
+            finally:
+                os.close(fd)
+            if records:
+                logger.info("Spool: adopted %d records from %s", records, directory)
+            adopted += records
+        return adopted
+
+    def _merge(self, directory: str) -> int:
+        """Append a locked sibling slot's unreplayed records here, then empty it"""
+        seqs = self._segment_seqs(directory)
+        read_seq, read_offset = self._load_checkpoint(directory)
+        records = 0
+        for seq in seqs:
+            if seq < read_seq:
+                continue
+            path = self._path(seq, directory)
+            size = os.path.getsize(path)
+            offset = read_offset if seq == read_seq else 0
+            with open(path, "rb") as f:
+                f.seek(offset)
+                while offset < size:
+                    header = f.read(HEADER.size)
+                    if len(header) < HEADER.size:
+                        break
+                    length, crc = HEADER.unpack(header)
+                    payload = f.read(length)
+                    if len(payload) != length or zlib.crc32(payload) != crc:
+                        break
+                    self._append(payload)
+                    offset += HEADER.size + length
+                    records += 1
+            if offset < size:
+                SPOOL_DROPPED_BYTES.inc(size - offset)
+                logger.warning(
+                    "Spool segment %d in %s is corrupt after byte %d, skipping the rest",
+                    seq,
+                    directory,
+                    offset,
+                )
+        # Durable here before the originals go; a crash in between replays them twice
+        self.sync()
+        for seq in seqs:
+            os.unlink(self._path(seq, directory))
+        try:
+            os.unlink(os.path.join(directory, CHECKPOINT))
+        except FileNotFoundError:
+            pass
+        return records
+
+    async def start(self) -> None:
+        """Open the spool and start the batched fsync task"""
+        if self._fd is None:
+            await asyncio.to_thread(self.open)
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.fsync_interval)
+            if self._dirty:
+                async with self._io:
+                    await asyncio.to_thread(self.sync)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        async with self._io:
+            await asyncio.to_thread(self.close)
+
+    def close(self) -> None:
+        """Sync and close the active segment and give up the slot"""
+        if self._fd is not None:
+            self.sync()
+            os.close(self._fd)
+            self._fd = None
+        if self._lock_fd is not None:
+            # Closing the descriptor releases the lock
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    # Replay
+
+    async def peek(self) -> Optional[bytes]:
+        """Next unreplayed record, or None; repeated until commit()"""
+        async with self._io:
+            return await asyncio.to_thread(self._peek)
+
+    def _peek(self) -> Optional[bytes]:
+        while not self.empty:
+            seq, offset = self._read_seq, self._read_offset
+            if offset >= self._sizes[seq]:
+                # Fully replayed; the writer has moved on to a newer segment
+                self._advance(seq)
+                continue
+            with open(self._path(seq), "rb") as f:
+                f.seek(offset)
+                header = f.read(HEADER.size)
+                intact = False
+                # A short header is a torn tail like a short payload
+                if len(header) == HEADER.size:
+                    length, crc = HEADER.unpack(header)
+                    payload = f.read(length)
+                    intact = len(payload) == length and zlib.crc32(payload) == crc
+            if intact:
+                self._peeked = (seq, offset + HEADER.size + length)
+                return payload
+            if seq == self._segments[-1]:
+                # Still being written; not reachable with whole-record writes
+                return None
+            # Torn or corrupt tail of a segment left by a crash
+            SPOOL_DROPPED_BYTES.inc(self._sizes[seq] - offset)
+            logger.warning(
+                "Spool segment %d is corrupt after byte %d, skipping the rest", seq, offset
+            )
+            self._advance(seq)
+        return None
+
+    def _advance(self, seq: int) -> None:
+        """Move the cursor past a fully consumed, non-active segment"""
+        index = self._segments.index(seq)
+        self._read_seq, self._read_offset = self._segments[index + 1], 0
+        self._delete(seq)
+        self._save_checkpoint()
+
+    async def commit(self) -> None:
+        """Mark the record returned by the last peek() as replayed"""
+        async with self._io:
+            await asyncio.to_thread(self._commit)
+
+    def _commit(self) -> None:
+        if self._peeked is None:
+            return
+        seq, offset = self._peeked
+        self._peeked = None
+        self._read_seq, self._read_offset = seq, offset
+        SPOOL_RECORDS.labels("replayed").inc()
+        if seq != self._segments[-1] and offset >= self._sizes[seq]:
+            self._advance(seq)
+        else:
+            self._save_checkpoint()
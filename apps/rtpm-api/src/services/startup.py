@@ -0,0 +1,225 @@
+"""
+Startup verification and timing
+
+In production the API refuses to start unless every required Secrets
+Manager secret exists.  ``describe_secret`` is a blocking HTTPS round
+trip, so the checks run concurrently on a small thread pool, all under
+one deadline; a check that errors or does not finish in time fails
+startup just as a missing secret does.
+
+Secrets that were found are remembered in a small JSON file for
+``cache_ttl`` seconds, so a restart inside that window (a crash loop, a
+deploy, an autoscaled machine reusing its volume) skips the round trips
+and the boto3 import altogether.  Only existence is cached, never secret
+material, and missing secrets are never cached, so a secret that has
+just been created is picked up on the next start.
+
+``check_secrets`` applies a deployment's policy to the result: ``strict``
+refuses to start, ``advisory`` logs and carries on with environment
+variables only (Fly, where secrets are set on the machine), ``off`` skips
+the check.
+
+``StartupPhases`` times the named steps of startup for the log and the
+``rtpm_startup_phase_seconds`` gauge.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from prometheus_client import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+SECRET_CHECK_MODES = ("strict", "advisory", "off")
+
+REQUIRED_SECRETS = (
+    "candlefish-database-production",
+    "candlefish-redis-production",
+    "candlefish-auth-secrets-production",
+    "candlefish-jwt-keys-production",
+    "candlefish-api-keys-production",
+)
+
+STARTUP_PHASE_SECONDS = Gauge(
+    "rtpm_startup_phase_seconds",
+    "Wall time of each startup phase of this process",
+    ["phase"],
+)
+SECRET_CHECKS = Counter(
+    "rtpm_startup_secret_checks_total",
+    "Required secrets checked at startup, by outcome",
+    ["result"],
+)
+
+
+class SecretVerifier:
+    """Concurrent, cached existence checks for required secrets"""
+
+    def __init__(
+        self,
+        secret_ids: Sequence[str] = REQUIRED_SECRETS,
+        region: str = "us-east-1",
+        timeout: float = 10.0,
+        max_workers: int = 8,
+        cache_path: Optional[str] = None,
+        cache_ttl: float = 300.0,
+        client_factory: Optional[Callable[[], Any]] = None,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.secret_ids = tuple(secret_ids)
+        self.region = region
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.cache_path = cache_path
+        self.cache_ttl = cache_ttl
+        self.client_factory = client_factory
+        self.clock = clock
+
+    def _client(self):
+        if self.client_factory is not None:
+            return self.client_factory()
+        # Imported here: a start served from the cache never loads boto3
+        import boto3
+
+        return boto3.client("secretsmanager", region_name=self.region)
+
+    def load_cache(self, now: float) -> Dict[str, float]:
+        """Secrets verified less than ``cache_ttl`` ago, with when they were"""
+        if not self.cache_path or self.cache_ttl <= 0:
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+            if cache.get("region") != self.region:
+                return {}
+            return {
+                secret_id: float(verified_at)
+                for secret_id, verified_at in cache.get("verified", {}).items()
+                if 0 <= now - float(verified_at) < self.cache_ttl
+            }
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logger.warning("Ignoring unreadable secrets cache %s: %s", self.cache_path, e)
+            return {}
+
+    def save_cache(self, verified: Dict[str, float]) -> None:
+        if not self.cache_path or self.cache_ttl <= 0:
+            return
+        tmp = f"{self.cache_path}.tmp"
+        try:
+            directory = os.path.dirname(self.cache_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(tmp, "w") as f:
+                json.dump({"region": self.region, "verified": verified}, f)
+            os.replace(tmp, self.cache_path)
+        except OSError as e:
+            logger.warning("Could not write secrets cache %s: %s", self.cache_path, e)
+
+    async def verify(self) -> Dict[str, str]:
+        """Check every secret; returns ``{secret_id: "cached" | "verified"}``
+
+        Raises ``RuntimeError`` when a secret is missing or inaccessible, or
+        the checks do not finish within ``timeout`` seconds.
+        """
+        now = self.clock()
+        cached = self.load_cache(now)
+        results = {secret_id: "cached" for secret_id in self.secret_ids if secret_id in cached}
+        pending = [secret_id for secret_id in self.secret_ids if secret_id not in cached]
+        SECRET_CHECKS.labels("cached").inc(len(results))
+        if not pending:
+            return results
+
+        loop = asyncio.get_running_loop()
+        pool = ThreadPoolExecutor(
+            max_workers=max(1, min(self.max_workers, len(pending))),
+            thread_name_prefix="secrets",
+        )
+
+        async def check_all() -> List[Any]:
+            client = await loop.run_in_executor(pool, self._client)
+
+            def describe(secret_id: str):
+                return client.describe_secret(SecretId=secret_id)
+
+            return await asyncio.gather(
+                *(loop.run_in_executor(pool, describe, secret_id) for secret_id in pending),
+                return_exceptions=True,
+            )
+
+        try:
+            outcomes = await asyncio.wait_for(check_all(), self.timeout)
+        except asyncio.TimeoutError as e:
+            SECRET_CHECKS.labels("timeout").inc(len(pending))
+            logger.error("Secrets not verified within %gs", self.timeout)
+            raise RuntimeError("Startup denied: required secrets could not be verified") from e
+        finally:
+            # Never wait on a hung call; its thread exits when the call does
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        verified_at = self.clock()
+        failure: Optional[BaseException] = None
+        for secret_id, outcome in zip(pending, outcomes):
+            if isinstance(outcome, BaseException):
+                SECRET_CHECKS.labels("missing").inc()
+                logger.error("Missing or inaccessible secret: %s (%s)", secret_id, outcome)
+                failure = failure or outcome
+            else:
+                SECRET_CHECKS.labels("verified").inc()
+                cached[secret_id] = verified_at
+                results[secret_id] = "verified"
+        self.save_cache(cached)
+        if failure is not None:
+            raise RuntimeError("Startup denied: required secret missing") from failure
+        return results
+
+
+async def check_secrets(verifier: SecretVerifier, mode: str = "strict") -> None:
+    """Verify required secrets under one of ``SECRET_CHECK_MODES``"""
+    if mode not in SECRET_CHECK_MODES:
+        raise ValueError(f"unknown secrets check mode: {mode}")
+    if mode == "off":
+        return
+    try:
+        checked = await verifier.verify()
+    except RuntimeError as e:
+        if mode == "strict":
+            raise
+        logger.warning("Secrets: %s; running with environment variables only", e)
+        return
+    cached = sum(1 for result in checked.values() if result == "cached")
+    logger.info("Secrets: %d verified, %d from cache", len(checked) - cached, cached)
+
+
+class StartupPhases:
+    """Wall-clock durations of named startup steps, in order"""
+
+    def __init__(self, clock: Callable[[], float] = time.perf_counter):
+        self.clock = clock
+        self.started = clock()
+        self.phases: List[Tuple[str, float]] = []
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = self.clock()
+        try:
+            yield
+        finally:
+            elapsed = self.clock() - start
+            self.phases.append((name, elapsed))
+            STARTUP_PHASE_SECONDS.labels(name).set(elapsed)
+
+    def finish(self) -> str:
+        """Record the time since construction; returns a one-line summary"""
+        total = self.clock() - self.started
+        STARTUP_PHASE_SECONDS.labels("total").set(total)
+        parts = [f"{name} {elapsed * 1000:.0f}ms" for name, elapsed in self.phases]
+        parts.append(f"total {total * 1000:.0f}ms")
+        return ", ".join(parts)
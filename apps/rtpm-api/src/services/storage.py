@@ -0,0 +1,240 @@
+"""
+Metric persistence
+
+Writes ingestion batches into the ``metrics`` hypertable with a single
+``COPY`` per batch, so the database sees one round trip per flush rather
+than one ``INSERT`` per sample.
+
+``DurableWriter`` puts a write-ahead spool in front of the writer: a
+batch that cannot be copied (or is not even tried, while the pool is
+unhealthy) is appended to the spool, and a replay task copies spooled
+batches back in order once the database is healthy.  While anything is
+spooled, live batches are appended behind it too, so rows reach the
+database in the order they were ingested.  The backlog is replayed at no
+more than ``replay_rate`` rows per second on top of the live rows queued
+behind it, so catching up never starves the pool.
+
+A batch is spooled only once its ``COPY`` has failed: the batcher waits
+``write_timeout`` seconds for a slow ``COPY`` and then moves on, leaving
+it running.  Spooling on a timeout instead would insert the batch twice
+whenever the server had committed it after all, and ``metrics`` has no
+key to deduplicate on.  Replayed batches are likewise awaited to the
+end (bounded by the pool's ``command_timeout``), never abandoned.
+
+Every ``adopt_interval`` seconds the replay task also takes over the
+spool slots of workers that exited without being replaced, so their
+records are replayed instead of waiting for a worker to claim the slot.
+"""
+
+import asyncio
+import json
+import logging
+from datetime import datetime
+from time import monotonic, perf_counter
+from typing import List, Optional, Sequence, Set, Tuple
+
+from prometheus_client import Counter, Histogram
+
+from .database import Database
+from .ingestion import MetricSample
+from .spool import Spool
+
+logger = logging.getLogger(__name__)
+
+METRIC_COLUMNS = (
+    "timestamp",
+    "metric_name",
+    "metric_type",
+    "value",
+    "labels",
+    "help_text",
+    "unit",
+    "source",
+)
+
+DB_ROWS_WRITTEN = Counter(
+    "rtpm_db_rows_written_total",
+    "Metric rows copied into TimescaleDB",
+)
+DB_ROWS_SPOOLED = Counter(
+    "rtpm_db_rows_spooled_total",
+    "Metric rows diverted to the write-ahead spool instead of TimescaleDB",
+)
+DB_WRITE_LATENCY = Histogram(
+    "rtpm_db_write_latency_seconds",
+    "Time to COPY one ingestion batch into TimescaleDB",
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+
+
+def to_record(sample: MetricSample) -> Tuple:
+    """Row tuple in ``METRIC_COLUMNS`` order; labels travel as JSON text"""
+    return (
+        sample.timestamp,
+        sample.metric_name,
+        sample.metric_type,
+        sample.value,
+        json.dumps(sample.labels, separators=(",", ":")),
+        sample.help_text,
+        sample.unit,
+        sample.source,
+    )
+
+
+class MetricWriter:
+    """Ingestion sink that bulk-loads batches with COPY"""
+
+    def __init__(self, database: Database, table: str = "metrics"):
+        self.database = database
+        self.table = table
+
+    async def write(self, batch: Sequence[MetricSample]) -> None:
+        await self.copy([to_record(sample) for sample in batch])
+
+    async def copy(self, records: List[Tuple]) -> None:
+        start = perf_counter()
+        async with self.database.pool.acquire() as conn:
+            await conn.copy_records_to_table(
+                self.table,
+                records=records,
+                columns=METRIC_COLUMNS,
+            )
+        DB_WRITE_LATENCY.observe(perf_counter() - start)
+        DB_ROWS_WRITTEN.inc(len(records))
+
+
+def encode_records(records: List[Tuple]) -> bytes:
+    """Spool payload for a batch of ``to_record`` rows"""
+    return json.dumps(
+        [(r[0].isoformat(),) + tuple(r[1:]) for r in records], separators=(",", ":")
+    ).encode()
+
+
+def decode_records(payload: bytes) -> List[Tuple]:
+    return [(datetime.fromisoformat(r[0]),) + tuple(r[1:]) for r in json.loads(payload)]
+
+
+class DurableWriter:
+    """Ingestion sink that spools what the database cannot take and replays it later"""
+
+    def __init__(
+        self,
+        writer: MetricWriter,
+        spool: Spool,
+        write_timeout: float = 2.0,
+        replay_rate: float = 5000.0,
+        retry_interval: float = 1.0,
+        adopt_interval: float = 60.0,
+    ):
+        self.writer = writer
+        self.database = writer.database
+        self.spool = spool
+        self.write_timeout = write_timeout
+        self.replay_rate = replay_rate
+        self.retry_interval = retry_interval
+        self.adopt_interval = adopt_interval
+        self._adopt_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+        # Live COPYs, including those still running after write_timeout
+        self._copies: Set[asyncio.Future] = set()
+        # Live rows queued behind a backlog, not charged to replay_rate
+        self._queued_live = 0
+
+    async def write(self, batch: Sequence[MetricSample]) -> None:
+        records = [to_record(sample) for sample in batch]
+        if not self.spool.empty:
+            # Behind the backlog, so replay keeps ingestion order
+            self._queued_live += len(records)
+            await self._spool(records)
+            return
+        if not self.database.healthy:
+            await self._spool(records)
+            return
+        copy = asyncio.ensure_future(self._copy_or_spool(records))
+        self._copies.add(copy)
+        copy.add_done_callback(self._copies.discard)
+        try:
+            await asyncio.wait_for(asyncio.shield(copy), self.write_timeout)
+        except asyncio.TimeoutError:
+            # May still commit: spooling now could insert it twice
+            logger.warning(
+                "COPY of %d rows still running after %gs", len(records), self.write_timeout
+            )
+
+    async def _copy_or_spool(self, records: List[Tuple]) -> None:
+        try:
+            await self.writer.copy(records)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("Spooling %d rows after failed write: %s", len(records), e)
+            await self._spool(records)
+
+    async def _spool(self, records: List[Tuple]) -> None:
+        await self.spool.append(encode_records(records))
+        DB_ROWS_SPOOLED.inc(len(records))
+
+    async def start(self) -> None:
+        await self.spool.start()
+        if self._task is None:
+            self._task = asyncio.create_task(self._replay())
+
+    async def stop(self) -> None:
+        """Stop replaying; whatever is left stays spooled for the next start"""
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        # Slow COPYs finish (or fail into the spool) before it closes
+        if self._copies:
+            await asyncio.gather(*self._copies, return_exceptions=True)
+        await self.spool.stop()
+
+    async def _adopt(self) -> None:
+        if monotonic() < self._adopt_at:
+            return
+        self._adopt_at = monotonic() + self.adopt_interval
+        try:
+            await self.spool.adopt()
+        except OSError as e:
+            logger.warning("Could not adopt orphaned spool slots: %s", e)
+
+    async def _replay(self) -> None:
+        while True:
+            await self._adopt()
+            try:
+                payload = await self.spool.peek() if self.database.healthy else None
+            except OSError as e:
+                logger.warning("Spool replay paused: %s", e)
+                payload = None
+            if payload is None:
+                await asyncio.sleep(self.retry_interval)
+                continue
+            try:
+                records = decode_records(payload)
+            except (ValueError, TypeError, IndexError) as e:
+                # Intact on disk but unreadable; retrying it would stall replay for good
+                logger.error("Dropping undecodable spooled batch: %s", e)
+                await self.spool.commit()
+                continue
+            start = monotonic()
+            try:
+                # No timeout of our own: an abandoned COPY may still commit
+                await self.writer.copy(records)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Spool replay paused: %s", e)
+                await asyncio.sleep(self.retry_interval)
+                continue
+            await self.spool.commit()
+            # Pace the backlog to replay_rate rows per second; live rows queued
+            # behind it pass at the rate they arrive
+            live = min(len(records), self._queued_live)
+            self._queued_live = 0 if self.spool.empty else self._queued_live - live
+            pause = (len(records) - live) / self.replay_rate - (monotonic() - start)
+            if pause > 0:
+                await asyncio.sleep(pause)
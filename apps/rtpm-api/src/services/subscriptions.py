@@ -0,0 +1,232 @@
+"""
+WebSocket subscriptions
+
+Clients on ``/ws/metrics`` narrow their stream with a subscribe message::
+
+    {"type": "subscribe", "metrics": ["cpu_usage"], "labels": ["host=web-1"], "max_rate": 2}
+
+``metrics`` and ``labels`` are optional (labels may also be an object);
+a client that never subscribes receives everything.  ``window`` (seconds)
+switches the stream to per-series summaries, see ``downsampling``.
+Subscriptions are kept in a :class:`TopicIndex` keyed by metric name, or
+by one label pair when no names are given, so routing an event only looks
+at clients that could possibly want it.
+"""
+
+from dataclasses import dataclass, field
+from time import monotonic
+from typing import Any, Dict, FrozenSet, Hashable, List, Optional, Set, Tuple
+
+from prometheus_client import Counter
+
+from .series import series_key
+
+MAX_SUBSCRIBED_METRICS = 256
+MAX_SELECTORS = 32
+MAX_RATE = 100.0
+MIN_WINDOW = 0.1
+MAX_WINDOW = 3600.0
+# Per-subscription throttle state is reset rather than grown past this
+MAX_TRACKED_SERIES = 10000
+
+WEBSOCKET_RATE_LIMITED = Counter(
+    "rtpm_websocket_rate_limited_total",
+    "Updates skipped because a subscription's max_rate was exceeded",
+)
+
+
+class SubscriptionError(ValueError):
+    """Raised when a subscribe message is malformed"""
+
+
+@dataclass
+class Subscription:
+    """What one client wants to receive"""
+
+    metrics: FrozenSet[str] = frozenset()
+    labels: Dict[str, str] = field(default_factory=dict)
+    max_rate: Optional[float] = None
+    window: Optional[float] = None
+    _last_sent: Dict[Hashable, float] = field(default_factory=dict, repr=False)
+
+    @property
+    def min_interval(self) -> float:
+        return 1.0 / self.max_rate if self.max_rate else 0.0
+
+    def matches(self, metric_name: str, labels: Dict[str, str]) -> bool:
+        if self.metrics and metric_name not in self.metrics:
+            return False
+        for name, value in self.labels.items():
+            if labels.get(name) != value:
+                return False
+        return True
+
+    def allow(self, series: Hashable, now: float) -> bool:
+        """Apply ``max_rate`` to one series; records the send when allowed"""
+        last = self._last_sent.get(series)
+        if last is not None and now - last < self.min_interval:
+            WEBSOCKET_RATE_LIMITED.inc()
+            return False
+        if last is None and len(self._last_sent) >= MAX_TRACKED_SERIES:
+            self._last_sent.clear()
+        self._last_sent[series] = now
+        return True
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "metrics": sorted(self.metrics),
+            "labels": dict(self.labels),
+            "max_rate": self.max_rate,
+            "window": self.window,
+        }
+
+
+def parse_label_selectors(raw: Any) -> Dict[str, str]:
+    """Equality selectors from an object or a list of ``name=value`` strings"""
+    if raw is None:
+        return {}
+    if isinstance(raw, dict):
+        items = list(raw.items())
+    elif isinstance(raw, list):
+        items = []
+        for selector in raw:
+            if not isinstance(selector, str) or "=" not in selector:
+                raise SubscriptionError(f"label selector must look like name=value: {selector!r}")
+            name, _, value = selector.partition("=")
+            items.append((name.strip(), value.strip()))
+    else:
+        raise SubscriptionError("labels must be an object or a list of name=value strings")
+
+    if len(items) > MAX_SELECTORS:
+        raise SubscriptionError(f"at most {MAX_SELECTORS} label selectors are allowed")
+    selectors = {}
+    for name, value in items:
+        if not isinstance(name, str) or not name:
+            raise SubscriptionError("label selector names must be non-empty strings")
+        if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+            raise SubscriptionError(f"label selector {name!r} must have a scalar value")
+        selectors[name] = str(value)
+    return selectors
+
+
+def parse_subscription(message: Dict[str, Any]) -> Subscription:
+    """Build a :class:`Subscription` from a client's subscribe message"""
+    # Older clients nest the fields under "data"
+    body = message.get("data") if isinstance(message.get("data"), dict) else message
+
+    metrics = body.get("metrics", body.get("metric_names"))
+    if metrics is None:
+        metrics = []
+    elif isinstance(metrics, str):
+        metrics = [metrics]
+    if not isinstance(metrics, list) or not all(isinstance(m, str) and m for m in metrics):
+        raise SubscriptionError("metrics must be a list of metric names")
+    if len(metrics) > MAX_SUBSCRIBED_METRICS:
+        raise SubscriptionError(f"at most {MAX_SUBSCRIBED_METRICS} metrics can be subscribed")
+
+    max_rate = body.get("max_rate")
+    if max_rate is not None:
+        if isinstance(max_rate, bool) or not isinstance(max_rate, (int, float)) or max_rate <= 0:
+            raise SubscriptionError("max_rate must be a positive number of updates per second")
+        max_rate = min(float(max_rate), MAX_RATE)
+
+    window = body.get("window")
+    if window is not None:
+        if isinstance(window, bool) or not isinstance(window, (int, float)):
+            raise SubscriptionError("window must be a number of seconds")
+        if not MIN_WINDOW <= window <= MAX_WINDOW:
+            raise SubscriptionError(
+                f"window must be between {MIN_WINDOW:g} and {MAX_WINDOW:g} seconds"
+            )
+        window = float(window)
+
+    return Subscription(
+        metrics=frozenset(metrics),
+        labels=parse_label_selectors(body.get("labels")),
+        max_rate=max_rate,
+        window=window,
+    )
+
+
+class TopicIndex:
+    """Routes events to the subscriptions that can match them"""
+
+    def __init__(self):
+        self._subscriptions: Dict[Hashable, Subscription] = {}
+        self._by_metric: Dict[str, Set[Hashable]] = {}
+        self._by_label: Dict[Tuple[str, str], Set[Hashable]] = {}
+        self._everything: Set[Hashable] = set()
+
+    def __len__(self) -> int:
+        return len(self._subscriptions)
+
+    def get(self, key: Hashable) -> Optional[Subscription]:
+        return self._subscriptions.get(key)
+
+    def add(self, key: Hashable, subscription: Subscription) -> None:
+        """Register or replace the subscription for ``key``"""
+        self.remove(key)
+        self._subscriptions[key] = subscription
+        for bucket in self._buckets(subscription):
+            bucket.add(key)
+
+    def remove(self, key: Hashable) -> None:
+        subscription = self._subscriptions.pop(key, None)
+        if subscription is None:
+            return
+        for name in subscription.metrics:
+            self._discard(self._by_metric, name, key)
+        if not subscription.metrics and subscription.labels:
+            self._discard(self._by_label, next(iter(subscription.labels.items())), key)
+        self._everything.discard(key)
+
+    def match(
+        self,
+        metric_name: str,
+        labels: Dict[str, str],
+        now: Optional[float] = None,
+        series: Optional[Hashable] = None,
+    ) -> List[Hashable]:
+        """Keys whose subscription wants this event right now
+
+        ``series`` identifies the series for ``max_rate`` throttling; pass the
+        sample's series ID to avoid building a key from its labels.
+        """
+        candidates = list(self._everything)
+        candidates.extend(self._by_metric.get(metric_name, ()))
+        for pair in labels.items():
+            candidates.extend(self._by_label.get(pair, ()))
+        if not candidates:
+            return []
+
+        matched = []
+        for key in candidates:
+            subscription = self._subscriptions[key]
+            if not subscription.matches(metric_name, labels):
+                continue
+            # Windowed subscriptions need every sample; the window bounds their rate
+            if subscription.max_rate and not subscription.window:
+                if series is None:
+                    series = series_key(metric_name, labels)
+                if now is None:
+                    now = monotonic()
+                if not subscription.allow(series, now):
+                    continue
+            matched.append(key)
+        return matched
+
+    def _buckets(self, subscription: Subscription):
+        if subscription.metrics:
+            return [self._by_metric.setdefault(name, set()) for name in subscription.metrics]
+        if subscription.labels:
+            pair = next(iter(subscription.labels.items()))
+            return [self._by_label.setdefault(pair, set())]
+        return [self._everything]
+
+    @staticmethod
+    def _discard(index: Dict, bucket_key, key: Hashable) -> None:
+        bucket = index.get(bucket_key)
+        if bucket is not None:
+            bucket.discard(key)
+            if not bucket:
+                del index[bucket_key]
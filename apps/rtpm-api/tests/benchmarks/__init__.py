@@ -0,0 +1,6 @@
+"""
+Benchmarks for the RTPM API
+
+Run from ``apps/rtpm-api`` with ``python -m tests.benchmarks``; see
+``--help`` and the Benchmarks section of the README.
+"""
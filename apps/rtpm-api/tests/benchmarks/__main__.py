@@ -0,0 +1,106 @@
+"""
+Run RTPM benchmarks and gate on the recorded baseline
+
+    python -m tests.benchmarks                     # every scenario, compared to baseline.json
+    python -m tests.benchmarks ingest fanout       # selected scenarios
+    python -m tests.benchmarks --update-baseline   # record the current numbers
+    python -m tests.benchmarks mixed --profile spike --connections 200
+
+Exits 1 when a scenario is over its latency budget or has regressed past
+``--tolerance`` against the baseline.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+from .harness import compare, environment, load_baseline, over_budget, save_baseline
+from .scenarios import PROFILES, SCENARIOS, run_scenario
+
+DEFAULT_BASELINE = Path(__file__).with_name("baseline.json")
+COLUMNS = ("requests", "errors", "throughput_rps", "p50_ms", "p99_ms", "server_cpu_ms_per_request")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="python -m tests.benchmarks", description=__doc__.strip())
+    parser.add_argument("scenarios", nargs="*", help=f"default: all of {', '.join(SCENARIOS)}")
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=2.0, help="unmeasured seconds first")
+    parser.add_argument("--connections", type=int, default=16, help="peak HTTP workers")
+    parser.add_argument("--profile", choices=PROFILES, default="constant")
+    parser.add_argument("--clients", type=int, default=50, help="fanout WebSocket clients")
+    parser.add_argument("--rate", type=float, default=200.0, help="fanout samples per second")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per scenario; median kept")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=None, help="default: the baseline's")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--json", type=Path, help="also write the results here")
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name!r}, choose from {', '.join(SCENARIOS)}")
+    return args
+
+
+def median_run(runs):
+    """The run with the median throughput, so one noisy run cannot set the numbers"""
+    return sorted(runs, key=lambda r: r["throughput_rps"])[len(runs) // 2]
+
+
+def result_name(scenario: str, profile: str) -> str:
+    return scenario if profile == "constant" else f"{scenario}:{profile}"
+
+
+async def run(args: argparse.Namespace) -> int:
+    baseline = load_baseline(args.baseline)
+    tolerance = args.tolerance if args.tolerance is not None else baseline.get("tolerance", 0.25)
+    if baseline.get("environment") and baseline["environment"] != environment():
+        print(f"note: baseline recorded on {baseline['environment']}", file=sys.stderr)
+
+    results, failures = {}, []
+    for name in args.scenarios or list(SCENARIOS):
+        scenario = SCENARIOS[name]
+        key = result_name(name, args.profile)
+        print(f"{key}: {scenario.description}", file=sys.stderr)
+        runs = [
+            await run_scenario(
+                scenario,
+                duration=args.duration,
+                connections=args.connections,
+                profile=args.profile,
+                warmup=args.warmup,
+                clients=args.clients,
+                rate=args.rate,
+            )
+            for _ in range(max(1, args.repeat))
+        ]
+        result = median_run(runs)
+        results[key] = result
+        failures.extend(over_budget(key, result, scenario.budget))
+
+    widths = [len(c) + 2 for c in COLUMNS]
+    print(f"{'scenario':<16}" + "".join(f"{c:>{w}}" for c, w in zip(COLUMNS, widths)))
+    for key, result in results.items():
+        cells = (f"{result.get(c, ''):>{w}}" for c, w in zip(COLUMNS, widths))
+        print(f"{key:<16}" + "".join(cells))
+    if args.json:
+        args.json.write_text(json.dumps(results, indent=2) + "\n")
+
+    if args.update_baseline:
+        save_baseline(args.baseline, results, tolerance)
+        print(f"baseline updated: {args.baseline}", file=sys.stderr)
+    else:
+        failures.extend(compare(results, baseline, tolerance))
+    for failure in failures:
+        print(f"FAIL {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+def main(argv=None) -> int:
+    return asyncio.run(run(parse_args(argv)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
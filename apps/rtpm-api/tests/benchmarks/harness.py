@@ -0,0 +1,405 @@
+"""
+Benchmark harness for the RTPM API
+
+Boots the real ASGI app under uvicorn in a subprocess, bound to loopback
+with no database or Redis, and drives it from an asyncio load generator
+in this process.  Requests go over a minimal keep-alive HTTP/1.1 client
+so what is timed is the server, not a test client: each worker owns one
+connection and sends its next request as soon as the previous response
+is read (closed loop), with the number of active workers following a
+k6-style stage profile.
+
+A run is summarised as p50/p90/p99/max latency, throughput and the
+server's CPU time per request.  Summaries are saved to a JSON baseline
+and later runs are compared against it: any latency more than
+``tolerance`` above the baseline, or throughput more than ``tolerance``
+below it, is a regression.
+"""
+
+import asyncio
+import json
+import math
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+import psutil
+
+APP_DIR = Path(__file__).resolve().parents[2]
+
+# Environment for the server under test: no external services, nothing rate limited
+SERVER_ENV = {
+    "ENVIRONMENT": "benchmark",
+    "LOG_LEVEL": "WARNING",
+    "DATABASE_URL": "",
+    "REDIS_URL": "",
+    "SPOOL_DIR": "",
+    "INGEST_RATE_LIMIT": "0",
+}
+
+# Latency fields compared against the baseline (lower is better)
+LATENCY_FIELDS = ("p50_ms", "p99_ms")
+# Throughput fields compared against the baseline (higher is better)
+THROUGHPUT_FIELDS = ("throughput_rps",)
+
+# (seconds from the start of the stage, active workers at its end); linear ramps
+Stages = Sequence[Tuple[float, int]]
+
+
+class BenchmarkError(RuntimeError):
+    """Raised when the server under test cannot be started or misbehaves"""
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class HTTPConnection:
+    """Keep-alive HTTP/1.1 client for Content-Length responses"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def open(self) -> None:
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except ConnectionError:
+                pass
+            self._writer = self._reader = None
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        body: Optional[bytes] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Tuple[int, bytes]:
+        """Send one request and read the whole response: (status, body)"""
+        if self._writer is None:
+            await self.open()
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}"]
+        for name, value in (headers or {}).items():
+            lines.append(f"{name}: {value}")
+        if body is not None:
+            lines.append("Content-Type: application/json")
+            lines.append(f"Content-Length: {len(body)}")
+        self._writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + (body or b""))
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            await self.close()
+            raise ConnectionError("server closed the connection")
+        status = int(status_line.split(b" ", 2)[1])
+        length = 0
+        keep_alive = True
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            name = name.strip().lower()
+            if name == "content-length":
+                length = int(value)
+            elif name == "transfer-encoding":
+                raise BenchmarkError(f"{path}: chunked responses are not supported")
+            elif name == "connection" and value.strip().lower() == "close":
+                keep_alive = False
+        payload = await self._reader.readexactly(length) if length else b""
+        if not keep_alive:
+            await self.close()
+        return status, payload
+
+
+class Server:
+    """The RTPM API under uvicorn in a child process"""
+
+    def __init__(
+        self,
+        env: Optional[Dict[str, str]] = None,
+        port: Optional[int] = None,
+        startup_timeout: float = 30.0,
+        args: Sequence[str] = (),
+    ):
+        self.host = "127.0.0.1"
+        self.port = port or free_port()
+        self.env = {**os.environ, **SERVER_ENV, **(env or {})}
+        # Extra uvicorn command-line options
+        self.args = list(args)
+        self.startup_timeout = startup_timeout
+        self.process: Optional[subprocess.Popen] = None
+        self._ps: Optional[psutil.Process] = None
+        # Server output goes here rather than interleaving with the results
+        self.log = tempfile.NamedTemporaryFile(prefix="rtpm-bench-", suffix=".log", delete=False)
+
+    @property
+    def http_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def ws_url(self) -> str:
+        return f"ws://{self.host}:{self.port}"
+
+    def connection(self) -> HTTPConnection:
+        return HTTPConnection(self.host, self.port)
+
+    async def start(self) -> None:
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "src.main:app",
+                "--host",
+                self.host,
+                "--port",
+                str(self.port),
+                "--log-level",
+                "warning",
+                "--no-access-log",
+                *self.args,
+            ],
+            cwd=APP_DIR,
+            env=self.env,
+            stdout=self.log,
+            stderr=subprocess.STDOUT,
+        )
+        self._ps = psutil.Process(self.process.pid)
+        deadline = time.monotonic() + self.startup_timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise BenchmarkError(
+                    f"server exited with {self.process.returncode}, see {self.log.name}"
+                )
+            conn = self.connection()
+            try:
+                status, _ = await conn.request("GET", "/health")
+                if status == 200:
+                    return
+            except (OSError, asyncio.IncompleteReadError):
+                pass
+            finally:
+                await conn.close()
+            await asyncio.sleep(0.1)
+        await self.stop()
+        raise BenchmarkError(
+            f"server not healthy after {self.startup_timeout:g}s, see {self.log.name}"
+        )
+
+    async def stop(self) -> None:
+        if self.process is None:
+            return
+        process, self.process = self.process, None
+        if process.poll() is None:
+            process.send_signal(signal.SIGINT)
+            try:
+                await asyncio.to_thread(process.wait, 15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        self.log.close()
+        if process.returncode in (0, -signal.SIGINT):
+            os.unlink(self.log.name)
+
+    def cpu_seconds(self) -> float:
+        """User plus system CPU time the server has used so far"""
+        times = self._ps.cpu_times()
+        return times.user + times.system
+
+    def rss_bytes(self) -> int:
+        return self._ps.memory_info().rss
+
+    async def __aenter__(self) -> "Server":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.stop()
+
+
+def percentile(ordered: Sequence[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted sequence"""
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))
+    return ordered[index]
+
+
+class Recorder:
+    """Latencies and errors of one workload"""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.errors = 0
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.latencies.append(seconds)
+
+    def error(self) -> None:
+        self.errors += 1
+
+    def finish(self) -> None:
+        self.elapsed = time.perf_counter() - self.started
+
+    def summary(self, cpu_seconds: Optional[float] = None) -> Dict[str, Any]:
+        ordered = sorted(self.latencies)
+        count = len(ordered)
+        elapsed = self.elapsed or time.perf_counter() - self.started
+        summary = {
+            "requests": count,
+            "errors": self.errors,
+            "throughput_rps": round(count / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+            "p90_ms": round(percentile(ordered, 0.90) * 1000, 3),
+            "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+            "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+        }
+        if cpu_seconds is not None and count:
+            summary["server_cpu_ms_per_request"] = round(cpu_seconds / count * 1000, 4)
+        return summary
+
+
+def active_workers(stages: Stages, elapsed: float) -> int:
+    """Workers a stage profile calls for ``elapsed`` seconds into the run"""
+    previous = 0
+    for duration, target in stages:
+        if elapsed < duration:
+            return round(previous + (target - previous) * elapsed / duration)
+        elapsed -= duration
+        previous = target
+    return previous
+
+
+Request = Callable[[HTTPConnection, int], Awaitable[int]]
+
+
+async def closed_loop(
+    server: Server,
+    request: Request,
+    stages: Stages,
+    recorder: Recorder,
+) -> None:
+    """Run ``request`` from as many workers as the profile calls for
+
+    ``request(connection, sequence)`` returns the response status; anything
+    but 2xx/3xx (or an exception) counts as an error.
+    """
+    workers = max(target for _, target in stages)
+    total = sum(duration for duration, _ in stages)
+    started = time.perf_counter()
+    deadline = started + total
+
+    async def worker(index: int) -> None:
+        conn = server.connection()
+        sequence = index
+        try:
+            while True:
+                now = time.perf_counter()
+                if now >= deadline:
+                    return
+                if index >= active_workers(stages, now - started):
+                    await asyncio.sleep(0.01)
+                    continue
+                begin = time.perf_counter()
+                try:
+                    status = await request(conn, sequence)
+                except (OSError, asyncio.IncompleteReadError, BenchmarkError):
+                    await conn.close()
+                    status = 0
+                end = time.perf_counter()
+                sequence += workers
+                if 200 <= status < 400:
+                    recorder.record(end - begin)
+                else:
+                    recorder.error()
+        finally:
+            await conn.close()
+
+    await asyncio.gather(*(worker(i) for i in range(workers)))
+
+
+def environment() -> Dict[str, Any]:
+    """Where a baseline was recorded; numbers only compare on like hardware"""
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def load_baseline(path: Path) -> Dict[str, Any]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"environment": None, "results": {}}
+
+
+def save_baseline(path: Path, results: Dict[str, Dict[str, Any]], tolerance: float) -> None:
+    """Merge ``results`` into the baseline file, keeping other benchmarks' entries"""
+    baseline = load_baseline(path)
+    baseline["environment"] = environment()
+    baseline["tolerance"] = tolerance
+    baseline.setdefault("results", {}).update(results)
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def compare(
+    results: Dict[str, Dict[str, Any]],
+    baseline: Dict[str, Any],
+    tolerance: float,
+) -> List[str]:
+    """Regressions of ``results`` against a baseline, as human-readable lines"""
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get("results", {}).get(name)
+        if not reference:
+            continue
+        for key in LATENCY_FIELDS:
+            if key in reference and result.get(key, 0) > reference[key] * (1 + tolerance):
+                regressions.append(
+                    f"{name}: {key} {result[key]:.3f} > baseline {reference[key]:.3f} "
+                    f"+{tolerance:.0%}"
+                )
+        for key in THROUGHPUT_FIELDS:
+            if key in reference and result.get(key, 0) < reference[key] * (1 - tolerance):
+                regressions.append(
+                    f"{name}: {key} {result[key]:.1f} < baseline {reference[key]:.1f} "
+                    f"-{tolerance:.0%}"
+                )
+    return regressions
+
+
+def over_budget(name: str, result: Dict[str, Any], budget: Dict[str, float]) -> List[str]:
+    """Absolute limits a result must meet on any hardware"""
+    failures = []
+    for key, limit in budget.items():
+        if key == "error_rate":
+            total = result["requests"] + result["errors"]
+            value = result["errors"] / total if total else 0.0
+        else:
+            value = result.get(key, 0.0)
+        if value > limit:
+            failures.append(f"{name}: {key} {value:g} over budget {limit:g}")
+    return failures
@@ -0,0 +1,162 @@
+"""
+Import-time benchmark
+
+A machine scaled up from zero cannot answer until ``import src.main`` has
+finished, so the time it takes is part of every cold start.  Each run
+imports the app in a fresh interpreter (with the benchmark server's
+environment) and records:
+
+* the import itself, timed inside the child
+* the whole process, interpreter start to exit, timed by the parent
+* which of ``LAZY_MODULES`` were loaded; these must stay out of import
+  (they are imported where first used) and any that appear fail the run
+
+One extra run under ``python -X importtime`` lists the modules that cost
+the most, to show where a regression came from.
+
+    python -m tests.benchmarks.imports
+    python -m tests.benchmarks.imports --runs 20 --update-baseline
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from .harness import (
+    APP_DIR,
+    SERVER_ENV,
+    compare,
+    environment,
+    load_baseline,
+    over_budget,
+    percentile,
+    save_baseline,
+)
+
+DEFAULT_BASELINE = Path(__file__).with_name("baseline.json")
+BASELINE_KEY = "import"
+BUDGET = {"p50_ms": 2000.0}
+# Heavy dependencies that only specific code paths need
+LAZY_MODULES = ("boto3", "botocore", "asyncpg", "redis")
+
+PROBE = f"""
+import json, sys, time
+start = time.perf_counter()
+import src.main
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "import": elapsed,
+    "modules": len(sys.modules),
+    "lazy": [m for m in {LAZY_MODULES!r} if m in sys.modules],
+}}))
+"""
+
+
+def _run(*flags: str) -> Tuple[Dict[str, Any], float, str]:
+    """Import the app once in a new interpreter; returns (probe, wall seconds, stderr)"""
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, *flags, "-c", PROBE],
+        cwd=APP_DIR,
+        env={**os.environ, **SERVER_ENV},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    wall = time.perf_counter() - start
+    return json.loads(proc.stdout.strip().splitlines()[-1]), wall, proc.stderr
+
+
+def slowest_modules(importtime: str, top: int) -> List[Tuple[str, float]]:
+    """Modules with the most self time, from ``-X importtime`` output"""
+    modules = []
+    for line in importtime.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:") :].split("|")
+        modules.append((name.strip(), int(self_us) / 1000))
+    return sorted(modules, key=lambda m: m[1], reverse=True)[:top]
+
+
+def run_imports(runs: int = 10, top: int = 10) -> Dict[str, Any]:
+    """Time ``runs`` cold imports of the app; returns the summary"""
+    # Unmeasured: writes any missing bytecode, as a built image already has
+    _run()
+    imports, walls, lazy = [], [], set()
+    modules = 0
+    for _ in range(runs):
+        probe, wall, _ = _run()
+        imports.append(probe["import"])
+        walls.append(wall)
+        lazy.update(probe["lazy"])
+        modules = probe["modules"]
+    _, _, importtime = _run("-X", "importtime")
+
+    imports.sort()
+    walls.sort()
+    return {
+        "runs": runs,
+        "p50_ms": round(percentile(imports, 0.50) * 1000, 1),
+        "p99_ms": round(percentile(imports, 0.99) * 1000, 1),
+        "process_p50_ms": round(percentile(walls, 0.50) * 1000, 1),
+        "modules": modules,
+        "lazy_loaded": sorted(lazy),
+        "slowest_modules": [
+            {"module": name, "self_ms": round(ms, 1)} for name, ms in slowest_modules(importtime, top)
+        ],
+    }
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m tests.benchmarks.imports", description=__doc__.strip().splitlines()[0]
+    )
+    parser.add_argument("--runs", type=int, default=10, help="measured interpreter starts")
+    parser.add_argument("--top", type=int, default=10, help="slowest modules listed")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=None, help="default: the baseline's")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--json", type=Path, help="also write the result here")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    baseline = load_baseline(args.baseline)
+    tolerance = args.tolerance if args.tolerance is not None else baseline.get("tolerance", 0.25)
+    if baseline.get("environment") and baseline["environment"] != environment():
+        print(f"note: baseline recorded on {baseline['environment']}", file=sys.stderr)
+
+    result = run_imports(runs=args.runs, top=args.top)
+    slowest = result.pop("slowest_modules")
+    width = max(len(k) for k in result)
+    for name, value in result.items():
+        print(f"{name:<{width}}  {value}")
+    print("\nslowest modules (self time)")
+    for entry in slowest:
+        print(f"  {entry['self_ms']:>8.1f} ms  {entry['module']}")
+    if args.json:
+        args.json.write_text(
+            json.dumps({BASELINE_KEY: {**result, "slowest_modules": slowest}}, indent=2) + "\n"
+        )
+
+    failures = over_budget(BASELINE_KEY, result, BUDGET)
+    if result["lazy_loaded"]:
+        failures.append(f"{BASELINE_KEY}: loaded at import: {', '.join(result['lazy_loaded'])}")
+    if args.update_baseline:
+        save_baseline(args.baseline, {BASELINE_KEY: result}, tolerance)
+        print(f"baseline updated: {args.baseline}", file=sys.stderr)
+    else:
+        failures.extend(compare({BASELINE_KEY: result}, baseline, tolerance))
+    for failure in failures:
+        print(f"FAIL {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
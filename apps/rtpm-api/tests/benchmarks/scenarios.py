@@ -0,0 +1,339 @@
+"""
+RTPM benchmark scenarios
+
+Python equivalents of the k6 scenarios in ``tests/load_testing`` and the
+locust users in ``tests/performance``, runnable against a local server
+with no network beyond loopback.  Payloads come from a seeded generator
+so every run sends the same requests.
+
+Workloads:
+
+* ``ingest`` - metric batches and agent snapshots to ``POST /api/v1/metrics``
+* ``query`` - hot-window reads and filtered agent listings
+* ``mixed`` - the locust ``RTPMAPIUser`` task mix
+* ``fanout`` - samples ingested at a fixed rate, timed from POST until
+  every subscribed WebSocket client has received them
+
+Profiles (k6 executors, scaled to ``duration`` and ``connections``):
+``constant`` (``baseline_load``), ``stress`` (``stress_test``), ``spike``
+(``spike_test``) and ``soak`` (``soak_test``, five times as long).
+"""
+
+import asyncio
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+from .harness import HTTPConnection, Recorder, Server, Stages, closed_loop
+
+SEED = 1337
+METRIC_NAMES = ("cpu_usage", "memory_usage", "response_time")
+FANOUT_METRIC = "bench_fanout"
+
+
+def profile_stages(profile: str, duration: float, connections: int) -> Stages:
+    """Stage list for a k6-style profile"""
+    if profile == "constant":
+        return [(duration, connections)]
+    if profile == "soak":
+        return [(duration * 5, connections)]
+    if profile == "stress":
+        # 1m to 20, 3m at 50, 2m to 100, 2m at 100, 1m down, out of 100 VUs
+        unit = duration / 9
+        return [
+            (unit, max(1, connections // 5)),
+            (unit * 3, max(1, connections // 2)),
+            (unit * 2, connections),
+            (unit * 2, connections),
+            (unit, 0),
+        ]
+    if profile == "spike":
+        # 30s at 10, 10s to 200, 30s at 200, 10s back to 10, 30s at 10
+        unit = duration / 110
+        base = max(1, connections // 20)
+        return [
+            (unit * 30, base),
+            (unit * 10, connections),
+            (unit * 30, connections),
+            (unit * 10, base),
+            (unit * 30, base),
+        ]
+    raise ValueError(f"unknown profile: {profile}")
+
+
+PROFILES = ("constant", "stress", "spike", "soak")
+
+
+class Payloads:
+    """Deterministic request bodies, generated once per run"""
+
+    def __init__(self, seed: int = SEED, agents: int = 100, variants: int = 256):
+        rng = random.Random(seed)
+        self.agent_ids = [f"agent-{i:04d}" for i in range(agents)]
+        self.agents = [
+            {
+                "id": agent_id,
+                "name": f"Agent-{agent_id[6:]}",
+                "status": rng.choice(["online", "offline", "warning", "error"]),
+                "version": f"v{rng.randint(1, 3)}.{rng.randint(0, 9)}.{rng.randint(0, 9)}",
+                "capabilities": ["monitoring", "analysis", "reporting"][: rng.randint(1, 3)],
+                "region": rng.choice(["us-east-1", "us-west-2", "eu-west-1"]),
+                "platform": rng.choice(["OpenAI", "Anthropic", "Google"]),
+            }
+            for agent_id in self.agent_ids
+        ]
+        # locust ingest_metrics: 1-10 metrics per request
+        self.batches = [
+            json.dumps(
+                {
+                    "metrics": [
+                        {
+                            "name": rng.choice(METRIC_NAMES),
+                            "value": rng.uniform(0, 100),
+                            "labels": {
+                                "host": f"load-test-host-{rng.randint(1, 10)}",
+                                "environment": "load-test",
+                            },
+                        }
+                        for _ in range(rng.randint(1, 10))
+                    ]
+                }
+            ).encode()
+            for _ in range(variants)
+        ]
+        # k6 generateMetrics: one agent snapshot
+        self.snapshots = [
+            json.dumps(
+                {
+                    "agentId": rng.choice(self.agent_ids),
+                    "cpu": rng.random() * 100,
+                    "memory": rng.random() * 100,
+                    "requestRate": rng.random() * 1000,
+                    "errorRate": rng.random() * 10,
+                    "responseTime": rng.random() * 500,
+                    "throughput": rng.random() * 2000,
+                    "activeConnections": rng.randint(0, 100),
+                    "queueDepth": rng.randint(0, 50),
+                    "diskUsage": rng.random() * 100,
+                    "networkLatency": rng.random() * 100,
+                }
+            ).encode()
+            for _ in range(variants)
+        ]
+
+
+async def seed(server: Server, payloads: Payloads) -> None:
+    """Register the agents and fill the hot window before a read workload"""
+    conn = server.connection()
+    try:
+        for agent in payloads.agents:
+            await conn.request("POST", "/api/v1/agents", json.dumps(agent).encode())
+        for body in payloads.batches + payloads.snapshots:
+            await conn.request("POST", "/api/v1/metrics", body)
+    finally:
+        await conn.close()
+    # Let the ingestion batcher flush into the hot window
+    await asyncio.sleep(0.5)
+
+
+Request = Callable[[HTTPConnection, int], Awaitable[int]]
+
+
+def ingest_request(payloads: Payloads) -> Request:
+    async def request(conn: HTTPConnection, sequence: int) -> int:
+        pool = payloads.snapshots if sequence % 2 else payloads.batches
+        status, _ = await conn.request("POST", "/api/v1/metrics", pool[sequence % len(pool)])
+        return status
+
+    return request
+
+
+QUERY_PATHS = (
+    "/api/v1/metrics/current?metric_name=cpu_usage&limit=100",
+    "/api/v1/metrics/latest/memory_usage",
+    "/api/v1/metrics/current?labels=environment%3Dload-test",
+    "/api/v1/agents?status=online&limit=50",
+    "/api/v1/agents?region=us-east-1&capability=monitoring",
+)
+
+
+def query_request(payloads: Payloads) -> Request:
+    async def request(conn: HTTPConnection, sequence: int) -> int:
+        status, _ = await conn.request("GET", QUERY_PATHS[sequence % len(QUERY_PATHS)])
+        return status
+
+    return request
+
+
+def mixed_request(payloads: Payloads) -> Request:
+    """locust RTPMAPIUser weights: health 3, ingest 5, query 4, agents 2, alert rules 1"""
+    tasks: List[Tuple[str, str, Any]] = (
+        [("GET", "/health", None)] * 3
+        + [("POST", "/api/v1/metrics", payloads.batches)] * 5
+        + [("GET", QUERY_PATHS[i % 3], None) for i in range(4)]
+        + [("GET", QUERY_PATHS[3 + i], None) for i in range(2)]
+        + [("GET", "/api/v1/alerts/rules", None)]
+    )
+    order = list(range(len(tasks)))
+    random.Random(SEED).shuffle(order)
+
+    async def request(conn: HTTPConnection, sequence: int) -> int:
+        method, path, bodies = tasks[order[sequence % len(order)]]
+        body = bodies[sequence % len(bodies)] if bodies else None
+        status, _ = await conn.request(method, path, body)
+        return status
+
+    return request
+
+
+async def run_fanout(
+    server: Server,
+    duration: float,
+    clients: int = 50,
+    rate: float = 200.0,
+    warmup: float = 1.0,
+) -> Dict[str, Any]:
+    """Open-loop ingest of ``rate`` samples/s, each timed until every client has it"""
+    import websockets
+
+    recorder = Recorder()
+    subscribed = asyncio.Event()
+    ready = 0
+    measuring = False
+
+    async def client() -> None:
+        nonlocal ready
+        async with websockets.connect(f"{server.ws_url}/ws/metrics", max_size=None) as ws:
+            await ws.send(json.dumps({"type": "subscribe", "metrics": [FANOUT_METRIC]}))
+            async for message in ws:
+                event = json.loads(message)
+                if event.get("type") == "subscribed":
+                    ready += 1
+                    if ready == clients:
+                        subscribed.set()
+                elif event.get("type") == "metric" and measuring:
+                    payload = event["payload"]
+                    if payload.get("name", payload.get("metric_name")) == FANOUT_METRIC:
+                        recorder.record(time.time() - payload["value"])
+
+    tasks = [asyncio.create_task(client()) for _ in range(clients)]
+    try:
+        await asyncio.wait_for(subscribed.wait(), timeout=30.0)
+        conn = server.connection()
+        published = 0
+        interval = 1.0 / rate
+        started = time.perf_counter()
+        next_send = started
+        cpu_start = server.cpu_seconds()
+        while True:
+            now = time.perf_counter()
+            if now - started >= duration + warmup:
+                break
+            if not measuring and now - started >= warmup:
+                measuring = True
+                recorder = Recorder()
+                cpu_start = server.cpu_seconds()
+                published = 0
+            body = json.dumps({"name": FANOUT_METRIC, "value": time.time()}).encode()
+            status, _ = await conn.request("POST", "/api/v1/metrics", body)
+            if status != 202:
+                recorder.error()
+            published += 1
+            next_send += interval
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        await conn.close()
+        recorder.finish()
+        # Frames still in flight when publishing stopped
+        await asyncio.sleep(1.0)
+        cpu = server.cpu_seconds() - cpu_start
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    summary = recorder.summary(cpu_seconds=cpu)
+    expected = published * clients
+    summary.update(
+        {
+            "clients": clients,
+            "published": published,
+            "errors": summary["errors"] + max(0, expected - summary["requests"]),
+        }
+    )
+    # Deliveries per second, for every client together
+    summary["throughput_rps"] = round(summary["requests"] / duration, 1)
+    return summary
+
+
+@dataclass
+class Scenario:
+    name: str
+    description: str
+    # Absolute limits, independent of the baseline (see harness.over_budget)
+    budget: Dict[str, float] = field(default_factory=dict)
+    request: Callable[[Payloads], Request] = None
+    seeded: bool = False
+
+
+SCENARIOS = {
+    scenario.name: scenario
+    for scenario in (
+        Scenario(
+            "ingest",
+            "Metric batches and agent snapshots to POST /api/v1/metrics",
+            budget={"p99_ms": 100.0, "error_rate": 0.001},
+            request=ingest_request,
+        ),
+        Scenario(
+            "query",
+            "Hot-window reads and filtered agent listings",
+            budget={"p99_ms": 100.0, "error_rate": 0.001},
+            request=query_request,
+            seeded=True,
+        ),
+        Scenario(
+            "mixed",
+            "The locust RTPMAPIUser task mix",
+            budget={"p99_ms": 150.0, "error_rate": 0.001},
+            request=mixed_request,
+            seeded=True,
+        ),
+        Scenario(
+            "fanout",
+            "Fixed-rate ingest timed to delivery on every subscribed WebSocket",
+            budget={"p99_ms": 1000.0, "error_rate": 0.01},
+        ),
+    )
+}
+
+
+async def run_scenario(
+    scenario: Scenario,
+    duration: float = 10.0,
+    connections: int = 16,
+    profile: str = "constant",
+    warmup: float = 1.0,
+    clients: int = 50,
+    rate: float = 200.0,
+) -> Dict[str, Any]:
+    """Run one scenario against a freshly started server"""
+    async with Server() as server:
+        if scenario.name == "fanout":
+            return await run_fanout(server, duration, clients=clients, rate=rate, warmup=warmup)
+        payloads = Payloads()
+        if scenario.seeded:
+            await seed(server, payloads)
+        request = scenario.request(payloads)
+        if warmup:
+            await closed_loop(server, request, [(warmup, connections)], Recorder())
+        recorder = Recorder()
+        cpu_start = server.cpu_seconds()
+        await closed_loop(server, request, profile_stages(profile, duration, connections), recorder)
+        recorder.finish()
+        summary = recorder.summary(cpu_seconds=server.cpu_seconds() - cpu_start)
+        summary["connections"] = connections
+        return summary
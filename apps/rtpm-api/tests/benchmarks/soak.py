@@ -0,0 +1,303 @@
+"""
+WebSocket fan-out soak benchmark
+
+Opens thousands of ``/ws/metrics`` subscribers against a local server,
+ingests one sample at a time at a fixed rate and measures what capacity
+planning needs:
+
+* end-to-end latency, from just before the POST until a client has the
+  frame (the sample's value is its send time; both ends share a clock)
+* the share of frames delivered (the rest were dropped or their client
+  was evicted as a slow consumer)
+* server memory per connection (RSS with every client subscribed minus
+  RSS before the first connected)
+* server CPU per delivered frame
+
+A single Python process cannot read tens of thousands of frames a second,
+so the clients are spread over ``--processes`` worker processes.  Each
+reports its own CPU use; when a worker is close to a full core the
+numbers measure the load generator rather than the server, and the run
+says so.
+
+    python -m tests.benchmarks.soak --clients 1000 --rate 20 --duration 30
+    python -m tests.benchmarks.soak --clients 10000 --rate 5 --processes 8 --update-baseline
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from array import array
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from .harness import (
+    Server,
+    compare,
+    environment,
+    load_baseline,
+    over_budget,
+    percentile,
+    save_baseline,
+)
+from .scenarios import FANOUT_METRIC
+
+DEFAULT_BASELINE = Path(__file__).with_name("baseline.json")
+BUDGET = {"p99_ms": 1000.0, "error_rate": 0.01}
+# Concurrent WebSocket handshakes per worker process
+HANDSHAKES = 100
+# Generator CPU share above which results are suspect
+GENERATOR_SATURATED = 0.9
+
+
+def raise_fd_limit() -> int:
+    """Lift the soft open-file limit to the hard one; returns the new limit"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+async def _clients(url: str, count: int, pipe) -> None:
+    """Worker process body: connect, subscribe, record, report"""
+    import websockets
+
+    loop = asyncio.get_running_loop()
+    sent_at = array("d")
+    latency = array("d")
+    subscribe = json.dumps({"type": "subscribe", "metrics": [FANOUT_METRIC]})
+    handshakes = asyncio.Semaphore(HANDSHAKES)
+    subscribed = 0
+    failed = 0
+    closed = 0
+    settled = asyncio.Event()
+
+    def settle() -> None:
+        if subscribed + failed == count:
+            settled.set()
+
+    async def client() -> None:
+        nonlocal subscribed, failed, closed
+        try:
+            async with handshakes:
+                ws = await websockets.connect(
+                    url, max_size=None, open_timeout=120, ping_interval=None
+                )
+                await ws.send(subscribe)
+        except Exception:
+            failed += 1
+            settle()
+            return
+        try:
+            async for message in ws:
+                now = time.time()
+                event = json.loads(message)
+                kind = event.get("type")
+                if kind == "metric" and event["payload"].get("name") == FANOUT_METRIC:
+                    sent = event["payload"]["value"]
+                    sent_at.append(sent)
+                    latency.append(now - sent)
+                elif kind == "subscribed":
+                    subscribed += 1
+                    settle()
+        except websockets.ConnectionClosed:
+            pass
+        closed += 1
+
+    tasks = [asyncio.create_task(client()) for _ in range(count)]
+    await settled.wait()
+    pipe.send(("ready", subscribed, failed))
+
+    await loop.run_in_executor(None, pipe.recv)
+    cpu = time.process_time()
+    _, start, end = await loop.run_in_executor(None, pipe.recv)
+    cpu = time.process_time() - cpu
+    # Only the server closes sockets before this point: slow-consumer evictions
+    evicted = closed
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    window = array("d", (lat for sent, lat in zip(sent_at, latency) if start <= sent < end))
+    pipe.send(("done", window.tobytes(), evicted, cpu))
+
+
+def _worker_main(url: str, count: int, pipe) -> None:
+    raise_fd_limit()
+    asyncio.run(_clients(url, count, pipe))
+
+
+async def run_soak(
+    clients: int = 1000,
+    rate: float = 20.0,
+    duration: float = 30.0,
+    warmup: float = 5.0,
+    processes: Optional[int] = None,
+    drain: float = 2.0,
+) -> Dict[str, Any]:
+    """Soak ``clients`` subscribers with ``rate`` samples/s; returns the summary"""
+    raise_fd_limit()
+    processes = processes or max(1, min(os.cpu_count() or 1, math.ceil(clients / 1000)))
+    loop = asyncio.get_running_loop()
+    context = multiprocessing.get_context("spawn")
+
+    async with Server(args=["--backlog", "4096"]) as server:
+        url = f"{server.ws_url}/ws/metrics"
+        await asyncio.sleep(0.5)
+        rss_idle = server.rss_bytes()
+
+        workers = []
+        for index in range(processes):
+            count = clients // processes + (1 if index < clients % processes else 0)
+            parent, child = context.Pipe()
+            process = context.Process(target=_worker_main, args=(url, count, child), daemon=True)
+            process.start()
+            workers.append((process, parent))
+        try:
+            connected = failed = 0
+            for _, pipe in workers:
+                _, ok, bad = await loop.run_in_executor(None, pipe.recv)
+                connected += ok
+                failed += bad
+            await asyncio.sleep(0.5)
+            rss_connected = server.rss_bytes()
+
+            conn = server.connection()
+            interval = 1.0 / rate
+            started = time.perf_counter()
+            next_send = started
+            start = end = None
+            published = 0
+            cpu_start = 0.0
+            while True:
+                now = time.perf_counter()
+                if start is None and now - started >= warmup:
+                    start, cpu_start, published = time.time(), server.cpu_seconds(), 0
+                    for _, pipe in workers:
+                        pipe.send(("start",))
+                if now - started >= warmup + duration:
+                    end = time.time()
+                    break
+                body = json.dumps({"name": FANOUT_METRIC, "value": time.time()}).encode()
+                await conn.request("POST", "/api/v1/metrics", body)
+                published += 1
+                next_send += interval
+                delay = next_send - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await conn.close()
+            # Let frames sent near the end arrive before the clients stop counting
+            await asyncio.sleep(drain)
+            server_cpu = server.cpu_seconds() - cpu_start
+            rss_end = server.rss_bytes()
+
+            latencies = array("d")
+            evicted = 0
+            generator_cpu = []
+            for _, pipe in workers:
+                pipe.send(("stop", start, end))
+            for _, pipe in workers:
+                _, data, gone, cpu = await loop.run_in_executor(None, pipe.recv)
+                latencies.frombytes(data)
+                evicted += gone
+                generator_cpu.append(cpu)
+        finally:
+            for process, _ in workers:
+                process.join(timeout=10)
+                if process.is_alive():
+                    process.kill()
+
+    window = end - start
+    ordered = sorted(latencies)
+    delivered = len(ordered)
+    expected = published * connected
+    return {
+        "clients": clients,
+        "connected": connected,
+        "connect_failures": failed,
+        "evicted": evicted,
+        "rate": rate,
+        "published": published,
+        "requests": delivered,
+        "errors": max(0, expected - delivered),
+        "delivery_ratio": round(delivered / expected, 4) if expected else 0.0,
+        "throughput_rps": round(delivered / window, 1),
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+        "p90_ms": round(percentile(ordered, 0.90) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+        "p999_ms": round(percentile(ordered, 0.999) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+        "server_rss_idle_mb": round(rss_idle / 2**20, 1),
+        "server_rss_end_mb": round(rss_end / 2**20, 1),
+        "memory_per_connection_kb": (
+            round((rss_connected - rss_idle) / connected / 1024, 2) if connected else 0.0
+        ),
+        "server_cpu_percent": round(server_cpu / (window + drain) * 100, 1),
+        "server_cpu_us_per_message": round(server_cpu / delivered * 1e6, 2) if delivered else 0.0,
+        # Busiest client worker, over the same span as the server
+        "generator_cpu_percent": round(max(generator_cpu) / (window + drain) * 100, 1),
+        "processes": processes,
+    }
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="python -m tests.benchmarks.soak", description=__doc__.strip().splitlines()[0]
+    )
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=20.0, help="samples per second")
+    parser.add_argument("--duration", type=float, default=30.0, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5.0)
+    parser.add_argument("--processes", type=int, help="client worker processes")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--tolerance", type=float, default=None, help="default: the baseline's")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--json", type=Path, help="also write the result here")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    baseline = load_baseline(args.baseline)
+    tolerance = args.tolerance if args.tolerance is not None else baseline.get("tolerance", 0.25)
+    if baseline.get("environment") and baseline["environment"] != environment():
+        print(f"note: baseline recorded on {baseline['environment']}", file=sys.stderr)
+
+    result = asyncio.run(
+        run_soak(
+            clients=args.clients,
+            rate=args.rate,
+            duration=args.duration,
+            warmup=args.warmup,
+            processes=args.processes,
+        )
+    )
+    key = f"soak-{args.clients}x{args.rate:g}"
+    width = max(len(k) for k in result)
+    for name, value in result.items():
+        print(f"{name:<{width}}  {value}")
+    if args.json:
+        args.json.write_text(json.dumps({key: result}, indent=2) + "\n")
+
+    if result["generator_cpu_percent"] > GENERATOR_SATURATED * 100:
+        print(
+            "warning: a client worker was near a full core; add --processes or cores",
+            file=sys.stderr,
+        )
+    failures: List[str] = over_budget(key, result, BUDGET)
+    if args.update_baseline:
+        save_baseline(args.baseline, {key: result}, tolerance)
+        print(f"baseline updated: {args.baseline}", file=sys.stderr)
+    else:
+        failures.extend(compare({key: result}, baseline, tolerance))
+    for failure in failures:
+        print(f"FAIL {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
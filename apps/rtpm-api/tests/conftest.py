@@ -15,6 +15,8 @@
 import os
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Tests scrape /metrics right after the requests they check
+os.environ.setdefault("METRICS_CACHE_INTERVAL", "0")
 from src.main import app
 
 
@@ -376,6 +378,74 @@ def get_secret_value(self, SecretId):
     return MockSecretsManager()
 
 
+# In-process Redis pub/sub for fan-out tests
+@pytest.fixture
+def fake_redis():
+    """Broker shared by the fake Redis clients of several replicas"""
+
+    class FakePubSub:
+        def __init__(self, broker):
+            self.broker = broker
+            self.channels = set()
+            self.queue = asyncio.Queue()
+
+        async def subscribe(self, *channels):
+            self.channels.update(channels)
+            self.broker.subscribers.add(self)
+
+        async def unsubscribe(self, *channels):
+            self.channels.difference_update(channels or self.channels)
+
+        async def get_message(self, ignore_subscribe_messages=False, timeout=None):
+            # asyncio.wait, unlike wait_for, never swallows a cancellation
+            getter = asyncio.ensure_future(self.queue.get())
+            try:
+                done, _ = await asyncio.wait({getter}, timeout=timeout)
+            finally:
+                if not getter.done():
+                    getter.cancel()
+            return getter.result() if done else None
+
+        async def aclose(self):
+            self.broker.subscribers.discard(self)
+
+    class FakeRedis:
+        def __init__(self, broker):
+            self.broker = broker
+            self.closed = False
+
+        async def ping(self):
+            if self.broker.down:
+                raise ConnectionError("Connection refused")
+            return True
+
+        async def publish(self, channel, message):
+            if self.broker.down:
+                raise ConnectionError("Connection refused")
+            self.broker.published.append((channel, message))
+            receivers = [s for s in self.broker.subscribers if channel in s.channels]
+            for pubsub in receivers:
+                pubsub.queue.put_nowait({"type": "message", "channel": channel, "data": message})
+            return len(receivers)
+
+        def pubsub(self):
+            return FakePubSub(self.broker)
+
+        async def aclose(self):
+            self.closed = True
+
+    class FakeRedisBroker:
+        def __init__(self):
+            self.subscribers = set()
+            self.published = []
+            self.down = False
+
+        def client(self):
+            return FakeRedis(self)
+
+    return FakeRedisBroker()
+
+
 # Test data validation helpers
 def validate_agent_data(agent_data):
     """Validate agent data structure"""
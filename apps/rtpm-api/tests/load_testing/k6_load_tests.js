@@ -264,18 +264,18 @@ function testMetricsIngestion() {
       });
 
       check(response, {
-        'metrics ingestion returns 200': (r) => r.status === 200,
+        'metrics ingestion returns 202': (r) => r.status === 202,
         'metrics ingestion response time < 100ms': (r) => r.timings.duration < 100,
-        'metrics ingestion response has success': (r) => {
+        'metrics ingestion response is accepted': (r) => {
           const body = JSON.parse(r.body);
-          return body.status === 'success';
+          return body.status === 'accepted';
         },
       });
 
-      errorRate.add(response.status !== 200);
+      errorRate.add(response.status !== 202);
       responseTime.add(response.timings.duration);
 
-      if (response.status === 200) {
+      if (response.status === 202) {
         metricsIngested.add(1);
       }
     });
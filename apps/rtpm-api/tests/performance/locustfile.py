@@ -80,7 +80,7 @@ def ingest_metrics(self):
             headers=self.get_headers(),
             name="/api/v1/metrics [batch]",
         ) as response:
-            if response.status_code == 200:
+            if response.status_code == 202:
                 result = response.json()
                 if result.get("processed_count") != len(metrics_data["metrics"]):
                     response.failure("Processed count mismatch")
@@ -357,7 +357,7 @@ def ingest_high_volume_metrics(self):
         ) as response:
             response_time = (time.time() - start_time) * 1000  # ms
 
-            if response.status_code == 200:
+            if response.status_code == 202:
                 result = response.json()
                 processed = result.get("processed_count", 0)
 
@@ -0,0 +1,125 @@
+"""
+Unit tests for the RTPM agent registry
+Tests validation, secondary indexes, cursor pagination and ETags
+"""
+
+import pytest
+
+from src.services.agents import (
+    AgentError,
+    AgentRegistry,
+    etag_matches,
+    parse_agent,
+    parse_filters,
+)
+
+
+def _agent(agent_id, **fields):
+    return parse_agent({"id": agent_id, "name": agent_id, **fields})
+
+
+class TestAgentParsing:
+    """Test validation of agent definitions"""
+
+    def test_valid_agent(self, sample_agent):
+        """Test that fixture agents round-trip"""
+        agent = parse_agent(sample_agent)
+        assert agent.to_dict()["capabilities"] == ["monitoring", "analysis"]
+        assert agent.to_dict()["lastSeen"].startswith(sample_agent["lastSeen"][:19])
+
+    def test_invalid_agents(self):
+        """Test that bad fields are rejected"""
+        for data in (
+            {"name": "no id"},
+            {"id": "a"},
+            {"id": "a", "name": "a", "status": "sleeping"},
+            {"id": "a", "name": "a", "capabilities": "monitoring"},
+            {"id": "a", "name": "a", "lastSeen": "yesterday"},
+        ):
+            with pytest.raises(AgentError):
+                parse_agent(data)
+
+
+class TestAgentRegistry:
+    """Test indexes and listing"""
+
+    def test_indexes_follow_updates(self):
+        """Test that replacing or deleting an agent moves it between index entries"""
+        registry = AgentRegistry()
+        registry.upsert(_agent("a", status="online", capabilities=["monitoring"]))
+        registry.upsert(_agent("b", status="online"))
+        assert registry.counts() == {"online": 2}
+
+        registry.upsert(_agent("a", status="error", capabilities=["alerting"]))
+        assert registry.counts() == {"online": 1, "error": 1}
+        assert registry.list({"capability": ["monitoring"]})[1] == 0
+
+        assert registry.delete("b")
+        assert not registry.delete("b")
+        assert registry.counts() == {"error": 1}
+        assert [a.id for a in registry.list()[0]] == ["a"]
+
+    def test_filters_and_or(self):
+        """Test that values of one field are OR'd and fields are AND'd"""
+        registry = AgentRegistry()
+        registry.upsert(_agent("a", status="online", region="us-east-1"))
+        registry.upsert(_agent("b", status="warning", region="us-east-1"))
+        registry.upsert(_agent("c", status="online", region="eu-west-1"))
+
+        agents, total, _ = registry.list(
+            {"status": ["online", "warning"], "region": ["us-east-1"]}
+        )
+        assert [a.id for a in agents] == ["a", "b"]
+        assert total == 2
+
+    def test_cursor_pagination(self):
+        """Test that cursors resume after the last ID even when it was deleted"""
+        registry = AgentRegistry()
+        for i in range(10):
+            registry.upsert(_agent(f"agent-{i:02d}"))
+
+        page, total, cursor = registry.list(limit=4)
+        assert [a.id for a in page] == ["agent-00", "agent-01", "agent-02", "agent-03"]
+        assert total == 10
+        registry.delete("agent-03")
+        page, _, cursor = registry.list(cursor=cursor, limit=4)
+        assert [a.id for a in page] == ["agent-04", "agent-05", "agent-06", "agent-07"]
+        page, _, cursor = registry.list(cursor=cursor, limit=4)
+        assert [a.id for a in page] == ["agent-08", "agent-09"]
+        assert cursor is None
+
+        with pytest.raises(AgentError):
+            registry.list(cursor="!!!")
+
+    def test_etag_changes_with_registry(self):
+        """Test that the ETag only changes when agents do"""
+        registry = AgentRegistry()
+        etag = registry.etag
+        registry.list({"status": ["online"]})
+        assert registry.etag == etag
+        registry.upsert(_agent("a"))
+        assert registry.etag != etag
+
+    def test_etag_differs_across_processes(self):
+        """Test that registries at the same generation do not share an ETag"""
+        first, second = AgentRegistry(), AgentRegistry()
+        assert first.generation == second.generation
+        assert first.etag != second.etag
+
+    def test_etag_matches(self):
+        """Test If-None-Match parsing"""
+        assert etag_matches('W/"agents-3"', 'W/"agents-3"')
+        assert etag_matches('"x", "agents-3"', 'W/"agents-3"')
+        assert etag_matches("*", 'W/"agents-3"')
+        assert not etag_matches('W/"agents-2"', 'W/"agents-3"')
+        assert not etag_matches(None, 'W/"agents-3"')
+
+    def test_parse_filters(self):
+        """Test repeated and comma-separated query values"""
+        params = [("status", "online,warning"), ("capabilities", "monitoring"), ("limit", "5")]
+        assert parse_filters(params) == {
+            "status": ["online", "warning"],
+            "capability": ["monitoring"],
+        }
+        with pytest.raises(AgentError):
+            parse_filters([("status", "sleeping")])
@@ -0,0 +1,396 @@
+"""
+Unit tests for the RTPM streaming alert engine
+Tests rule parsing, pending/firing/resolved transitions and batched writes
+"""
+
+import json
+import uuid
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+from src.services.alerting import (
+    DELETE_RULE_SQL,
+    FIRING,
+    PENDING,
+    RESOLVED,
+    RULE_COLUMNS,
+    UPSERT_RULE_SQL,
+    AlertEngine,
+    AlertRuleConflict,
+    AlertRuleError,
+    fingerprint,
+    parse_condition,
+    parse_rule,
+)
+from src.services.database import Database
+from src.services.ingestion import intern_samples, parse_sample
+
+RULE_ID = "6f1c2d7e-0b7a-4b8e-9a53-0c1f4f2b9a10"
+
+
+def _rule(**overrides):
+    data = {
+        "id": RULE_ID,
+        "name": "High CPU Usage",
+        "metric_name": "cpu_usage_percent",
+        "condition": "> 80",
+        "threshold": 80.0,
+        "severity": "high",
+        "for_duration": 60,
+    }
+    data.update(overrides)
+    return parse_rule(data)
+
+
+def _sample(value, timestamp, name="cpu_usage_percent", host="web-1"):
+    sample = parse_sample(
+        {"name": name, "value": value, "timestamp": timestamp, "labels": {"host": host}}
+    )
+    return intern_samples([sample])[0]
+
+
+class _Conn:
+    def __init__(self):
+        self.executemany = AsyncMock()
+        self.execute = AsyncMock()
+
+
+class _Acquire:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def __aenter__(self):
+        return self.conn
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+def _connected_database():
+    database = Database(None)
+    conn = _Conn()
+    database._pool = MagicMock()
+    database._pool.acquire = lambda: _Acquire(conn)
+    database.healthy = True
+    return database, conn
+
+
+class TestRuleParsing:
+    """Test validation of alert rule definitions"""
+
+    @pytest.mark.parametrize(
+        "raw,expected",
+        [("> 80", ">"), (">=90", ">="), ("<", "<"), ("greater_than", ">"), ("LT", "<")],
+    )
+    def test_conditions(self, raw, expected):
+        """Test the operator spellings accepted in condition"""
+        assert parse_condition(raw) == expected
+
+    def test_seed_row_shape(self):
+        """Test that rows shaped like init.sql seeds parse, JSONB given as text"""
+        rule = parse_rule(
+            {
+                "id": RULE_ID,
+                "name": "Low Disk Space",
+                "metric_name": "disk_usage_percent",
+                "condition": "> 85",
+                "threshold": 85.0,
+                "severity": "medium",
+                "labels": "{}",
+                "annotations": '{"description": "Disk usage is above 85%"}',
+                "evaluation_interval": 60,
+                "for_duration": 300,
+                "enabled": True,
+            }
+        )
+        assert rule.condition == ">" and rule.expression == "> 85"
+        assert rule.annotations == {"description": "Disk usage is above 85%"}
+
+    def test_load_test_aliases(self):
+        """Test the metric/duration spellings used by the load-test scenarios"""
+        rule = parse_rule(
+            {
+                "name": "r",
+                "metric": "cpu_usage",
+                "condition": "greater_than",
+                "threshold": 70,
+                "duration": 30,
+                "severity": "warning",
+            }
+        )
+        assert (rule.metric_name, rule.condition, rule.for_duration) == ("cpu_usage", ">", 30)
+
+    def test_threshold_from_condition(self):
+        """Test that a threshold written only inside the condition is used"""
+        rule = parse_rule({"name": "r", "metric_name": "m", "condition": "< 5"})
+        assert rule.threshold == 5.0
+
+    @pytest.mark.parametrize(
+        "overrides",
+        [
+            {"condition": "between"},
+            {"threshold": "not_a_number"},
+            {"severity": "urgent"},
+            {"for_duration": -1},
+            {"metric_name": ""},
+            {"labels": ["host"]},
+            {"id": "rule-1"},
+        ],
+    )
+    def test_invalid_rules(self, overrides):
+        """Test that malformed rules raise AlertRuleError"""
+        with pytest.raises(AlertRuleError):
+            _rule(**overrides)
+
+
+@pytest.mark.asyncio
+class TestAlertEngine:
+    """Test evaluation of samples against indexed rules"""
+
+    async def test_pending_then_firing_then_resolved(self):
+        """Test that for_duration gates firing and a recovery resolves"""
+        engine = AlertEngine(Database(None))
+        engine.set_rules([_rule(for_duration=60)])
+
+        await engine.evaluate([_sample(90, 1000)])
+        assert [a["status"] for a in engine.active()] == [PENDING]
+
+        await engine.evaluate([_sample(95, 1030)])
+        assert engine.active()[0]["status"] == PENDING
+
+        await engine.evaluate([_sample(97, 1060)])
+        active = engine.active()
+        assert active[0]["status"] == FIRING
+        assert active[0]["current_value"] == 97
+        assert active[0]["fingerprint"] == fingerprint(RULE_ID, {"host": "web-1"})
+
+        await engine.evaluate([_sample(50, 1070)])
+        assert engine.active() == []
+        statuses = [record[4] for record in engine._unwritten.values()]
+        assert statuses == [RESOLVED]
+
+    async def test_pending_clears_without_firing(self):
+        """Test that a breach shorter than for_duration never fires"""
+        engine = AlertEngine(Database(None))
+        engine.set_rules([_rule(for_duration=60)])
+        await engine.evaluate([_sample(90, 1000), _sample(10, 1010)])
+        assert engine.active() == []
+        assert not engine._unwritten
+
+    async def test_only_matching_rules_are_checked(self):
+        """Test the metric index and label selectors"""
+        engine = AlertEngine(Database(None))
+        engine.set_rules(
+            [
+                _rule(for_duration=0, labels={"host": "web-2"}),
+                _rule(id=None, name="disabled", for_duration=0, enabled=False),
+            ]
+        )
+        await engine.evaluate(
+            [
+                _sample(90, 1000, host="web-1"),
+                _sample(90, 1000, host="web-2"),
+                _sample(90, 1000, name="memory_usage_percent", host="web-2"),
+            ]
+        )
+        active = engine.active()
+        assert len(active) == 1
+        assert active[0]["labels"] == {"host": "web-2"}
+        assert active[0]["status"] == FIRING
+
+    async def test_notifies_transitions(self):
+        """Test that notifiers see firing and resolved transitions only"""
+        engine = AlertEngine(Database(None))
+        engine.set_rules([_rule(for_duration=0)])
+        seen = []
+
+        async def notify(alert):
+            seen.append(alert["status"])
+
+        engine.add_notifier(notify)
+        await engine.evaluate([_sample(90, 1000), _sample(91, 1001), _sample(10, 1002)])
+        assert seen == [FIRING, RESOLVED]
+
+    async def test_stale_series_resolve(self):
+        """Test that firing alerts resolve once their series stops reporting"""
+        engine = AlertEngine(Database(None), stale_after=300, clock=lambda: 1000.0)
+        engine.set_rules([_rule(for_duration=0)])
+        await engine.evaluate([_sample(90, 1000)])
+        assert engine.resolve_stale(now=1200) == []
+        resolved = engine.resolve_stale(now=1400)
+        assert [s.status for s in resolved] == [RESOLVED]
+        assert engine.active() == []
+
+    async def test_sample_time_is_capped_at_receive_time(self):
+        """Test that staleness and firing share the wall clock samples arrive on"""
+        engine = AlertEngine(Database(None), stale_after=300, clock=lambda: 10_000.0)
+        engine.set_rules([_rule(for_duration=60)])
+
+        # Dated a day ahead: still pending, since only received time has passed
+        await engine.evaluate([_sample(90, 10_000), _sample(95, 96_400)])
+        assert engine.active()[0]["status"] == PENDING
+
+        # Backfilled long ago, but just received: not stale yet
+        backfill = AlertEngine(Database(None), stale_after=300, clock=lambda: 10_000.0)
+        backfill.set_rules([_rule(for_duration=60)])
+        await backfill.evaluate([_sample(90, 1000), _sample(95, 1060)])
+        assert backfill.active()[0]["status"] == FIRING
+        assert backfill.resolve_stale(now=10_001) == []
+        assert len(backfill.resolve_stale(now=10_301)) == 1
+
+    async def test_rule_edit_resets_state(self):
+        """Test that replacing a rule drops state evaluated against the old one"""
+        engine = AlertEngine(Database(None))
+        engine.set_rules([_rule(for_duration=0)])
+        await engine.evaluate([_sample(90, 1000)])
+        await engine.save_rule(_rule(threshold=95.0, condition=">"))
+        assert engine.active() == []
+        await engine.evaluate([_sample(90, 1001)])
+        assert engine.active() == []
+
+    async def test_duplicate_names_conflict(self):
+        """Test that rule names stay unique like the alert_rules table"""
+        engine = AlertEngine(Database(None))
+        await engine.save_rule(_rule())
+        with pytest.raises(AlertRuleConflict):
+            await engine.save_rule(_rule(id=None))
+
+    async def test_flush_batches_transitions(self):
+        """Test that transitions are upserted in one executemany per flush"""
+        database, conn = _connected_database()
+        engine = AlertEngine(database)
+        engine.set_rules([_rule(for_duration=0)])
+        await engine.evaluate(
+            [_sample(90, 1000, host=f"web-{i}") for i in range(5)] + [_sample(10, 1001, host="web-0")]
+        )
+
+        assert await engine.flush() == 5
+        conn.executemany.assert_awaited_once()
+        sql, records = conn.executemany.await_args.args
+        assert "ON CONFLICT (fingerprint)" in sql
+        by_host = {json.loads(r[9])["host"]: r[4] for r in records}
+        assert by_host == {
+            "web-0": RESOLVED,
+            "web-1": FIRING,
+            "web-2": FIRING,
+            "web-3": FIRING,
+            "web-4": FIRING,
+        }
+        assert await engine.flush() == 0
+
+    async def test_failed_flush_is_retried(self):
+        """Test that transitions stay buffered when the write fails"""
+        database, conn = _connected_database()
+        conn.executemany.side_effect = OSError("connection reset")
+        engine = AlertEngine(database)
+        engine.set_rules([_rule(for_duration=0)])
+        await engine.evaluate([_sample(90, 1000)])
+
+        assert await engine.flush() == 0
+        assert len(engine._unwritten) == 1
+        conn.executemany.side_effect = None
+        assert await engine.flush() == 1
+
+    async def test_deleting_firing_rule_keeps_flushing(self):
+        """Test that a deleted rule's transitions are not written after its rows cascade"""
+        database, conn = _connected_database()
+        engine = AlertEngine(database)
+        await engine.save_rule(_rule(for_duration=0))
+        other = await engine.save_rule(_rule(id=None, name="other", for_duration=0))
+        await engine.evaluate([_sample(90, 1000)])
+        assert len(engine._unwritten) == 2
+
+        assert await engine.delete_rule(RULE_ID)
+        assert [r[1] for r in engine._unwritten.values()] == [uuid.UUID(other.id)]
+        assert await engine.flush() == 1
+
+        await engine.evaluate([_sample(10, 1010)])
+        assert await engine.flush() == 1
+
+    async def test_refused_records_are_dropped(self):
+        """Test that a record failing a constraint does not block the others"""
+        database, conn = _connected_database()
+        violation = type("ForeignKeyViolationError", (Exception,), {"sqlstate": "23503"})
+        conn.executemany.side_effect = violation("alerts_rule_id_fkey")
+        conn.execute.side_effect = [violation("alerts_rule_id_fkey"), None]
+        engine = AlertEngine(database)
+        engine.set_rules([_rule(for_duration=0)])
+        await engine.evaluate([_sample(90, 1000, host="web-1"), _sample(90, 1000, host="web-2")])
+
+        assert await engine.flush() == 1
+        assert conn.execute.await_count == 2
+        assert engine._unwritten == {}
+
+    async def test_edited_rule_resolves_firing_alerts(self):
+        """Test that editing or deleting a rule resolves its firing alerts first"""
+        engine = AlertEngine(Database(None))
+        notified = []
+        engine.add_notifier(AsyncMock(side_effect=notified.append))
+        await engine.save_rule(_rule(for_duration=0))
+        await engine.evaluate([_sample(90, 1000)])
+        assert [a["status"] for a in notified] == [FIRING]
+
+        await engine.save_rule(_rule(for_duration=0, threshold=95.0))
+        assert [a["status"] for a in notified] == [FIRING, RESOLVED]
+        assert engine.active() == []
+        assert [record[4] for record in engine._unwritten.values()] == [RESOLVED]
+
+        await engine.evaluate([_sample(97, 1010)])
+        await engine.delete_rule(RULE_ID)
+        assert [a["status"] for a in notified] == [FIRING, RESOLVED, FIRING, RESOLVED]
+
+    async def test_offline_rule_changes_survive_reconnect(self):
+        """Test that rules saved or deleted while disconnected are written on reload"""
+        database, conn = _connected_database()
+        pool, database._pool = database._pool, None
+        stored = _rule(id=None, name="stored")
+        engine = AlertEngine(database)
+        engine.set_rules([stored])
+
+        created = await engine.save_rule(_rule())
+        await engine.delete_rule(stored.id)
+        conn.execute.assert_not_awaited()
+
+        # The table as it stands once the pending changes are written
+        database._pool = pool
+        conn.fetch = AsyncMock(return_value=[dict(zip(RULE_COLUMNS, created.to_record()))])
+        assert await engine.load_rules() == 1
+        assert [r.id for r in engine.rules()] == [created.id]
+        queries = [call.args[0] for call in conn.execute.await_args_list]
+        assert sorted(queries) == sorted([UPSERT_RULE_SQL, DELETE_RULE_SQL])
+        assert engine._unsaved == {}
+
+    async def test_rule_changes_failing_to_write_are_retried(self):
+        """Test that a rule saved while the database fails is kept and written later"""
+        database, conn = _connected_database()
+        engine = AlertEngine(database)
+        conn.execute.side_effect = OSError("connection reset")
+        rule = await engine.save_rule(_rule())
+        assert engine.get_rule(RULE_ID) is rule
+        assert RULE_ID in engine._unsaved
+
+        database.healthy = False
+        await engine.delete_rule(RULE_ID)
+        assert conn.execute.await_count == 1
+        assert engine._unsaved == {RULE_ID: None}
+
+        database.healthy = True
+        conn.execute.side_effect = None
+        await engine.save_pending()
+        conn.execute.assert_awaited_with(DELETE_RULE_SQL, uuid.UUID(RULE_ID))
+        assert engine._unsaved == {}
+
+    async def test_unwritten_rule_wins_over_stored_row(self):
+        """Test that a rule the reload could not write still replaces the stored row"""
+        database, conn = _connected_database()
+        pool, database._pool = database._pool, None
+        engine = AlertEngine(database)
+        edited = await engine.save_rule(_rule(threshold=95.0))
+
+        database._pool = pool
+        conn.execute.side_effect = OSError("connection reset")
+        conn.fetch = AsyncMock(return_value=[dict(zip(RULE_COLUMNS, _rule().to_record()))])
+        assert await engine.load_rules() == 1
+        assert engine.get_rule(RULE_ID) is edited
+        assert RULE_ID in engine._unsaved
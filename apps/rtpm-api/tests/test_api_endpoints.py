@@ -4,8 +4,18 @@
 """
 
 import pytest
-from datetime import datetime, timedelta
-from unittest.mock import patch
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from src.services.alerting import AlertEngine, parse_rule
+from src.services.agents import AgentRegistry, parse_agent
+from src.services.database import Database
+from src.services.heartbeat import HeartbeatTracker
+from src.services.hotwindow import HotWindow
+from src.services.ingestion import IngestionQueueFull, intern_samples, parse_payload, parse_sample
+from src.services.limits import TenantQuotas
+from src.services.query import HOURLY, RAW, QueryPlan, parse_query
+from src.services.series import registry as series_registry
 
 
 class TestHealthEndpoints:
@@ -22,6 +32,14 @@ def test_health_check(self, client):
         assert data["service"] == "rtpm-api"
         assert data["version"] == "1.0.0"
 
+    def test_health_unready_without_database(self, client):
+        """Test that a configured but unreachable database fails readiness"""
+        with patch("src.main.database", Database("postgresql://db/rtpm")):
+            response = client.get("/health")
+        assert response.status_code == 503
+        assert response.json()["status"] == "unhealthy"
+        assert response.json()["database"]["connected"] is False
+
     def test_metrics_endpoint(self, client):
         """Test Prometheus metrics endpoint"""
         response = client.get("/metrics")
@@ -66,20 +84,48 @@ def test_get_status(self, client):
 
         services = data["services"]
         assert services["api"] == "healthy"
-        assert services["database"] == "healthy"
-        assert services["cache"] == "healthy"
+        assert services["database"] == "not_configured"
+        assert services["cache"] == "not_configured"
+        assert data["database"]["configured"] is False
+
+    def test_status_reports_database_outage(self, client):
+        """Test that an unreachable database shows up in the system status"""
+        with patch("src.main.database", Database("postgresql://db/rtpm")):
+            response = client.get("/api/v1/status")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["status"] == "degraded"
+        assert data["services"]["database"] == "unhealthy"
+        assert data["database"]["connected"] is False
+
+        database = Database("postgresql://db/rtpm")
+        database.healthy = True
+        with patch("src.main.database", database):
+            data = client.get("/api/v1/status").json()
+        assert data["status"] == "operational"
+        assert data["services"]["database"] == "healthy"
 
 
 class TestAgentEndpoints:
     """Test agent management endpoints"""
 
-    def test_list_agents_empty(self, client, mock_database):
+    @pytest.fixture(autouse=True)
+    def registry(self):
+        registry = AgentRegistry()
+        with patch("src.main.agent_registry", registry):
+            yield registry
+
+    @pytest.fixture(autouse=True)
+    def heartbeats(self):
+        tracker = HeartbeatTracker(timeout=30.0)
+        with patch("src.main.heartbeats", tracker):
+            yield tracker
+
+    def test_list_agents_empty(self, client):
         """Test listing agents when none exist"""
-        with patch("src.main.db", mock_database):
-            response = client.get("/api/v1/agents")
-            # Since this endpoint doesn't exist yet, expect 404
-            # This test documents the expected behavior
-            assert response.status_code == 404
+        response = client.get("/api/v1/agents")
+        assert response.status_code == 200
+        assert response.json() == {"data": [], "total": 0, "limit": 100, "next_cursor": None}
 
     def test_get_agent_not_found(self, client):
         """Test getting non-existent agent"""
@@ -89,9 +135,14 @@ def test_get_agent_not_found(self, client):
     def test_register_agent_valid_data(self, client, sample_agent):
         """Test registering a new agent with valid data"""
         response = client.post("/api/v1/agents", json=sample_agent)
-        # Since this endpoint doesn't exist yet, expect 404
-        # This test documents the expected behavior
-        assert response.status_code == 404
+        assert response.status_code == 201
+        assert response.json()["id"] == "agent-001"
+        assert client.get("/api/v1/agents/agent-001").json()["region"] == "us-east-1"
+
+        # Registering again replaces the agent
+        response = client.post("/api/v1/agents", json={**sample_agent, "status": "offline"})
+        assert response.status_code == 200
+        assert client.get("/api/v1/agents/agent-001").json()["status"] == "offline"
 
     def test_register_agent_invalid_data(self, client):
         """Test registering agent with invalid data"""
@@ -102,7 +153,7 @@ def test_register_agent_invalid_data(self, client):
         }
 
         response = client.post("/api/v1/agents", json=invalid_agent)
-        assert response.status_code == 404  # Will be 422 when implemented
+        assert response.status_code == 422
 
     def test_register_agent_missing_required_fields(self, client):
         """Test registering agent with missing required fields"""
@@ -112,24 +163,139 @@ def test_register_agent_missing_required_fields(self, client):
         }
 
         response = client.post("/api/v1/agents", json=incomplete_agent)
-        assert response.status_code == 404  # Will be 422 when implemented
+        assert response.status_code == 422
 
-    def test_delete_agent_success(self, client):
+    def test_update_agent(self, client, sample_agent):
+        """Test that an update keeps omitted fields"""
+        client.post("/api/v1/agents", json=sample_agent)
+        response = client.put("/api/v1/agents/agent-001", json={"status": "maintenance"})
+        assert response.status_code == 200
+        assert response.json()["status"] == "maintenance"
+        assert response.json()["platform"] == "OpenAI"
+
+    def test_delete_agent_success(self, client, sample_agent):
         """Test successful agent deletion"""
-        agent_id = "agent-001"
-        response = client.delete(f"/api/v1/agents/{agent_id}")
-        assert response.status_code == 404  # Will be 204 when implemented
+        client.post("/api/v1/agents", json=sample_agent)
+        response = client.delete("/api/v1/agents/agent-001")
+        assert response.status_code == 204
+        assert client.get("/api/v1/agents/agent-001").status_code == 404
 
     def test_delete_agent_not_found(self, client):
         """Test deleting non-existent agent"""
         response = client.delete("/api/v1/agents/non-existent")
         assert response.status_code == 404
 
+    def test_list_agents_filtered_and_paged(self, client, registry, sample_agents_list):
+        """Test that filters combine and cursors walk every match exactly once"""
+        for agent in sample_agents_list:
+            registry.upsert(parse_agent(agent))
+        expected = sorted(
+            a["id"]
+            for a in sample_agents_list
+            if a["status"] in ("online", "warning") and "monitoring" in a["capabilities"]
+        )
+
+        seen, cursor = [], None
+        while True:
+            params = {"status": "online,warning", "capability": "monitoring", "limit": 7}
+            if cursor:
+                params["cursor"] = cursor
+            data = client.get("/api/v1/agents", params=params).json()
+            assert data["total"] == len(expected)
+            seen.extend(agent["id"] for agent in data["data"])
+            cursor = data["next_cursor"]
+            if cursor is None:
+                break
+        assert seen == expected
+
+    def test_list_agents_invalid_filter(self, client):
+        """Test that an unknown status is rejected"""
+        response = client.get("/api/v1/agents", params={"status": "sleeping"})
+        assert response.status_code == 422
+
+    def test_list_agents_not_modified(self, client, sample_agent):
+        """Test that an unchanged listing answers 304 to If-None-Match"""
+        etag = client.get("/api/v1/agents").headers["etag"]
+        response = client.get("/api/v1/agents", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+
+        client.post("/api/v1/agents", json=sample_agent)
+        response = client.get("/api/v1/agents", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+
+    def test_agent_heartbeat(self, client, sample_agent, heartbeats):
+        """Test that heartbeats are accepted for registered agents only"""
+        response = client.post("/api/v1/agents/agent-001/heartbeat")
+        assert response.status_code == 404
+
+        client.post("/api/v1/agents", json=sample_agent)
+        heartbeats.forget("agent-001")
+        response = client.post("/api/v1/agents/agent-001/heartbeat")
+        assert response.status_code == 204
+        assert heartbeats.is_online("agent-001")
+
+    @pytest.mark.asyncio
+    async def test_snapshots_track_registered_agents_only(
+        self, registry, heartbeats, sample_agent, sample_agent_metrics
+    ):
+        """Test that snapshots from unknown agent IDs leave no liveness state"""
+        from src.main import record_agent_heartbeats
+
+        await record_agent_heartbeats(parse_payload(sample_agent_metrics))
+        assert not heartbeats.is_online("agent-001")
+        assert heartbeats.last_seen("agent-001") is None
+
+        registry.upsert(parse_agent(sample_agent))
+        await record_agent_heartbeats(parse_payload(sample_agent_metrics))
+        assert heartbeats.is_online("agent-001")
+
+    @pytest.mark.asyncio
+    async def test_liveness_transitions_update_registry(self, registry, sample_agent):
+        """Test that offline transitions reach the registry, alerts and WebSockets"""
+        from src.main import publish_agent_transitions
+
+        registry.upsert(parse_agent(sample_agent))
+        evaluate = AsyncMock()
+        with patch("src.main.alert_engine.evaluate", evaluate), patch(
+            "src.main.manager.broadcast", AsyncMock()
+        ) as broadcast, patch("src.main.manager.clients", 1):
+            await publish_agent_transitions([("agent-001", "offline", 45.0)])
+
+        assert registry.get("agent-001").status == "offline"
+        assert registry.counts() == {"offline": 1}
+        sample = evaluate.await_args.args[0][0]
+        assert (sample.metric_name, sample.value) == ("agent_up", 0.0)
+        broadcast.assert_awaited_once()
+
 
 class TestMetricsEndpoints:
     """Test metrics-related endpoints"""
 
-    def test_get_current_metrics(self, client):
+    @pytest.fixture
+    def hot_window(self):
+        """A fresh hot window holding cpu/memory/response_time for two hosts"""
+        window = HotWindow(retention=900)
+        now = datetime.now(timezone.utc)
+        for host in ("web-1", "web-2"):
+            for i, (name, unit) in enumerate(
+                (("cpu_usage", "percent"), ("memory_usage", "percent"), ("response_time", "ms"))
+            ):
+                for age in (30, 10):
+                    sample = parse_sample(
+                        {
+                            "name": name,
+                            "value": 10 * i + age,
+                            "unit": unit,
+                            "labels": {"host": host},
+                            "timestamp": (now - timedelta(seconds=age)).isoformat(),
+                        }
+                    )
+                    window.add(intern_samples([sample])[0])
+        with patch("src.main.hot_window", window):
+            yield window
+
+    def test_get_current_metrics(self, client, hot_window):
         """Test getting current system metrics"""
         response = client.get("/api/v1/metrics/current")
         assert response.status_code == 200
@@ -148,47 +314,352 @@ def test_get_current_metrics(self, client):
             assert "timestamp" in metric
             assert isinstance(metric["value"], (int, float))
 
+        # Only the newest point of each series is reported
+        assert data["series_count"] == 6
+        assert {m["value"] for m in metrics} == {10, 20, 30}
+
+    def test_get_current_metrics_filtered(self, client, hot_window):
+        """Test filtering current metrics by name and label"""
+        response = client.get(
+            "/api/v1/metrics/current", params={"metric_name": "cpu_usage", "labels": "host=web-2"}
+        )
+        assert response.status_code == 200
+        metrics = response.json()["metrics"]
+        assert len(metrics) == 1
+        assert metrics[0]["labels"] == {"host": "web-2"}
+
+    def test_get_latest_metric(self, client, hot_window):
+        """Test the latest value of a metric"""
+        response = client.get("/api/v1/metrics/latest/memory_usage")
+        assert response.status_code == 200
+        data = response.json()
+        assert data["metric_name"] == "memory_usage"
+        assert data["value"] == 20
+        assert len(data["series"]) == 2
+
+        response = client.get("/api/v1/metrics/latest/unknown_metric")
+        assert response.status_code == 404
+
     def test_get_agent_metrics_not_found(self, client):
         """Test getting metrics for non-existent agent"""
         response = client.get("/api/v1/agents/non-existent/metrics")
         assert response.status_code == 404
 
-    def test_get_realtime_metrics(self, client):
+    def test_get_realtime_metrics(self, client, hot_window):
         """Test real-time metrics endpoint"""
         response = client.get("/api/v1/metrics/realtime")
-        assert response.status_code == 404  # Will be 200 when implemented
+        assert response.status_code == 200
+        data = response.json()
+        assert data["window"] == "15m"
+        assert len(data["series"]) == 6
+        assert all(len(s["data_points"]) == 2 for s in data["series"])
+
+        response = client.get(
+            "/api/v1/metrics/realtime", params={"metric_name": "cpu_usage", "window": "20s"}
+        )
+        series = response.json()["series"]
+        assert [len(s["data_points"]) for s in series] == [1, 1]
+
+        response = client.get("/api/v1/metrics/realtime", params={"window": "soon"})
+        assert response.status_code == 422
+
+    def test_get_series_cardinality(self, client, hot_window):
+        """Test series registry stats, overall and for one metric"""
+        response = client.get("/api/v1/series/cardinality", params={"limit": 3})
+        assert response.status_code == 200
+        data = response.json()
+        assert data["series"] >= 6
+        assert len(data["top_metrics"]) <= 3
+
+        response = client.get("/api/v1/series/cardinality", params={"metric_name": "cpu_usage"})
+        data = response.json()
+        assert data["series"] >= 2
+        assert data["labels"]["host"] >= 2
 
     def test_get_aggregate_metrics(self, client):
         """Test aggregated metrics endpoint"""
         response = client.get("/api/v1/metrics/aggregate")
-        assert response.status_code == 404  # Will be 200 when implemented
+        assert response.status_code == 422  # metric_name is required
+
+        plan = QueryPlan(HOURLY, parse_query({"metric_name": "cpu"}))
+        result = (plan, [{"labels": {"host": "web-1"}, "value": 42.0, "samples": 60}])
+        with patch("src.main.query_engine.aggregate", AsyncMock(return_value=result)):
+            response = client.get(
+                "/api/v1/metrics/aggregate",
+                params={
+                    "metric_name": "cpu",
+                    "aggregation": "max",
+                    "start_time": "2024-01-01T00:00:00Z",
+                    "end_time": "2024-01-02T00:00:00Z",
+                },
+            )
+        assert response.status_code == 200
+        data = response.json()
+        assert data["source"] == "metrics_hourly"
+        assert data["raw_tail_from"] is None
+        assert data["aggregation"] == "max"
+        assert data["series"][0]["value"] == 42.0
 
     def test_get_historical_metrics(self, client):
         """Test historical metrics endpoint"""
         response = client.get("/api/v1/metrics/historical")
-        assert response.status_code == 404  # Will be 200 when implemented
+        assert response.status_code == 422  # metric_name is required
 
     def test_get_historical_metrics_with_time_range(self, client):
         """Test historical metrics with time range parameters"""
         params = {
+            "metric_name": "cpu_usage_percent",
             "start_time": (datetime.utcnow() - timedelta(hours=24)).isoformat(),
             "end_time": datetime.utcnow().isoformat(),
             "interval": "1h",
+            "labels": ["host=web-1"],
         }
 
-        response = client.get("/api/v1/metrics/historical", params=params)
-        assert response.status_code == 404  # Will be 200 when implemented
+        series = [
+            {"metric_name": "cpu_usage_percent", "labels": {"host": "web-1"}, "data_points": []}
+        ]
+        plan = QueryPlan(HOURLY, parse_query({"metric_name": "cpu_usage_percent"}))
+        engine = AsyncMock(return_value=(plan, series))
+        with patch("src.main.query_engine.range_query", engine):
+            response = client.get("/api/v1/metrics/historical", params=params)
+        assert response.status_code == 200
+
+        data = response.json()
+        assert data["step"] == "1h"
+        assert data["labels"] == {"host": "web-1"}
+        assert data["series"] == series
+        assert engine.call_args[0][0].step == timedelta(hours=1)
+
+    def test_historical_metrics_without_database(self, client):
+        """Test that queries report unavailable storage instead of failing"""
+        response = client.get("/api/v1/metrics/historical", params={"metric_name": "cpu"})
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "5"
+
+    def test_historical_metrics_database_error(self, client):
+        """Test that a connected pool that fails mid-query answers 503"""
+        pool = MagicMock()
+        pool.acquire.side_effect = ConnectionRefusedError("connection refused")
+        with patch("src.main.database._pool", pool):
+            response = client.get("/api/v1/metrics/historical", params={"metric_name": "cpu"})
+        assert response.status_code == 503
+        assert response.json()["error"] == "Metric storage unavailable"
+
+    def test_query_metrics(self, client):
+        """Test the POST query endpoint used by the API client"""
+        series = [{"metric_name": "cpu", "labels": {}, "data_points": [{"value": 1.0}]}]
+        with patch("src.main.query_engine.range_query", AsyncMock(return_value=(QueryPlan(RAW, None), series))):
+            response = client.post(
+                "/api/v1/metrics/query",
+                json={"metric_name": "cpu", "step": "5m", "aggregation": "avg"},
+            )
+        assert response.status_code == 200
+        assert response.json() == series
+
+    def test_query_metrics_invalid(self, client):
+        """Test that unplannable queries are rejected"""
+        response = client.post("/api/v1/metrics/query", json={"metric_name": "cpu", "step": "x"})
+        assert response.status_code == 422
+        assert response.json()["error"] == "Invalid query"
 
     def test_ingest_metric_valid(self, client, sample_agent_metrics):
         """Test ingesting valid metric data"""
         response = client.post("/api/v1/metrics", json=sample_agent_metrics)
-        assert response.status_code == 200
+        assert response.status_code == 202
 
         data = response.json()
-        assert data["status"] == "success"
-        assert data["message"] == "Metric ingested"
+        assert data["status"] == "accepted"
+        assert data["message"] == "Metric accepted for ingestion"
+        # Agent snapshots expand into one sample per numeric field
+        assert data["processed_count"] == 10
         assert "timestamp" in data
 
+    def test_ingest_single_metric(self, client):
+        """Test ingesting a metric shaped like a metrics table row"""
+        metric = {
+            "name": "cpu_usage_percent",
+            "type": "gauge",
+            "value": 42.5,
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "labels": {"host": "server01"},
+            "unit": "percent",
+        }
+        response = client.post("/api/v1/metrics", json=metric)
+        assert response.status_code == 202
+        assert response.json()["processed_count"] == 1
+
+    def test_ingest_metric_batch(self, client):
+        """Test ingesting a batch payload"""
+        batch = {
+            "metrics": [
+                {"metric_name": "cpu_usage", "value": float(i), "labels": {"host": "h1"}}
+                for i in range(5)
+            ]
+        }
+        response = client.post("/api/v1/metrics", json=batch)
+        assert response.status_code == 202
+        assert response.json()["processed_count"] == 5
+
+    def test_ingest_endpoint_single_metric(self, client):
+        """Test the single-metric ingest endpoint used by the test client"""
+        response = client.post(
+            "/api/v1/metrics/ingest",
+            json={"name": "cpu_usage_percent", "type": "gauge", "value": 45.2},
+        )
+        assert response.status_code == 202
+        data = response.json()
+        assert data["status"] == "accepted"
+        assert data["metric_name"] == "cpu_usage_percent"
+
+    def test_ingest_endpoint_rejects_batch(self, client):
+        """Test that the single-metric endpoint does not accept batches"""
+        response = client.post(
+            "/api/v1/metrics/ingest", json={"metrics": [{"name": "cpu", "value": 1}]}
+        )
+        assert response.status_code == 422
+
+    def test_batch_endpoint(self, client):
+        """Test the batch ingest endpoint"""
+        batch = {"metrics": [{"name": "cpu", "value": float(i)} for i in range(10)]}
+        response = client.post("/api/v1/metrics/batch", json=batch)
+        assert response.status_code == 202
+        assert response.json()["metrics_count"] == 10
+
+    def test_ingest_rate_limited_per_api_key(self, client):
+        """Test that each configured API key has its own sample budget"""
+        batch = {"metrics": [{"name": "cpu", "value": float(i)} for i in range(6)]}
+        with patch("src.main.quotas", TenantQuotas(rate=1, burst=10)), patch(
+            "src.main.api_keys", {"a", "b", "c"}
+        ):
+            first = client.post("/api/v1/metrics", json=batch, headers={"X-API-Key": "a"})
+            second = client.post("/api/v1/metrics", json=batch, headers={"X-API-Key": "a"})
+            other = client.post(
+                "/api/v1/metrics", json=batch, headers={"Authorization": "Bearer b"}
+            )
+            too_big = client.post(
+                "/api/v1/metrics",
+                json={"metrics": [{"name": "cpu", "value": 1}] * 11},
+                headers={"X-API-Key": "c"},
+            )
+        assert first.status_code == 202
+        assert second.status_code == 429
+        assert second.json()["error"] == "Ingestion rate limit exceeded"
+        assert int(second.headers["Retry-After"]) >= 1
+        assert other.status_code == 202
+        assert too_big.status_code == 413
+
+    def test_unknown_api_keys_share_the_client_budget(self, client):
+        """Test that rotating unknown keys does not buy a fresh bucket"""
+        batch = {"metrics": [{"name": "cpu", "value": float(i)} for i in range(6)]}
+        with patch("src.main.quotas", TenantQuotas(rate=1, burst=10)), patch(
+            "src.main.api_keys", {"a"}
+        ):
+            first = client.post("/api/v1/metrics", json=batch, headers={"X-API-Key": "x-1"})
+            second = client.post("/api/v1/metrics", json=batch, headers={"X-API-Key": "x-2"})
+        assert first.status_code == 202
+        assert second.status_code == 429
+
+    def test_queue_full_spends_no_quota(self, client):
+        """Test that requests refused with a 503 leave the client's budget intact"""
+        batch = {"metrics": [{"name": "cpu", "value": float(i)} for i in range(6)]}
+        with patch("src.main.quotas", TenantQuotas(rate=1, burst=10)):
+            with patch("src.main.ingestion.has_room", return_value=False):
+                assert client.post("/api/v1/metrics", json=batch).status_code == 503
+            with patch("src.main.ingestion.submit", side_effect=IngestionQueueFull()):
+                assert client.post("/api/v1/metrics", json=batch).status_code == 503
+            assert client.post("/api/v1/metrics", json=batch).status_code == 202
+
+    def test_ingest_series_limit(self, client):
+        """Test that samples creating series past the per-metric limit are refused"""
+        metrics = [
+            {"name": "limited_metric", "value": 1, "labels": {"id": str(i)}} for i in range(5)
+        ]
+        with patch.object(series_registry, "max_series_per_metric", 3):
+            response = client.post("/api/v1/metrics/batch", json={"metrics": metrics})
+            assert response.status_code == 202
+            assert response.json()["metrics_count"] == 3
+            assert response.json()["rejected_count"] == 2
+
+            # Existing series keep flowing; only new ones are refused
+            response = client.post("/api/v1/metrics", json=metrics[0])
+            assert response.status_code == 202
+            response = client.post("/api/v1/metrics", json=metrics[4])
+            assert response.status_code == 422
+            assert response.json()["error"] == "Series limit exceeded"
+
+    def test_series_limit_per_api_key(self, client):
+        """Test that the per-tenant limit follows the API key, not the client's source field"""
+        metrics = [
+            {"name": "tenant_metric", "value": 1, "labels": {"id": str(i)}, "source": f"s{i}"}
+            for i in range(3)
+        ]
+        with patch.object(series_registry, "max_series_per_tenant", 2), patch(
+            "src.main.api_keys", {"tenant-key-1", "tenant-key-2"}
+        ):
+            response = client.post(
+                "/api/v1/metrics/batch",
+                json={"metrics": metrics},
+                headers={"X-API-Key": "tenant-key-1"},
+            )
+            assert response.json()["rejected_count"] == 1
+            response = client.post(
+                "/api/v1/metrics", json=metrics[2], headers={"X-API-Key": "tenant-key-2"}
+            )
+            assert response.status_code == 202
+
+        tenants = client.get("/api/v1/series/cardinality?limit=1000").json()["top_tenants"]
+        assert {"tenant": "tena***", "series": 2} in tenants
+        assert not any(t["tenant"].startswith("tenant-key") for t in tenants)
+
+    def test_refused_requests_register_no_series(self, client):
+        """Test that 413, 422 and 503 responses leave the series registry alone"""
+
+        def post(name, value=1):
+            metric = {"name": name, "value": value, "labels": {"id": "x"}}
+            return client.post("/api/v1/metrics", json={"metrics": [metric] * 11})
+
+        with patch("src.main.quotas", TenantQuotas(rate=1, burst=10)):
+            assert post("refused_too_big").status_code == 413
+        with patch("src.main.ingestion.has_room", return_value=False):
+            assert post("refused_queue_full").status_code == 503
+        assert post("refused_invalid", value="high").status_code == 422
+        for name in ("refused_too_big", "refused_queue_full", "refused_invalid"):
+            assert series_registry.lookup(name, {"id": "x"}) is None
+
+    def test_batch_endpoint_requires_metrics_list(self, client):
+        """Test that the batch endpoint rejects a bare metric"""
+        response = client.post("/api/v1/metrics/batch", json={"name": "cpu", "value": 1})
+        assert response.status_code == 422
+
+    def test_ingest_metric_invalid_value(self, client):
+        """Test ingesting a metric whose value is not numeric"""
+        response = client.post("/api/v1/metrics", json={"name": "cpu", "value": "high"})
+        assert response.status_code == 422
+        assert "value" in response.json()["detail"]
+
+    def test_ingest_metric_timestamp_out_of_range(self, client):
+        """Test that an unrepresentable epoch timestamp is a 422, not a 500"""
+        metric = {"name": "cpu", "value": 1, "timestamp": 1e20}
+        response = client.post("/api/v1/metrics", json=metric)
+        assert response.status_code == 422
+        assert "timestamp" in response.json()["detail"]
+
+    def test_ingest_metric_invalid_type(self, client):
+        """Test ingesting a metric with an unknown metric type"""
+        response = client.post(
+            "/api/v1/metrics", json={"name": "cpu", "value": 1.0, "type": "bogus"}
+        )
+        assert response.status_code == 422
+
+    def test_ingest_metric_queue_full(self, client):
+        """Test that a full ingestion queue sheds load with 503"""
+        from src.services.ingestion import IngestionQueueFull
+
+        with patch("src.main.ingestion.submit", side_effect=IngestionQueueFull("full")):
+            response = client.post("/api/v1/metrics", json={"name": "cpu", "value": 1.0})
+        assert response.status_code == 503
+        assert response.headers["retry-after"] == "1"
+
     def test_ingest_metric_invalid_json(self, client):
         """Test ingesting invalid JSON data"""
         response = client.post(
@@ -199,7 +670,7 @@ def test_ingest_metric_invalid_json(self, client):
     def test_ingest_metric_empty_payload(self, client):
         """Test ingesting empty payload"""
         response = client.post("/api/v1/metrics", json={})
-        assert response.status_code == 200  # Current implementation accepts any JSON
+        assert response.status_code == 422
 
 
 class TestAlertEndpoints:
@@ -259,6 +730,91 @@ def test_delete_alert_not_found(self, client):
         assert response.status_code == 404
 
 
+class TestAlertRuleEndpoints:
+    """Test alert rule management and active alerts"""
+
+    @pytest.fixture
+    def alert_engine(self):
+        """A fresh in-memory alert engine"""
+        engine = AlertEngine(Database(None))
+        with patch("src.main.alert_engine", engine):
+            yield engine
+
+    @pytest.fixture
+    def rule(self):
+        return {
+            "name": "Test High CPU Alert",
+            "metric_name": "cpu_usage_percent",
+            "condition": "> 75",
+            "threshold": 75.0,
+            "severity": "high",
+            "for_duration": 0,
+        }
+
+    def test_rule_lifecycle(self, client, alert_engine, rule):
+        """Test creating, reading, updating and deleting a rule"""
+        response = client.post("/api/v1/alerts/rules", json=rule)
+        assert response.status_code == 201
+        created = response.json()
+        rule_id = created["id"]
+        assert created["condition"] == "> 75"
+
+        assert client.get(f"/api/v1/alerts/rules/{rule_id}").json()["name"] == rule["name"]
+        assert [r["id"] for r in client.get("/api/v1/alerts/rules").json()] == [rule_id]
+
+        response = client.put(f"/api/v1/alerts/rules/{rule_id}", json={"threshold": 90})
+        assert response.status_code == 200
+        assert response.json()["threshold"] == 90
+        assert response.json()["metric_name"] == "cpu_usage_percent"
+
+        assert client.delete(f"/api/v1/alerts/rules/{rule_id}").status_code == 204
+        assert client.get(f"/api/v1/alerts/rules/{rule_id}").status_code == 404
+
+    def test_create_rule_invalid(self, client, alert_engine, rule):
+        """Test that invalid rules are rejected with 422"""
+        rule["condition"] = "invalid_operator"
+        response = client.post("/api/v1/alerts/rules", json=rule)
+        assert response.status_code == 422
+        assert response.json()["error"] == "Invalid alert rule"
+
+    def test_create_rule_duplicate_name(self, client, alert_engine, rule):
+        """Test that rule names are unique"""
+        assert client.post("/api/v1/alerts/rules", json=rule).status_code == 201
+        assert client.post("/api/v1/alerts/rules", json=rule).status_code == 409
+
+    def test_rule_not_found(self, client, alert_engine):
+        """Test updating and deleting unknown rules"""
+        assert client.put("/api/v1/alerts/rules/missing", json={}).status_code == 404
+        assert client.delete("/api/v1/alerts/rules/missing").status_code == 404
+
+    async def _fire(self, engine, rule):
+        await engine.save_rule(parse_rule(rule))
+        await engine.evaluate(
+            intern_samples(
+                [
+                    parse_sample(
+                        {"name": "cpu_usage_percent", "value": 95, "labels": {"host": h}}
+                    )
+                    for h in ("web-1", "web-2")
+                ]
+            )
+        )
+
+    def test_active_alerts(self, client, alert_engine, rule, event_loop):
+        """Test listing firing alerts with filters"""
+        event_loop.run_until_complete(self._fire(alert_engine, rule))
+
+        response = client.get("/api/v1/alerts/active")
+        assert response.status_code == 200
+        alerts = response.json()
+        assert len(alerts) == 2
+        assert {a["labels"]["host"] for a in alerts} == {"web-1", "web-2"}
+        assert all(a["status"] == "firing" and a["rule_name"] == rule["name"] for a in alerts)
+
+        assert client.get("/api/v1/alerts/active?status=pending").json() == []
+        assert client.get("/api/v1/alerts/active?severity=critical").json() == []
+
+
 class TestErrorHandling:
     """Test error handling and edge cases"""
 
@@ -292,7 +848,7 @@ def test_large_payload(self, client):
 
         response = client.post("/api/v1/metrics", json=large_payload)
         # Should either succeed or fail gracefully
-        assert response.status_code in [200, 413, 422]
+        assert response.status_code in [202, 413, 422]
 
 
 class TestSecurityHeaders:
@@ -308,6 +864,39 @@ def test_security_headers_present(self, client):
         assert "x-frame-options" in headers
         assert "referrer-policy" in headers
         assert "permissions-policy" in headers
+        assert headers["permissions-policy"] == "geolocation=(), microphone=(), camera=()"
+
+    def test_requests_labelled_by_route_template(self, client):
+        """Test that request metrics use the route template, not the raw path"""
+        client.get("/api/v1/metrics/latest/some_unique_metric")
+        client.get("/no/such/path/3f2a")
+
+        content = client.get("/metrics").text
+        assert 'endpoint="/api/v1/metrics/latest/{metric_name}"' in content
+        assert "some_unique_metric" not in content
+        assert 'endpoint="<unmatched>"' in content
+        assert "3f2a" not in content
+
+    def test_request_id_exemplars(self, client):
+        """Test that latency observations carry the request ID as an exemplar"""
+        assert len(client.get("/health").headers["x-request-id"]) == 32
+        response = client.get("/api/v1/status", headers={"X-Request-ID": "req-abc123"})
+        assert response.headers["x-request-id"] == "req-abc123"
+
+        response = client.get("/metrics", headers={"Accept": "application/openmetrics-text"})
+        assert response.headers["content-type"].startswith("application/openmetrics-text")
+        assert 'request_id="req-abc123"' in response.text
+
+    def test_debug_latency(self, client):
+        """Test the live per-route percentile view"""
+        for _ in range(5):
+            client.get("/health")
+
+        data = client.get("/debug/latency").json()
+        routes = {(r["method"], r["route"]): r for r in data["routes"]}
+        health = routes[("GET", "/health")]
+        assert health["count"] >= 5
+        assert 0 < health["p50_ms"] <= health["p95_ms"] <= health["p99_ms"] <= health["max_ms"]
 
     def test_cors_headers(self, client):
         """Test CORS headers"""
@@ -382,7 +971,7 @@ def test_xss_attempt_in_json(self, client):
         }
 
         response = client.post("/api/v1/metrics", json=xss_payload)
-        assert response.status_code in [200, 422]  # Should not cause server error
+        assert response.status_code in [202, 422]  # Should not cause server error
 
     def test_extremely_long_strings(self, client):
         """Test handling of extremely long strings"""
@@ -390,7 +979,7 @@ def test_extremely_long_strings(self, client):
         payload = {"name": long_string, "description": long_string}
 
         response = client.post("/api/v1/metrics", json=payload)
-        assert response.status_code in [200, 422, 413]  # Should handle gracefully
+        assert response.status_code in [202, 422, 413]  # Should handle gracefully
 
 
 class TestPerformanceMetrics:
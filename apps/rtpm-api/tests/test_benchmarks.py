@@ -0,0 +1,153 @@
+"""
+Tests for the RTPM benchmark harness
+Tests the statistics, profiles and baseline gate, and runs each scenario briefly
+against a real server
+"""
+
+import pytest
+
+from tests.benchmarks.harness import (
+    Recorder,
+    active_workers,
+    compare,
+    over_budget,
+    percentile,
+)
+from tests.benchmarks.imports import run_imports, slowest_modules
+from tests.benchmarks.scenarios import SCENARIOS, Payloads, profile_stages, run_scenario
+from tests.benchmarks.soak import run_soak
+
+
+class TestStatistics:
+    """Test latency summaries"""
+
+    def test_percentile_nearest_rank(self):
+        """Test nearest-rank percentiles over a sorted sample"""
+        ordered = [float(i) for i in range(1, 101)]
+        assert percentile(ordered, 0.50) == 50.0
+        assert percentile(ordered, 0.99) == 99.0
+        assert percentile(ordered, 1.0) == 100.0
+        assert percentile([], 0.5) == 0.0
+
+    def test_summary(self):
+        """Test that a summary reports milliseconds, throughput and CPU per request"""
+        recorder = Recorder()
+        for ms in range(1, 101):
+            recorder.record(ms / 1000)
+        recorder.error()
+        recorder.elapsed = 2.0
+        summary = recorder.summary(cpu_seconds=0.05)
+        assert summary["requests"] == 100
+        assert summary["errors"] == 1
+        assert summary["throughput_rps"] == 50.0
+        assert summary["p50_ms"] == 50.0
+        assert summary["p99_ms"] == 99.0
+        assert summary["server_cpu_ms_per_request"] == 0.5
+
+
+class TestProfiles:
+    """Test k6-style stage profiles"""
+
+    def test_ramps_are_linear(self):
+        """Test that workers ramp between stage targets"""
+        stages = [(10.0, 10), (10.0, 10), (10.0, 0)]
+        assert active_workers(stages, 0.0) == 0
+        assert active_workers(stages, 5.0) == 5
+        assert active_workers(stages, 15.0) == 10
+        assert active_workers(stages, 25.0) == 5
+        assert active_workers(stages, 99.0) == 0
+
+    @pytest.mark.parametrize("profile", ["constant", "stress", "spike"])
+    def test_profiles_fit_duration_and_peak(self, profile):
+        """Test that a profile lasts the requested time and peaks at the connection count"""
+        stages = profile_stages(profile, 30.0, 100)
+        assert sum(duration for duration, _ in stages) == pytest.approx(30.0)
+        assert max(target for _, target in stages) == 100
+
+    def test_payloads_are_deterministic(self):
+        """Test that every run sends the same requests"""
+        assert Payloads().batches == Payloads().batches
+        assert Payloads().snapshots[:5] == Payloads().snapshots[:5]
+
+
+class TestBaselineGate:
+    """Test regression detection against a recorded baseline"""
+
+    BASELINE = {
+        "results": {"ingest": {"p50_ms": 5.0, "p99_ms": 20.0, "throughput_rps": 1000.0}}
+    }
+
+    def test_within_tolerance_passes(self):
+        """Test that noise inside the tolerance is not a regression"""
+        result = {"ingest": {"p50_ms": 5.5, "p99_ms": 24.0, "throughput_rps": 850.0}}
+        assert compare(result, self.BASELINE, 0.25) == []
+
+    def test_regressions_are_reported(self):
+        """Test that slower latencies and lower throughput fail the gate"""
+        result = {"ingest": {"p50_ms": 5.0, "p99_ms": 30.0, "throughput_rps": 700.0}}
+        regressions = compare(result, self.BASELINE, 0.25)
+        assert len(regressions) == 2
+        assert regressions[0].startswith("ingest: p99_ms")
+        assert regressions[1].startswith("ingest: throughput_rps")
+
+    def test_new_scenarios_have_nothing_to_regress_from(self):
+        """Test that a scenario missing from the baseline is not compared"""
+        assert compare({"fanout": {"p99_ms": 1e6}}, self.BASELINE, 0.25) == []
+
+    def test_budget(self):
+        """Test absolute latency and error-rate budgets"""
+        result = {"requests": 990, "errors": 10, "p99_ms": 120.0}
+        failures = over_budget("ingest", result, {"p99_ms": 100.0, "error_rate": 0.001})
+        assert len(failures) == 2
+
+
+class TestImportTime:
+    """Test the cold-import benchmark"""
+
+    def test_slowest_modules(self):
+        """Test that -X importtime output is ranked by self time"""
+        output = "\n".join(
+            [
+                "import time: self [us] | cumulative | imported package",
+                "import time:       120 |        120 |   json.decoder",
+                "import time:      3000 |       3500 | fastapi",
+                "import time:       900 |       4400 | src.main",
+            ]
+        )
+        assert slowest_modules(output, 2) == [("fastapi", 3.0), ("src.main", 0.9)]
+
+    @pytest.mark.performance
+    @pytest.mark.slow
+    def test_heavy_dependencies_stay_lazy(self):
+        """Test that importing the app loads none of the lazily imported dependencies"""
+        result = run_imports(runs=1, top=3)
+        assert result["lazy_loaded"] == []
+        assert result["p50_ms"] > 0
+        assert len(result["slowest_modules"]) == 3
+
+
+@pytest.mark.performance
+@pytest.mark.slow
+@pytest.mark.asyncio
+class TestScenarios:
+    """Run every scenario for a moment against uvicorn"""
+
+    @pytest.mark.parametrize("name", list(SCENARIOS))
+    async def test_scenario_runs(self, name):
+        """Test that a scenario completes without errors and within its budget"""
+        scenario = SCENARIOS[name]
+        result = await run_scenario(
+            scenario, duration=1.0, connections=4, warmup=0.2, clients=5, rate=50.0
+        )
+        assert result["requests"] > 0
+        assert result["errors"] == 0
+        assert over_budget(name, result, {"error_rate": 0.0}) == []
+
+    async def test_soak_runs(self):
+        """Test that the soak benchmark delivers every frame to every client"""
+        result = await run_soak(clients=20, rate=10.0, duration=1.0, warmup=0.5, processes=2)
+        assert result["connected"] == 20
+        assert result["published"] > 0
+        assert result["delivery_ratio"] == 1.0
+        assert "memory_per_connection_kb" in result
+        assert result["server_cpu_us_per_message"] > 0
@@ -0,0 +1,161 @@
+"""
+Unit tests for the cached Prometheus exposition
+Tests snapshot reuse, format and gzip negotiation
+"""
+
+import asyncio
+import gzip
+import threading
+
+from prometheus_client import CollectorRegistry, Counter
+
+from src.services import exposition as exposition_module
+from src.services.alerting import FIRING, AlertEngine
+from src.services.database import Database
+from src.services.exposition import (
+    OPENMETRICS,
+    TEXT,
+    ExpositionCache,
+    accepts_gzip,
+    negotiate,
+)
+from src.services.spool import Spool
+
+
+def _registry():
+    registry = CollectorRegistry()
+    counter = Counter("cache_test_total", "Test counter", registry=registry)
+    return registry, counter
+
+
+class TestExpositionCache:
+    """Test that renders are shared between scrapes"""
+
+    def test_serves_snapshot_within_interval(self):
+        """Test that scrapes within the interval see the same bytes"""
+        registry, counter = _registry()
+        cache = ExpositionCache(interval=60, registry=registry)
+
+        async def scrape_twice():
+            first = await cache.get()
+            counter.inc()
+            second = await cache.get()
+            return first, second
+
+        first, second = asyncio.run(scrape_twice())
+        assert second is first
+        assert b"cache_test_total 0.0" in first.body
+
+    def test_zero_interval_renders_every_scrape(self):
+        """Test that interval 0 disables caching"""
+        registry, counter = _registry()
+        cache = ExpositionCache(interval=0, registry=registry)
+
+        async def scrape_twice():
+            await cache.get()
+            counter.inc()
+            return await cache.get()
+
+        assert b"cache_test_total 1.0" in asyncio.run(scrape_twice()).body
+
+    def test_concurrent_scrapes_render_once(self, monkeypatch):
+        """Test that scrapers arriving during a render share its result"""
+        registry, _ = _registry()
+        cache = ExpositionCache(interval=60, registry=registry)
+        renders = []
+
+        def render(reg):
+            renders.append(reg)
+            return b"body"
+
+        monkeypatch.setitem(exposition_module._RENDERERS, TEXT, render)
+
+        async def scrape_many():
+            return await asyncio.gather(*(cache.get() for _ in range(20)))
+
+        snapshots = asyncio.run(scrape_many())
+        assert len(renders) == 1
+        assert all(s is snapshots[0] for s in snapshots)
+
+    def test_gzip_response(self):
+        """Test that gzip is served when accepted and compressed once"""
+        registry, _ = _registry()
+        cache = ExpositionCache(interval=60, registry=registry)
+
+        async def scrape():
+            plain = await cache.response("", "")
+            zipped = await cache.response("", "gzip, deflate")
+            return plain, zipped, (await cache.get()).gzipped
+
+        (plain, plain_headers), (zipped, zipped_headers), cached = asyncio.run(scrape())
+        assert "Content-Encoding" not in plain_headers
+        assert zipped_headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(zipped) == plain
+        assert zipped is cached
+
+
+class TestNegotiation:
+    """Test Accept and Accept-Encoding parsing"""
+
+    def test_format(self):
+        """Test that OpenMetrics is served only when asked for"""
+        assert negotiate("application/openmetrics-text; version=1.0.0") == OPENMETRICS
+        assert negotiate("text/plain") == TEXT
+        assert negotiate("") == TEXT
+
+    def test_gzip(self):
+        """Test that gzip honours q-values"""
+        assert accepts_gzip("gzip")
+        assert accepts_gzip("deflate, GZIP;q=0.5")
+        assert not accepts_gzip("gzip;q=0")
+        assert not accepts_gzip("identity")
+        assert not accepts_gzip("")
+
+
+def _read_while_mutating(read, mutate, rounds=200000):
+    """Call ``read`` on a thread, as a render does, while ``mutate`` runs here"""
+    errors = []
+    done = threading.Event()
+
+    def reader():
+        while not done.is_set():
+            try:
+                read()
+            except RuntimeError as e:
+                errors.append(e)
+                return
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    try:
+        for i in range(rounds):
+            mutate(i)
+    finally:
+        done.set()
+        thread.join()
+    return errors
+
+
+class TestGaugeCallbacks:
+    """Test that gauge callbacks survive being read off the event loop"""
+
+    def test_alert_count(self):
+        """Test counting alert states while the engine adds and drops them"""
+        engine = AlertEngine(Database(None))
+        state = type("State", (), {"status": FIRING})()
+
+        def mutate(i):
+            engine._states[("rule", i)] = state
+            engine._states.pop(("rule", i - 50), None)
+
+        assert _read_while_mutating(lambda: engine._count(FIRING), mutate) == []
+
+    def test_spool_size(self, tmp_path):
+        """Test summing segment sizes while segments come and go"""
+        spool = Spool(str(tmp_path))
+
+        def mutate(i):
+            spool._sizes[i] = 1
+            spool._sizes.pop(i - 50, None)
+
+        assert _read_while_mutating(lambda: spool.size, mutate) == []
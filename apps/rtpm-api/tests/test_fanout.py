@@ -0,0 +1,141 @@
+"""
+Unit tests for cross-replica fan-out over Redis pub/sub
+Tests relaying between replicas, batching, backpressure and Redis outages
+"""
+
+import asyncio
+import json
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+from src.services.fanout import RedisFanout
+from src.services.ingestion import parse_sample
+
+
+def _sample(value, name="cpu", host="web-1"):
+    return parse_sample({"name": name, "value": value, "labels": {"host": host}})
+
+
+async def _eventually(condition, timeout=2.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        assert loop.time() < deadline, "condition not met in time"
+        await asyncio.sleep(0.01)
+
+
+def _replica(broker, **kwargs):
+    fanout = RedisFanout(client_factory=broker.client, **kwargs)
+    received = []
+
+    async def relay(batch):
+        received.extend(batch)
+
+    fanout.add_relay(relay)
+    return fanout, received
+
+
+@pytest.mark.asyncio
+class TestRedisFanout:
+    """Test publishing to and relaying from other replicas"""
+
+    async def test_relays_between_replicas(self, fake_redis):
+        """Test that samples reach other replicas but are not echoed back"""
+        a, received_a = _replica(fake_redis)
+        b, received_b = _replica(fake_redis)
+        assert await a.start() and await b.start()
+        try:
+            await _eventually(lambda: len(fake_redis.subscribers) == 2)
+            await a.publish([_sample(1), _sample(2, host="web-2")])
+
+            await _eventually(lambda: len(received_b) == 2)
+            assert [s.value for s in received_b] == [1, 2]
+            assert received_b[1].labels == {"host": "web-2"}
+            await asyncio.sleep(0.05)
+            assert received_a == []
+        finally:
+            await a.stop()
+            await b.stop()
+
+    async def test_batches_messages(self, fake_redis):
+        """Test that buffered samples are packed into batch_size messages"""
+        fanout, _ = _replica(fake_redis, batch_size=500)
+        await fanout.publish([_sample(i) for i in range(1200)])
+        assert await fanout.start()
+        try:
+            await _eventually(lambda: len(fake_redis.published) == 3)
+            sizes = [len(json.loads(m)["samples"]) for _, m in fake_redis.published]
+            assert sizes == [500, 500, 200]
+            assert {channel for channel, _ in fake_redis.published} == {"rtpm:metrics"}
+        finally:
+            await fanout.stop()
+
+    async def test_buffer_drops_oldest_when_full(self, fake_redis):
+        """Test that a full buffer sheds the oldest samples instead of blocking"""
+        fanout, _ = _replica(fake_redis, max_pending=10)
+        await fanout.publish([_sample(i) for i in range(15)])
+        assert [s.value for s in fanout._pending] == list(range(5, 15))
+
+    async def test_publish_failures_keep_samples_buffered(self, fake_redis):
+        """Test that samples survive a Redis outage while the buffer has room"""
+        fanout, _ = _replica(fake_redis)
+        assert await fanout.start()
+        try:
+            fake_redis.down = True
+            await fanout.publish([_sample(1)])
+            await asyncio.sleep(0.05)
+            assert len(fanout._pending) == 1
+
+            fake_redis.down = False
+            await _eventually(lambda: fake_redis.published)
+            assert not fanout._pending
+        finally:
+            await fanout.stop()
+
+    async def test_start_without_redis(self, fake_redis):
+        """Test that an unreachable or unset Redis leaves broadcasts local"""
+        fake_redis.down = True
+        fanout, _ = _replica(fake_redis)
+        assert await fanout.start() is False
+        assert not fanout.running
+
+        unconfigured = RedisFanout(None)
+        assert not unconfigured.configured
+        assert await unconfigured.start() is False
+
+    async def test_ignores_malformed_messages(self, fake_redis):
+        """Test that undecodable messages are skipped without stopping the listener"""
+        fanout, received = _replica(fake_redis)
+        await fanout._relay(b"not json")
+        await fanout._relay(json.dumps({"origin": "other", "samples": [{"value": 1}]}))
+        await fanout._relay(
+            json.dumps({"origin": "other", "samples": [{"name": "cpu", "value": 3}]})
+        )
+        assert [s.value for s in received] == [3]
+
+
+@pytest.mark.asyncio
+class TestRelayedSamples:
+    """Test what the API does with samples relayed from other replicas"""
+
+    async def test_relayed_samples_skip_alerts_heartbeats_and_storage(self):
+        """Test that relayed samples reach clients and the hot window only"""
+        from src import main
+
+        sample = parse_sample(
+            {"name": "cpu", "value": 99.0, "source": "agent", "labels": {"agent_id": "a-1"}}
+        )
+        with patch("src.main.broadcast_batch", AsyncMock()) as broadcast, patch.object(
+            main.hot_window, "record", AsyncMock()
+        ) as hot, patch.object(main.alert_engine, "evaluate", AsyncMock()) as evaluate, patch(
+            "src.main.record_agent_heartbeats", AsyncMock()
+        ) as heartbeats, patch.object(
+            main.metric_writer, "write", AsyncMock()
+        ) as write:
+            await main.relay_remote_batch([sample])
+        broadcast.assert_awaited_once()
+        hot.assert_awaited_once()
+        evaluate.assert_not_awaited()
+        heartbeats.assert_not_awaited()
+        write.assert_not_awaited()
@@ -0,0 +1,185 @@
+"""
+Unit tests for RTPM agent liveness
+Tests the hierarchical timer wheel, heartbeat expiry and transition delivery
+"""
+
+import asyncio
+import random
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+from src.services.heartbeat import (
+    OFFLINE,
+    ONLINE,
+    HeartbeatTracker,
+    TimerWheel,
+    liveness_samples,
+    transition_to_dict,
+)
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestTimerWheel:
+    """Test scheduling, cancelling and cascading"""
+
+    def test_timer_fires_at_its_tick(self):
+        """Test that a timer fires once the clock reaches it, not before"""
+        wheel = TimerWheel(resolution=1.0, slots=8, levels=3)
+        wheel.schedule("a", 5.0)
+        assert wheel.advance(4.9) == []
+        assert wheel.advance(5.0) == ["a"]
+        assert "a" not in wheel
+
+    def test_cancel_and_reschedule(self):
+        """Test that rescheduling replaces the earlier timer"""
+        wheel = TimerWheel(resolution=1.0, slots=8, levels=3)
+        wheel.schedule("a", 3.0)
+        wheel.schedule("a", 6.0)
+        assert wheel.advance(5.0) == []
+        assert wheel.advance(6.0) == ["a"]
+        wheel.schedule("b", 10.0)
+        assert wheel.cancel("b")
+        assert not wheel.cancel("b")
+        assert wheel.advance(20.0) == []
+
+    def test_cascaded_timers_fire_in_order(self):
+        """Test that timers in coarser rings fire at their exact tick and in order"""
+        wheel = TimerWheel(resolution=1.0, slots=4, levels=3)
+        deadlines = random.Random(7).sample(range(1, 60), 30)
+        for deadline in deadlines:
+            wheel.schedule(deadline, float(deadline))
+        fired = []
+        for now in range(1, 61):
+            for key in wheel.advance(float(now)):
+                assert key == now
+                fired.append(key)
+        assert fired == sorted(deadlines)
+
+    def test_timers_beyond_the_horizon(self):
+        """Test that timers past the top ring still fire on time"""
+        wheel = TimerWheel(resolution=1.0, slots=4, levels=2)
+        wheel.schedule("far", 100.0)
+        assert wheel.advance(99.0) == []
+        assert wheel.advance(100.0) == ["far"]
+
+
+class TestHeartbeatTracker:
+    """Test liveness transitions"""
+
+    def test_agent_goes_offline_after_timeout(self):
+        """Test that a silent agent is reported offline once, after timeout"""
+        clock = FakeClock()
+        tracker = HeartbeatTracker(timeout=10.0, clock=clock)
+        tracker.heartbeat("agent-1")
+        assert tracker.expire() == [("agent-1", ONLINE, 0.0)]
+
+        clock.now += 9.0
+        assert tracker.expire() == []
+        clock.now += 1.0
+        assert tracker.expire() == [("agent-1", OFFLINE, 10.0)]
+        assert not tracker.is_online("agent-1")
+        clock.now += 30.0
+        assert tracker.expire() == []
+
+    def test_heartbeats_keep_agent_online(self):
+        """Test that an agent heard from within the timeout never goes offline"""
+        clock = FakeClock()
+        tracker = HeartbeatTracker(timeout=10.0, clock=clock)
+        tracker.heartbeat("agent-1")
+        tracker.expire()
+        for _ in range(20):
+            clock.now += 4.0
+            tracker.heartbeat("agent-1")
+            assert tracker.expire() == []
+        assert tracker.is_online("agent-1")
+
+    def test_agent_comes_back_online(self):
+        """Test that a heartbeat from an offline agent is an online transition"""
+        clock = FakeClock()
+        tracker = HeartbeatTracker(timeout=5.0, clock=clock)
+        tracker.heartbeat("agent-1")
+        clock.now += 5.0
+        tracker.expire()
+        tracker.heartbeat("agent-1")
+        assert tracker.expire() == [("agent-1", ONLINE, 0.0)]
+
+    def test_forget_drops_agent_silently(self):
+        """Test that a deregistered agent is not reported offline"""
+        clock = FakeClock()
+        tracker = HeartbeatTracker(timeout=5.0, clock=clock)
+        tracker.heartbeat("agent-1")
+        tracker.expire()
+        tracker.forget("agent-1")
+        clock.now += 10.0
+        assert tracker.expire() == []
+
+    def test_fleet_tick_cost_is_independent_of_fleet_size(self):
+        """Test that 10k heartbeating agents cost one re-arm each per timeout"""
+        clock = FakeClock()
+        tracker = HeartbeatTracker(timeout=30.0, clock=clock)
+        agents = [f"agent-{i}" for i in range(10000)]
+        for agent_id in agents:
+            tracker.heartbeat(agent_id)
+        tracker.expire()
+
+        start = time.perf_counter()
+        for _ in range(60):
+            clock.now += 1.0
+            for agent_id in agents:
+                tracker.heartbeat(agent_id)
+            assert tracker.expire() == []
+        elapsed = time.perf_counter() - start
+        # 600k heartbeats plus 20k re-arms
+        assert elapsed < 5.0
+        assert len(tracker.wheel) == len(agents)
+
+        clock.now += 30.0
+        offline = tracker.expire()
+        assert len(offline) == len(agents)
+        assert {state for _, state, _ in offline} == {OFFLINE}
+
+
+class TestTransitions:
+    """Test what transitions are turned into"""
+
+    def test_liveness_samples(self):
+        """Test that transitions become agent_up gauges for the alert engine"""
+        samples = liveness_samples([("a", ONLINE, 0.0), ("b", OFFLINE, 31.0)])
+        assert [(s.metric_name, s.labels, s.value) for s in samples] == [
+            ("agent_up", {"agent_id": "a"}, 1.0),
+            ("agent_up", {"agent_id": "b"}, 0.0),
+        ]
+
+    def test_transition_to_dict(self):
+        """Test that the frame payload carries the wall-clock last heartbeat"""
+        now = datetime(2024, 1, 1, 0, 1, tzinfo=timezone.utc)
+        assert transition_to_dict(("a", OFFLINE, 60.0), now) == {
+            "agent_id": "a",
+            "status": OFFLINE,
+            "lastSeen": "2024-01-01T00:00:00+00:00",
+        }
+
+    @pytest.mark.asyncio
+    async def test_listeners_receive_transitions(self):
+        """Test that the background task delivers each tick's transitions"""
+        received = []
+
+        async def listener(transitions):
+            received.extend(transitions)
+
+        tracker = HeartbeatTracker(timeout=0.05, resolution=0.01)
+        tracker.add_listener(listener)
+        await tracker.start()
+        tracker.heartbeat("agent-1")
+        await asyncio.sleep(0.2)
+        await tracker.stop()
+        assert [state for _, state, _ in received] == [ONLINE, OFFLINE]
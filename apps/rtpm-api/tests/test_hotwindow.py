@@ -0,0 +1,94 @@
+"""
+Unit tests for the RTPM in-memory hot window
+Tests ring-buffer wraparound, windowed reads, series caps and pruning
+"""
+
+import pytest
+from array import array
+
+from src.services.hotwindow import POINT_BYTES, HotWindow, SeriesBuffer
+from src.services.ingestion import intern_samples, parse_payload, parse_sample
+
+
+def _sample(value, timestamp, name="cpu", host="web-1"):
+    sample = parse_sample(
+        {"name": name, "value": value, "timestamp": timestamp, "labels": {"host": host}}
+    )
+    return intern_samples([sample])[0]
+
+
+class TestSeriesBuffer:
+    """Test the per-series ring buffer"""
+
+    def test_stores_doubles_in_arrays(self):
+        """Test that points live in array('d') storage, not objects"""
+        buffer = SeriesBuffer(_sample(1, 0), capacity=4)
+        buffer.append(1.0, 10.0)
+        assert isinstance(buffer._ts, array) and buffer._ts.typecode == "d"
+        assert isinstance(buffer._values, array) and buffer._values.typecode == "d"
+        assert buffer.nbytes == POINT_BYTES
+
+    def test_wraparound_keeps_newest(self):
+        """Test that a full ring overwrites its oldest points"""
+        buffer = SeriesBuffer(_sample(1, 0), capacity=3)
+        for i in range(5):
+            buffer.append(float(i), float(i * 10))
+
+        assert len(buffer) == 3
+        assert list(buffer.points()) == [(2.0, 20.0), (3.0, 30.0), (4.0, 40.0)]
+        assert buffer.latest() == (4.0, 40.0)
+        assert list(buffer.points(since=3.0)) == [(3.0, 30.0), (4.0, 40.0)]
+
+
+@pytest.mark.asyncio
+class TestHotWindow:
+    """Test the ingestion sink and read paths"""
+
+    async def test_record_and_read(self):
+        """Test latest and windowed reads per series"""
+        window = HotWindow(retention=60, capacity=100)
+        await window.record(
+            [_sample(v, 1000 + v, host=h) for v in range(10) for h in ("a", "b")]
+        )
+
+        latest = window.latest("cpu")
+        assert [p["value"] for p in latest] == [9, 9]
+        assert window.latest("cpu", {"host": "b"})[0]["labels"] == {"host": "b"}
+
+        series = window.window("cpu", {"host": "a"}, seconds=3, now=1009)
+        assert [p["value"] for p in series[0]["data_points"]] == [6, 7, 8, 9]
+
+    async def test_memory_is_bounded(self):
+        """Test that memory stops growing at capacity and max_series"""
+        window = HotWindow(retention=60, capacity=8, max_series=2)
+        for i in range(100):
+            window.add(_sample(i, i, host=f"h{i % 3}"))
+
+        assert len(window) == 2
+        assert window.nbytes() == 2 * 8 * POINT_BYTES
+        assert window.stats()["bytes_per_series"] == 8 * POINT_BYTES
+
+    async def test_prune_idle_series(self):
+        """Test that series without recent points are released"""
+        window = HotWindow(retention=60)
+        window.add(_sample(1, 1000, host="old"))
+        window.add(_sample(1, 1100, host="new"))
+
+        assert window.prune(now=1120) == 1
+        assert [p["labels"]["host"] for p in window.latest()] == ["new"]
+        assert window.nbytes() == POINT_BYTES
+
+    async def test_agent_snapshot(self, sample_agent_metrics):
+        """Test that agent snapshots become one series per field"""
+        window = HotWindow()
+        await window.record(intern_samples(parse_payload(sample_agent_metrics)))
+        assert len(window) == 10
+        assert window.latest("cpu")[0]["labels"] == {"agent_id": "agent-001"}
+
+    async def test_unrenderable_timestamp_is_clamped(self):
+        """Test that a point outside datetime's range never breaks a read"""
+        window = HotWindow(retention=60)
+        sample = _sample(1, 1000)
+        window.add(sample)
+        window._buffers[sample.series_id].append(-62135614800.0, 2.0)
+        assert window.latest("cpu")[0]["timestamp"] == "1970-01-01T00:00:00+00:00"
@@ -0,0 +1,318 @@
+"""
+Unit tests for the RTPM metric ingestion pipeline
+Tests payload validation, batching by size and time, shutdown draining
+and the database pool lifecycle
+"""
+
+import asyncio
+import json
+import pytest
+
+from src.services.database import Database, normalize_dsn
+from src.services.ingestion import (
+    IngestionPipeline,
+    IngestionQueueFull,
+    MetricValidationError,
+    parse_payload,
+)
+from src.services.storage import METRIC_COLUMNS, MetricWriter
+
+
+class TestPayloadValidation:
+    """Test validation against the metrics table shape"""
+
+    def test_single_metric(self):
+        """Test a metric using API field names"""
+        samples = parse_payload(
+            {
+                "name": "cpu_usage_percent",
+                "type": "gauge",
+                "value": 42,
+                "timestamp": "2024-01-01T00:00:00Z",
+                "labels": {"host": "server01", "core": 3},
+                "unit": "percent",
+            }
+        )
+        assert len(samples) == 1
+        sample = samples[0]
+        assert sample.metric_name == "cpu_usage_percent"
+        assert sample.value == 42.0
+        assert sample.labels == {"host": "server01", "core": "3"}
+        assert sample.timestamp.tzinfo is not None
+
+    def test_column_names_and_defaults(self):
+        """Test a metric using metrics table column names"""
+        sample = parse_payload({"metric_name": "requests", "metric_type": "counter", "value": 1})[0]
+        assert sample.metric_type == "counter"
+        assert sample.source == "api"
+        assert sample.labels == {}
+
+    def test_batch(self):
+        """Test a batch payload"""
+        samples = parse_payload({"metrics": [{"name": "a", "value": i} for i in range(3)]})
+        assert [s.value for s in samples] == [0.0, 1.0, 2.0]
+
+    def test_batch_reports_failing_index(self):
+        """Test that batch errors identify the offending metric"""
+        with pytest.raises(MetricValidationError, match=r"metrics\[1\]"):
+            parse_payload([{"name": "a", "value": 1}, {"name": "b"}])
+
+    def test_agent_snapshot(self, sample_agent_metrics):
+        """Test that agent snapshots expand into labelled gauges"""
+        samples = parse_payload(sample_agent_metrics)
+        names = {s.metric_name for s in samples}
+        assert {"cpu", "memory", "queueDepth"} <= names
+        assert all(s.labels == {"agent_id": "agent-001"} for s in samples)
+        assert all(s.source == "agent" for s in samples)
+
+    @pytest.mark.parametrize(
+        "payload",
+        [
+            {},
+            [],
+            {"metrics": []},
+            {"name": "cpu"},
+            {"name": "", "value": 1},
+            {"name": "cpu", "value": True},
+            {"name": "cpu", "value": float("nan")},
+            {"name": "cpu", "value": 1, "type": "bogus"},
+            {"name": "cpu", "value": 1, "labels": ["a"]},
+            {"name": "cpu", "value": 1, "labels": {"a": {"nested": 1}}},
+            {"name": "cpu", "value": 1, "timestamp": "yesterday"},
+            {"name": "cpu", "value": 1, "timestamp": 1e20},
+            {"name": "cpu", "value": 1, "timestamp": -1e20},
+            {"name": "cpu", "value": 1, "timestamp": "0001-01-01T00:00:00+05:00"},
+            {"name": "cpu", "value": 1, "timestamp": "9999-12-31T23:59:59Z"},
+            {"name": "cpu", "value": 1, "timestamp": -1},
+            {"name": "x" * 256, "value": 1},
+            "cpu=1",
+        ],
+    )
+    def test_invalid_payloads(self, payload):
+        """Test payloads that cannot become metrics rows"""
+        with pytest.raises(MetricValidationError):
+            parse_payload(payload)
+
+
+@pytest.mark.asyncio
+class TestIngestionPipeline:
+    """Test queueing and batch flushing"""
+
+    async def _pipeline(self, **kwargs):
+        batches = []
+
+        async def sink(batch):
+            batches.append(list(batch))
+
+        pipeline = IngestionPipeline(**kwargs)
+        pipeline.add_sink(sink)
+        await pipeline.start()
+        return pipeline, batches
+
+    async def test_flush_on_batch_size(self):
+        """Test that a full batch is flushed without waiting for the timer"""
+        pipeline, batches = await self._pipeline(batch_size=10, flush_interval=60)
+        pipeline.submit(parse_payload([{"name": "m", "value": i} for i in range(25)]))
+        await asyncio.sleep(0.05)
+
+        assert [len(b) for b in batches] == [10, 10]
+        await pipeline.stop()
+        assert [len(b) for b in batches] == [10, 10, 5]
+
+    async def test_flush_on_interval(self):
+        """Test that a partial batch is flushed after the flush interval"""
+        pipeline, batches = await self._pipeline(batch_size=100, flush_interval=0.05)
+        pipeline.submit(parse_payload({"name": "m", "value": 1}))
+        await asyncio.sleep(0.01)
+        assert batches == []
+
+        await asyncio.sleep(0.1)
+        assert len(batches) == 1
+        await pipeline.stop()
+
+    async def test_queue_full_rejects_whole_submission(self):
+        """Test that submissions are all-or-nothing when the queue is bounded"""
+        pipeline = IngestionPipeline(max_queue_size=5, batch_size=100, flush_interval=60)
+        await pipeline.start()
+        pipeline.submit(parse_payload([{"name": "m", "value": i} for i in range(4)]))
+
+        with pytest.raises(IngestionQueueFull):
+            pipeline.submit(parse_payload([{"name": "m", "value": i} for i in range(2)]))
+        await pipeline.stop()
+
+    async def test_submit_before_start(self):
+        """Test that a stopped pipeline refuses work"""
+        pipeline = IngestionPipeline()
+        with pytest.raises(IngestionQueueFull):
+            pipeline.submit(parse_payload({"name": "m", "value": 1}))
+
+    async def test_failing_sink_does_not_block_others(self):
+        """Test that one failing sink does not prevent delivery to the rest"""
+        delivered = []
+
+        async def broken(batch):
+            raise RuntimeError("boom")
+
+        async def healthy(batch):
+            delivered.extend(batch)
+
+        pipeline = IngestionPipeline(batch_size=1, flush_interval=0.01)
+        pipeline.add_sink(broken)
+        pipeline.add_sink(healthy)
+        await pipeline.start()
+        pipeline.submit(parse_payload({"name": "m", "value": 1}))
+        await asyncio.sleep(0.05)
+        await pipeline.stop()
+
+        assert len(delivered) == 1
+
+
+class FakeConnection:
+    """Records COPY calls made by the writer"""
+
+    def __init__(self):
+        self.copies = []
+        self.fail = False
+
+    async def copy_records_to_table(self, table, records, columns):
+        self.copies.append((table, list(records), columns))
+
+    async def fetchval(self, query, timeout=None):
+        if self.fail:
+            raise ConnectionError("connection reset")
+        return 1
+
+
+class FakePool:
+    def __init__(self, close_delay=0.0):
+        self.connection = FakeConnection()
+        self.acquired = 0
+        self.close_delay = close_delay
+        self.closed = False
+        self.terminated = False
+
+    async def close(self):
+        await asyncio.sleep(self.close_delay)
+        self.closed = True
+
+    def terminate(self):
+        self.terminated = True
+
+    def get_size(self):
+        return 1
+
+    def get_idle_size(self):
+        return 1
+
+    def acquire(self, timeout=None):
+        pool = self
+
+        class _Acquire:
+            async def __aenter__(self):
+                pool.acquired += 1
+                return pool.connection
+
+            async def __aexit__(self, *exc):
+                return False
+
+        return _Acquire()
+
+
+@pytest.mark.asyncio
+class TestMetricWriter:
+    """Test bulk persistence into the metrics hypertable"""
+
+    async def test_one_copy_per_batch(self):
+        """Test that a batch is written with a single COPY on one connection"""
+        database = Database("postgresql+asyncpg://rtpm:secret@db:5432/rtpm_db")
+        pool = FakePool()
+        database._pool = pool
+        writer = MetricWriter(database)
+
+        batch = parse_payload(
+            [{"name": "cpu", "value": i, "labels": {"host": f"h{i}"}} for i in range(50)]
+        )
+        await writer.write(batch)
+
+        assert pool.acquired == 1
+        assert len(pool.connection.copies) == 1
+        table, records, columns = pool.connection.copies[0]
+        assert table == "metrics"
+        assert columns == METRIC_COLUMNS
+        assert len(records) == 50
+        assert json.loads(records[3][columns.index("labels")]) == {"host": "h3"}
+
+    async def test_writer_requires_connection(self):
+        """Test that writing without a pool fails loudly"""
+        writer = MetricWriter(Database(None))
+        with pytest.raises(RuntimeError):
+            await writer.write(parse_payload({"name": "cpu", "value": 1}))
+
+    async def test_unconfigured_database_does_not_connect(self):
+        """Test that no DATABASE_URL means no pool and no error"""
+        database = Database(None)
+        assert await database.connect() is False
+        assert not database.connected
+
+
+@pytest.mark.asyncio
+class TestDatabaseLifecycle:
+    """Test pool health probing and shutdown draining"""
+
+    async def test_health_follows_probe(self):
+        """Test that readiness tracks the last health probe"""
+        database = Database("postgresql://db/rtpm")
+        assert not database.ready
+        pool = database._pool = FakePool()
+
+        assert await database.check() is True
+        assert database.ready
+        pool.connection.fail = True
+        assert await database.check() is False
+        assert not database.ready
+        assert database.status()["healthy"] is False
+
+    async def test_unconfigured_database_is_ready(self):
+        """Test that running without persistence never fails readiness"""
+        assert Database(None).ready
+
+    async def test_close_drains_pool(self):
+        """Test that shutdown waits for the pool to close gracefully"""
+        database = Database("postgresql://db/rtpm", drain_timeout=1)
+        pool = database._pool = FakePool(close_delay=0.01)
+        await database.close()
+        assert pool.closed and not pool.terminated
+        assert not database.connected
+
+    async def test_close_terminates_after_timeout(self):
+        """Test that connections still busy after the drain timeout are terminated"""
+        database = Database("postgresql://db/rtpm", drain_timeout=0.01)
+        pool = database._pool = FakePool(close_delay=1)
+        await database.close()
+        assert pool.terminated
+
+    async def test_monitor_reconnects(self, monkeypatch):
+        """Test that the monitor opens the pool once the database is reachable"""
+        database = Database("postgresql://db/rtpm", health_interval=0.01)
+        connected = []
+
+        async def connect():
+            database._pool = FakePool()
+            database.healthy = True
+            connected.append(True)
+            return True
+
+        monkeypatch.setattr(database, "connect", connect)
+        await database.start()
+        await asyncio.sleep(0.05)
+        await database.close()
+        assert connected == [True]
+
+
+class TestDatabaseUrl:
+    """Test DATABASE_URL handling"""
+
+    def test_normalize_dsn(self):
+        """Test that SQLAlchemy driver suffixes are stripped for asyncpg"""
+        assert normalize_dsn("postgresql+asyncpg://u:p@h/db") == "postgresql://u:p@h/db"
+        assert normalize_dsn("postgresql://u:p@h/db") == "postgresql://u:p@h/db"
@@ -601,14 +601,14 @@ def test_metrics_ingestion_workflow(self, client, sample_agent_metrics):
         """Test complete metrics ingestion and processing workflow"""
         # 1. Ingest metrics
         response = client.post("/api/v1/metrics", json=sample_agent_metrics)
-        assert response.status_code == 200
+        assert response.status_code == 202
 
         # 2. Verify metrics are stored (would query database)
         # 3. Verify metrics appear in real-time feed
         # 4. Verify historical data is updated
 
         data = response.json()
-        assert data["status"] == "success"
+        assert data["status"] == "accepted"
 
     def test_alerting_workflow(self, client, sample_alert):
         """Test complete alerting workflow"""
@@ -644,7 +644,7 @@ def test_dashboard_data_flow(self, client):
                 },
             )
 
-            assert response.status_code == 200
+            assert response.status_code == 202
 
             # This would verify WebSocket receives the update
             # Implementation depends on whether ingested metrics are broadcast
@@ -687,7 +687,7 @@ def ingest_metric(agent_id, cpu_value):
 
         # All requests should succeed
         assert len(results) == 20
-        assert all(status == 200 for status in results)
+        assert all(status == 202 for status in results)
 
     def test_websocket_message_ordering(self, client):
         """Test that WebSocket messages maintain proper ordering"""
@@ -732,7 +732,7 @@ def test_database_connection_failure(self, client):
             # But data operations might fail gracefully
             response = client.post("/api/v1/metrics", json={"agentId": "test-agent", "cpu": 50.0})
             # Should either succeed (if using mock) or fail gracefully
-            assert response.status_code in [200, 500, 503]
+            assert response.status_code in [202, 500, 503]
 
     def test_redis_connection_failure(self, client):
         """Test behavior when Redis is unavailable"""
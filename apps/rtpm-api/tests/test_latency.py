@@ -0,0 +1,72 @@
+"""
+Unit tests for RTPM request latency sketches
+Tests quantile accuracy and window rotation
+"""
+
+import random
+
+from src.services.latency import LatencySketch, LatencyTracker
+
+
+class TestLatencySketch:
+    """Test the log-bucketed latency sketch"""
+
+    def test_quantiles_within_precision(self):
+        """Test that quantiles stay within the configured relative error"""
+        rng = random.Random(7)
+        values = sorted(rng.lognormvariate(-7, 1.5) for _ in range(20000))
+        sketch = LatencySketch(precision=0.01)
+        for value in values:
+            sketch.record(value)
+
+        qs = [0.5, 0.95, 0.99]
+        for q, estimate in zip(qs, sketch.quantiles(qs)):
+            exact = values[int(q * (len(values) - 1))]
+            assert abs(estimate - exact) / exact < 0.03
+
+    def test_single_value(self):
+        """Test that estimates never exceed the recorded maximum"""
+        sketch = LatencySketch()
+        sketch.record(0.005)
+        assert sketch.quantiles([0.5, 0.99]) == [0.005, 0.005]
+        assert LatencySketch().quantiles([0.5]) == [0.0]
+
+    def test_merge(self):
+        """Test that merged sketches answer for both inputs"""
+        fast, slow = LatencySketch(), LatencySketch()
+        for _ in range(99):
+            fast.record(0.001)
+        slow.record(1.0)
+        fast.merge(slow)
+        assert fast.count == 100
+        assert fast.max == 1.0
+        p50, p100 = fast.quantiles([0.5, 1.0])
+        assert abs(p50 - 0.001) < 0.00002
+        assert abs(p100 - 1.0) < 0.02
+
+
+class TestLatencyTracker:
+    """Test per-route tracking and rotation"""
+
+    def test_snapshot_per_route(self):
+        """Test that routes are tracked separately and slowest come first"""
+        tracker = LatencyTracker(window=60)
+        for _ in range(10):
+            tracker.record("GET", "/health", 0.0002, now=tracker._started)
+            tracker.record("POST", "/api/v1/metrics", 0.02, now=tracker._started)
+
+        routes = tracker.snapshot(now=tracker._started)
+        assert [(r["method"], r["route"]) for r in routes] == [
+            ("POST", "/api/v1/metrics"),
+            ("GET", "/health"),
+        ]
+        assert routes[0]["count"] == 10
+        assert abs(routes[1]["p99_ms"] - 0.2) < 0.01
+
+    def test_old_windows_expire(self):
+        """Test that samples fall out after two windows"""
+        tracker = LatencyTracker(window=10)
+        start = tracker._started
+        tracker.record("GET", "/health", 0.001, now=start)
+        assert tracker.snapshot(now=start + 15)[0]["count"] == 1
+        assert tracker.snapshot(now=start + 25) == []
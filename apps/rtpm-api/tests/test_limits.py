@@ -0,0 +1,119 @@
+"""
+Unit tests for RTPM ingestion limits
+Tests token buckets, per-tenant quotas and series cardinality limits
+"""
+
+import math
+
+from src.services.limits import TenantQuotas, TokenBucket
+from src.services.series import REJECTED, SeriesRegistry
+
+
+class TestTokenBucket:
+    """Test lazy refill and charging"""
+
+    def test_refills_from_elapsed_time(self):
+        """Test that tokens accrue at rate up to burst"""
+        bucket = TokenBucket(rate=10, burst=20, now=0.0)
+        assert bucket.take(20, now=0.0) == 0.0
+        assert bucket.take(5, now=0.0) == 0.5
+        assert bucket.take(5, now=0.5) == 0.0
+        # Idle time never banks more than burst
+        assert bucket.take(21, now=100.0) == math.inf
+        assert bucket.take(20, now=100.0) == 0.0
+
+    def test_refused_take_spends_nothing(self):
+        """Test that a refused charge leaves the tokens for smaller requests"""
+        bucket = TokenBucket(rate=1, burst=10, now=0.0)
+        assert bucket.take(8, now=0.0) == 0.0
+        assert bucket.take(5, now=0.0) == 3.0
+        assert bucket.take(2, now=0.0) == 0.0
+
+
+class TestTenantQuotas:
+    """Test per-API-key buckets"""
+
+    def test_tenants_are_isolated(self):
+        """Test that one key exhausting its budget does not affect another"""
+        quotas = TenantQuotas(rate=100, burst=100)
+        assert quotas.take("a", 100, now=0.0) == (True, 0.0)
+        allowed, retry_after = quotas.take("a", 50, now=0.0)
+        assert not allowed and retry_after == 0.5
+        assert quotas.take("b", 100, now=0.0) == (True, 0.0)
+        assert quotas.take("a", 50, now=0.5) == (True, 0.0)
+
+    def test_disabled(self):
+        """Test that a zero rate means unlimited"""
+        quotas = TenantQuotas(rate=0)
+        assert quotas.take("a", 10**9) == (True, 0.0)
+
+    def test_refund(self):
+        """Test that refunded samples can be spent again, up to the burst"""
+        quotas = TenantQuotas(rate=1, burst=10)
+        assert quotas.take("a", 10, now=0.0) == (True, 0.0)
+        quotas.refund("a", 25)
+        assert quotas.take("a", 10, now=0.0) == (True, 0.0)
+        assert quotas.take("a", 1, now=0.0)[0] is False
+
+    def test_idle_tenants_are_evicted(self):
+        """Test that the bucket table is bounded"""
+        quotas = TenantQuotas(rate=1, burst=1, max_tenants=2)
+        quotas.take("a", 1, now=0.0)
+        quotas.take("b", 1, now=0.0)
+        quotas.take("a", 0, now=0.0)
+        quotas.take("c", 1, now=0.0)
+        assert list(quotas._buckets) == ["a", "c"]
+
+
+class TestSeriesLimits:
+    """Test cardinality limits in the series registry"""
+
+    def test_series_per_metric(self):
+        """Test that a full metric refuses new series but keeps existing ones"""
+        series = SeriesRegistry(max_series_per_metric=2)
+        a = series.intern("requests", {"id": "a"})
+        b = series.intern("requests", {"id": "b"})
+        assert series.intern("requests", {"id": "c"}) == REJECTED
+        assert series.intern("requests", {"id": "a"}) == a
+        assert series.intern("other", {"id": "c"}) not in (a, b, REJECTED)
+        assert len(series) == 3
+
+    def test_series_per_tenant(self):
+        """Test that one tenant cannot create series past its limit"""
+        series = SeriesRegistry(max_series_per_tenant=2)
+        series.intern("cpu", {"host": "1"}, tenant="key-1")
+        series.intern("memory", {"host": "1"}, tenant="key-1")
+        assert series.intern("disk", {"host": "1"}, tenant="key-1") == REJECTED
+        assert series.intern("disk", {"host": "1"}, tenant="key-2") != REJECTED
+        assert series.stats()["top_tenants"][0] == {"tenant": "key-1", "series": 2}
+
+    def test_series_total(self):
+        """Test that the registry as a whole refuses series past max_series"""
+        series = SeriesRegistry(max_series=2)
+        series.intern("cpu", {"host": "1"}, tenant="key-1")
+        series.intern("cpu", {"host": "2"}, tenant="key-2")
+        assert series.intern("cpu", {"host": "3"}, tenant="key-3") == REJECTED
+        assert series.intern("cpu", {"host": "3"}) == REJECTED
+
+    def test_idle_series_are_evicted(self):
+        """Test that series without samples for idle_seconds free their room"""
+        now = [0.0]
+        series = SeriesRegistry(
+            max_series=2, max_series_per_tenant=2, idle_seconds=60, clock=lambda: now[0]
+        )
+        busy = series.intern("cpu", {"host": "busy"}, tenant="key-1")
+        idle = series.intern("cpu", {"host": "idle"}, tenant="key-1")
+        now[0] = 30
+        assert series.evict_idle_if_due() == 0
+        now[0] = 61
+        assert series.evict_idle_if_due() == 0
+        now[0] = 100
+        assert series.intern("cpu", {"host": "busy"}) == busy
+        now[0] = 122
+
+        new = series.intern("cpu", {"host": "new"}, tenant="key-1")
+        assert new not in (REJECTED, busy, idle)
+        assert series.lookup("cpu", {"host": "idle"}) is None
+        assert series.select("cpu") == {busy, new}
+        assert series.stats()["label_pairs"] == 2
+        assert series.stats()["top_tenants"] == [{"tenant": "key-1", "series": 2}]
@@ -156,23 +156,47 @@ def large_metrics_dataset(self, large_agent_dataset):
 
     def test_agent_listing_performance(self, client, large_agent_dataset):
         """Test performance of listing large number of agents"""
-        # Mock the database to return large dataset
-        with patch("src.main.db") as mock_db:
-            mock_db.get_agents.return_value = large_agent_dataset
+        from src.services.agents import AgentRegistry, parse_agent
 
+        registry = AgentRegistry()
+        for agent in large_agent_dataset:
+            registry.upsert(parse_agent(agent))
+
+        with patch("src.main.agent_registry", registry):
             start_time = time.time()
-            response = client.get("/api/v1/agents")
+            response = client.get("/api/v1/agents", params={"limit": 1000})
             end_time = time.time()
 
-            # Since endpoint doesn't exist yet, this tests the expected behavior
-            # In real implementation, should complete within reasonable time
-            response_time = (end_time - start_time) * 1000
+            filtered_times = []
+            for _ in range(100):
+                start = time.time()
+                filtered = client.get(
+                    "/api/v1/agents", params={"status": "online", "region": "us-east-1"}
+                )
+                filtered_times.append((time.time() - start) * 1000)
 
-            # Should handle large dataset efficiently
-            # assert response.status_code == 200
-            # data = response.json()
-            # assert len(data["data"]) == 1000
-            assert response_time < 1000  # Under 1 second for listing
+            etag = response.headers["etag"]
+            unchanged_times = []
+            for _ in range(100):
+                start = time.time()
+                unchanged = client.get("/api/v1/agents", headers={"If-None-Match": etag})
+                unchanged_times.append((time.time() - start) * 1000)
+
+        response_time = (end_time - start_time) * 1000
+        assert response.status_code == 200
+        data = response.json()
+        assert len(data["data"]) == 1000
+        assert response_time < 1000  # Under 1 second for listing
+
+        # status online is i % 4 == 0 and us-east-1 is i % 3 == 0
+        assert filtered.json()["total"] == len(range(0, 1000, 12))
+        assert unchanged.status_code == 304
+        assert statistics.mean(unchanged_times) <= statistics.mean(filtered_times) * 2
+
+        print("Agent listing performance:")
+        print(f"  Full listing (1000 agents): {response_time:.2f}ms")
+        print(f"  Filtered listing: {statistics.mean(filtered_times):.2f}ms")
+        print(f"  Not modified: {statistics.mean(unchanged_times):.2f}ms")
 
     def test_metrics_ingestion_performance(self, client, large_metrics_dataset):
         """Test performance of ingesting large volume of metrics"""
@@ -188,7 +212,7 @@ def test_metrics_ingestion_performance(self, client, large_metrics_dataset):
             # Ingest each metric in the batch
             for metric in batch:
                 response = client.post("/api/v1/metrics", json=metric)
-                assert response.status_code == 200
+                assert response.status_code == 202
 
             end_time = time.time()
             batch_time = (end_time - start_time) * 1000
@@ -227,7 +251,7 @@ def ingest_metrics(agent_id, count):
                 response = client.post("/api/v1/metrics", json=metric)
                 end_time = time.time()
 
-                assert response.status_code == 200
+                assert response.status_code == 202
                 times.append((end_time - start_time) * 1000)
 
             return times
@@ -257,6 +281,101 @@ def ingest_metrics(agent_id, count):
         print(f"  95th percentile: {p95_time:.2f}ms")
 
 
+class TestMiddlewareOverhead:
+    """Before/after benchmark of the HTTP middleware stack"""
+
+    @staticmethod
+    def _requests_per_second(asgi_app, count=2000):
+        """Drive GET /ping straight through the ASGI interface"""
+        import asyncio
+
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": "/ping",
+            "raw_path": b"/ping",
+            "root_path": "",
+            "query_string": b"",
+            "headers": [(b"host", b"testserver")],
+            "client": ("127.0.0.1", 1234),
+            "server": ("testserver", 80),
+        }
+
+        async def send(message):
+            pass
+
+        async def request():
+            received = False
+            idle = asyncio.Event()
+
+            async def receive():
+                nonlocal received
+                if received:
+                    # Like a server whose client stays connected
+                    await idle.wait()
+                received = True
+                return {"type": "http.request", "body": b"", "more_body": False}
+
+            await asgi_app(dict(scope), receive, send)
+
+        async def run():
+            for _ in range(100):
+                await request()
+            start = time.perf_counter()
+            for _ in range(count):
+                await request()
+            return count / (time.perf_counter() - start)
+
+        return asyncio.run(run())
+
+    def test_pure_asgi_middleware_throughput(self):
+        """Test that the pure ASGI middleware outpaces the BaseHTTPMiddleware pair it replaced"""
+        from fastapi import FastAPI
+        from starlette.middleware.base import BaseHTTPMiddleware
+        from src.services.middleware import SECURITY_HEADERS, HTTPMiddleware
+
+        def make_app():
+            bench_app = FastAPI()
+
+            @bench_app.get("/ping")
+            async def ping():
+                return {"ok": True}
+
+            return bench_app
+
+        class TimingMiddleware(BaseHTTPMiddleware):
+            async def dispatch(self, request, call_next):
+                start = time.perf_counter()
+                response = await call_next(request)
+                response.headers["x-elapsed"] = str(time.perf_counter() - start)
+                return response
+
+        class HeadersMiddleware(BaseHTTPMiddleware):
+            async def dispatch(self, request, call_next):
+                response = await call_next(request)
+                for name, value in SECURITY_HEADERS:
+                    response.headers.setdefault(name, value)
+                return response
+
+        before = make_app()
+        before.add_middleware(TimingMiddleware)
+        before.add_middleware(HeadersMiddleware)
+        after = make_app()
+        after.add_middleware(HTTPMiddleware)
+
+        before_rps = self._requests_per_second(before)
+        after_rps = self._requests_per_second(after)
+
+        print("Middleware throughput:")
+        print(f"  BaseHTTPMiddleware x2: {before_rps:.0f} requests/second")
+        print(f"  Pure ASGI: {after_rps:.0f} requests/second")
+
+        assert after_rps > before_rps
+
+
 class TestWebSocketPerformance:
     """Test WebSocket performance with many connections"""
 
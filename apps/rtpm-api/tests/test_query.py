@@ -0,0 +1,323 @@
+"""
+Unit tests for the RTPM metric query layer
+Tests query parsing, source selection and the generated time_bucket SQL
+"""
+
+import asyncio
+import json
+import pytest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import AsyncMock
+
+from src.services.database import Database
+from src.services.query import (
+    DAILY,
+    FIVE_MINUTE,
+    HOURLY,
+    RAW,
+    WATERMARK_SQL,
+    QueryEngine,
+    QueryPlan,
+    QueryError,
+    QueryUnavailable,
+    build_aggregate_sql,
+    build_range_sql,
+    parse_duration,
+    parse_query,
+)
+
+START = "2024-01-01T00:00:00Z"
+
+
+class TestQueryParsing:
+    """Test validation of query bodies and parameters"""
+
+    def test_full_query(self):
+        """Test a query as sent by the API client"""
+        query = parse_query(
+            {
+                "metric_name": "cpu_usage_percent",
+                "start_time": START,
+                "end_time": "2024-01-01T01:00:00Z",
+                "step": "5m",
+                "aggregation": "max",
+                "labels": {"host": "web-1"},
+            }
+        )
+        assert query.step == timedelta(minutes=5)
+        assert query.aggregation == "max"
+        assert query.labels == {"host": "web-1"}
+        assert query.start == datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def test_defaults(self):
+        """Test the default range, step and label selector strings"""
+        query = parse_query({"metric_name": "cpu", "interval": "1h"}, labels=["host=web-1"])
+        assert query.end - query.start == timedelta(hours=1)
+        assert query.step == timedelta(hours=1)
+        assert query.labels == {"host": "web-1"}
+
+        query = parse_query({"metric_name": "cpu", "start_time": START, "end_time": "2024-01-31"})
+        assert query.step == timedelta(hours=3)
+
+    @pytest.mark.parametrize("raw,expected", [("30s", 30), ("5m", 300), ("1d", 86400), (90, 90)])
+    def test_parse_duration(self, raw, expected):
+        """Test step formats"""
+        assert parse_duration(raw) == timedelta(seconds=expected)
+
+    @pytest.mark.parametrize(
+        "params",
+        [
+            {},
+            {"metric_name": ""},
+            {"metric_name": "cpu", "step": "5 minutes"},
+            {"metric_name": "cpu", "step": "0s"},
+            {"metric_name": "cpu", "aggregation": "median"},
+            {"metric_name": "cpu", "start_time": "2024-01-02", "end_time": "2024-01-01"},
+            {"metric_name": "cpu", "start_time": "soon"},
+            {"metric_name": "cpu", "start_time": "2020-01-01", "end_time": "2024-01-01", "step": "1s"},
+            {"metric_name": "cpu", "labels": ["host"]},
+            {"metric_name": "cpu", "max_points": 0},
+        ],
+    )
+    def test_invalid_queries(self, params):
+        """Test queries that cannot be planned"""
+        with pytest.raises(QueryError):
+            parse_query(params)
+
+
+class TestQueryPlanning:
+    """Test source selection and SQL generation"""
+
+    def _query(self, step, start=START, end="2024-02-01T00:00:00Z", **extra):
+        params = {"metric_name": "cpu", "start_time": start, "end_time": end, **extra}
+        if step is not None:
+            params["step"] = step
+        return parse_query(params)
+
+    def test_coarsest_source_for_step(self):
+        """Test that the planner picks the coarsest tier nesting in the step"""
+        engine = QueryEngine(Database(None))
+        now = datetime(2024, 3, 1, tzinfo=timezone.utc)
+        assert engine.plan(self._query("1d"), now).source is DAILY
+        assert engine.plan(self._query("2h"), now).source is HOURLY
+        assert engine.plan(self._query("90m"), now).source is FIVE_MINUTE
+        assert engine.plan(self._query("1m", end="2024-01-02"), now).source is RAW
+        assert engine.plan(self._query("1d", aggregation="last"), now).source is RAW
+
+    def test_point_budget_selects_tier(self):
+        """Test that the default step follows the range and max_points"""
+        engine = QueryEngine(Database(None))
+        now = datetime(2024, 3, 1, tzinfo=timezone.utc)
+        month = self._query(None, max_points=50)
+        assert month.step == timedelta(days=1)
+        assert engine.plan(month, now).source is DAILY
+
+        hour = self._query(None, end="2024-01-01T01:00:00Z", max_points=60)
+        assert hour.step == timedelta(minutes=1)
+        assert engine.plan(hour, now).source is RAW
+
+    def test_unmaterialized_tail_is_stitched_from_raw(self):
+        """Test that the tail after the rollup watermark is read from raw rows"""
+        engine = QueryEngine(Database(None))
+        now = datetime(2024, 1, 31, 12, 30, tzinfo=timezone.utc)
+        plan = engine.plan(self._query("1h"), now)
+        assert plan.source is HOURLY
+        # Hourly rollups lag two hours behind now
+        assert plan.raw_from == datetime(2024, 1, 31, 10, tzinfo=timezone.utc)
+
+        sql, args = build_range_sql(plan)
+        assert sql.count("UNION ALL") == 1
+        assert "FROM metrics_hourly WHERE" in sql
+        assert "FROM metrics WHERE" in sql
+        assert plan.raw_from in args
+
+    def test_recent_range_skips_unmaterialized_tiers(self):
+        """Test that a tier with nothing materialized in range is skipped"""
+        engine = QueryEngine(Database(None))
+        now = datetime(2024, 1, 1, 1, 0, tzinfo=timezone.utc)
+        plan = engine.plan(self._query("1h", end="2024-01-01T01:00:00Z"), now)
+        assert plan.source is FIVE_MINUTE
+        assert plan.raw_from == datetime(2024, 1, 1, 0, 50, tzinfo=timezone.utc)
+
+    def test_stalled_refresh_is_stitched_from_raw(self):
+        """Test that the real watermark, not the policy lag, decides the raw tail"""
+        engine = QueryEngine(Database(None))
+        now = datetime(2024, 1, 31, 12, 30, tzinfo=timezone.utc)
+        stalled = datetime(2024, 1, 29, 7, tzinfo=timezone.utc)
+        engine.watermarks = {"metrics_hourly": stalled}
+        plan = engine.plan(self._query("1h"), now)
+        assert plan.source is HOURLY
+        assert plan.raw_from == stalled
+
+    def test_aggregate_reads_partial_edge_buckets_raw(self):
+        """Test that buckets the range only partly covers come from raw rows"""
+        engine = QueryEngine(Database(None))
+        now = datetime(2024, 3, 1, tzinfo=timezone.utc)
+        plan = engine.plan_aggregate(self._query("1h"), now)
+        assert plan.source is DAILY
+        assert plan.raw_until is None and plan.raw_from is None
+
+        shifted = self._query("1h", start="2024-01-01T00:30:00Z", end="2024-01-31T06:00:00Z")
+        plan = engine.plan_aggregate(shifted, now)
+        assert plan.source is DAILY
+        assert plan.raw_until == datetime(2024, 1, 2, tzinfo=timezone.utc)
+        assert plan.raw_from == datetime(2024, 1, 31, tzinfo=timezone.utc)
+
+        sql, args = build_aggregate_sql(plan)
+        assert sql.count("UNION ALL") == 2
+        assert "FROM metrics_daily WHERE" in sql
+        assert sql.count("FROM metrics WHERE") == 2
+        assert shifted.start in args and shifted.end in args
+
+        # Within a single day no whole bucket is left, so a finer tier is used
+        day = self._query("1h", start="2024-01-01T00:00:01Z", end="2024-01-01T12:00:00Z")
+        plan = engine.plan_aggregate(day, now)
+        assert plan.source is HOURLY
+        assert plan.raw_until == datetime(2024, 1, 1, 1, tzinfo=timezone.utc)
+
+    def test_range_sql(self):
+        """Test that a range query is one time_bucket statement"""
+        query = self._query("1d", labels={"host": "web-1"})
+        sql, args = build_range_sql(QueryPlan(HOURLY, query))
+        assert sql.count("SELECT") == 1
+        assert "time_bucket($1::interval, bucket)" in sql
+        assert "FROM metrics_hourly" in sql
+        assert "sum(avg_value * sample_count) / sum(sample_count)" in sql
+        assert "labels @> $3::jsonb" in sql
+        assert args[0] == timedelta(days=1)
+        assert args[1] == "cpu"
+        assert json.loads(args[2]) == {"host": "web-1"}
+
+    def test_aggregate_sql(self):
+        """Test the whole-range aggregate statement on raw data"""
+        sql, args = build_aggregate_sql(QueryPlan(RAW, self._query("5m", aggregation="max")))
+        assert "time_bucket" not in sql
+        assert "max(value) AS value" in sql
+        assert "FROM metrics WHERE metric_name = $1" in sql
+        assert len(args) == 3
+
+
+class FakeQueryConnection:
+    def __init__(self, rows, watermarks=()):
+        self.rows = rows
+        self.watermarks = list(watermarks)
+        self.calls = []
+        self.watermark_reads = 0
+
+    async def fetch(self, sql, *args):
+        if sql is WATERMARK_SQL:
+            self.watermark_reads += 1
+            return self.watermarks
+        self.calls.append((sql, args))
+        return self.rows
+
+
+class FakeQueryPool:
+    def __init__(self, rows, watermarks=()):
+        self.connection = FakeQueryConnection(rows, watermarks)
+
+    def acquire(self):
+        connection = self.connection
+
+        class _Acquire:
+            async def __aenter__(self):
+                return connection
+
+            async def __aexit__(self, *exc):
+                return False
+
+        return _Acquire()
+
+
+@pytest.mark.asyncio
+class TestQueryEngine:
+    """Test running queries and shaping results"""
+
+    async def test_rows_grouped_into_series(self):
+        """Test that rows become one series per label set"""
+        t0 = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        rows = [
+            {"labels": '{"host": "a"}', "time": t0, "value": 1.0},
+            {"labels": '{"host": "a"}', "time": t0 + timedelta(hours=1), "value": 2.0},
+            {"labels": '{"host": "b"}', "time": t0, "value": 3.0},
+        ]
+        database = Database("postgresql://localhost/rtpm")
+        database._pool = FakeQueryPool(rows)
+        engine = QueryEngine(database)
+
+        query = parse_query(
+            {
+                "metric_name": "cpu",
+                "start_time": START,
+                "end_time": "2024-01-02T00:00:00Z",
+                "step": "1h",
+            }
+        )
+        plan, series = await engine.range_query(query)
+        assert plan.source is DAILY or plan.source is HOURLY
+        assert [s["labels"] for s in series] == [{"host": "a"}, {"host": "b"}]
+        assert [p["value"] for p in series[0]["data_points"]] == [1.0, 2.0]
+        assert len(database._pool.connection.calls) == 1
+
+    @pytest.mark.parametrize(
+        "error",
+        [
+            ConnectionResetError("connection reset by peer"),
+            asyncio.TimeoutError(),
+            type("ConnectionDoesNotExistError", (Exception,), {"__module__": "asyncpg.exceptions"})(
+                "connection was closed in the middle of operation"
+            ),
+        ],
+    )
+    async def test_storage_failures_are_unavailable(self, error):
+        """Test that a connected pool failing to answer maps to QueryUnavailable"""
+        database = Database("postgresql://localhost/rtpm")
+        database._pool = FakeQueryPool([])
+        database._pool.connection.fetch = AsyncMock(side_effect=error)
+        with pytest.raises(QueryUnavailable):
+            await QueryEngine(database).range_query(parse_query({"metric_name": "cpu"}))
+
+    async def test_bugs_are_not_masked(self):
+        """Test that errors outside storage still surface as they are"""
+        database = Database("postgresql://localhost/rtpm")
+        database._pool = FakeQueryPool([])
+        database._pool.connection.fetch = AsyncMock(side_effect=KeyError("labels"))
+        with pytest.raises(KeyError):
+            await QueryEngine(database).range_query(parse_query({"metric_name": "cpu"}))
+
+    async def test_watermarks_are_read_and_cached(self):
+        """Test that rollup watermarks come from TimescaleDB, once per TTL"""
+        watermark = datetime(2024, 1, 1, 5, tzinfo=timezone.utc)
+        database = Database("postgresql://localhost/rtpm")
+        database._pool = FakeQueryPool([], [{"name": "metrics_hourly", "watermark": watermark}])
+        engine = QueryEngine(database, watermark_ttl=60)
+        query = parse_query(
+            {
+                "metric_name": "cpu",
+                "start_time": START,
+                "end_time": "2024-01-02T00:00:00Z",
+                "step": "1h",
+            }
+        )
+
+        plan, _ = await engine.range_query(query)
+        await engine.range_query(query)
+        assert database._pool.connection.watermark_reads == 1
+        assert engine.watermarks == {"metrics_hourly": watermark}
+        assert plan.source is HOURLY and plan.raw_from == watermark
+
+    async def test_unreadable_watermarks_fall_back_to_lags(self):
+        """Test that planning still works where the catalog cannot be read"""
+        database = Database("postgresql://localhost/rtpm")
+        database._pool = FakeQueryPool([])
+        database._pool.connection.fetch = AsyncMock(side_effect=[OSError("denied"), []])
+        engine = QueryEngine(database)
+        plan, series = await engine.range_query(parse_query({"metric_name": "cpu"}))
+        assert engine.watermarks == {}
+        assert series == []
+
+    async def test_unavailable_without_database(self):
+        """Test that queries fail clearly when storage is not connected"""
+        engine = QueryEngine(Database(None))
+        with pytest.raises(QueryUnavailable):
+            await engine.range_query(parse_query({"metric_name": "cpu"}))
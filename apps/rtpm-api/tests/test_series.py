@@ -0,0 +1,101 @@
+"""
+Unit tests for the RTPM series registry
+Tests interning, the inverted label index and cardinality stats
+"""
+
+from src.services.ingestion import intern_samples, parse_payload, parse_sample
+from src.services.series import REJECTED, SeriesRegistry, registry
+
+
+class TestSeriesRegistry:
+    """Test series interning and label selection"""
+
+    def test_intern_is_stable_and_order_insensitive(self):
+        """Test that one label set maps to one dense ID whatever its key order"""
+        series = SeriesRegistry()
+        a = series.intern("cpu", {"host": "web-1", "region": "eu"})
+        b = series.intern("cpu", {"region": "eu", "host": "web-1"})
+        c = series.intern("cpu", {"host": "web-2", "region": "eu"})
+        d = series.intern("memory", {"host": "web-1", "region": "eu"})
+
+        assert a == b
+        assert [a, c, d] == [0, 1, 2]
+        assert len(series) == 3
+        assert series.metric_name(d) == "memory"
+        assert series.labels(c) == {"host": "web-2", "region": "eu"}
+        assert series.lookup("cpu", {"host": "web-3"}) is None
+
+    def test_select_intersects_postings(self):
+        """Test metric and label selectors against the inverted index"""
+        series = SeriesRegistry()
+        ids = {
+            (name, host, region): series.intern(name, {"host": host, "region": region})
+            for name in ("cpu", "memory")
+            for host in ("web-1", "web-2")
+            for region in ("eu", "us")
+        }
+
+        assert series.select("cpu", {"host": "web-1"}) == {
+            ids["cpu", "web-1", "eu"],
+            ids["cpu", "web-1", "us"],
+        }
+        assert series.select(labels={"host": "web-2", "region": "us"}) == {
+            ids["cpu", "web-2", "us"],
+            ids["memory", "web-2", "us"],
+        }
+        assert len(series.select("memory")) == 4
+        assert len(series.select()) == 8
+        assert series.select("cpu", {"host": "web-9"}) == set()
+        assert series.select("disk") == set()
+
+    def test_cardinality_stats(self):
+        """Test that the label with the most values is reported first"""
+        series = SeriesRegistry()
+        for i in range(50):
+            series.intern("requests", {"path": f"/item/{i}", "method": "GET"})
+        series.intern("cpu", {"host": "web-1"})
+
+        stats = series.stats(limit=2)
+        assert stats["series"] == 51
+        assert stats["metrics"] == 2
+        assert stats["label_pairs"] == 52
+        assert stats["top_metrics"][0] == {"metric_name": "requests", "series": 50}
+        assert stats["top_labels"][0] == {"label": "path", "values": 50, "series": 50}
+        assert len(stats["top_labels"]) == 2
+
+        assert series.cardinality("requests") == {
+            "metric_name": "requests",
+            "series": 50,
+            "labels": {"path": 50, "method": 1},
+        }
+
+
+class TestSampleSeriesIds:
+    """Test that accepted samples get series IDs once, at ingest time"""
+
+    def test_parse_does_not_intern(self):
+        """Test that validation alone never registers a series"""
+        before = len(registry)
+        sample = parse_sample({"name": "series_test_unseen", "value": 1})
+        assert sample.series_id == REJECTED
+        assert len(registry) == before
+
+    def test_intern_samples(self):
+        """Test that samples of one series share the process-wide ID"""
+        first, second, other = intern_samples(
+            [
+                parse_sample({"name": "series_test", "value": 1, "labels": {"a": "1", "b": 2}}),
+                parse_sample({"name": "series_test", "value": 2, "labels": {"b": "2", "a": "1"}}),
+                parse_sample({"name": "series_test", "value": 3, "labels": {"a": "2"}}),
+            ]
+        )
+
+        assert first.series_id == second.series_id >= 0
+        assert other.series_id != first.series_id
+        assert registry.key(first.series_id) == ("series_test", (("a", "1"), ("b", "2")))
+
+    def test_agent_snapshot_interns(self, sample_agent_metrics):
+        """Test that expanded agent snapshots carry series IDs"""
+        samples = intern_samples(parse_payload(sample_agent_metrics))
+        assert len({s.series_id for s in samples}) == len(samples)
+        assert all(registry.labels(s.series_id) == {"agent_id": "agent-001"} for s in samples)
@@ -0,0 +1,320 @@
+"""
+Unit tests for the RTPM write-ahead spool
+Tests record framing, segment rotation, crash recovery and replay through the durable writer
+"""
+
+import asyncio
+import errno
+import os
+from unittest.mock import patch
+
+import pytest
+
+from src.services.database import Database
+from src.services.ingestion import parse_payload
+from src.services.spool import Spool
+from src.services.storage import (
+    DurableWriter,
+    MetricWriter,
+    decode_records,
+    encode_records,
+    to_record,
+)
+
+
+async def _drain(spool):
+    records = []
+    while True:
+        payload = await spool.peek()
+        if payload is None:
+            return records
+        records.append(payload)
+        await spool.commit()
+
+
+@pytest.mark.asyncio
+class TestSpool:
+    """Test the on-disk record log"""
+
+    async def test_records_replay_in_order(self, tmp_path):
+        """Test that records come back in append order and only once"""
+        spool = Spool(str(tmp_path))
+        spool.open()
+        for i in range(5):
+            await spool.append(f"record-{i}".encode())
+
+        assert await spool.peek() == b"record-0"
+        # Not committed: the same record again
+        assert await spool.peek() == b"record-0"
+        assert await _drain(spool) == [f"record-{i}".encode() for i in range(5)]
+        assert spool.empty
+
+    async def test_segments_rotate_and_are_deleted(self, tmp_path):
+        """Test that full segments rotate and replayed ones are removed"""
+        spool = Spool(str(tmp_path), segment_bytes=64)
+        spool.open()
+        for i in range(10):
+            await spool.append(b"x" * 40)
+        # 48-byte records: a segment takes a second one before it passes 64 bytes
+        assert len([n for n in os.listdir(tmp_path) if n.endswith(".seg")]) == 5
+
+        assert len(await _drain(spool)) == 10
+        assert len([n for n in os.listdir(tmp_path) if n.endswith(".seg")]) == 1
+
+    async def test_restart_resumes_from_checkpoint(self, tmp_path):
+        """Test that a reopened spool replays only what was not yet replayed"""
+        spool = Spool(str(tmp_path))
+        spool.open()
+        for i in range(4):
+            await spool.append(f"record-{i}".encode())
+        await spool.peek()
+        await spool.commit()
+        spool.close()
+
+        reopened = Spool(str(tmp_path))
+        reopened.open()
+        await reopened.append(b"after-restart")
+        assert await _drain(reopened) == [b"record-1", b"record-2", b"record-3", b"after-restart"]
+
+    async def test_torn_tail_is_skipped(self, tmp_path):
+        """Test that a record cut short by a crash is dropped, not replayed as garbage"""
+        spool = Spool(str(tmp_path))
+        spool.open()
+        await spool.append(b"complete")
+        await spool.append(b"torn record")
+        spool.close()
+        segment = os.path.join(tmp_path, "00000001.seg")
+        with open(segment, "r+b") as f:
+            f.truncate(os.path.getsize(segment) - 3)
+
+        reopened = Spool(str(tmp_path))
+        reopened.open()
+        await reopened.append(b"next")
+        assert await _drain(reopened) == [b"complete", b"next"]
+
+    async def test_torn_header_is_skipped(self, tmp_path):
+        """Test that a segment ending mid-header is treated as a torn tail"""
+        with open(os.path.join(tmp_path, "00000001.seg"), "wb") as f:
+            f.write(b"\x00\x00\x01")
+
+        spool = Spool(str(tmp_path))
+        spool.open()
+        await spool.append(b"next")
+        assert await _drain(spool) == [b"next"]
+
+    async def test_short_write_is_cut_off(self, tmp_path):
+        """Test that a write the disk cuts short leaves no partial record behind"""
+        spool = Spool(str(tmp_path))
+        spool.open()
+        await spool.append(b"before")
+        real_write = os.write
+        calls = []
+
+        def short_write(fd, data):
+            calls.append(len(data))
+            if len(calls) == 1:
+                return real_write(fd, bytes(data[:5]))
+            raise OSError(errno.ENOSPC, "No space left on device")
+
+        with patch("src.services.spool.os.write", side_effect=short_write):
+            with pytest.raises(OSError):
+                await spool.append(b"cut short")
+        await spool.append(b"after")
+        assert await _drain(spool) == [b"before", b"after"]
+
+    async def test_each_process_gets_its_own_slot(self, tmp_path):
+        """Test that a locked spool directory sends the next owner to a free slot"""
+        base = str(tmp_path / "spool")
+        first, second = Spool(base), Spool(base)
+        first.open()
+        second.open()
+        assert first.directory == base
+        assert second.directory == f"{base}.1"
+        await second.append(b"worker-2")
+        second.close()
+
+        # A restarted worker takes over the freed slot and its records
+        restarted = Spool(base)
+        restarted.open()
+        assert restarted.directory == f"{base}.1"
+        assert await _drain(restarted) == [b"worker-2"]
+
+    async def test_unclaimed_slots_are_adopted(self, tmp_path):
+        """Test that a slot left by an exited worker is replayed by a running one"""
+        base = str(tmp_path / "spool")
+        first, second, third = Spool(base), Spool(base), Spool(base)
+        for spool in (first, second, third):
+            spool.open()
+        await second.append(b"replayed")
+        assert await second.peek() == b"replayed"
+        await second.commit()
+        await second.append(b"orphaned-1")
+        await second.append(b"orphaned-2")
+        await third.append(b"still-running")
+        second.close()
+
+        assert await first.adopt() == 2
+        assert await _drain(first) == [b"orphaned-1", b"orphaned-2"]
+        assert not [n for n in os.listdir(f"{base}.1") if n != "lock"]
+        # A slot held by a live worker is left to it
+        assert await _drain(third) == [b"still-running"]
+        assert await first.adopt() == 0
+
+    async def test_max_bytes_drops_oldest_segment(self, tmp_path):
+        """Test that the spool never grows past max_bytes"""
+        spool = Spool(str(tmp_path), segment_bytes=50, max_bytes=200)
+        spool.open()
+        for i in range(10):
+            await spool.append(f"{i:040d}".encode())
+        assert spool.size <= 200
+        replayed = await _drain(spool)
+        assert replayed[-1] == f"{9:040d}".encode()
+        assert len(replayed) < 10
+
+    async def test_records_round_trip(self):
+        """Test that spooled rows decode to the rows COPY would have written"""
+        records = [to_record(s) for s in _batch(0)]
+        assert decode_records(encode_records(records)) == records
+
+
+class FlakyWriter(MetricWriter):
+    """Records copies; fails while ``down`` is set"""
+
+    def __init__(self, database):
+        super().__init__(database)
+        self.down = False
+        self.delay = 0.0
+        self.copied = []
+
+    async def copy(self, records):
+        if self.down:
+            raise ConnectionError("database unavailable")
+        await asyncio.sleep(self.delay)
+        self.copied.append(records)
+
+
+def _batch(start, count=3):
+    return parse_payload([{"name": "cpu", "value": float(i)} for i in range(start, start + count)])
+
+
+@pytest.mark.asyncio
+class TestDurableWriter:
+    """Test spooling during outages and replay after recovery"""
+
+    async def test_outage_is_spooled_and_replayed(self, tmp_path):
+        """Test that batches written during an outage reach the database in order"""
+        database = Database("postgresql://db/rtpm")
+        database.healthy = True
+        writer = FlakyWriter(database)
+        durable = DurableWriter(writer, Spool(str(tmp_path)), retry_interval=0.01)
+        await durable.spool.start()
+
+        await durable.write(_batch(0))
+        writer.down = True
+        await durable.write(_batch(3))
+        database.healthy = False
+        await durable.write(_batch(6))
+        assert len(writer.copied) == 1
+        assert not durable.spool.empty
+
+        writer.down = False
+        database.healthy = True
+        durable._task = asyncio.create_task(durable._replay())
+        await asyncio.sleep(0.1)
+        await durable.stop()
+
+        values = [row[3] for records in writer.copied for row in records]
+        assert values == [float(i) for i in range(9)]
+        assert durable.spool.empty
+
+    async def test_live_batches_queue_behind_backlog(self, tmp_path):
+        """Test that a healthy database does not let live rows overtake spooled ones"""
+        database = Database("postgresql://db/rtpm")
+        database.healthy = True
+        writer = FlakyWriter(database)
+        durable = DurableWriter(writer, Spool(str(tmp_path)), retry_interval=0.01)
+        await durable.spool.start()
+
+        writer.down = True
+        await durable.write(_batch(0))
+        writer.down = False
+        await durable.write(_batch(3))
+        assert writer.copied == []
+
+        durable._task = asyncio.create_task(durable._replay())
+        await asyncio.sleep(0.1)
+        await durable.stop()
+        values = [row[3] for records in writer.copied for row in records]
+        assert values == [float(i) for i in range(6)]
+
+    async def test_slow_copy_is_not_spooled(self, tmp_path):
+        """Test that a COPY outliving write_timeout is left to finish, not written twice"""
+        database = Database("postgresql://db/rtpm")
+        database.healthy = True
+        writer = FlakyWriter(database)
+        writer.delay = 0.05
+        durable = DurableWriter(writer, Spool(str(tmp_path)), write_timeout=0.01)
+        await durable.spool.start()
+
+        await durable.write(_batch(0))
+        assert writer.copied == []
+        assert durable.spool.empty
+        await durable.stop()
+        assert len(writer.copied) == 1
+
+    async def test_spool_survives_restart(self, tmp_path):
+        """Test that spooled batches are replayed by the next process"""
+        database = Database("postgresql://db/rtpm")
+        writer = FlakyWriter(database)
+        durable = DurableWriter(writer, Spool(str(tmp_path)))
+        batch = _batch(0)
+        await durable.start()
+        await durable.write(batch)
+        await durable.stop()
+        assert writer.copied == []
+
+        database.healthy = True
+        restarted = DurableWriter(writer, Spool(str(tmp_path)), retry_interval=0.01)
+        await restarted.start()
+        await asyncio.sleep(0.1)
+        await restarted.stop()
+        assert writer.copied == [[to_record(s) for s in batch]]
+
+    async def test_orphaned_slot_is_replayed(self, tmp_path):
+        """Test that the replay task picks up records spooled by an exited worker"""
+        base = str(tmp_path / "spool")
+        database = Database("postgresql://db/rtpm")
+        writer = FlakyWriter(database)
+        running = DurableWriter(writer, Spool(base), retry_interval=0.01, adopt_interval=0.01)
+        exited = DurableWriter(writer, Spool(base))
+        await running.spool.start()
+        await exited.start()
+        batch = _batch(0)
+        await exited.write(batch)
+        await exited.stop()
+
+        database.healthy = True
+        await running.start()
+        await asyncio.sleep(0.1)
+        await running.stop()
+        assert writer.copied == [[to_record(s) for s in batch]]
+
+    async def test_replay_survives_bad_records(self, tmp_path):
+        """Test that a torn header or an undecodable batch does not stop replay"""
+        with open(os.path.join(tmp_path, "00000001.seg"), "wb") as f:
+            f.write(b"\x00\x00\x01")
+        database = Database("postgresql://db/rtpm")
+        database.healthy = True
+        writer = FlakyWriter(database)
+        spool = Spool(str(tmp_path))
+        spool.open()
+        await spool.append(b"not json")
+        batch = _batch(0)
+        await spool.append(encode_records([to_record(s) for s in batch]))
+
+        durable = DurableWriter(writer, spool, retry_interval=0.01)
+        await durable.start()
+        await asyncio.sleep(0.1)
+        assert durable._task is not None and not durable._task.done()
+        await durable.stop()
+        assert writer.copied == [[to_record(s) for s in batch]]
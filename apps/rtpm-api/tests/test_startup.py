@@ -0,0 +1,278 @@
+"""
+Tests for RTPM startup verification
+Tests concurrent, cached required-secret checks, startup strategies, phase
+timings and the app factory
+"""
+
+import json
+import os
+import threading
+import time
+from unittest.mock import AsyncMock, patch
+
+import pytest
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.testclient import TestClient
+
+from src.config.settings import Settings
+from src.services.startup import (
+    REQUIRED_SECRETS,
+    SecretVerifier,
+    StartupPhases,
+    check_secrets,
+)
+
+
+class SlowSecretsManager:
+    """Secrets Manager stand-in that takes ``delay`` seconds per call"""
+
+    def __init__(self, delay=0.0, missing=()):
+        self.delay = delay
+        self.missing = set(missing)
+        self.calls = []
+        self.threads = set()
+
+    def describe_secret(self, SecretId):
+        self.calls.append(SecretId)
+        self.threads.add(threading.get_ident())
+        time.sleep(self.delay)
+        if SecretId in self.missing:
+            from botocore.exceptions import ClientError
+
+            raise ClientError({"Error": {"Code": "ResourceNotFoundException"}}, "DescribeSecret")
+        return {"Name": SecretId}
+
+
+def no_client():
+    raise AssertionError("Secrets Manager should not be called")
+
+
+@pytest.mark.asyncio
+class TestSecretVerifier:
+    """Test required-secret checks"""
+
+    async def test_all_present(self, mock_aws_secrets):
+        """Test that every required secret is verified"""
+        verifier = SecretVerifier(client_factory=lambda: mock_aws_secrets)
+        results = await verifier.verify()
+        assert results == {secret_id: "verified" for secret_id in REQUIRED_SECRETS}
+
+    async def test_checks_run_concurrently(self):
+        """Test that five slow checks take about as long as one"""
+        sm = SlowSecretsManager(delay=0.2)
+        verifier = SecretVerifier(client_factory=lambda: sm)
+        started = time.perf_counter()
+        await verifier.verify()
+        assert time.perf_counter() - started < 0.6
+        assert sorted(sm.calls) == sorted(REQUIRED_SECRETS)
+        assert len(sm.threads) > 1
+
+    async def test_missing_secret_denies_startup(self, mock_aws_secrets):
+        """Test that a missing secret fails closed"""
+        verifier = SecretVerifier(
+            secret_ids=REQUIRED_SECRETS + ("candlefish-unknown-production",),
+            client_factory=lambda: mock_aws_secrets,
+        )
+        with pytest.raises(RuntimeError, match="required secret missing"):
+            await verifier.verify()
+
+    async def test_timeout_denies_startup(self):
+        """Test that checks still running at the deadline fail closed"""
+        verifier = SecretVerifier(
+            timeout=0.1, client_factory=lambda: SlowSecretsManager(delay=1.0)
+        )
+        started = time.perf_counter()
+        with pytest.raises(RuntimeError, match="could not be verified"):
+            await verifier.verify()
+        assert time.perf_counter() - started < 0.5
+
+    async def test_restart_within_ttl_uses_cache(self, tmp_path, mock_aws_secrets):
+        """Test that verified secrets are not checked again inside the TTL"""
+        cache = str(tmp_path / "secrets.json")
+        await SecretVerifier(cache_path=cache, client_factory=lambda: mock_aws_secrets).verify()
+
+        results = await SecretVerifier(cache_path=cache, client_factory=no_client).verify()
+        assert set(results.values()) == {"cached"}
+
+    async def test_expired_cache_is_rechecked(self, tmp_path):
+        """Test that entries older than the TTL are verified again"""
+        cache = str(tmp_path / "secrets.json")
+        sm = SlowSecretsManager()
+        now = [1000.0]
+        verifier = SecretVerifier(
+            cache_path=cache, cache_ttl=60, client_factory=lambda: sm, clock=lambda: now[0]
+        )
+        await verifier.verify()
+        now[0] += 30
+        await verifier.verify()
+        assert len(sm.calls) == len(REQUIRED_SECRETS)
+
+        now[0] += 31
+        await verifier.verify()
+        assert len(sm.calls) == 2 * len(REQUIRED_SECRETS)
+
+    async def test_only_found_secrets_are_cached(self, tmp_path):
+        """Test that a missing secret is checked again on the next start"""
+        cache = str(tmp_path / "secrets.json")
+        missing = REQUIRED_SECRETS[0]
+        sm = SlowSecretsManager(missing=[missing])
+        with pytest.raises(RuntimeError):
+            await SecretVerifier(cache_path=cache, client_factory=lambda: sm).verify()
+
+        with open(cache) as f:
+            verified = json.load(f)["verified"]
+        assert set(verified) == set(REQUIRED_SECRETS[1:])
+
+        sm.calls.clear()
+        sm.missing.clear()
+        await SecretVerifier(cache_path=cache, client_factory=lambda: sm).verify()
+        assert sm.calls == [missing]
+
+    async def test_cache_is_per_region(self, tmp_path, mock_aws_secrets):
+        """Test that a cache written for one region is not trusted in another"""
+        cache = str(tmp_path / "secrets.json")
+        await SecretVerifier(
+            region="us-east-1", cache_path=cache, client_factory=lambda: mock_aws_secrets
+        ).verify()
+        sm = SlowSecretsManager()
+        verifier = SecretVerifier(region="eu-west-1", cache_path=cache, client_factory=lambda: sm)
+        await verifier.verify()
+        assert len(sm.calls) == len(REQUIRED_SECRETS)
+
+    async def test_corrupt_cache_is_ignored(self, tmp_path, mock_aws_secrets):
+        """Test that an unreadable cache file only costs the checks"""
+        cache = tmp_path / "secrets.json"
+        cache.write_text("{not json")
+        verifier = SecretVerifier(cache_path=str(cache), client_factory=lambda: mock_aws_secrets)
+        results = await verifier.verify()
+        assert set(results.values()) == {"verified"}
+
+
+class TestStartupPhases:
+    """Test startup phase timings"""
+
+    def test_phases_are_recorded_in_order(self):
+        """Test that each phase and the total are reported"""
+        now = [0.0]
+        phases = StartupPhases(clock=lambda: now[0])
+        with phases.phase("secrets"):
+            now[0] += 0.25
+        with phases.phase("database"):
+            now[0] += 0.5
+        now[0] += 0.01
+        assert phases.phases == [("secrets", 0.25), ("database", 0.5)]
+        assert phases.finish() == "secrets 250ms, database 500ms, total 760ms"
+
+
+@pytest.mark.asyncio
+class TestCheckSecrets:
+    """Test the secrets check strategies"""
+
+    async def test_strict_raises(self):
+        """Test that strict mode stops startup on a missing secret"""
+        sm = SlowSecretsManager(missing=REQUIRED_SECRETS)
+        verifier = SecretVerifier(client_factory=lambda: sm)
+        with pytest.raises(RuntimeError):
+            await check_secrets(verifier, "strict")
+
+    async def test_advisory_continues(self):
+        """Test that advisory mode only logs a missing secret"""
+        sm = SlowSecretsManager(missing=REQUIRED_SECRETS)
+        verifier = SecretVerifier(client_factory=lambda: sm)
+        await check_secrets(verifier, "advisory")
+
+    async def test_off_skips(self):
+        """Test that the check can be turned off"""
+        await check_secrets(SecretVerifier(client_factory=no_client), "off")
+
+    async def test_unknown_mode(self):
+        """Test that a typo in the mode is not silently treated as off"""
+        with pytest.raises(ValueError):
+            await check_secrets(SecretVerifier(client_factory=no_client), "lenient")
+
+
+class TestAppFactory:
+    """Test create_app and its pluggable startup check"""
+
+    def test_custom_startup_check_runs_first(self):
+        """Test that a plugged-in check runs at startup and can stop it"""
+        from src.main import create_app
+
+        check = AsyncMock(side_effect=RuntimeError("Startup denied: custom check"))
+        with pytest.raises(RuntimeError, match="custom check"):
+            with TestClient(create_app(startup_check=check)):
+                pass
+        check.assert_awaited_once()
+
+    def test_production_checks_secrets(self):
+        """Test that production apps verify secrets and stop when one is missing"""
+        from src.main import create_app
+
+        verifier = AsyncMock()
+        verifier.verify.side_effect = RuntimeError("Startup denied: required secret missing")
+        with patch.dict(os.environ, {"CF_ENV": "production"}), patch(
+            "src.main.SecretVerifier", return_value=verifier
+        ):
+            with pytest.raises(RuntimeError, match="Startup denied"):
+                with TestClient(create_app(Settings(startup_secrets_check="strict"))):
+                    pass
+
+    def test_advisory_production_starts(self):
+        """Test that the Fly strategy starts despite missing secrets"""
+        from src.main import create_app
+
+        verifier = AsyncMock()
+        verifier.verify.side_effect = RuntimeError("Startup denied: required secret missing")
+        with patch.dict(os.environ, {"CF_ENV": "production"}), patch(
+            "src.main.SecretVerifier", return_value=verifier
+        ):
+            with TestClient(create_app(Settings(startup_secrets_check="advisory"))) as client:
+                assert client.get("/").status_code == 200
+        verifier.verify.assert_awaited_once()
+
+    def test_development_skips_secrets(self):
+        """Test that no secrets check runs outside production"""
+        from src.main import create_app
+
+        with patch.dict(os.environ, {"CF_ENV": "development"}), patch(
+            "src.main.SecretVerifier", side_effect=AssertionError("not in development")
+        ):
+            with TestClient(create_app()) as client:
+                assert client.get("/").status_code == 200
+
+    def test_cors_origins(self):
+        """Test that configured origins win and production defaults are strict"""
+        from src.main import create_app
+
+        def allowed(origins):
+            application = create_app(Settings(cors_origins=origins))
+            cors = next(m for m in application.user_middleware if m.cls is CORSMiddleware)
+            return cors.options["allow_origins"]
+
+        with patch.dict(os.environ, {"CF_ENV": "production"}):
+            assert "https://candlefish.ai" in allowed([])
+            assert allowed("https://a.example") == ["https://a.example"]
+        with patch.dict(os.environ, {"CF_ENV": "development"}):
+            assert allowed([]) == ["*"]
+
+    def test_service_settings_are_refused(self):
+        """Test that a config the shared services were not built with is not ignored"""
+        from src.main import create_app
+
+        with pytest.raises(ValueError, match="ingest_queue_size"):
+            create_app(Settings(ingest_queue_size=10, cors_origins="https://a.example"))
+
+    def test_invalid_strategy_rejected(self):
+        """Test that settings refuse an unknown secrets check mode"""
+        with pytest.raises(ValueError):
+            Settings(startup_secrets_check="lenient")
+
+    def test_relative_paths_follow_the_app(self):
+        """Test that relative file settings do not depend on the working directory"""
+        from src.config.settings import APP_DIR
+
+        config = Settings(spool_dir="data/spool", secrets_cache_path="/var/lib/rtpm/secrets.json")
+        assert config.spool_dir == os.path.join(APP_DIR, "data", "spool")
+        assert os.path.isfile(os.path.join(APP_DIR, "src", "main.py"))
+        assert config.secrets_cache_path == "/var/lib/rtpm/secrets.json"
+        assert Settings(spool_dir="").spool_dir == ""
@@ -3,11 +3,35 @@
 Tests WebSocket functionality, connection handling, and real-time data streaming
 """
 
+import asyncio
+import json
+import msgpack
 import pytest
 from datetime import datetime
 from unittest.mock import AsyncMock, MagicMock, patch
 import time
 
+from src.services.broadcast import ConnectionManager
+from src.services.downsampling import Downsampler
+from src.services.encoding import Frame, as_frame, encode_frame, negotiate_subprotocol
+from src.services.ingestion import intern_samples, parse_payload
+from src.services.subscriptions import (
+    Subscription,
+    SubscriptionError,
+    TopicIndex,
+    parse_subscription,
+)
+
+
+def _next_heartbeat(websocket, frames=20):
+    """Receive until a heartbeat arrives; other frames must be errors"""
+    for _ in range(frames):
+        data = websocket.receive_json()
+        if data["type"] == "heartbeat":
+            return data
+        assert data["type"] == "error"
+    pytest.fail(f"no heartbeat within {frames} frames")
+
 
 class TestWebSocketConnection:
     """Test basic WebSocket connection functionality"""
@@ -82,54 +106,36 @@ def test_websocket_connection_limit(self, client):
 class TestWebSocketMessaging:
     """Test WebSocket message sending and receiving"""
 
-    def test_receive_metric_updates(self, client):
-        """Test receiving real-time metric updates"""
-        with client.websocket_connect("/ws/metrics") as websocket:
-            # Skip connection message
-            websocket.receive_json()
-
-            # Should receive metric updates periodically
-            received_messages = []
-            start_time = time.time()
+    def test_receive_heartbeats(self, client):
+        """Test receiving periodic heartbeats from the shared ticker"""
+        from src.main import manager
 
-            # Collect messages for 10 seconds
-            while time.time() - start_time < 10:
-                try:
-                    data = websocket.receive_json(timeout=2)
-                    if data.get("type") == "metric":
-                        received_messages.append(data)
-
-                        # Validate metric structure
-                        assert "payload" in data
-                        payload = data["payload"]
-                        assert "name" in payload
-                        assert "value" in payload
-                        assert "timestamp" in payload
-
-                        if len(received_messages) >= 3:
-                            break
-                except:
-                    # Timeout or error receiving message
-                    break
+        with patch.object(manager, "heartbeat_interval", 0.05):
+            with client.websocket_connect("/ws/metrics") as websocket:
+                # Skip connection message
+                websocket.receive_json()
 
-            # Should receive at least some metric updates
-            assert len(received_messages) > 0
+                # The ticker keeps sending; the connection is idle otherwise
+                for _ in range(3):
+                    data = websocket.receive_json()
+                    assert data["type"] == "heartbeat"
+                    assert "timestamp" in data
+                    assert data["connections"] >= 1
 
     def test_client_message_handling(self, client):
         """Test sending messages from client to server"""
-        with client.websocket_connect("/ws/metrics") as websocket:
-            # Skip connection message
-            websocket.receive_json()
+        from src.main import manager
 
-            # Send a keepalive message
-            websocket.send_text("keepalive")
+        with patch.object(manager, "heartbeat_interval", 0.05):
+            with client.websocket_connect("/ws/metrics") as websocket:
+                # Skip connection message
+                websocket.receive_json()
 
-            # Should continue to receive updates
-            try:
-                data = websocket.receive_json(timeout=10)
-                assert data["type"] == "metric"
-            except:
-                pytest.fail("Failed to receive metric after sending keepalive")
+                # Send a keepalive message
+                websocket.send_text("keepalive")
+
+                # Should continue to receive heartbeats
+                assert _next_heartbeat(websocket)["connections"] >= 1
 
     def test_json_message_format(self, client):
         """Test that all messages are valid JSON"""
@@ -174,21 +180,18 @@ def test_websocket_disconnect_handling(self, client):
 
     def test_websocket_malformed_message(self, client):
         """Test handling of malformed messages from client"""
-        with client.websocket_connect("/ws/metrics") as websocket:
-            # Skip connection message
-            websocket.receive_json()
+        from src.main import manager
+
+        with patch.object(manager, "heartbeat_interval", 0.05):
+            with client.websocket_connect("/ws/metrics") as websocket:
+                # Skip connection message
+                websocket.receive_json()
 
-            # Send malformed message
-            try:
+                # Send malformed message
                 websocket.send_text("invalid json {")
 
-                # Server should continue operating
-                data = websocket.receive_json(timeout=10)
-                assert data["type"] == "metric"
-            except Exception:
-                # Connection might be closed due to malformed message
-                # This is acceptable behavior
-                pass
+                # Server should answer with an error at most and keep operating
+                _next_heartbeat(websocket)
 
     def test_websocket_connection_drop(self, client):
         """Test handling of unexpected connection drops"""
@@ -299,26 +302,25 @@ class TestWebSocketBroadcasting:
 
     def test_broadcast_to_multiple_clients(self, client):
         """Test broadcasting messages to multiple connected clients"""
+        from src.main import manager
+
         connections = []
 
         try:
-            # Create multiple connections
-            for i in range(3):
-                ws = client.websocket_connect("/ws/metrics")
-                connections.append(ws.__enter__())
+            with patch.object(manager, "heartbeat_interval", 0.05):
+                # Create multiple connections
+                for i in range(3):
+                    ws = client.websocket_connect("/ws/metrics")
+                    connections.append(ws.__enter__())
 
-            # Each should receive connection message
-            for ws in connections:
-                data = ws.receive_json()
-                assert data["type"] == "connection"
+                # Each should receive connection message
+                for ws in connections:
+                    data = ws.receive_json()
+                    assert data["type"] == "connection"
 
-            # All should receive metric updates
-            for ws in connections:
-                try:
-                    data = ws.receive_json(timeout=10)
-                    assert data["type"] == "metric"
-                except:
-                    pytest.fail("Not all clients received broadcast message")
+                # All should receive the shared heartbeat
+                for ws in connections:
+                    assert ws.receive_json()["type"] == "heartbeat"
 
         finally:
             for ws in connections:
@@ -420,10 +422,23 @@ def test_websocket_with_api_calls(self, client):
                 },
             )
 
-            assert response.status_code == 200
+            assert response.status_code == 202
 
-            # Should receive the metric via WebSocket
-            # (This depends on the implementation broadcasting the ingested metric)
+            # The batcher broadcasts each ingested sample to connected clients
+            data = websocket.receive_json()
+            assert data["type"] == "metric"
+            assert data["payload"]["labels"] == {"agent_id": "test-agent"}
+
+    def test_idle_connection_gets_shared_heartbeat(self, client):
+        """Test that an idle connection receives heartbeats and no made-up metrics"""
+        from src.main import manager
+
+        with patch.object(manager, "heartbeat_interval", 0.05):
+            with client.websocket_connect("/ws/metrics") as websocket:
+                assert websocket.receive_json()["type"] == "connection"
+                data = websocket.receive_json()
+                assert data["type"] == "heartbeat"
+                assert data["connections"] == len(manager.active_connections)
 
     def test_websocket_connection_manager(self, client):
         """Test the WebSocket connection manager functionality"""
@@ -484,20 +499,388 @@ def test_websocket_stress_connections(self, client):
 
     def test_websocket_message_flood(self, client):
         """Test handling of message flood from clients"""
+        from src.main import manager
+
+        with patch.object(manager, "heartbeat_interval", 0.05):
+            with client.websocket_connect("/ws/metrics") as websocket:
+                # Skip connection message
+                websocket.receive_json()
+
+                # Send many messages rapidly
+                for i in range(100):
+                    websocket.send_text(f"message-{i}")
+
+                # Server should still be responsive
+                _next_heartbeat(websocket, frames=200)
+
+
+class FakeWebSocket:
+    """Minimal WebSocket stand-in whose sends can be stalled or broken"""
+
+    def __init__(self, stalled=False, broken=False, subprotocols=()):
+        self.sent = []
+        self.closed_with = None
+        self.stalled = stalled
+        self.broken = broken
+        self.scope = {"type": "websocket", "subprotocols": list(subprotocols)}
+        self.subprotocol = None
+        self._release = asyncio.Event()
+
+    async def accept(self, subprotocol=None):
+        self.subprotocol = subprotocol
+
+    async def send_text(self, message):
+        if self.broken:
+            raise RuntimeError("connection reset")
+        if self.stalled:
+            await self._release.wait()
+        self.sent.append(message)
+
+    async def send_bytes(self, message):
+        await self.send_text(message)
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+@pytest.mark.asyncio
+class TestConnectionManagerQueues:
+    """Test per-client queues, writer tasks and slow-consumer eviction"""
+
+    async def test_broadcast_does_not_wait_for_stalled_client(self):
+        """Test that one stalled client does not hold up the others"""
+        manager = ConnectionManager(max_queue_size=10, max_lag=60)
+        stalled, healthy = FakeWebSocket(stalled=True), FakeWebSocket()
+        await manager.connect(stalled)
+        await manager.connect(healthy)
+
+        await asyncio.wait_for(manager.broadcast("frame-1"), timeout=0.1)
+        await asyncio.sleep(0.01)
+
+        assert healthy.sent == ["frame-1"]
+        assert stalled.sent == []
+        manager.disconnect(stalled)
+        manager.disconnect(healthy)
+
+    async def test_behind_client_keeps_freshest_frames(self):
+        """Test that a full queue drops the oldest frames first"""
+        manager = ConnectionManager(max_queue_size=3, max_lag=60)
+        ws = FakeWebSocket(stalled=True)
+        await manager.connect(ws)
+        await manager.broadcast("frame-0")
+        await asyncio.sleep(0.01)
+        for i in range(1, 6):
+            await manager.broadcast(f"frame-{i}")
+        # frame-0 is in flight in the writer, frames 3..5 remain queued
+        client = manager.clients[ws]
+        assert [f.text for _, f in client.queue] == ["frame-3", "frame-4", "frame-5"]
+        assert client.dropped == 2
+        manager.disconnect(ws)
+
+    async def test_slow_client_is_evicted(self):
+        """Test that a client lagging beyond max_lag is closed and removed"""
+        manager = ConnectionManager(max_queue_size=100, max_lag=0.05)
+        ws = FakeWebSocket(stalled=True)
+        await manager.connect(ws)
+        await manager.broadcast("frame-0")
+        await manager.broadcast("frame-1")
+        await asyncio.sleep(0.1)
+
+        await manager.broadcast("frame-2")
+        await asyncio.sleep(0)
+
+        assert ws not in manager.active_connections
+        assert ws.closed_with == 1013
+
+    async def test_failed_send_removes_client(self):
+        """Test that a dead socket is dropped from active connections"""
+        manager = ConnectionManager()
+        ws = FakeWebSocket(broken=True)
+        await manager.connect(ws)
+        await manager.broadcast("frame")
+        await asyncio.sleep(0.01)
+
+        assert ws not in manager.active_connections
+
+    async def test_disconnect_is_idempotent(self):
+        """Test that disconnecting twice is harmless"""
+        manager = ConnectionManager()
+        ws = FakeWebSocket()
+        await manager.connect(ws)
+        manager.disconnect(ws)
+        manager.disconnect(ws)
+        assert manager.active_connections == []
+
+
+@pytest.mark.asyncio
+class TestHeartbeats:
+    """Test the shared heartbeat ticker"""
+
+    async def test_one_ticker_for_all_clients(self):
+        """Test that every client is sent the same heartbeat frame from one task"""
+        manager = ConnectionManager(heartbeat_interval=0.02)
+        sockets = [FakeWebSocket() for _ in range(3)]
+        for ws in sockets:
+            await manager.connect(ws)
+        ticker = manager._ticker
+        await asyncio.sleep(0.05)
+
+        assert manager._ticker is ticker
+        frames = [ws.sent[0] for ws in sockets]
+        assert all(frame is frames[0] for frame in frames)
+        event = json.loads(frames[0])
+        assert event["type"] == "heartbeat"
+        assert event["connections"] == 3
+        for ws in sockets:
+            manager.disconnect(ws)
+
+    async def test_ticker_stops_with_last_client(self):
+        """Test that no task is left running once everyone has disconnected"""
+        manager = ConnectionManager(heartbeat_interval=0.02)
+        first, second = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(first)
+        await manager.connect(second)
+        ticker = manager._ticker
+        manager.disconnect(first)
+        assert not ticker.done()
+
+        manager.disconnect(second)
+        await asyncio.sleep(0)
+        assert ticker.cancelled()
+        assert manager._ticker is None
+
+    async def test_zero_interval_disables_heartbeats(self):
+        """Test that a zero interval starts no ticker"""
+        manager = ConnectionManager(heartbeat_interval=0)
+        ws = FakeWebSocket()
+        await manager.connect(ws)
+        await asyncio.sleep(0.02)
+        assert manager._ticker is None
+        assert ws.sent == []
+        manager.disconnect(ws)
+
+
+@pytest.mark.asyncio
+class TestFrameEncoding:
+    """Test that broadcast frames are serialized once and shared"""
+
+    async def test_one_frame_object_for_all_clients(self):
+        """Test that every client queue holds the same encoded frame"""
+        manager = ConnectionManager(max_queue_size=10, max_lag=60)
+        sockets = [FakeWebSocket(stalled=True) for _ in range(3)]
+        for ws in sockets:
+            await manager.connect(ws)
+        await manager.broadcast(encode_frame({"type": "metric", "payload": {"value": 1}}))
+
+        frames = {id(f) for ws in sockets for _, f in manager.clients[ws].queue}
+        assert len(frames) == 1
+        for ws in sockets:
+            manager.disconnect(ws)
+
+    async def test_msgpack_subprotocol(self):
+        """Test that msgpack clients get binary frames and JSON clients get text"""
+        manager = ConnectionManager()
+        binary, text = FakeWebSocket(subprotocols=["msgpack"]), FakeWebSocket()
+        await manager.connect(binary)
+        await manager.connect(text)
+        event = {"type": "metric", "payload": {"name": "cpu", "value": 1.5}}
+        await manager.broadcast(encode_frame(event))
+        await asyncio.sleep(0.01)
+
+        assert binary.subprotocol == "msgpack"
+        assert text.subprotocol is None
+        assert msgpack.unpackb(binary.sent[0]) == event
+        assert json.loads(text.sent[0]) == event
+        manager.disconnect(binary)
+        manager.disconnect(text)
+
+    def test_frame_encodes_lazily_once(self):
+        """Test that a frame caches each wire format"""
+        frame = Frame({"a": 1})
+        assert frame.text is frame.text
+        assert frame.msgpack is frame.msgpack
+        assert as_frame(frame) is frame
+        assert json.loads(as_frame('{"a": 1}').text) == {"a": 1}
+
+    def test_negotiate_subprotocol(self):
+        """Test that JSON stays the default wire format"""
+        assert negotiate_subprotocol(["msgpack", "json"]) == "msgpack"
+        assert negotiate_subprotocol(["json"]) is None
+        assert negotiate_subprotocol([]) is None
+
+    def test_endpoint_negotiates_msgpack(self, client):
+        """Test msgpack negotiation through the /ws/metrics endpoint"""
+        with client.websocket_connect("/ws/metrics", subprotocols=["msgpack"]) as websocket:
+            data = msgpack.unpackb(websocket.receive_bytes())
+            assert data["type"] == "connection"
+
+
+class TestSubscriptions:
+    """Test subscribe messages and topic-index routing"""
+
+    def test_parse_subscription(self):
+        """Test metric names, list and object label selectors, and max_rate"""
+        sub = parse_subscription(
+            {"type": "subscribe", "metrics": ["cpu"], "labels": ["host=web-1"], "max_rate": 2}
+        )
+        assert sub.metrics == frozenset({"cpu"})
+        assert sub.labels == {"host": "web-1"}
+        assert sub.min_interval == 0.5
+
+        legacy = parse_subscription({"type": "subscribe", "data": {"labels": {"host": "web-2"}}})
+        assert legacy.metrics == frozenset()
+        assert legacy.labels == {"host": "web-2"}
+
+    @pytest.mark.parametrize(
+        "message",
+        [
+            {"metrics": 5},
+            {"metrics": [""]},
+            {"labels": ["host"]},
+            {"labels": {"host": {"a": 1}}},
+            {"max_rate": 0},
+            {"max_rate": "fast"},
+            {"window": 0},
+            {"window": "1m"},
+        ],
+    )
+    def test_invalid_subscription(self, message):
+        """Test that malformed subscribe messages are rejected"""
+        with pytest.raises(SubscriptionError):
+            parse_subscription(message)
+
+    def test_topic_index_routing(self):
+        """Test that only matching subscriptions are returned"""
+        index = TopicIndex()
+        index.add("all", Subscription())
+        index.add("cpu", Subscription(metrics=frozenset({"cpu"})))
+        index.add("web1", Subscription(labels={"host": "web-1"}))
+        index.add("cpu-web2", Subscription(metrics=frozenset({"cpu"}), labels={"host": "web-2"}))
+
+        assert sorted(index.match("cpu", {"host": "web-1"})) == ["all", "cpu", "web1"]
+        assert sorted(index.match("cpu", {"host": "web-2"})) == ["all", "cpu", "cpu-web2"]
+        assert sorted(index.match("mem", {"host": "web-3"})) == ["all"]
+
+        index.add("cpu", Subscription(metrics=frozenset({"mem"})))
+        index.remove("all")
+        assert index.match("cpu", {"host": "web-3"}) == []
+        assert index.match("mem", {}) == ["cpu"]
+
+    def test_max_rate_per_series(self):
+        """Test that max_rate throttles each series independently"""
+        index = TopicIndex()
+        index.add("client", Subscription(max_rate=1))
+
+        assert index.match("cpu", {"host": "a"}, now=10.0) == ["client"]
+        assert index.match("cpu", {"host": "a"}, now=10.5) == []
+        assert index.match("cpu", {"host": "b"}, now=10.5) == ["client"]
+        assert index.match("cpu", {"host": "a"}, now=11.0) == ["client"]
+
+    def test_max_rate_uses_passed_series_id(self):
+        """Test that a caller-supplied series ID is the throttling key"""
+        index = TopicIndex()
+        subscription = Subscription(max_rate=1)
+        index.add("client", subscription)
+
+        assert index.match("cpu", {"host": "a"}, now=10.0, series=7) == ["client"]
+        assert index.match("cpu", {"host": "b"}, now=10.5, series=7) == []
+        assert list(subscription._last_sent) == [7]
+
+    def test_endpoint_filters_by_label(self, client):
+        """Test that a subscribed client only receives its host's metrics"""
         with client.websocket_connect("/ws/metrics") as websocket:
-            # Skip connection message
             websocket.receive_json()
+            websocket.send_json({"type": "subscribe", "labels": ["host=web-1"]})
+            ack = websocket.receive_json()
+            assert ack["type"] == "subscribed"
+            assert ack["subscription"]["labels"] == {"host": "web-1"}
 
-            # Send many messages rapidly
-            for i in range(100):
-                try:
-                    websocket.send_text(f"message-{i}")
-                except:
-                    break
+            response = client.post(
+                "/api/v1/metrics",
+                json=[
+                    {"name": "cpu", "value": 1, "labels": {"host": "web-2"}},
+                    {"name": "cpu", "value": 2, "labels": {"host": "web-1"}},
+                ],
+            )
+            assert response.status_code == 202
 
-            # Server should still be responsive
-            try:
-                data = websocket.receive_json(timeout=10)
-                assert data["type"] == "metric"
-            except:
-                pytest.fail("Server became unresponsive after message flood")
+            data = websocket.receive_json()
+            assert data["type"] == "metric"
+            assert data["payload"]["labels"] == {"host": "web-1"}
+            assert data["payload"]["value"] == 2
+
+    def test_endpoint_rejects_bad_subscription(self, client):
+        """Test that an invalid subscribe message gets an error frame"""
+        with client.websocket_connect("/ws/metrics") as websocket:
+            websocket.receive_json()
+            websocket.send_json({"type": "subscribe", "max_rate": -1})
+            data = websocket.receive_json()
+            assert data["type"] == "error"
+            assert "max_rate" in data["detail"]
+
+
+class TestDownsampling:
+    """Test per-subscription time-window aggregation"""
+
+    def _sample(self, value, host="web-1"):
+        sample = parse_payload({"name": "cpu", "value": value, "labels": {"host": host}})
+        return intern_samples(sample)[0]
+
+    def test_window_summary(self):
+        """Test min/max/avg/last/count for a closed window"""
+        downsampler = Downsampler(window=1.0)
+        for now, value in ((10.0, 1), (10.2, 5), (10.5, 3)):
+            downsampler.add(self._sample(value), now)
+
+        assert downsampler.drain(10.9) == []
+        events = downsampler.drain(11.0)
+        assert len(events) == 1
+        payload = events[0]["payload"]
+        assert events[0]["type"] == "metric"
+        assert payload["value"] == 3
+        assert payload["window"]["min"] == 1
+        assert payload["window"]["max"] == 5
+        assert payload["window"]["avg"] == 3
+        assert payload["window"]["count"] == 3
+        assert payload["window"]["end"].startswith("1970-01-01T00:00:11")
+
+    def test_state_is_constant_per_series(self):
+        """Test that state grows with series, not with samples"""
+        downsampler = Downsampler(window=60)
+        for i in range(1000):
+            downsampler.add(self._sample(i, host=f"web-{i % 3}"), 100.0)
+        assert len(downsampler) == 3
+
+        events = downsampler.drain(120.0)
+        assert sorted(e["payload"]["window"]["count"] for e in events) == [333, 333, 334]
+        assert len(downsampler) == 0
+
+    def test_late_sample_rolls_window(self):
+        """Test that a sample after the window end starts a new window"""
+        downsampler = Downsampler(window=1.0)
+        downsampler.add(self._sample(1), 10.1)
+        downsampler.add(self._sample(2), 11.1)
+
+        events = downsampler.drain(11.2)
+        assert [e["payload"]["window"]["last"] for e in events] == [1]
+        assert [e["payload"]["value"] for e in downsampler.drain(12.0)] == [2]
+
+    @pytest.mark.asyncio
+    async def test_manager_sends_summaries(self):
+        """Test that windowed clients get summaries and raw clients get samples"""
+        manager = ConnectionManager()
+        windowed, raw = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(windowed)
+        await manager.connect(raw)
+        manager.subscribe(windowed, parse_subscription({"type": "subscribe", "window": 0.1}))
+
+        for value in (1, 2, 3):
+            await manager.publish_sample(self._sample(value))
+        await asyncio.sleep(0.3)
+
+        assert len(raw.sent) == 3
+        summaries = [json.loads(m)["payload"]["window"] for m in windowed.sent]
+        assert sum(s["count"] for s in summaries) == 3
+        assert max(s["max"] for s in summaries) == 3
+        manager.disconnect(windowed)
+        manager.disconnect(raw)
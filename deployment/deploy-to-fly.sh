@@ -104,10 +104,11 @@ deploy_api() {
         rm -f .fly.env.tmp
     fi
 
-    # Deploy the API
-    cd "${SCRIPT_DIR}/fly/rtpm-api"
-    flyctl deploy --remote-only --build-arg BUILDKIT_PROGRESS=plain
-    cd - > /dev/null
+    # Deploy the API: apps/rtpm-api is the build context
+    flyctl deploy "${SCRIPT_DIR}/../apps/rtpm-api" \
+        --config "${SCRIPT_DIR}/fly/rtpm-api/fly.toml" \
+        --dockerfile "${SCRIPT_DIR}/fly/rtpm-api/Dockerfile" \
+        --remote-only --build-arg BUILDKIT_PROGRESS=plain
 
     echo -e "${GREEN}RTPM API deployed successfully${NC}"
 }